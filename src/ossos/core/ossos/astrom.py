@@ -8,13 +8,12 @@ import os
 import re
 import sys
 import traceback
-import cadcutils
 
+import numpy
 from astropy import units
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import SkyCoord, angular_separation
 from astropy.units import Quantity
 from astropy.time import TimeDelta, Time
-import time
 from . import util
 
 from .gui import logger
@@ -32,6 +31,12 @@ HEADER_LINE_LENGTH = 80
 
 FAKE_PREFIX = "fk"
 
+# The column names line that starts the source list.
+SOURCE_COLUMNS = ["##", "X", "Y", "X_0", "Y_0", "R.A.", "DEC"]
+
+# Bytes of the source list read at a time by AstromStream.
+STREAM_CHUNK_SIZE = 4 * 1024 ** 2
+
 OBS_LIST_PATTERN = "#\s+(?P<rawname>(?P<fk>%s)?(?P<expnum>\d{6,7})(?P<ftype>[ops])(?P<ccdnum>\d+))" % FAKE_PREFIX
 
 STATIONARY_LIST_PATTERN = "(?P<rawname>(?P<fk>fk)?(?P<expnum>\d{6,7})(?P<ftype>[ops])).vetting"
@@ -78,6 +83,38 @@ class AstromFormatError(Exception):
     """Base class for errors in working with Astrom files."""
 
 
+def _parse_source_lines(lines, num_observations):
+    """
+    Convert lines of an astrom source list, num_observations lines per source with sources separated by
+    blank lines, into SourceColumns.
+    """
+    blank = numpy.array([len(line.strip()) == 0 for line in lines], dtype=bool)
+    first = numpy.flatnonzero(~blank & numpy.concatenate(([True], blank[:-1])))
+    last = numpy.flatnonzero(~blank & numpy.concatenate((blank[1:], [True])))
+    readings_per_source = last - first + 1
+    assert numpy.all(readings_per_source == num_observations), (
+        "Source doesn't have same number of observations"
+        " ({0:d}) as in observations list ({1:d}).".format(
+            int(readings_per_source[readings_per_source != num_observations][0]), num_observations))
+
+    values = numpy.fromstring(" ".join([line for line, is_blank in zip(lines, blank) if not is_blank]),
+                              dtype=float, sep=' ')
+    if values.size != 6 * len(blank[~blank]):
+        raise AstromFormatError("Source lines should have 6 columns: X Y X_0 Y_0 R.A. DEC")
+    return SourceColumns.from_rows(values, num_observations)
+
+
+def _column_value(value, unit):
+    """
+    The float to store in a SourceColumns for a value that might be a Quantity or None.
+    """
+    if value is None:
+        return numpy.nan
+    if isinstance(value, Quantity):
+        return value.to(unit).value
+    return float(value)
+
+
 class AstromParser(object):
     """
     Parses a .astrom file (our own format) which specifies exposure numbers,
@@ -159,56 +196,72 @@ class AstromParser(object):
 
         assert source_list_match is not None, "Could not find the source list"
 
-        raw_source_list = (source_list_match.group(1)).split("\n\n")
+        return _parse_source_lines(source_list_match.group(1).strip().split('\n'), len(observations))
 
-        sources = []
-        for raw_source in raw_source_list:
-            source = []
-            source_obs = raw_source.strip().split('\n')
-            assert len(source_obs) == len(
-                observations), ("Source doesn't have same number of observations"
-                                " ({0:d}) as in observations list ({1:d}).".format(len(source_obs), len(observations)))
-
-            x_0 = []
-            y_0 = []
-            x_ref = None
-            y_ref = None
-            for i, source_ob in enumerate(source_obs):
-                fields = [float(x) for x in source_ob.split()]
-                x_0.append(fields[2])
-                y_0.append(fields[3])
-                if i == 0:
-                    x_ref = fields[0]
-                    y_ref = fields[1]
-                fields.append(x_ref)
-                fields.append(y_ref)
-                # Find the observation corresponding to this reading
-                fields.append(observations[i])
-
-                source.append(SourceReading(*fields))
-
-            # Add an ra/dec reference to the source.
-            ref_index = int(math.ceil(len(source) / 2.0)) - 1
-            for reading in source:
-                assert isinstance(reading, SourceReading)
-                reading.reference_sky_coord = source[ref_index].sky_coord
-
-            # determine the smallest cutout that will include the reference coordinate and all the readings
-            min_cutout = 30 * units.arcsec
-            for reading in source:
-                sep = reading.reference_sky_coord.separation(reading.sky_coord)
-                if min_cutout < sep:
-                    min_cutout = sep
-            # Overload the 'uncertainty' criterion to ensure we get a large enough cutout.
-            for fields in source:
-                assert isinstance(fields, SourceReading)
-                fields.uncertainty_ellipse.a = sep/2.5
-                fields.uncertainty_ellipse.b = sep/2.5
-                fields.uncertainty_ellipse.pa = 0.0 * units.degree
-
-            sources.append(source)
+    def _open(self, filename):
+        """
+        Open filename (VOSpace or local) for reading, VOSpace trouble is retried by the storage transport.
+        """
+        filehandle = storage.open_vos_or_local(filename, "rb")
+        assert filehandle is not None, "Failed to open file {} ".format(filename)
+        return filehandle
 
-        return sources
+    def _read_header(self, filehandle, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Read the header of an astrom file, up to and including the source column names line.
+
+        @param filehandle: open astrom file.
+        @return: the header text and the text read beyond it.
+        @rtype: str, str
+        """
+        text = ""
+        start = 0
+        while True:
+            chunk = filehandle.read(chunk_size)
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode('utf-8')
+            text += chunk
+            end = text.find('\n', start)
+            while end >= 0:
+                if text[start:end].split()[:7] == SOURCE_COLUMNS:
+                    return text[:end + 1], text[end + 1:]
+                start = end + 1
+                end = text.find('\n', start)
+            if len(chunk) == 0:
+                if text[start:].split()[:7] == SOURCE_COLUMNS:
+                    return text, ""
+                raise AstromFormatError("Could not find the source list")
+
+    def parse_iter(self, filename, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Parse the header of an astrom file and return a stream of its sources.
+
+        Only chunk_size bytes of the source list are held in memory at a time, use this to work through large
+        files.  The observations and system header are read before this returns.
+
+        Args:
+          filename: str
+            The name of the file whose contents will be parsed.
+          chunk_size: int
+            number of bytes of the source list read at a time.
+
+        Returns:
+          stream: AstromStream
+            observations, sys_header and an iterator over the Source objects.
+        """
+        filehandle = self._open(filename)
+        try:
+            header, remainder = self._read_header(filehandle, chunk_size)
+            observations = self._parse_observation_list(header)
+            self._parse_observation_headers(header, observations)
+            sys_header = self._parse_system_header(header)
+        except Exception:
+            filehandle.close()
+            raise
+        return AstromStream(filehandle, observations, sys_header,
+                            remainder=remainder,
+                            chunk_size=chunk_size,
+                            discovery_only=self.discovery_only)
 
     def parse(self, filename):
         """
@@ -223,33 +276,94 @@ class AstromParser(object):
             The file contents extracted into a data structure for programmatic
             access.
         """
-        _loop_count = 0
-        while _loop_count < 5:
-            try:
-                filehandle = storage.open_vos_or_local(filename, "rb")
-                assert filehandle is not None, "Failed to open file {} ".format(filename)
-                filestr = filehandle.read().decode('utf-8')
-                filehandle.close()
-                break
-            except cadcutils.exceptions.NotFoundException as ex:
-                logger.error(str(ex))
-                raise ex
-            except Exception as ex:
-                logger.warning(str(ex))
-                _loop_count += 1
-                time.sleep(3)
+        with self.parse_iter(filename) as stream:
+            columns = SourceColumns.concatenate(list(stream.iter_columns()), len(stream.observations))
+        return AstromData(stream.observations, stream.sys_header, columns, discovery_only=self.discovery_only)
 
-        assert filestr is not None, "File contents are None"
 
-        observations = self._parse_observation_list(str(filestr))
+class AstromStream(object):
+    """
+    The sources of an astrom file, read from the file a chunk at a time as they are iterated over.
+    """
 
-        self._parse_observation_headers(filestr, observations)
+    def __init__(self, filehandle, observations, sys_header, remainder="", chunk_size=STREAM_CHUNK_SIZE,
+                 discovery_only=False):
+        """
+        Args:
+          filehandle: file positioned in the source list.
+          observations: list(Observation)
+          sys_header: dict
+          remainder: str
+            text of the source list already read from filehandle (along with the header).
+          chunk_size: int
+            number of bytes to read from filehandle at a time.
+          discovery_only: bool
+            passed to the Source objects.
+        """
+        self.filehandle = filehandle
+        self.observations = observations
+        self.sys_header = sys_header
+        self.remainder = remainder
+        self.chunk_size = chunk_size
+        self.discovery_only = discovery_only
 
-        sys_header = self._parse_system_header(filestr)
+    def __enter__(self):
+        return self
 
-        sources = self._parse_source_data(filestr, observations)
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        return AstromData(observations, sys_header, sources, discovery_only=self.discovery_only)
+    def close(self):
+        self.filehandle.close()
+
+    def iter_columns(self):
+        """
+        Read the source list, yielding SourceColumns for the complete sources in each chunk.
+        """
+        remainder = self.remainder
+        self.remainder = ""
+        while True:
+            chunk = self.filehandle.read(self.chunk_size)
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode('utf-8')
+            text = remainder + chunk
+            if len(chunk) == 0:
+                # end of file, whatever is left is complete.
+                if len(text.strip()) > 0:
+                    yield _parse_source_lines(text.split('\n'), len(self.observations))
+                return
+            # sources are separated by blank lines, keep the (possibly partial) last source for the next chunk.
+            end = text.rfind('\n\n')
+            if end < 0:
+                remainder = text
+                continue
+            remainder = text[end + 1:]
+            yield _parse_source_lines(text[:end].split('\n'), len(self.observations))
+
+    def __iter__(self):
+        for columns in self.iter_columns():
+            for readings in columns.iter_readings(self.observations):
+                yield Source(readings, discovery_only=self.discovery_only)
+
+
+class ParsedAstromStream(AstromStream):
+    """
+    The sources of an AstromData, already parsed, for file formats that are read whole.
+    """
+
+    def __init__(self, data):
+        super(ParsedAstromStream, self).__init__(None, data.observations, data.sys_header)
+        self.data = data
+
+    def close(self):
+        pass
+
+    def iter_columns(self):
+        if self.data.columns is not None:
+            yield self.data.columns
+
+    def __iter__(self):
+        return iter(self.data.get_sources())
 
 
 class StationaryParser(AstromParser):
@@ -288,6 +402,32 @@ class StationaryParser(AstromParser):
         """
         return {'RMIN': 0.01, 'RMAX': 0.2, 'ANGLE': 0, 'AWIDTH': 90}
 
+    def parse_iter(self, filename, chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Stationary vetting lists are small and parsed whole, the stream is over the parsed sources.
+        """
+        return ParsedAstromStream(self.parse(filename))
+
+    def parse(self, filename):
+        """
+        Parses a stationary vetting list into an AstromData structure.
+        """
+        filehandle = self._open(filename)
+        try:
+            filestr = filehandle.read().decode('utf-8')
+        finally:
+            filehandle.close()
+
+        observations = self._parse_observation_list(filestr)
+
+        self._parse_observation_headers(filestr, observations)
+
+        sys_header = self._parse_system_header(filestr)
+
+        sources = self._parse_source_data(filestr, observations)
+
+        return AstromData(observations, sys_header, sources, discovery_only=self.discovery_only)
+
     def _parse_source_data(self, file_str, observations):
 
         sources = []
@@ -404,12 +544,14 @@ class BaseAstromWriter(object):
             self._write_source(source)
 
     def _write_source(self, source):
+        self._write_rows([(reading.x, reading.y, reading.x0, reading.y0, reading.ra, reading.dec)
+                          for reading in source.get_readings()])
+
+    def _write_rows(self, rows):
         self._write_blank_line()
 
-        for reading in source.get_readings():
-            self._write_line(" %8.2f %8.2f %8.2f %8.2f %12.7f %12.7f" % (
-                reading.x, reading.y, reading.x0, reading.y0, reading.ra,
-                reading.dec), ljust=False)
+        for row in rows:
+            self._write_line(" %8.2f %8.2f %8.2f %8.2f %12.7f %12.7f" % tuple(row), ljust=False)
 
     def _write_source_header(self):
         self._write_line("##   X        Y        X_0     Y_0          R.A.          DEC")
@@ -463,6 +605,18 @@ class StreamingAstromWriter(BaseAstromWriter):
 
         self._write_source(source)
 
+    def write_rows(self, rows):
+        """
+        Writes out a single source given as rows of (x, y, x0, y0, ra, dec), one row per observation.
+
+        Avoids building SourceReading objects when the values are already in arrays, the headers
+        must have been written with write_headers first.
+        """
+        if not self._header_written:
+            raise AstromFormatError("Astrom file headers must be written before the sources.")
+
+        self._write_rows(rows)
+
 
 class BulkAstromWriter(BaseAstromWriter):
     """
@@ -496,18 +650,24 @@ class AstromData(object):
           sys_header: dict
             Key-value pairs of system settings applicable to the data set.
             Ex: RMIN, RMAX, ANGLE, AWIDTH
-          sources: list(list(SourceReading))
+          sources: list(list(SourceReading)) or SourceColumns
             A list of point sources found in the data set.  These are
             potential moving objects.  Each point source is itself a list
             of source readings, one for each observation in
             <code>observations</code>.  By convention the ordering of
             source readings must match the ordering of the observations.
+            When given as SourceColumns the readings are views onto those
+            arrays, which are kept as self.columns.
           discovery_only: bool
             should we only use the discovery images on the first pass?
         """
         self.observations = observations
         self.mpc_observations = {}
         self.sys_header = sys_header
+        self.columns = None
+        if isinstance(sources, SourceColumns):
+            self.columns = sources
+            sources = sources.get_readings(observations)
         self.sources = [Source(reading_list, discovery_only=discovery_only) for reading_list in sources]
 
     def get_reading_count(self):
@@ -524,11 +684,100 @@ class AstromData(object):
         return len(self.get_sources())
 
 
+class SourceColumns(object):
+    """
+    The readings of a set of sources stored column-wise.
+
+    x, y, x0, y0, ra and dec are arrays of shape (number of sources, number
+    of observations), ra/dec in degrees.  The reference point of each source,
+    its reference sky coordinate and the separation of the readings from it
+    are computed for all the sources at once.  SourceReading objects are views
+    onto a row/column of these arrays.
+    """
+
+    # the smallest cutout radius that is used for a source.
+    MIN_CUTOUT = 30 * units.arcsec
+
+    def __init__(self, x, y, x0, y0, ra, dec):
+        self.x = numpy.array(x, dtype=float, ndmin=2)
+        self.y = numpy.array(y, dtype=float, ndmin=2)
+        self.x0 = numpy.array(x0, dtype=float, ndmin=2)
+        self.y0 = numpy.array(y0, dtype=float, ndmin=2)
+        self.ra = numpy.array(ra, dtype=float, ndmin=2)
+        self.dec = numpy.array(dec, dtype=float, ndmin=2)
+
+        # The reference pixel is the location in the first frame, the reference sky position the middle frame.
+        # These are copies so they do not move when a reading is re-centroided.
+        self.xref = self.x[:, 0].copy()
+        self.yref = self.y[:, 0].copy()
+        ref_index = int(math.ceil(self.num_observations / 2.0)) - 1
+        self.ref_ra = self.ra[:, ref_index].copy()
+        self.ref_dec = self.dec[:, ref_index].copy()
+
+        # determine the smallest cutout that will include the reference coordinate and all the readings
+        separation = numpy.degrees(angular_separation(numpy.radians(self.ra),
+                                                      numpy.radians(self.dec),
+                                                      numpy.radians(self.ref_ra)[:, numpy.newaxis],
+                                                      numpy.radians(self.ref_dec)[:, numpy.newaxis]))
+        self.max_separation = separation.max(axis=1) * 3600.0
+        self.min_cutout = numpy.maximum(self.max_separation, self.MIN_CUTOUT.to(units.arcsec).value)
+
+    @classmethod
+    def from_rows(cls, rows, num_observations):
+        """
+        Build from an array of (x, y, x0, y0, ra, dec) rows, the readings of each source on consecutive rows.
+        """
+        rows = numpy.asarray(rows, dtype=float).reshape(-1, num_observations, 6)
+        return cls(*[rows[:, :, column] for column in range(6)])
+
+    @classmethod
+    def concatenate(cls, columns_list, num_observations):
+        """
+        Join several SourceColumns, eg. the chunks from an AstromStream, into one.
+        """
+        if len(columns_list) == 0:
+            return cls.from_rows(numpy.zeros((0, 6)), num_observations)
+        return cls(*[numpy.concatenate([getattr(columns, name) for columns in columns_list])
+                     for name in ['x', 'y', 'x0', 'y0', 'ra', 'dec']])
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    @property
+    def num_observations(self):
+        return self.x.shape[1]
+
+    def get_readings(self, observations):
+        """
+        Build SourceReading views onto the columns.
+
+        @param observations: list of the Observation each column of readings was measured on.
+        @return: list(list(SourceReading)), one list of readings per source.
+        """
+        return list(self.iter_readings(observations))
+
+    def iter_readings(self, observations):
+        """
+        Build the SourceReading views onto the columns one source at a time.
+
+        @param observations: list of the Observation each column of readings was measured on.
+        @return: generator of list(SourceReading), one list of readings per source.
+        """
+        if len(observations) != self.num_observations:
+            raise AstromFormatError("Readings for {} observations but {} observations given.".format(
+                self.num_observations, len(observations)))
+        for row in range(len(self)):
+            yield [SourceReading.from_columns(self, row, col, observation)
+                   for col, observation in enumerate(observations)]
+
+
 class Source(object):
     """
     A collection of source readings.
     """
 
+    __slots__ = ['readings', 'provisional_name', 'discovery_only']
+
     def __init__(self, readings, provisional_name=None, discovery_only=False):
         self.readings = readings
         self.provisional_name = provisional_name
@@ -537,11 +786,8 @@ class Source(object):
             self.set_min_cutout()
 
     def set_min_cutout(self):
-        x = []
-        y = []
-        for reading in self.readings:
-            x.append(reading.x0)
-            y.append(reading.y0)
+        x = [reading.x0 for reading in self.readings]
+        y = [reading.y0 for reading in self.readings]
         dx = max(x) - min(x)
         dy = max(y) - min(y)
         for reading in self.readings:
@@ -638,8 +884,17 @@ class Ellipse(object):
 class SourceReading(object):
     """
     Data for a detected point source (which is a potential moving objects).
+
+    The positions are held in a SourceColumns, a reading is a view onto one
+    row/column of those arrays.  The astropy objects (SkyCoord, Ellipse, etc.)
+    are only built when asked for.
     """
 
+    __slots__ = ['_columns', '_row', '_col', 'xref', 'yref', '_sky_coord', '_reference_sky_coord',
+                 '_uncertainty_ellipse', '_ellipse_args', '_inverted', '_obs', 'ssos', '_from_input_file',
+                 'null_observation', 'discovery', 'mpc_observation', '_mpc_observations', '_min_cutout',
+                 'dx', 'dy', 'pa', 'object_id']
+
     def __init__(self, x, y, x0, y0, ra, dec, xref, yref, obs, ssos=False, from_input_file=False,
                  null_observation=False, discovery=False, dx=0, dy=0, pa=0):
         """
@@ -659,33 +914,64 @@ class SourceReading(object):
           naxis1, naxis2: the size of the FITS image where this detection is from.
         @param is_inverted:
         """
-        # print x, y, x0, y0, ra, dec, xref, yref
-        self._pix_coord = None
-        if x is not None and y is not None:
-            self.pix_coord = x, y
-        self._ref_coord = None
-        if x0 is not None and y0 is not None:
-            self.ref_coord = x0, y0
-        self._sky_coord = None
-        self.sky_coord = ra, dec
+        # A reading made on its own gets its own single entry columns.
+        self._set_view(SourceColumns(*[[[_column_value(value, unit)]] for value, unit in
+                                       ((x, units.pix), (y, units.pix), (x0, units.pix), (y0, units.pix),
+                                        (ra, units.degree), (dec, units.degree))]),
+                       0, 0, obs)
         self.xref = xref
         self.yref = yref
-        self._uncertainty_ellipse = None
-        self._inverted = None
-        self.uncertainty_ellipse = dx, dy, pa
-        self._obs = None
-        self.obs = obs
-        self._ssos = None
+        self._ellipse_args = (dx, dy, pa)
         self.ssos = ssos
-        self._from_input_file = None
         self.from_input_file = from_input_file
         self.null_observation = null_observation
-        self._discovery = None
         self.discovery = discovery
+        self._min_cutout = 0.3 * units.arcminute
+
+    @classmethod
+    def from_columns(cls, columns, row, col, obs):
+        """
+        A reading that is a view onto row, col of columns.
+
+        :param columns: the arrays holding the reading.
+        :type columns: SourceColumns
+        :param row: the source index
+        :param col: the observation index
+        :param obs: the observation of column col.
+        :type obs: Observation
+        """
+        reading = cls.__new__(cls)
+        reading._set_view(columns, row, col, obs)
+        reading.xref = columns.xref.item(row)
+        reading.yref = columns.yref.item(row)
+        # Overload the 'uncertainty' criterion to ensure we get a large enough cutout.
+        a = columns.max_separation.item(row) / 2.5
+        reading._ellipse_args = (a, a, 0.0)
+        reading.ssos = False
+        reading.from_input_file = False
+        reading.null_observation = False
+        reading.discovery = False
+        reading._min_cutout = None
+        return reading
+
+    def _set_view(self, columns, row, col, obs):
+        self._columns = columns
+        self._row = row
+        self._col = col
+        self._sky_coord = None
+        self._reference_sky_coord = None
+        self._uncertainty_ellipse = None
+        self._inverted = None
+        self._obs = None
+        self.obs = obs
         self.mpc_observation = None
-        self.mpc_observations = {}
-        self.reference_sky_coord = self.sky_coord
-        self.min_cutout = 0.3 * units.arcminute
+        self._mpc_observations = None
+
+    def _get(self, column):
+        return getattr(self._columns, column).item(self._row, self._col)
+
+    def _set(self, column, value):
+        getattr(self._columns, column)[self._row, self._col] = value
 
     def _original_frame(self, x, y):
         """
@@ -719,6 +1005,16 @@ class SourceReading(object):
         assert isinstance(obs, Observation)
         self._obs = obs
 
+    @property
+    def mpc_observations(self):
+        if self._mpc_observations is None:
+            self._mpc_observations = {}
+        return self._mpc_observations
+
+    @mpc_observations.setter
+    def mpc_observations(self, mpc_observations):
+        self._mpc_observations = mpc_observations
+
     @property
     def x_ref_offset(self):
         return self.x - self.x0
@@ -734,7 +1030,9 @@ class SourceReading(object):
         :return: The x,y pixel location of the source in the current frame.
         :rtype: (Quantity, Quantity)
         """
-        return self._pix_coord
+        if numpy.isnan(self._get('x')) or numpy.isnan(self._get('y')):
+            return None
+        return self.x * units.pix, self.y * units.pix
 
     @pix_coord.setter
     def pix_coord(self, pix_coord):
@@ -749,11 +1047,8 @@ class SourceReading(object):
         if not isinstance(pix_coord, list) or len(pix_coord) != 2:
             raise ValueError("pix_coord needs to be set with an (x,y) coordinate pair, got {}".format(pix_coord))
         x, y = pix_coord
-        if not isinstance(x, Quantity):
-            x = float(x) * units.pix
-        if not isinstance(y, Quantity):
-            y = float(y) * units.pix
-        self._pix_coord = x, y
+        self._set('x', _column_value(x, units.pix))
+        self._set('y', _column_value(y, units.pix))
 
     @property
     def x(self):
@@ -761,7 +1056,7 @@ class SourceReading(object):
         :return: the x coordinate value
         :rtype: float
         """
-        return self.pix_coord[0].value
+        return self._get('x')
 
     @property
     def y(self):
@@ -769,7 +1064,7 @@ class SourceReading(object):
         :return: the y coordinate value
         :rtype: float
         """
-        return self.pix_coord[1].value
+        return self._get('y')
 
     @property
     def ref_coord(self):
@@ -778,7 +1073,9 @@ class SourceReading(object):
         :return: The x,y pixel location of the source in the reference frame.
         :rtype: (Quantity, Quantity)
         """
-        return self._ref_coord
+        if numpy.isnan(self._get('x0')) or numpy.isnan(self._get('y0')):
+            return None
+        return self.x0 * units.pix, self.y0 * units.pix
 
     @ref_coord.setter
     def ref_coord(self, pix_coord):
@@ -793,19 +1090,16 @@ class SourceReading(object):
         if not isinstance(pix_coord, list) or len(pix_coord) != 2:
             raise ValueError("pix_coord needs to be set with an (x,y) coordinate pair, got {}".format(pix_coord))
         x, y = pix_coord
-        if not isinstance(x, Quantity):
-            x = float(x) * units.pix
-        if not isinstance(y, Quantity):
-            y = float(y) * units.pix
-        self._ref_coord = x, y
+        self._set('x0', _column_value(x, units.pix))
+        self._set('y0', _column_value(y, units.pix))
 
     @property
     def x0(self):
-        return self._ref_coord[0].value
+        return self._get('x0')
 
     @property
     def y0(self):
-        return self._ref_coord[1].value
+        return self._get('y0')
 
     @property
     def sky_coord(self):
@@ -814,15 +1108,17 @@ class SourceReading(object):
         :return: the world coordinate longitude location.
         :rtype: SkyCoord
         """
+        if self._sky_coord is None:
+            self._sky_coord = SkyCoord(self.ra * units.degree, self.dec * units.degree, 1)
         return self._sky_coord
 
     @property
     def ra(self):
-        return self.sky_coord.ra.degree
+        return self._get('ra')
 
     @property
     def dec(self):
-        return self.sky_coord.dec.degree
+        return self._get('dec')
 
     @sky_coord.setter
     def sky_coord(self, sky_coord):
@@ -838,8 +1134,39 @@ class SourceReading(object):
             sky_coord = SkyCoord(ra, dec, 1)
         if not isinstance(sky_coord, SkyCoord):
             raise ValueError("Failed to initialize coordinate using {}".format(sky_coord))
+        self._set('ra', sky_coord.ra.degree)
+        self._set('dec', sky_coord.dec.degree)
         self._sky_coord = sky_coord
 
+    @property
+    def reference_sky_coord(self):
+        """
+        :return: the sky position the cutouts of this source are centred on.
+        :rtype: SkyCoord
+        """
+        if self._reference_sky_coord is None:
+            self._reference_sky_coord = SkyCoord(self._columns.ref_ra[self._row] * units.degree,
+                                                 self._columns.ref_dec[self._row] * units.degree, 1)
+        return self._reference_sky_coord
+
+    @reference_sky_coord.setter
+    def reference_sky_coord(self, reference_sky_coord):
+        self._reference_sky_coord = reference_sky_coord
+
+    @property
+    def min_cutout(self):
+        """
+        :return: radius of the smallest cutout that includes all the readings of the source.
+        :rtype: Quantity
+        """
+        if self._min_cutout is None:
+            self._min_cutout = self._columns.min_cutout[self._row] * units.arcsec
+        return self._min_cutout
+
+    @min_cutout.setter
+    def min_cutout(self, min_cutout):
+        self._min_cutout = min_cutout
+
     @property
     def uncertainty_ellipse(self):
         """
@@ -847,6 +1174,8 @@ class SourceReading(object):
         :return: The semi-major axis, semi-minor axis and position angle of the uncertainty ellipse
         :rtype: Ellipse
         """
+        if self._uncertainty_ellipse is None:
+            self.uncertainty_ellipse = self._ellipse_args
         return self._uncertainty_ellipse
 
     @uncertainty_ellipse.setter
@@ -1128,6 +1457,10 @@ class Observation(object):
                 self._header = self.astheader
         return self._header
 
+    @header.setter
+    def header(self, header):
+        self._header = header
+
     def get_mpc_date(self):
         header = self.header
         if isinstance(header, list):
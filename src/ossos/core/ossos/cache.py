@@ -0,0 +1,511 @@
+"""Local, persistent caches for content retrieved from VOSpace and the CADC data web service."""
+import contextlib
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+
+from .gui import config
+
+
+def _read_bool(keypath, default=False):
+    """
+    Read a boolean valued configuration setting, allowing for string values set via MOP_ environment variables.
+    """
+    try:
+        value = config.read(keypath)
+    except KeyError:
+        return default
+    if isinstance(value, str):
+        return value.lower() in ['1', 'true', 'yes', 'on']
+    return bool(value)
+
+
+def _read_value(keypath, default=None, cast=str):
+    try:
+        return cast(config.read(keypath))
+    except KeyError:
+        return default
+
+
+class HeaderCache(object):
+    """
+    An SQLite backed, size bounded, cache of FITS headers (or any small blob) retrieved from a URI.
+
+    Entries are content addressed by the URI plus the modification time of the node the content came from, so
+    a changed node never returns a stale header when validation is on.  The cache is shared by all processes that
+    use the same cache directory.
+
+    Lookups follow these rules:
+        - no entry for the URI -> miss.
+        - entry younger than ttl (or ttl == 0, for content that never changes) -> hit, no network access at all.
+        - entry older than ttl and validate is set -> compare the stored modification time to that of the node,
+          hit if they agree.
+        - otherwise -> miss.
+
+    When the total size of the stored content exceeds max_size the least recently used entries are evicted.
+
+    The database (and its directory) is only created when the cache is first used.
+    """
+
+    SCHEMA = """CREATE TABLE IF NOT EXISTS headers (
+                    key TEXT PRIMARY KEY,
+                    uri TEXT NOT NULL,
+                    mtime TEXT,
+                    content BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL)"""
+
+    def __init__(self, directory, max_size=200 * 1024 ** 2, ttl=86400, validate=True, enabled=True):
+        """
+        @param directory: where the sqlite database holding the cache lives.
+        @param max_size: maximum number of bytes of content to keep before evicting least recently used entries.
+        @param ttl: seconds an entry is trusted without validation, 0 means forever (only for content addressed
+        entries, that can't go stale).
+        @param validate: check the node's modification time when an entry is older than ttl.
+        @param enabled: set False to bypass the cache entirely.
+        """
+        self.directory = os.path.expanduser(directory)
+        self.filename = os.path.join(self.directory, 'headers.sqlite')
+        self.max_size = max_size
+        self.ttl = ttl
+        self.validate = validate
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._initialised = False
+
+    def _available(self):
+        """
+        Create the database on first use.
+
+        @return: is the cache usable?
+        """
+        if not self.enabled or self._initialised:
+            return self.enabled
+        with self._lock:
+            if self._initialised:
+                return self.enabled
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                with self._connect() as connection:
+                    connection.execute(self.SCHEMA)
+                    connection.execute("CREATE INDEX IF NOT EXISTS headers_uri ON headers (uri, created)")
+                    connection.execute("CREATE INDEX IF NOT EXISTS headers_accessed ON headers (accessed)")
+            except (OSError, sqlite3.Error) as ex:
+                logging.warning("Header cache at {} disabled: {}".format(self.directory, ex))
+                self.enabled = False
+            self._initialised = True
+        return self.enabled
+
+    @staticmethod
+    def key(uri, mtime):
+        """
+        The content address of the entry for uri as modified at mtime.
+        """
+        return hashlib.sha1("{}\n{}".format(uri, mtime).encode('utf-8')).hexdigest()
+
+    @contextlib.contextmanager
+    def _connect(self):
+        """
+        A connection wrapped in a transaction, connections are not shared between threads so we open one per
+        operation, they are cheap.
+        """
+        connection = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def _lookup(self, uri, get_mtime):
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute("SELECT key, mtime, content, created FROM headers WHERE uri=? "
+                                     "ORDER BY created DESC LIMIT 1", (uri,)).fetchone()
+            if row is None:
+                return None
+            key, mtime, content, created = row
+            if self.ttl and now - created > self.ttl:
+                if not self.validate or get_mtime is None or get_mtime(uri) != mtime:
+                    return None
+                connection.execute("UPDATE headers SET created=? WHERE key=?", (now, key))
+            connection.execute("UPDATE headers SET accessed=? WHERE key=?", (now, key))
+        return content
+
+    def _store(self, uri, mtime, content):
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("DELETE FROM headers WHERE uri=?", (uri,))
+            connection.execute("INSERT OR REPLACE INTO headers (key, uri, mtime, content, size, created, accessed) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (self.key(uri, mtime), uri, mtime, sqlite3.Binary(content), len(content), now, now))
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM headers").fetchone()[0]
+            while total > self.max_size:
+                row = connection.execute("SELECT key, size FROM headers ORDER BY accessed LIMIT 1").fetchone()
+                if row is None:
+                    break
+                connection.execute("DELETE FROM headers WHERE key=?", (row[0],))
+                total -= row[1]
+                self.evictions += 1
+
+    def lookup(self, uri, get_mtime=None):
+        """
+        Return the content stored for uri, or None on a miss.
+
+        @param uri: the cache key.
+        @param get_mtime: callable that returns the modification time of the node at uri, used for validation.
+        @return: bytes
+        """
+        if self._available():
+            try:
+                content = self._lookup(uri, get_mtime)
+                if content is not None:
+                    with self._lock:
+                        self.hits += 1
+                    logging.debug("Header cache hit: {}".format(uri))
+                    return bytes(content)
+            except Exception as ex:
+                # including failures to get the node's modification time, the entry is then not trusted.
+                logging.warning("Header cache lookup failed for {}: {}".format(uri, ex))
+        with self._lock:
+            self.misses += 1
+        logging.debug("Header cache miss: {}".format(uri))
+        return None
+
+    def store(self, uri, content, get_mtime=None):
+        """
+        Store content as the entry for uri.
+
+        @param uri: the cache key.
+        @param content: bytes (or str, stored utf-8 encoded) to store.
+        @param get_mtime: callable that returns the modification time of the node at uri, used for validation.
+        @return: the content as stored.
+        @rtype: bytes
+        """
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        if self._available():
+            mtime = None
+            if self.validate and get_mtime is not None:
+                try:
+                    mtime = get_mtime(uri)
+                except Exception as ex:
+                    # still good until the ttl runs out, then the failed validation makes it a miss.
+                    logging.debug("No modification time for {}: {}".format(uri, ex))
+            try:
+                self._store(uri, mtime, content)
+            except Exception as ex:
+                logging.warning("Header cache store failed for {}: {}".format(uri, ex))
+        return content
+
+    def get(self, uri, fetch, get_mtime=None):
+        """
+        Return the content stored for uri, calling fetch() to retrieve (and then store) it on a miss.
+
+        @param uri: the URI the content is retrieved from, the cache key.
+        @param fetch: callable that returns the content, as bytes, from the source.
+        @param get_mtime: callable that returns the modification time of the node at uri, used for validation.
+        @return: bytes
+        """
+        content = self.lookup(uri, get_mtime)
+        if content is None:
+            content = self.store(uri, fetch(), get_mtime)
+        return content
+
+    def invalidate(self, uri):
+        """
+        Remove any entry for uri.
+        """
+        if not self._available():
+            return
+        with self._connect() as connection:
+            connection.execute("DELETE FROM headers WHERE uri=?", (uri,))
+
+    def clear(self):
+        if not self._available():
+            return
+        with self._connect() as connection:
+            connection.execute("DELETE FROM headers")
+
+    def stats(self):
+        """
+        @return: dictionary of hit/miss/eviction counters and the current size of the cache.
+        """
+        entries = size = 0
+        if self._available():
+            with self._connect() as connection:
+                entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM headers").fetchone()
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': entries,
+                'size': size}
+
+    def __str__(self):
+        return "HeaderCache {directory}: {hits} hits, {misses} misses, {evictions} evictions, " \
+               "{entries} entries using {size} bytes".format(directory=self.directory, **self.stats())
+
+
+class FileCache(object):
+    """
+    A node wide, size bounded, cache of files (images and the like) retrieved from VOSpace, shared by every job
+    that uses the same cache directory.
+
+    Entries are addressed by a key naming the content, normally the URI plus any cutout and the MD5 (or date) of
+    the VOSpace node, so a file that is rewritten gets a new entry rather than the stale copy.  Only one of the
+    processes (or threads) asking for a key at the same time retrieves it, the others wait on a lock file (flock)
+    for it to arrive and then share the copy.  A copy is handed to a job as a hard link (or a symbolic link, or a
+    copy) in the job's directory, cached copies are read-only so a job can't modify what the others will be given.
+
+    When the total size of the cached files exceeds max_size the least recently used are evicted, a job's hard
+    link to an evicted file remains valid.
+    """
+
+    LINK_TYPES = ['hard', 'symbolic', 'copy']
+
+    def __init__(self, directory, max_size=20 * 1024 ** 3, link='hard', enabled=True):
+        """
+        @param directory: where the cached files live, should be on the same file system as the job directories
+        for hard links to work.
+        @param max_size: maximum number of bytes of files to keep before evicting least recently used entries.
+        @param link: how a cached file is put in a job directory, one of LINK_TYPES, falls back to the next on
+        failure.
+        @param enabled: set False to bypass the cache entirely.
+        """
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        self.link = link in self.LINK_TYPES and link or 'hard'
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+        self.bytes_fetched = 0
+        self._lock = threading.Lock()
+        if self.enabled:
+            try:
+                for subdir in ['locks', 'tmp']:
+                    if not os.path.isdir(os.path.join(self.directory, subdir)):
+                        os.makedirs(os.path.join(self.directory, subdir))
+            except OSError as ex:
+                logging.warning("File cache at {} disabled: {}".format(self.directory, ex))
+                self.enabled = False
+
+    def _paths(self, key):
+        """
+        The cached file and lock file of the entry for key.
+        """
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return (os.path.join(self.directory, digest[:2], digest),
+                os.path.join(self.directory, 'locks', digest))
+
+    def _hit(self, filename):
+        size = os.stat(filename).st_size
+        try:
+            os.utime(filename, None)
+        except OSError:
+            # someone else's file, the access is just not recorded.
+            pass
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+
+    def path(self, key, fetch):
+        """
+        The path of the cached copy of the content named key, calling fetch(filename) to retrieve it on a miss.
+
+        @param key: names the content, normally the URI (and cutout) it is retrieved from and its version.
+        @param fetch: callable that writes the content to the file named by its argument.
+        @return: the path of the cached (read-only) file.
+        """
+        filename, lock_filename = self._paths(key)
+        if os.access(filename, os.R_OK):
+            self._hit(filename)
+            logging.debug("File cache hit: {}".format(key))
+            return filename
+
+        with open(lock_filename, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.access(filename, os.R_OK):
+                # retrieved while we waited for the lock.
+                self._hit(filename)
+                logging.debug("File cache hit after wait: {}".format(key))
+                return filename
+            fd, tmp_filename = tempfile.mkstemp(dir=os.path.join(self.directory, 'tmp'))
+            os.close(fd)
+            try:
+                fetch(tmp_filename)
+                size = os.stat(tmp_filename).st_size
+                os.chmod(tmp_filename, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                if not os.path.isdir(os.path.dirname(filename)):
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                os.rename(tmp_filename, filename)
+            except BaseException:
+                if os.path.exists(tmp_filename):
+                    os.unlink(tmp_filename)
+                raise
+        with self._lock:
+            self.misses += 1
+            self.bytes_fetched += size
+        logging.debug("File cache miss: {}".format(key))
+        self._evict(keep=filename)
+        return filename
+
+    def get(self, key, filename, fetch, writable=False):
+        """
+        Put the content named key in filename, from the cache if possible.
+
+        @param key: names the content, normally the URI (and cutout) it is retrieved from and its version, None if
+        the content can't be named and so is retrieved without the cache.
+        @param filename: where the job wants the content.
+        @param fetch: callable that writes the content to the file named by its argument.
+        @param writable: the caller may change the file (eg. open it in update mode), so it gets a copy rather than a
+        link to the cached file.
+        @return: filename
+        """
+        if not self.enabled or key is None:
+            fetch(filename)
+            return filename
+        link_types = writable and ['copy'] or self.LINK_TYPES[self.LINK_TYPES.index(self.link):]
+        for attempt in range(3):
+            source = self.path(key, fetch)
+            try:
+                self._put(source, filename, link_types)
+                return filename
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+                # evicted by another process between path() and the link.
+                logging.debug("{} evicted before it was put in {}, retrieving again".format(source, filename))
+        raise IOError(errno.EIO, "Failed to put {} in {}".format(key, filename))
+
+    @staticmethod
+    def _put(source, filename, link_types):
+        """
+        Put source in filename using the first of link_types that works.
+
+        @raise OSError: ENOENT if source has gone.
+        """
+        if os.path.lexists(filename):
+            os.unlink(filename)
+        for link_type in link_types:
+            try:
+                if link_type == 'hard':
+                    os.link(source, filename)
+                elif link_type == 'symbolic':
+                    if not os.path.exists(source):
+                        raise OSError(errno.ENOENT, "No such file", source)
+                    os.symlink(source, filename)
+                else:
+                    shutil.copyfile(source, filename)
+                return
+            except OSError as ex:
+                if not os.path.exists(source):
+                    raise OSError(errno.ENOENT, "No such file", source)
+                logging.debug("Failed to {} link {} to {}: {}".format(link_type, source, filename, ex))
+        raise IOError(errno.EIO, "Failed to put {} in {}".format(source, filename))
+
+    def _entries(self):
+        for subdir in os.listdir(self.directory):
+            if subdir in ['locks', 'tmp'] or not os.path.isdir(os.path.join(self.directory, subdir)):
+                continue
+            for entry in os.scandir(os.path.join(self.directory, subdir)):
+                try:
+                    stat_result = entry.stat()
+                except OSError:
+                    continue
+                yield stat_result.st_mtime, stat_result.st_size, entry.path
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently used files until the total size is below max_size, skipped if another
+        process is already evicting.
+        """
+        with open(os.path.join(self.directory, 'locks', 'evict'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            entries = sorted(self._entries())
+            total = sum(size for mtime, size, path in entries)
+            for mtime, size, path in entries:
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+                with self._lock:
+                    self.evictions += 1
+
+    def clear(self):
+        if not self.enabled:
+            return
+        for mtime, size, path in list(self._entries()):
+            os.unlink(path)
+
+    def stats(self):
+        """
+        @return: dictionary of the hit/miss/eviction counters and bytes saved and retrieved by this process.
+        """
+        requests = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': requests and float(self.hits) / requests or 0.0,
+                'bytes_saved': self.bytes_saved,
+                'bytes_fetched': self.bytes_fetched}
+
+    def __str__(self):
+        return "FileCache {directory}: {hits} hits, {misses} misses ({hit_rate:.0%} hit rate), " \
+               "{bytes_saved} bytes saved, {bytes_fetched} bytes retrieved, " \
+               "{evictions} evictions".format(directory=self.directory, **self.stats())
+
+
+def header_cache_from_config():
+    """
+    Build the HeaderCache described by the STORAGE.HEADER_CACHE section of the configuration.
+    """
+    return HeaderCache(directory=_read_value("STORAGE.HEADER_CACHE.DIRECTORY", "~/.ossos/cache"),
+                       max_size=_read_value("STORAGE.HEADER_CACHE.MAX_SIZE", 200 * 1024 ** 2, int),
+                       ttl=_read_value("STORAGE.HEADER_CACHE.TTL", 86400, float),
+                       validate=_read_bool("STORAGE.HEADER_CACHE.VALIDATE", True),
+                       enabled=_read_bool("STORAGE.HEADER_CACHE.ENABLED", True))
+
+
+def orbit_cache_from_config():
+    """
+    Build the cache of orbit fits described by the ORBFIT.CACHE section of the configuration.
+
+    Entries are keyed by a hash of the content of the astrometry file that was fit, so they never go stale.
+    """
+    return HeaderCache(directory=_read_value("ORBFIT.CACHE.DIRECTORY", "~/.ossos/cache/orbfit"),
+                       max_size=_read_value("ORBFIT.CACHE.MAX_SIZE", 50 * 1024 ** 2, int),
+                       ttl=0,
+                       enabled=_read_bool("ORBFIT.CACHE.ENABLED", True))
+
+
+def file_cache_from_config():
+    """
+    Build the FileCache described by the STORAGE.FILE_CACHE section of the configuration.
+    """
+    return FileCache(directory=_read_value("STORAGE.FILE_CACHE.DIRECTORY",
+                                           os.path.join(tempfile.gettempdir(), "ossos-file-cache")),
+                     max_size=_read_value("STORAGE.FILE_CACHE.MAX_SIZE", 20 * 1024 ** 3, int),
+                     link=_read_value("STORAGE.FILE_CACHE.LINK", "hard"),
+                     enabled=_read_bool("STORAGE.FILE_CACHE.ENABLED", False))
@@ -2,10 +2,142 @@ import math
 import Polygon
 import logging
 
+import numpy
 from astropy import units
 from astropy.coordinates import SkyCoord
 
 
+class Footprint(object):
+    """
+    The CCDs of a camera as rectangles in the tangent plane about a pointing centre.
+
+    Positions are projected onto the tangent plane once and compared against
+    all the CCDs with numpy, rather than point by point with a Polygon.
+    """
+
+    # number of candidate offsets scored at a time by grid_search, bounds the size of the (offsets, points) arrays.
+    BLOCK_SIZE = 256
+
+    def __init__(self, coordinate, geometry):
+        """
+        @param coordinate: the centre of the pointing.
+        @type coordinate: SkyCoord
+        @param geometry: list of CCDs in the format of Camera._geometry, offsets and sizes in degrees.
+        """
+        self.coordinate = coordinate
+        self.ra0 = coordinate.ra.radian
+        self.dec0 = coordinate.dec.radian
+        # x_min, y_min, x_max, y_max of rectangular CCDs and the radius of circular ones, nan if not that shape.
+        self.rectangles = numpy.zeros((len(geometry), 4)) * numpy.nan
+        self.radii = numpy.zeros(len(geometry)) * numpy.nan
+        self.centres = numpy.zeros((len(geometry), 2))
+        for idx, geo in enumerate(geometry):
+            self.centres[idx] = geo["ra"], geo["dec"]
+            if "rad" in geo:
+                self.radii[idx] = geo["rad"]
+            else:
+                self.rectangles[idx] = (geo["ra"] - geo["dra"] / 2.0, geo["dec"] - geo["ddec"] / 2.0,
+                                        geo["ra"] + geo["dra"] / 2.0, geo["dec"] + geo["ddec"] / 2.0)
+
+    def project(self, ra, dec):
+        """
+        Gnomonic projection of ra/dec onto the tangent plane at the centre of the footprint.
+
+        @param ra: right ascension in degrees.
+        @param dec: declination in degrees.
+        @return: x (towards east) and y (towards north) in degrees, nan for positions more than 90 degrees away.
+        """
+        ra = numpy.radians(numpy.asarray(ra, dtype=float))
+        dec = numpy.radians(numpy.asarray(dec, dtype=float))
+        cos_dra = numpy.cos(ra - self.ra0)
+        cos_c = math.sin(self.dec0) * numpy.sin(dec) + math.cos(self.dec0) * numpy.cos(dec) * cos_dra
+        cos_c = numpy.where(cos_c > 0, cos_c, numpy.nan)
+        x = numpy.cos(dec) * numpy.sin(ra - self.ra0) / cos_c
+        y = (math.cos(self.dec0) * numpy.sin(dec) - math.sin(self.dec0) * numpy.cos(dec) * cos_dra) / cos_c
+        return numpy.degrees(x), numpy.degrees(y)
+
+    def deproject(self, x, y):
+        """
+        The sky position of the tangent plane point x, y (degrees).
+
+        @rtype: SkyCoord
+        """
+        x = math.radians(x)
+        y = math.radians(y)
+        rho = math.hypot(x, y)
+        if rho == 0:
+            return self.coordinate
+        c = math.atan(rho)
+        dec = math.asin(math.cos(c) * math.sin(self.dec0) + y * math.sin(c) * math.cos(self.dec0) / rho)
+        ra = self.ra0 + math.atan2(x * math.sin(c),
+                                   rho * math.cos(self.dec0) * math.cos(c) - y * math.sin(self.dec0) * math.sin(c))
+        return SkyCoord(math.degrees(ra) % 360.0, math.degrees(dec), unit=('degree', 'degree'))
+
+    def _inside(self, x, y):
+        """
+        @return: boolean array of shape (CCDs,) + x.shape, is x,y on each CCD.
+        """
+        x = numpy.asarray(x)[numpy.newaxis]
+        y = numpy.asarray(y)[numpy.newaxis]
+        extra = (slice(None),) + (numpy.newaxis,) * (x.ndim - 1)
+        rectangles = self.rectangles
+        centres = self.centres
+        with numpy.errstate(invalid='ignore'):
+            inside = ((rectangles[:, 0][extra] <= x) & (x <= rectangles[:, 2][extra]) &
+                      (rectangles[:, 1][extra] <= y) & (y <= rectangles[:, 3][extra]))
+            inside |= ((x - centres[:, 0][extra]) ** 2 + (y - centres[:, 1][extra]) ** 2 <=
+                       self.radii[extra] ** 2)
+        return inside
+
+    def contains(self, ra, dec):
+        """
+        Which CCD each of the ra/dec positions (degrees) lands on.
+
+        @return: array of CCD indices, in the order of the camera geometry, -1 where off the camera.
+        """
+        x, y = self.project(ra, dec)
+        inside = self._inside(x, y)
+        return numpy.where(inside.any(axis=0), inside.argmax(axis=0), -1)
+
+    def grid_search(self, ra, dec, required=None, anchor=None, half_width=0.5, step=0.05):
+        """
+        Find the shift of the footprint, on a grid of shifts, that covers the most positions.
+
+        Every shift is scored against every position in one pass.  A shift that covers more of the anchor positions
+        always wins, then one that covers more of the required positions, amongst those the one covering the most
+        positions overall is chosen.
+
+        @param ra: right ascension of the positions in degrees.
+        @param dec: declination of the positions in degrees.
+        @param required: boolean array, the positions that should be covered first.
+        @param anchor: boolean array, the positions that must be covered, ahead of the required ones.
+        @param half_width: the shifts range from -half_width to +half_width degrees in both directions.
+        @param step: grid spacing in degrees.
+        @return: the best (x, y) shift in degrees and the boolean array of positions it covers.
+        """
+        x, y = self.project(ra, dec)
+        if required is None:
+            required = numpy.zeros(x.shape, dtype=bool)
+        required = numpy.asarray(required, dtype=bool)
+        if anchor is None:
+            anchor = numpy.zeros(x.shape, dtype=bool)
+        anchor = numpy.asarray(anchor, dtype=bool)
+        grid = numpy.arange(-half_width, half_width + step / 2.0, step)
+        shifts = numpy.array([(dx, dy) for dx in grid for dy in grid])
+        best_score = -1
+        best = None
+        for start in range(0, len(shifts), self.BLOCK_SIZE):
+            block = shifts[start:start + self.BLOCK_SIZE]
+            covered = self._inside(x[numpy.newaxis] - block[:, 0:1], y[numpy.newaxis] - block[:, 1:2]).any(axis=0)
+            score = ((covered[:, anchor].sum(axis=1) * (len(x) + 1) + covered[:, required].sum(axis=1)) * (len(x) + 1)
+                     + covered.sum(axis=1))
+            idx = score.argmax()
+            if score[idx] > best_score:
+                best_score = score[idx]
+                best = block[idx], covered[idx]
+        return (float(best[0][0]), float(best[0][1])), best[1]
+
+
 class Camera:
     """The Field of View of a direct imager"""
 
@@ -194,6 +326,8 @@ class Camera:
             camera = "MEGACAM_40"
         self.camera = camera
         self._coordinate = None
+        self._polygon = None
+        self._footprint = None
 
     def __str__(self):
 
@@ -265,6 +399,9 @@ class Camera:
 
     @property
     def polygon(self):
+        """The CCDs as a Polygon, rebuilt only when the pointing moves."""
+        if self._polygon is not None and self._polygon[0] is self.coord:
+            return self._polygon[1]
         ccds = self.geometry
         p = None
         for ccd in ccds:
@@ -277,8 +414,38 @@ class Camera:
                 p = Polygon.Polygon(vertices)
             else:
                 p.addContour(vertices)
+        self._polygon = self.coord, p
         return p
 
+    @property
+    def footprint(self):
+        """
+        The CCDs in the tangent plane of the pointing, rebuilt only when the pointing moves.
+        @rtype: Footprint
+        """
+        if self._footprint is None or self._footprint.coordinate is not self.coord:
+            self._footprint = Footprint(self.coord, self._geometry[self.camera])
+        return self._footprint
+
+    def contains(self, ra, dec):
+        """
+        Which CCD each of the ra/dec positions (degrees, scalars or arrays) lands on, -1 for off the camera.
+        """
+        return self.footprint.contains(ra, dec)
+
+    def grid_search(self, ra, dec, required=None, anchor=None, half_width=0.5, step=0.05):
+        """
+        Move the pointing to the shift on a grid around the current pointing that covers the most of the ra/dec
+        positions (degrees), covering the anchor and then the required ones first.  See Footprint.grid_search.
+
+        @return: boolean array of the positions covered by the new pointing.
+        """
+        footprint = self.footprint
+        shift, covered = footprint.grid_search(ra, dec, required=required, anchor=anchor, half_width=half_width,
+                                               step=step)
+        self._coordinate = footprint.deproject(*shift)
+        return covered
+
     @property
     def geometry(self):
         """Return an array of rectangles that represent the 'ra,dec' corners of the FOV
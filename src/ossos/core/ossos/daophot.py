@@ -4,12 +4,33 @@ import os
 import tempfile
 import warnings
 
-from .gui import logger
-
-warnings.simplefilter("ignore")
-from pyraf import iraf
+import numpy
 from astropy.io import fits
 from astropy.io import ascii
+from astropy.table import Table, MaskedColumn
+
+from .gui import config
+from .gui import logger
+
+# The backend used by phot when none is given, 'python' (in process) or 'iraf' (pyraf's daophot.phot).
+try:
+    BACKEND = config.read("PHOT.BACKEND")
+except KeyError:
+    BACKEND = "python"
+
+# datapars.datamin as set for the IRAF backend
+DATAMIN = -100
+# datapars.epadu, the IRAF default gain.
+EPADU = 1.0
+
+# apphot style error codes reported in the CIER/SIER/PIER columns.
+CIER_OFF_IMAGE = 101
+CIER_BIG_SHIFT = 103
+SIER_NO_SKY = 201
+PIER_OFF_IMAGE = 302
+PIER_NO_SKY = 303
+PIER_NEGATIVE_FLUX = 304
+PIER_BAD_PIXELS = 305
 
 
 class TaskError(Exception):
@@ -17,13 +38,13 @@ class TaskError(Exception):
 
 
 def phot(fits_filename, x_in, y_in, aperture=15, sky=20, swidth=10, apcor=0.3,
-         maxcount=30000.0, exptime=1.0, zmag=None, extno=0, centroid=True):
+         maxcount=30000.0, exptime=1.0, zmag=None, extno=0, centroid=True, backend=None):
     """
     Compute the centroids and magnitudes of a bunch sources  on fits image.
 
     :rtype : astropy.table.Table
-    :param fits_filename: Name of fits image to measure source photometry on.
-    :type fits_filename: str
+    :param fits_filename: Name of fits image to measure source photometry on, or an in memory HDUList/HDU.
+    :type fits_filename: str, astropy.io.fits.HDUList, astropy.io.fits.ImageHDU
     :param x_in: x location of source to measure
     :type x_in: float, numpy.array
     :param y_in: y location of source to measure
@@ -42,28 +63,39 @@ def phot(fits_filename, x_in, y_in, aperture=15, sky=20, swidth=10, apcor=0.3,
     :type exptime: float
     :param zmag: zeropoint magnitude
     :param extno: extension of fits_filename the x/y location refers to.
+    :param centroid: re-centre the sources before measuring?
+    :param backend: 'python' to measure in process, 'iraf' to use the pyraf/IRAF daophot package (default BACKEND)
     """
     if not hasattr(x_in, '__iter__'):
         x_in = [x_in, ]
     if not hasattr(y_in, '__iter__'):
         y_in = [y_in, ]
+    backend = backend is None and BACKEND or backend
 
-    if (not os.path.exists(fits_filename) and
-            not fits_filename.endswith(".fits")):
-        # For convenience, see if we just forgot to provide the extension
-        fits_filename += ".fits"
+    if isinstance(fits_filename, str):
+        if (not os.path.exists(fits_filename) and
+                not fits_filename.endswith(".fits")):
+            # For convenience, see if we just forgot to provide the extension
+            fits_filename += ".fits"
 
-    try:
-        input_hdulist = fits.open(fits_filename)
-    except Exception as err:
-        logger.error(f'Failed trying to open {fits_filename}')
-        logger.error(str(err))
-        raise FileNotFoundError(fits_filename)
+        try:
+            input_hdulist = fits.open(fits_filename)
+        except Exception as err:
+            logger.error(f'Failed trying to open {fits_filename}')
+            logger.error(str(err))
+            raise FileNotFoundError(fits_filename)
+        input_hdu = input_hdulist[extno]
+    elif isinstance(fits_filename, fits.HDUList):
+        input_hdulist = fits_filename
+        input_hdu = input_hdulist[extno]
+    else:
+        input_hdulist = fits.HDUList([fits.PrimaryHDU(header=fits_filename.header)])
+        input_hdu = fits_filename
 
     # get the filter for this image
-    filter_name = input_hdulist[extno].header.get('FILTER',
-                                                  input_hdulist[0].header.get('FILTER',
-                                                                              'DEFAULT'))
+    filter_name = input_hdu.header.get('FILTER',
+                                       input_hdulist[0].header.get('FILTER',
+                                                                   'DEFAULT'))
 
     # Some nominal CFHT zeropoints that might be useful
     zeropoints = {"I": 25.77,
@@ -77,20 +109,60 @@ def phot(fits_filename, x_in, y_in, aperture=15, sky=20, swidth=10, apcor=0.3,
                   'gri.MP9603': 33.520}
     if zmag is None:
         logger.warning("No zmag supplied to daophot, looking for header or default values.")
-        zmag = input_hdulist[extno].header.get('PHOTZP', zeropoints[filter_name])
+        zmag = input_hdu.header.get('PHOTZP', zeropoints[filter_name])
         logger.warning("Setting zmag to: {}".format(zmag))
         # check for magic 'zeropoint.used' files
-        for zpu_file in ["{}.zeropoint.used".format(os.path.splitext(fits_filename)[0]), "zeropoint.used"]:
+        zpu_files = ["zeropoint.used"]
+        if isinstance(fits_filename, str):
+            zpu_files.insert(0, "{}.zeropoint.used".format(os.path.splitext(fits_filename)[0]))
+        for zpu_file in zpu_files:
             if os.access(zpu_file, os.R_OK):
                 with open(zpu_file) as zpu_fh:
                     zmag = float(zpu_fh.read())
                     logger.warning("Using file {} to set zmag to: {}".format(zpu_file, zmag))
                     break
-    photzp = input_hdulist[extno].header.get('PHOTZP', zeropoints.get(filter_name, zeropoints["DEFAULT"]))
+    photzp = input_hdu.header.get('PHOTZP', zeropoints.get(filter_name, zeropoints["DEFAULT"]))
     if zmag != photzp:
         logger.warning(("zmag sent to daophot: ({}) "
                         "doesn't match PHOTZP value in image header: ({})".format(zmag, photzp)))
 
+    if backend == 'iraf':
+        if isinstance(fits_filename, str):
+            pdump_out = _iraf_phot(fits_filename + "[{}]".format(extno), x_in, y_in, aperture, sky, swidth,
+                                   maxcount, exptime, zmag, centroid)
+        else:
+            # IRAF routines need their input on disk.
+            with tempfile.NamedTemporaryFile(mode="r+b", suffix=".fits") as hdu_file:
+                fits.PrimaryHDU(data=input_hdu.data, header=input_hdu.header).writeto(hdu_file.name,
+                                                                                      overwrite=True)
+                pdump_out = _iraf_phot(hdu_file.name + "[0]", x_in, y_in, aperture, sky, swidth,
+                                       maxcount, exptime, zmag, centroid)
+    else:
+        pdump_out = aperture_phot(input_hdu.data, x_in, y_in, aperture=aperture, sky=sky, swidth=swidth,
+                                  maxcount=maxcount, exptime=exptime, zmag=zmag, centroid=centroid)
+    logging.debug("PHOT FILE:\n"+str(pdump_out))
+    if not len(pdump_out) > 0:
+        raise TaskError("photometry failed. {}".format(pdump_out))
+
+    # apply the aperture correction
+    pdump_out['MAG'] -= apcor
+
+    # if pdump_out['PIER'][0] != 0 or pdump_out['SIER'][0] != 0 or pdump_out['CIER'][0] != 0:
+    #    raise ValueError("Photometry failed:\n {}".format(pdump_out))
+
+    logger.debug("Computed aperture photometry on {} objects in {}".format(len(pdump_out), fits_filename))
+
+    del input_hdulist
+    return pdump_out
+
+
+def _iraf_phot(image, x_in, y_in, aperture, sky, swidth, maxcount, exptime, zmag, centroid):
+    """
+    Run the IRAF daophot.phot task on image (a filename[extno] string) and return the .mag file as a Table.
+    """
+    warnings.simplefilter("ignore")
+    from pyraf import iraf
+
     # setup IRAF to do the magnitude/centroid measurements
     iraf.set(uparm="./")
     iraf.digiphot()
@@ -99,7 +171,7 @@ def phot(fits_filename, x_in, y_in, aperture=15, sky=20, swidth=10, apcor=0.3,
 
     iraf.photpars.apertures = aperture
     iraf.photpars.zmag = zmag
-    iraf.datapars.datamin = -100
+    iraf.datapars.datamin = DATAMIN
     iraf.datapars.datamax = maxcount
     iraf.datapars.exposur = ""
     iraf.datapars.itime = exptime
@@ -138,28 +210,184 @@ def phot(fits_filename, x_in, y_in, aperture=15, sky=20, swidth=10, apcor=0.3,
     magfile.close()
     os.remove(magfile.name)
 
-    iraf.phot(fits_filename+"[{}]".format(extno), coofile.name, magfile.name)
+    iraf.phot(image, coofile.name, magfile.name)
     pdump_out = ascii.read(magfile.name, format='daophot')
-    logging.debug("PHOT FILE:\n"+str(pdump_out))
     if not len(pdump_out) > 0:
         mag_content = open(magfile.name).read()
         raise TaskError("photometry failed. {}".format(mag_content))
 
-    # apply the aperture correction
-    pdump_out['MAG'] -= apcor
-
-    # if pdump_out['PIER'][0] != 0 or pdump_out['SIER'][0] != 0 or pdump_out['CIER'][0] != 0:
-    #    raise ValueError("Photometry failed:\n {}".format(pdump_out))
-
     # Clean up temporary files generated by IRAF
     os.remove(coofile.name)
     os.remove(magfile.name)
-    logger.debug("Computed aperture photometry on {} objects in {}".format(len(pdump_out), fits_filename))
-
-    del input_hdulist
     return pdump_out
 
 
+def _stamps(data, xc, yc, half_width):
+    """
+    Extract (2*half_width+1)^2 pixel stamps centred on the (1-based, integer) pixels xc, yc.
+
+    Pixels that fall off the image are NaN.
+
+    @return: stamps (N x M x M), offsets (M) of the stamp pixels from the centre pixel.
+    """
+    offsets = numpy.arange(-half_width, half_width + 1)
+    rows = yc[:, None, None] - 1 + offsets[None, :, None]
+    cols = xc[:, None, None] - 1 + offsets[None, None, :]
+    inside = (rows >= 0) & (rows < data.shape[0]) & (cols >= 0) & (cols < data.shape[1])
+    stamps = numpy.where(inside,
+                         data[numpy.clip(rows, 0, data.shape[0] - 1), numpy.clip(cols, 0, data.shape[1] - 1)],
+                         numpy.nan)
+    return stamps, offsets
+
+
+def _centroid(data, x, y, cbox=5.0, maxshift=2.0, maxiter=10):
+    """
+    apphot 'centroid' centering: threshold the x/y marginal distributions of a cbox wide box at their mean and
+    compute the first moment of what is left, repeating while the box centre moves.
+
+    @return: x, y, cier
+    """
+    half_width = int(cbox / 2)
+    x_new = x.copy()
+    y_new = y.copy()
+    cier = numpy.zeros(len(x), dtype=int)
+    for iteration in range(maxiter):
+        xc = numpy.round(x_new).astype(int)
+        yc = numpy.round(y_new).astype(int)
+        stamps, offsets = _stamps(data, xc, yc, half_width)
+        off_image = numpy.isnan(stamps).any(axis=(1, 2))
+        stamps = numpy.nan_to_num(stamps)
+        x_marginal = stamps.sum(axis=1)
+        y_marginal = stamps.sum(axis=2)
+        x_weight = numpy.clip(x_marginal - x_marginal.mean(axis=1)[:, None], 0, None)
+        y_weight = numpy.clip(y_marginal - y_marginal.mean(axis=1)[:, None], 0, None)
+        x_norm = x_weight.sum(axis=1)
+        y_norm = y_weight.sum(axis=1)
+        good = (x_norm > 0) & (y_norm > 0) & ~off_image
+        cier[off_image] = CIER_OFF_IMAGE
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            x_next = numpy.where(good, xc + (x_weight * offsets).sum(axis=1) / x_norm, x_new)
+            y_next = numpy.where(good, yc + (y_weight * offsets).sum(axis=1) / y_norm, y_new)
+        moved = (numpy.round(x_next) != xc) | (numpy.round(y_next) != yc)
+        x_new = x_next
+        y_new = y_next
+        if not moved.any():
+            break
+    big_shift = numpy.hypot(x_new - x, y_new - y) > maxshift
+    cier[big_shift] = CIER_BIG_SHIFT
+    reset = cier != 0
+    x_new[reset] = x[reset]
+    y_new[reset] = y[reset]
+    return x_new, y_new, cier
+
+
+def _sky_mode(values, loclip=5.0, hiclip=5.0, ksigma=3.0, maxiter=10):
+    """
+    apphot 'mode' sky fitting on the rows of values (NaN marks pixels not in the annulus): clip loclip/hiclip percent
+    off each end of the sorted distribution then iteratively reject pixels more than ksigma from the
+    mode = 3 * median - 2 * mean.
+
+    @return: msky, stdev, nsky
+    """
+    values = numpy.sort(values, axis=1)
+    nvalid = numpy.isfinite(values).sum(axis=1)
+    rank = numpy.arange(values.shape[1])[None, :]
+    low = numpy.floor(nvalid * loclip / 100.0).astype(int)[:, None]
+    high = (nvalid - numpy.floor(nvalid * hiclip / 100.0).astype(int))[:, None]
+    values = numpy.where((rank >= low) & (rank < high), values, numpy.nan)
+    msky = stdev = None
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for iteration in range(maxiter):
+            mean = numpy.nanmean(values, axis=1)
+            median = numpy.nanmedian(values, axis=1)
+            stdev = numpy.nanstd(values, axis=1)
+            msky = numpy.where(mean < median, mean, 3.0 * median - 2.0 * mean)
+            reject = numpy.fabs(values - msky[:, None]) > ksigma * stdev[:, None]
+            if not reject.any():
+                break
+            values = numpy.where(reject, numpy.nan, values)
+    nsky = numpy.isfinite(values).sum(axis=1)
+    return msky, stdev, nsky
+
+
+def aperture_phot(data, x_in, y_in, aperture=15, sky=20, swidth=10, maxcount=30000.0, exptime=1.0, zmag=26.0,
+                  centroid=True, datamin=DATAMIN, epadu=EPADU):
+    """
+    Circular aperture photometry of many sources at once, done in process on an image array.
+
+    This follows the IRAF daophot.phot recipe used by the IRAF backend of phot: centroid centering, a mode
+    sky in the annulus [sky, sky + swidth] with 5% low/high clipping, a fractional pixel aperture sum and
+    the phot magnitude error model.  x_in/y_in are 1-based (IRAF/FITS) pixel coordinates.
+
+    :rtype : astropy.table.Table
+    :return: Table with the same XCENTER/YCENTER/MAG/MERR/PIER columns (and friends) as the IRAF .mag file.
+    """
+    data = numpy.asarray(data, dtype=numpy.float64)
+    x_init = numpy.array(x_in, dtype=numpy.float64, ndmin=1)
+    y_init = numpy.array(y_in, dtype=numpy.float64, ndmin=1)
+
+    if centroid:
+        xcenter, ycenter, cier = _centroid(data, x_init, y_init)
+    else:
+        xcenter, ycenter, cier = x_init.copy(), y_init.copy(), numpy.zeros(len(x_init), dtype=int)
+
+    # one stamp per source big enough to hold the sky annulus.
+    half_width = int(numpy.ceil(sky + swidth)) + 1
+    xc = numpy.round(xcenter).astype(int)
+    yc = numpy.round(ycenter).astype(int)
+    stamps, offsets = _stamps(data, xc, yc, half_width)
+    dx = (xc - xcenter)[:, None, None] + offsets[None, None, :]
+    dy = (yc - ycenter)[:, None, None] + offsets[None, :, None]
+    radius = numpy.hypot(dx, dy)
+
+    # sky
+    in_annulus = (radius >= sky) & (radius <= sky + swidth) & (stamps >= datamin) & (stamps <= maxcount)
+    sky_values = numpy.where(in_annulus, stamps, numpy.nan).reshape(len(xcenter), -1)
+    msky, stdev, nsky = _sky_mode(sky_values)
+    sier = numpy.where(nsky > 0, 0, SIER_NO_SKY)
+
+    # aperture sum, pixels partially inside the aperture contribute by the fraction of the pixel inside.
+    weights = numpy.clip(aperture + 0.5 - radius, 0.0, 1.0)
+    in_aperture = weights > 0
+    off_image = (in_aperture & numpy.isnan(stamps)).any(axis=(1, 2))
+    bad_pixels = (in_aperture & ((stamps < datamin) | (stamps > maxcount))).any(axis=(1, 2))
+    values = numpy.nan_to_num(stamps)
+    total = (weights * values).sum(axis=(1, 2))
+    area = (weights * numpy.isfinite(stamps)).sum(axis=(1, 2))
+    flux = total - area * msky
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mag = zmag - 2.5 * numpy.log10(flux / exptime)
+        merr = 1.0857 * numpy.sqrt(flux / epadu + area * stdev ** 2 + area ** 2 * stdev ** 2 / nsky) / flux
+
+    pier = numpy.zeros(len(xcenter), dtype=int)
+    pier[bad_pixels] = PIER_BAD_PIXELS
+    pier[flux <= 0] = PIER_NEGATIVE_FLUX
+    pier[sier != 0] = PIER_NO_SKY
+    pier[off_image] = PIER_OFF_IMAGE
+    undefined = ~numpy.isfinite(mag) | (pier != 0)
+
+    result = Table()
+    result['ID'] = numpy.arange(1, len(xcenter) + 1)
+    result['XINIT'] = x_init
+    result['YINIT'] = y_init
+    result['XCENTER'] = xcenter
+    result['YCENTER'] = ycenter
+    result['CIER'] = cier
+    result['MSKY'] = msky
+    result['STDEV'] = stdev
+    result['NSKY'] = nsky
+    result['SIER'] = sier
+    result['SUM'] = total
+    result['AREA'] = area
+    result['FLUX'] = flux
+    result['MAG'] = MaskedColumn(numpy.where(undefined, 0.0, mag), mask=undefined)
+    result['MERR'] = MaskedColumn(numpy.where(undefined, 0.0, merr), mask=undefined)
+    result['PIER'] = pier
+    return result
+
+
 def phot_mag(*args, **kwargs):
     """Wrapper around phot which only returns the computed magnitude directly."""
     try:
@@ -79,7 +79,8 @@ class DownloadRequest(object):
                  reading,
                  focus=None,
                  needs_apcor=False,
-                 callback=None):
+                 callback=None,
+                 error_callback=None):
         """
         Constructor.
 
@@ -99,10 +100,15 @@ class DownloadRequest(object):
           callback: callable
             An optional callback to be called with the downloaded snapshot
             as its argument.
+          error_callback: callable
+            An optional callback to be called with this request if the
+            download fails (the error is still passed to the error handler).
         """
         self.reading = reading
         self.needs_apcor = needs_apcor
         self.callback = callback
+        self.error_callback = error_callback
+        self.cancelled = False
 
         if focus is None:
             self.focus = reading.source_point
@@ -110,12 +116,26 @@ class DownloadRequest(object):
             self.focus = focus
 
     def __lt__(self, other):
-        self.reading.get_exposure_number() < other.reading.get_exposure_number()
+        return self.reading.get_exposure_number() < other.reading.get_exposure_number()
+
+    def cancel(self):
+        """
+        Mark the request as superseded, a cancelled request still in the queue is dropped when it reaches a worker.
+        """
+        self.cancelled = True
 
     def execute(self, downloader):
-        cutout = downloader.download_cutout(self.reading,
-                                            focus=self.focus,
-                                            needs_apcor=self.needs_apcor)
+        if self.cancelled:
+            logger.debug("Skipping cancelled download of {}".format(self.reading))
+            return
+        try:
+            cutout = downloader.download_cutout(self.reading,
+                                                focus=self.focus,
+                                                needs_apcor=self.needs_apcor)
+        except Exception:
+            if self.error_callback is not None:
+                self.error_callback(self)
+            raise
         logger.debug("Got cutout: {}".format(cutout))
         if self.callback is not None:
             self.callback(cutout)
@@ -2,18 +2,59 @@ import os
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+from collections import namedtuple
 from astropy.io import fits
-import io
+import tempfile
+import time
 from ossos.gui import logger
 from .. import storage
 import sys
 
+# Size of the blocks the VOSpace response is streamed in.
+CHUNK_SIZE = 1024 ** 2
+
+DownloadStats = namedtuple('DownloadStats', ['uri', 'nbytes', 'latency', 'elapsed'])
+"""Bytes received, seconds to the first byte and total seconds taken by one download."""
+
 
 class Downloader(object):
     """
     Downloads data from VOSpace.
     """
 
+    def __init__(self):
+        self.last_download = None
+        self.total_bytes = 0
+        self.total_downloads = 0
+
+    def _record(self, uri, nbytes, latency, elapsed):
+        self.last_download = DownloadStats(uri, nbytes, latency, elapsed)
+        self.total_bytes += nbytes
+        self.total_downloads += 1
+        logger.info("Downloaded {} bytes from {} in {:.3f}s ({:.3f}s to first byte)".format(nbytes, uri,
+                                                                                             elapsed, latency))
+
+    def _stream_to_file(self, uri, vobj, fobj):
+        """
+        Copy the content of vobj into fobj CHUNK_SIZE bytes at a time so the response is never held in memory.
+        """
+        start = time.time()
+        latency = None
+        nbytes = 0
+        while True:
+            chunk = vobj.read(CHUNK_SIZE)
+            if latency is None:
+                latency = time.time() - start
+            if not chunk:
+                break
+            if isinstance(chunk, str):
+                chunk = chunk.encode('latin-1')
+            fobj.write(chunk)
+            nbytes += len(chunk)
+        fobj.flush()
+        fobj.seek(0)
+        self._record(uri, nbytes, latency, time.time() - start)
+
     def download_hdulist(self, uri, **kwargs):
         """
         Downloads a FITS image as a HDUList.
@@ -29,16 +70,31 @@ class Downloader(object):
           hdulist: astropy.io.fits.hdu.hdulist.HDUList
             The requests FITS image as an Astropy HDUList object
             (http://docs.astropy.org/en/latest/io/fits/api/hdulists.html).
+            The pixels are memory mapped from a local file, the response is streamed into an anonymous temporary
+            file that is removed when the HDUList is closed (or garbage collected).
         """
 
         logger.debug(str(kwargs))
         hdulist = None
+        local_file = os.path.basename(uri)
+        if os.access(local_file, os.R_OK):
+            # storage.vofile would hand back the local copy anyway, map it rather than reading it in.
+            return fits.open(local_file, memmap=True)
         try:
             vobj = storage.vofile(uri, **kwargs)
             try:
-                fobj = io.StringIO(vobj.read())
-                fobj.seek(0)
-                hdulist = fits.open(fobj)
+                download = tempfile.TemporaryFile(suffix=".fits")
+                self._stream_to_file(uri, vobj, download)
+                # astropy won't open a file handle that is open for writing read-only, use a read-only handle on
+                # the same (anonymous) file.
+                fobj = open(os.dup(download.fileno()), 'rb')
+                download.close()
+                try:
+                    hdulist = fits.open(fobj, mode='readonly', memmap=True)
+                except Exception:
+                    # scaled or compressed data can't always be mapped.
+                    fobj.seek(0)
+                    hdulist = fits.open(fobj, mode='readonly', memmap=False)
             except Exception as e:
                 sys.stderr.write("ERROR: {}\n".format(str(e)))
                 sys.stderr.write("While loading {} {}\n".format(uri, kwargs))
@@ -67,6 +123,9 @@ class Downloader(object):
         if os.access(local_file, os.F_OK):
             fobj = open(local_file)
         else:
+            apcor = storage.calibrations.get_by_uri(uri)
+            if apcor is not None:
+                return ApcorData(*apcor)
             fobj = storage.vofile(uri, view='data')
             fobj.seek(0)
         str = fobj.read()
@@ -78,6 +137,9 @@ class Downloader(object):
         local_file = os.path.basename(uri)
         if os.access(local_file, os.F_OK):
             return float(open(local_file).read())
+        zmag = storage.calibrations.get_by_uri(uri)
+        if zmag is not None:
+            return zmag
         fobj = storage.vofile(uri, view="data")
         fobj.seek(0)
         str = fobj.read()
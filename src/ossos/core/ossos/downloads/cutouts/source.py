@@ -304,8 +304,6 @@ class SourceCutout(object):
         return self._apcor
 
     def get_observed_magnitude(self, centroid=True):
-        # NOTE: this import is only here so that we don't load up IRAF
-        # unnecessarily (ex: for candidates processing).
         """
         Get the magnitude at the current pixel x/y location.
 
@@ -314,17 +312,17 @@ class SourceCutout(object):
 
         max_count = float(self.astrom_header.get("MAXCOUNT", 30000))
         (x, y, hdulist_index) = self.pixel_coord
-        tmp_file = self._hdu_on_disk(hdulist_index)
         try:
             from ossos import daophot
-            phot = daophot.phot_mag(tmp_file,
+            # measured directly on the in memory HDU, the IRAF backend will put it on disk if it needs to.
+            phot = daophot.phot_mag(self.hdulist[hdulist_index],
                                     x, y,
                                     aperture=self.apcor.aperture,
                                     sky=self.apcor.sky,
                                     swidth=self.apcor.swidth,
                                     apcor=self.apcor.apcor,
                                     zmag=self.zmag,
-                                    maxcount=max_count, extno=1,
+                                    maxcount=max_count,
                                     centroid=centroid)
             if not self.apcor.valid:
                 logger.error(f'No valid apcor, invalidating phot {phot}')
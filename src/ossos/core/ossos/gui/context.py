@@ -1,10 +1,16 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
 import os
+import threading
+import time
 
 from ossos import storage
-from ossos.gui import logger
-from ossos.gui.progress import LocalProgressManager, VOSpaceProgressManager
+from ossos.gui import config, logger
+from ossos.gui.progress import (LocalProgressManager, VOSpaceProgressManager, SQLiteProgressManager,
+                                SQLITE_BACKEND, SYNC_INTERVAL, INDEX_BATCH)
+
+# seconds a VOSpace listing snapshot is used before it is fetched again.
+SNAPSHOT_LIFETIME = 120
 
 
 def get_context(directory, userid=None):
@@ -14,6 +20,25 @@ def get_context(directory, userid=None):
         return LocalDirectoryWorkingContext(directory, userid=userid)
 
 
+def _progress_setting(keypath, default, cast=str):
+    try:
+        return cast(config.read(keypath))
+    except KeyError:
+        return default
+
+
+def _sqlite_progress_manager(working_context, **kwargs):
+    """
+    The SQLiteProgressManager for working_context if it is the PROGRESS.BACKEND, otherwise None.
+    """
+    if _progress_setting("PROGRESS.BACKEND", None) != SQLITE_BACKEND:
+        return None
+    return SQLiteProgressManager(working_context, userid=working_context.userid,
+                                 sync_interval=_progress_setting("PROGRESS.SYNC_INTERVAL", SYNC_INTERVAL, float),
+                                 index_batch=_progress_setting("PROGRESS.INDEX_BATCH", INDEX_BATCH, int),
+                                 **kwargs)
+
+
 class WorkingContext(object):
     def __init__(self, directory, userid=None):
         self.userid = userid
@@ -38,6 +63,14 @@ class WorkingContext(object):
     def get_file_size(self, filename):
         raise NotImplementedError()
 
+    def get_properties(self, force=False):
+        """
+        The properties of all the files in the directory, fetched in bulk.
+
+        @return: dict of filename -> dict of properties, or None if this context can't list them in bulk.
+        """
+        return None
+
     def exists(self, filename):
         raise NotImplementedError()
 
@@ -88,26 +121,43 @@ class LocalDirectoryWorkingContext(WorkingContext):
         os.remove(self.get_full_path(filename))
 
     def get_progress_manager(self):
-        return LocalProgressManager(self, userid=self.userid)
+        return _sqlite_progress_manager(self) or LocalProgressManager(self, userid=self.userid)
 
 
 class VOSpaceWorkingContext(WorkingContext):
-    def __init__(self, directory, userid=None):
+    def __init__(self, directory, userid=None, snapshot_lifetime=SNAPSHOT_LIFETIME):
         super(VOSpaceWorkingContext, self).__init__(directory, userid=userid)
+        self.snapshot_lifetime = snapshot_lifetime
+        self._snapshot = None
+        self._snapshot_time = 0
+        self._snapshot_lock = threading.Lock()
 
     def is_remote(self):
         return True
 
     def listdir(self):
-        # Don't force because it causes a HUGE performance hit.
+        # The snapshot is one detailed listing request, which also gives the lengths/done/lock properties.
         logger.debug(f"Getting a listing of {self.directory}")
-        dir_list = storage.listdir(self.directory, force=False)
+        dir_list = list(self.get_properties().keys())
         logger.debug(f"Got: {dir_list}")
         return dir_list
 
+    def get_properties(self, force=False):
+        """
+        A snapshot of the properties of every file in the directory, refreshed once it is snapshot_lifetime old.
+        The snapshot can be stale, use it to filter out files not to decide who holds a lock.
+        """
+        with self._snapshot_lock:
+            if force or self._snapshot is None or time.time() - self._snapshot_time > self.snapshot_lifetime:
+                self._snapshot = storage.list_properties(self.directory)
+                self._snapshot_time = time.time()
+            return self._snapshot
+
     def get_file_size(self, filename):
-        length_property = storage.get_property(
-            self.get_full_path(filename), "length", ossos_base=False)
+        length_property = self.get_properties().get(filename, {}).get("length", None)
+        if length_property is None:
+            length_property = storage.get_property(
+                self.get_full_path(filename), "length", ossos_base=False)
 
         if length_property is None:
             # Fall-back if the length property is not set for some reason
@@ -134,4 +184,5 @@ class VOSpaceWorkingContext(WorkingContext):
         storage.delete_uri(self.get_full_path(filename))
 
     def get_progress_manager(self):
-        return VOSpaceProgressManager(self, track_partial_progress=False, userid=self.userid)
+        return (_sqlite_progress_manager(self, track_partial_progress=False) or
+                VOSpaceProgressManager(self, track_partial_progress=False, userid=self.userid))
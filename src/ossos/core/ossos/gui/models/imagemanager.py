@@ -1,6 +1,11 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
-from ...gui import events, logger
+import threading
+from collections import OrderedDict
+
+import numpy
+
+from ...gui import events, logger, config
 from ...downloads.async_download import DownloadRequest
 from ...downloads.cutouts.focus import (SingletFocusCalculator,
                                         TripletFocusCalculator)
@@ -8,17 +13,66 @@ from ...downloads.cutouts.grid import CutoutGrid
 from ...gui.models.exceptions import ImageNotLoadedException
 
 
+def _read_prefetch_config(key, default):
+    try:
+        return config.read("APP.PREFETCH.{}".format(key))
+    except KeyError:
+        return default
+
+
+def _cutout_size(cutout):
+    """
+    Number of bytes of pixel data held by a cutout.
+    """
+    size = 0
+    try:
+        for hdu in cutout.hdulist:
+            if isinstance(hdu.data, numpy.ndarray):
+                size += hdu.data.nbytes
+    except TypeError:
+        pass
+    return size
+
+
 class ImageManager(object):
     """
     TODO: refactor duplication.
+
+    Singlet cutouts are fetched with a look-ahead: the cutouts for the source being displayed and for the next
+    prefetch_depth unprocessed sources are queued, nearest first, and requests for sources that leave that window
+    (because the user jumped) are cancelled.  Loaded cutouts are kept, least recently used first out, within
+    memory_budget bytes of pixel data; the cutouts of the current source and of the look-ahead window are never
+    evicted.
     """
 
-    def __init__(self, singlet_download_manager, triplet_download_manager):
+    def __init__(self, singlet_download_manager, triplet_download_manager,
+                 prefetch_depth=None, memory_budget=None):
+        """
+        @param prefetch_depth: number of sources beyond the current one to fetch, 0 fetches the whole workunit.
+        @param memory_budget: bytes of cutout pixel data to keep loaded.
+        """
         self._singlet_download_manager = singlet_download_manager
         self._triplet_download_manager = triplet_download_manager
 
-        self._cutouts = {}
+        if prefetch_depth is None:
+            prefetch_depth = int(_read_prefetch_config("DEPTH", 5))
+        if memory_budget is None:
+            memory_budget = int(_read_prefetch_config("MEMORY_BUDGET", 500 * 1024 ** 2))
+        self.prefetch_depth = prefetch_depth
+        self.memory_budget = memory_budget
+
+        self._cutouts = OrderedDict()
+        self._cutout_sizes = {}
         self._cutout_grids = {}
+        # requests that have been submitted but have not yet delivered a cutout, by reading.
+        self._pending_singlets = {}
+        # readings of the current source and the look-ahead window.
+        self._window_readings = set()
+        self._lock = threading.RLock()
+
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        self._accessed_readings = set()
 
         self._workunits_downloaded_for_singlets = set()
         self._workunits_downloaded_for_triplets = set()
@@ -38,9 +92,44 @@ class ImageManager(object):
 
         self._workunits_downloaded_for_singlets.add(workunit)
 
+        self.prefetch_singlets(workunit)
+
+    def _lookahead_sources(self, workunit):
+        """
+        The current source followed by the next prefetch_depth unprocessed sources, in the order they will be shown.
+        """
+        sources = workunit.get_sources()
+        ordered = list(sources)
+        start = max(sources.get_index(), 0)
+        ordered = ordered[start:] + ordered[:start]
+        window = [source for index, source in enumerate(ordered)
+                  if index == 0 or not workunit.is_source_finished(source)]
+        if self.prefetch_depth:
+            window = window[:self.prefetch_depth + 1]
+        return window
+
+    def prefetch_singlets(self, workunit):
+        """
+        Queue the singlet cutouts for the sources around the current source of workunit, nearest source at the
+        highest priority, and cancel any queued requests for sources that are no longer nearby.
+        """
+        if workunit not in self._workunits_downloaded_for_singlets:
+            return
+        window = self._lookahead_sources(workunit)
+        wanted = set()
+        for source in window:
+            wanted.update(source.get_readings())
+
+        with self._lock:
+            self._window_readings = wanted
+            for reading in list(self._pending_singlets):
+                if reading not in wanted:
+                    self._pending_singlets.pop(reading).cancel()
+                    logger.debug("Cancelled superseded download of {}".format(reading))
+
         needs_apcor = workunit.is_apcor_needed()
-        for source in workunit.get_unprocessed_sources():
-            self.download_singlets_for_source(source, needs_apcor=needs_apcor)
+        for priority, source in enumerate(window):
+            self.download_singlets_for_source(source, needs_apcor=needs_apcor, priority=priority)
 
     def download_singlets_for_source(self, source, needs_apcor=False, priority=100):
         focus_calculator = SingletFocusCalculator(source)
@@ -50,16 +139,20 @@ class ImageManager(object):
             # Check to see if we should only be downloading the discovery images
             if source.discovery_only and not reading.discovery:
                 continue
+            with self._lock:
+                if reading in self._cutouts or reading in self._pending_singlets:
+                    continue
             logger.debug("Getting focus location for {}".format(reading))
             focus = focus_calculator.calculate_focus(reading)
             logger.debug("Focus is {}".format(focus))
-            self._singlet_download_manager.submit_request(
-                DownloadRequest(reading,
-                                needs_apcor=needs_apcor,
-                                focus=focus,
-                                callback=self.on_singlet_image_loaded),
-                priority=priority
-            )
+            download_request = DownloadRequest(reading,
+                                               needs_apcor=needs_apcor,
+                                               focus=focus,
+                                               callback=self.on_singlet_image_loaded,
+                                               error_callback=self.on_singlet_download_failed)
+            with self._lock:
+                self._pending_singlets[reading] = download_request
+            self._singlet_download_manager.submit_request(download_request, priority=priority)
 
     def download_singlet_for_reading(self, reading, focus, needs_apcor=False):
         self._singlet_download_manager.submit_request(
@@ -71,11 +164,50 @@ class ImageManager(object):
 
     def get_cutout(self, reading):
         logger.debug("Getting cutout for {}".format(reading))
-        try:
-            return self._cutouts[reading]
-        except KeyError as err:
-            logger.info(str(err)+str(reading))
-            raise ImageNotLoadedException(reading)
+        with self._lock:
+            first_access = reading not in self._accessed_readings
+            self._accessed_readings.add(reading)
+            try:
+                cutout = self._cutouts[reading]
+                self._cutouts.move_to_end(reading)
+            except KeyError as err:
+                if first_access:
+                    self.prefetch_misses += 1
+                    self._log_prefetch_stats()
+                logger.info(str(err)+str(reading))
+                raise ImageNotLoadedException(reading)
+            if first_access:
+                self.prefetch_hits += 1
+                self._log_prefetch_stats()
+        return cutout
+
+    @property
+    def prefetch_hit_rate(self):
+        """
+        Fraction of readings whose cutout was already loaded when first displayed.
+        """
+        total = self.prefetch_hits + self.prefetch_misses
+        return total and float(self.prefetch_hits) / total or 0.0
+
+    def _log_prefetch_stats(self):
+        logger.info("Prefetch depth {}: {} hits, {} misses, hit rate {:.2f}, {} cutouts using {} bytes".format(
+            self.prefetch_depth, self.prefetch_hits, self.prefetch_misses, self.prefetch_hit_rate,
+            len(self._cutouts), sum(self._cutout_sizes.values())))
+
+    def _evict_cutouts(self):
+        """
+        Drop least recently used cutouts until the loaded pixel data fits in the memory budget, the cutouts of the
+        current source and the look-ahead window are always kept.
+        """
+        size = sum(self._cutout_sizes.values())
+        for reading in list(self._cutouts):
+            if size <= self.memory_budget:
+                break
+            if reading in self._window_readings:
+                continue
+            del self._cutouts[reading]
+            size -= self._cutout_sizes.pop(reading, 0)
+            logger.debug("Evicted cutout of {} to stay within the memory budget".format(reading))
 
     def download_triplets_for_workunit(self, workunit):
         if workunit in self._workunits_downloaded_for_triplets:
@@ -142,5 +274,16 @@ class ImageManager(object):
 
     def on_singlet_image_loaded(self, cutout):
         reading = cutout.reading
-        self._cutouts[reading] = cutout
+        with self._lock:
+            self._pending_singlets.pop(reading, None)
+            self._cutouts[reading] = cutout
+            self._cutouts.move_to_end(reading)
+            self._cutout_sizes[reading] = _cutout_size(cutout)
+            self._evict_cutouts()
         events.send(events.IMG_LOADED, reading)
+
+    def on_singlet_download_failed(self, download_request):
+        # forget the request so the next prefetch asks again.
+        with self._lock:
+            if self._pending_singlets.get(download_request.reading) is download_request:
+                del self._pending_singlets[download_request.reading]
@@ -98,8 +98,11 @@ class ValidationModel(object):
     def expect_observation_transition(self):
         self.expect_image_transition()
 
-    @staticmethod
-    def expect_image_transition():
+    def expect_image_transition(self):
+        try:
+            self.image_state.prefetch_images(self.get_current_workunit())
+        except NoWorkUnitException:
+            pass
         events.send(events.CHANGE_IMAGE)
 
     def acknowledge_image_displayed(self):
@@ -388,6 +391,9 @@ class SingletState(object):
     def download_workunit_images(self, workunit):
         self.image_manager.download_singlets_for_workunit(workunit)
 
+    def prefetch_images(self, workunit):
+        self.image_manager.prefetch_singlets(workunit)
+
     def submit_download_request(self, download_request):
         self.image_manager.submit_singlet_download_request(download_request)
 
@@ -412,5 +418,9 @@ class TripletState(object):
     def download_workunit_images(self, workunit):
         self.image_manager.download_triplets_for_workunit(workunit)
 
+    def prefetch_images(self, workunit):
+        # the triplet grids for the whole workunit are requested up front.
+        pass
+
     def submit_download_request(self, download_request):
         self.image_manager.submit_triplet_download_request(download_request)
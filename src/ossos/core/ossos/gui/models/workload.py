@@ -662,6 +662,8 @@ class WorkUnitProvider(object):
                 version = len(str(version)) > 0 and ".{}".format(version) or version
                 filenames.append("{}{}{}".format(basename, version, self.taskid))
                 # print basename, basenames[basename], filenames[-1]
+        # drop the done, empty and locked files before any per-file requests are made.
+        filenames = self.progress_manager.filter_available(filenames)
         logger.debug(f"Got a list of these files {filenames}")
 
         return filenames
@@ -674,7 +676,7 @@ class WorkUnitProvider(object):
             return potential_files[0]
 
     def shutdown(self):
-        pass
+        self.progress_manager.close()
 
 
 class PreFetchingWorkUnitProvider(object):
@@ -763,6 +765,8 @@ class PreFetchingWorkUnitProvider(object):
         for workunit in self.workunits:
             workunit.unlock()
 
+        self.workunit_provider.shutdown()
+
 
 class WorkUnitBuilder(object):
     """
@@ -1,11 +1,15 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
 import collections
+import contextlib
+import hashlib
+import os
+import sqlite3
 import threading
 
 from .. import storage
 from .. import auth
-from . import tasks, logger
+from . import config, tasks, logger
 
 CANDS = "CANDS"
 REALS = "REALS"
@@ -20,6 +24,12 @@ DONE_PROPERTY = "done"
 PROCESSED_INDICES_PROPERTY = "processed_indices"
 LOCK_PROPERTY = "lock_holder"
 
+# Constants for SQLite progress manager
+PROGRESS_DB = ".progress.sqlite"
+SQLITE_BACKEND = "sqlite"
+SYNC_INTERVAL = 30
+INDEX_BATCH = 1
+
 # TODO: just make them both "," for consistency
 INDEX_SEP = "\n"
 VO_INDEX_SEP = ","
@@ -100,6 +110,23 @@ class AbstractProgressManager(object):
         """
         raise NotImplementedError()
 
+    def filter_available(self, filenames):
+        """
+        Removes files that are certainly not available to work on (done,
+        empty or locked by someone else) using what is already known
+        about the directory, without making a request per file.
+
+        Args:
+          filenames: list(str)
+            Files in the working directory.
+
+        Returns:
+          available: list(str)
+            The filenames that might be available, a lock must still be
+            acquired before working on one.
+        """
+        return list(filenames)
+
     def get_processed_indices(self, filename):
         """
         Retrieve indices of items that have been processed in a file.
@@ -182,6 +209,13 @@ class AbstractProgressManager(object):
     def owns_lock(self, filename):
         raise NotImplementedError()
 
+    def close(self):
+        """
+        Called when the application exits, writes out any progress not yet
+        persisted.
+        """
+        pass
+
 
 class VOSpaceProgressManager(AbstractProgressManager):
     def __init__(self, working_context, userid=None, track_partial_progress=False):
@@ -201,6 +235,25 @@ class VOSpaceProgressManager(AbstractProgressManager):
     def is_done(self, filename):
         return storage.has_property(self._get_uri(filename), DONE_PROPERTY)
 
+    def filter_available(self, filenames):
+        properties = self.working_context.get_properties()
+        if properties is None:
+            return list(filenames)
+
+        done_uri = storage.tag_uri(DONE_PROPERTY)
+        lock_uri = storage.tag_uri(LOCK_PROPERTY)
+        available = []
+        for filename in filenames:
+            props = properties.get(filename, {})
+            if props.get(done_uri, None) is not None:
+                continue
+            if props.get(lock_uri, None) not in [None, self.userid]:
+                continue
+            if props.get("length", None) is not None and int(props["length"]) == 0:
+                continue
+            available.append(filename)
+        return available
+
     def get_processed_indices(self, filename):
         if not self.track_partial_results:
             return []
@@ -397,6 +450,305 @@ class LocalProgressManager(AbstractProgressManager):
         return tasks.get_suffix(task) + DONE_SUFFIX
 
 
+class SQLiteProgressManager(AbstractProgressManager):
+    """
+    Persists progress to a single SQLite database.
+
+    Locks, done marks and processed indices are rows in the database, so acquiring a lock is one transaction
+    and finding the done or locked files is one indexed query.  The database is in WAL mode so several sessions
+    sharing it read while another writes.
+
+    When the working context is remote the database is kept in a local directory and the remote context is
+    only used to acquire locks and to check the progress of other users.  Done marks, processed indices and
+    lock releases are written to the database and then pushed to VOSpace by a background thread every
+    sync_interval seconds, so recording progress never waits on the network.
+    """
+
+    SCHEMA = ["""CREATE TABLE IF NOT EXISTS progress (
+                     filename TEXT PRIMARY KEY,
+                     done TEXT,
+                     lock_holder TEXT,
+                     remote_lock INTEGER NOT NULL DEFAULT 0,
+                     changed INTEGER NOT NULL DEFAULT 0,
+                     synced INTEGER NOT NULL DEFAULT 0)""",
+              """CREATE TABLE IF NOT EXISTS indices (
+                     filename TEXT NOT NULL,
+                     idx INTEGER NOT NULL,
+                     PRIMARY KEY (filename, idx))""",
+              "CREATE INDEX IF NOT EXISTS progress_done ON progress (done)",
+              "CREATE INDEX IF NOT EXISTS progress_lock ON progress (lock_holder)",
+              "CREATE INDEX IF NOT EXISTS progress_changed ON progress (changed, synced)"]
+
+    def __init__(self, working_context, userid=None, filename=None, track_partial_progress=True,
+                 sync_interval=SYNC_INTERVAL, index_batch=INDEX_BATCH):
+        """
+        Args:
+          filename: str
+            The database to use, defaults to PROGRESS_DB in a local working
+            directory and to a file named for the directory in
+            PROGRESS.DIRECTORY for a remote one.
+          track_partial_progress: bool
+            Push processed indices to a remote working directory.
+          sync_interval: float
+            Seconds between pushes of progress to a remote working directory.
+          index_batch: int
+            Number of processed indices recorded before they are written
+            to the database.
+        """
+        super(SQLiteProgressManager, self).__init__(working_context, userid=userid)
+        self.index_batch = max(1, index_batch)
+        self.sync_interval = sync_interval
+        self.remote = None
+        if working_context.is_remote():
+            self.remote = VOSpaceProgressManager(working_context, userid=self.userid,
+                                                 track_partial_progress=track_partial_progress)
+        if filename is None:
+            filename = self._default_filename()
+        self.filename = filename
+
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sync_lock = threading.Lock()
+        self._sync_thread = None
+
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+
+        if self.remote is not None:
+            self._sync_thread = threading.Thread(target=self._sync_loop, name="progress-sync")
+            self._sync_thread.daemon = True
+            self._sync_thread.start()
+
+    def _default_filename(self):
+        if self.remote is None:
+            return self.working_context.get_full_path(PROGRESS_DB)
+        try:
+            directory = config.read("PROGRESS.DIRECTORY")
+        except KeyError:
+            directory = "~/.ossos/progress"
+        directory = os.path.expanduser(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        digest = hashlib.sha1(self.working_context.directory.encode('utf-8')).hexdigest()
+        return os.path.join(directory, digest + ".sqlite")
+
+    @contextlib.contextmanager
+    def _connect(self, immediate=False):
+        """
+        A connection wrapped in a transaction, a connection is opened per operation as they are cheap and
+        can't be shared between the GUI and sync threads.
+
+        Args:
+          immediate: bool
+            Take the database write lock when the transaction starts, so
+            what is read can't change before it is written.
+        """
+        connection = sqlite3.connect(self.filename, timeout=60)
+        try:
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                if immediate:
+                    connection.execute("BEGIN IMMEDIATE")
+                yield connection
+        finally:
+            connection.close()
+
+    def _flush(self):
+        """
+        Write the processed indices not yet in the database.
+        """
+        with self._pending_lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        with self._connect() as connection:
+            connection.executemany("INSERT OR IGNORE INTO indices (filename, idx) VALUES (?, ?)", pending)
+            for filename in set(filename for filename, index in pending):
+                self._touch(connection, filename)
+
+    @staticmethod
+    def _touch(connection, filename):
+        connection.execute("INSERT OR IGNORE INTO progress (filename) VALUES (?)", (filename,))
+        connection.execute("UPDATE progress SET changed=changed+1 WHERE filename=?", (filename,))
+
+    def get_done(self, task):
+        suffix = tasks.get_suffix(task)
+        with self._connect() as connection:
+            done = [row[0] for row in connection.execute("SELECT filename FROM progress WHERE done IS NOT NULL")
+                    if row[0].endswith(suffix)]
+        if self.remote is not None:
+            done.extend(filename for filename in self.remote.get_done(task) if filename not in done)
+        return done
+
+    def is_done(self, filename):
+        with self._connect() as connection:
+            row = connection.execute("SELECT done FROM progress WHERE filename=?", (filename,)).fetchone()
+        if row is not None and row[0] is not None:
+            return True
+        return self.remote is not None and self.remote.is_done(filename)
+
+    def filter_available(self, filenames):
+        with self._connect() as connection:
+            unavailable = set(row[0] for row in connection.execute(
+                "SELECT filename FROM progress WHERE done IS NOT NULL OR lock_holder != ?", (self.userid,)))
+        available = [filename for filename in filenames if filename not in unavailable]
+        if self.remote is not None:
+            available = self.remote.filter_available(available)
+        return available
+
+    def get_processed_indices(self, filename):
+        self._flush()
+        if self.remote is not None:
+            remote_indices = self.remote.get_processed_indices(filename)
+            if remote_indices:
+                # keep them locally so that they are pushed back along with ours.
+                with self._connect() as connection:
+                    connection.executemany("INSERT OR IGNORE INTO indices (filename, idx) VALUES (?, ?)",
+                                           [(filename, index) for index in remote_indices])
+        with self._connect() as connection:
+            return [row[0] for row in connection.execute("SELECT idx FROM indices WHERE filename=? ORDER BY rowid",
+                                                         (filename,))]
+
+    def _record_done(self, filename):
+        self._flush()
+        with self._connect() as connection:
+            self._touch(connection, filename)
+            connection.execute("UPDATE progress SET done=? WHERE filename=?", (self.userid, filename))
+
+    def _record_index(self, filename, index):
+        with self._pending_lock:
+            self._pending.append((filename, index))
+            full = len(self._pending) >= self.index_batch
+        if full:
+            self._flush()
+
+    def lock(self, filename):
+        if self.remote is None:
+            self._lock(filename)
+            return
+        # a sync in progress may be releasing the remote lock on this file.
+        with self._sync_lock:
+            if self._lock(filename):
+                return
+            try:
+                self.remote.lock(filename)
+            except Exception:
+                with self._connect() as connection:
+                    connection.execute("UPDATE progress SET lock_holder=NULL WHERE filename=?", (filename,))
+                raise
+            with self._connect() as connection:
+                connection.execute("UPDATE progress SET remote_lock=1 WHERE filename=?", (filename,))
+
+    def _lock(self, filename):
+        """
+        Take the lock in the database.
+
+        Returns:
+          remote_lock: bool
+            True if the remote lock on the file is still held.
+        """
+        with self._connect(immediate=True) as connection:
+            connection.execute("INSERT OR IGNORE INTO progress (filename) VALUES (?)", (filename,))
+            lock_holder, remote_lock = connection.execute("SELECT lock_holder, remote_lock FROM progress "
+                                                          "WHERE filename=?", (filename,)).fetchone()
+            if lock_holder not in [None, self.userid]:
+                raise FileLockedException(filename, lock_holder)
+            connection.execute("UPDATE progress SET lock_holder=? WHERE filename=?", (self.userid, filename))
+        return bool(remote_lock)
+
+    def unlock(self, filename, do_async=False):
+        # NOTE: the database is local, releasing the remote lock is left to the sync thread.
+        self._flush()
+        with self._connect(immediate=True) as connection:
+            row = connection.execute("SELECT lock_holder FROM progress WHERE filename=?", (filename,)).fetchone()
+            if row is None or row[0] is None:
+                return
+            if row[0] != self.userid:
+                # Can't remove someone else's lock!
+                raise FileLockedException(filename, row[0])
+            self._touch(connection, filename)
+            connection.execute("UPDATE progress SET lock_holder=NULL WHERE filename=?", (filename,))
+
+    def clean(self, suffixes=None):
+        """
+        Remove the progress recorded in the database, the suffixes select
+        which of done marks, locks and processed indices are removed.
+        """
+        if suffixes is None:
+            suffixes = [DONE_SUFFIX, LOCK_SUFFIX, PART_SUFFIX]
+        self._flush()
+        with self._connect() as connection:
+            if DONE_SUFFIX in suffixes:
+                connection.execute("UPDATE progress SET done=NULL")
+            if LOCK_SUFFIX in suffixes:
+                connection.execute("UPDATE progress SET lock_holder=NULL")
+            if PART_SUFFIX in suffixes:
+                connection.execute("DELETE FROM indices")
+
+    def owns_lock(self, filename):
+        with self._connect() as connection:
+            row = connection.execute("SELECT lock_holder FROM progress WHERE filename=?", (filename,)).fetchone()
+        return row is not None and row[0] == self.userid
+
+    def sync(self):
+        """
+        Push the progress recorded since the last sync to the remote working
+        directory: done marks, then processed indices, then lock releases.
+
+        Returns:
+          count: int
+            The number of files whose progress was pushed.
+        """
+        if self.remote is None:
+            return 0
+        self._flush()
+        count = 0
+        with self._sync_lock:
+            with self._connect() as connection:
+                rows = connection.execute("SELECT filename, done, lock_holder, remote_lock, changed FROM progress "
+                                          "WHERE changed > synced").fetchall()
+            for filename, done, lock_holder, remote_lock, changed in rows:
+                try:
+                    if done is not None:
+                        self.remote._record_done(filename)
+                    if self.remote.track_partial_results:
+                        with self._connect() as connection:
+                            indices = [str(row[0]) for row in connection.execute(
+                                "SELECT idx FROM indices WHERE filename=? ORDER BY rowid", (filename,))]
+                        if indices:
+                            storage.set_property(self.remote._get_uri(filename), PROCESSED_INDICES_PROPERTY,
+                                                 VO_INDEX_SEP.join(indices))
+                    if lock_holder is None and remote_lock:
+                        self.remote._do_unlock(filename)
+                        remote_lock = 0
+                except Exception as ex:
+                    logger.warning("Failed to sync progress of {}: {}".format(filename, ex))
+                    continue
+                with self._connect() as connection:
+                    connection.execute("UPDATE progress SET synced=?, remote_lock=? WHERE filename=?",
+                                       (changed, remote_lock, filename))
+                count += 1
+        return count
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception as ex:
+                logger.warning("Progress sync failed: {}".format(ex))
+
+    def close(self):
+        self._stop.set()
+        if self._sync_thread is not None:
+            self._sync_thread.join()
+            self._sync_thread = None
+        self._flush()
+        self.sync()
+
+
 class InMemoryProgressManager(AbstractProgressManager):
     """
     An implementation of the ProgressManager interface which stores all
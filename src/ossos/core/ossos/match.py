@@ -75,7 +75,7 @@ def measure_mags(measures):
         hdulist_index = source.get_hdulist_idx(observation.ccdnum)
         #source.update_pixel_location((observations[observation]['x'],
         #                              observations[observation]['y']), hdulist_index)
-        observations[observation]['mags'] = daophot.phot(source._hdu_on_disk(hdulist_index),
+        observations[observation]['mags'] = daophot.phot(source.hdulist[hdulist_index],
                                                          observations[observation]['x'],
                                                          observations[observation]['y'],
                                                          aperture=source.apcor.aperture,
@@ -83,8 +83,7 @@ def measure_mags(measures):
                                                          swidth=source.apcor.swidth,
                                                          apcor=source.apcor.apcor,
                                                          zmag=source.zmag,
-                                                         maxcount=30000,
-                                                         extno=0)
+                                                         maxcount=30000)
 
     return observations
 
@@ -1,5 +1,246 @@
 __author__ = 'jjk'
 
+import collections
+import ctypes
+import glob
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+
 import mp_ephem
+import numpy
+from astropy import units
+from astropy.time import Time
+from mp_ephem.ephem import obscode_to_int
+
+from . import cache
+
 Orbfit = mp_ephem.BKOrbit
-OrbfitError = mp_ephem.BKOrbitError
\ No newline at end of file
+OrbfitError = mp_ephem.BKOrbitError
+
+# Predicted locations of a set of orbits at a set of times, each an array of shape (orbits, times).
+Ephemeris = collections.namedtuple('Ephemeris', ['ra', 'dec', 'dra', 'ddec', 'pa'])
+
+_liborbfit = None
+_orbit_cache = None
+
+
+def _load_liborbfit():
+    """
+    Load the BK orbfit library that ships with mp_ephem, once per process.
+    """
+    global _liborbfit
+    if _liborbfit is None:
+        path = os.path.dirname(mp_ephem.__file__)
+        bin_ephem = ctypes.sizeof(ctypes.c_voidp) == 8 and 'binEphem.405_64' or 'binEphem.405_32'
+        os.environ.setdefault('ORBIT_EPHEMERIS', os.path.join(path, 'data', bin_ephem))
+        os.environ.setdefault('ORBIT_OBSERVATORIES', os.path.join(path, 'data', 'observatories.dat'))
+        _liborbfit = ctypes.CDLL(glob.glob(os.path.join(path, 'orbfit*.so'))[0])
+        _liborbfit.predict.restype = ctypes.POINTER(ctypes.c_double * 8)
+        _liborbfit.predict.argtypes = [ctypes.c_char_p, ctypes.c_double, ctypes.c_int]
+    return _liborbfit
+
+
+def _julian_dates(times):
+    """
+    :param times: an astropy Time (scalar or array) or a list of Time, julian date floats or date strings.
+    :return: the UTC julian dates.
+    :rtype: numpy.ndarray
+    """
+    if isinstance(times, Time):
+        return numpy.atleast_1d(times.utc.jd)
+    jds = []
+    for time in times:
+        if not isinstance(time, Time):
+            time = isinstance(time, float) and Time(time, format='jd', scale='utc') or Time(time, scale='utc')
+        jds.append(time.utc.jd)
+    return numpy.array(jds)
+
+
+def _predict_abg(args):
+    """
+    Predict the location of the orbit described by an abg string at each julian date.
+
+    The abg is written to disk once, liborbfit only reads orbits from a file, and the library is called directly
+    so none of the per-call SkyCoord and frame transformations of BKOrbit.predict are done.
+
+    :return: array of shape (5, len(jds)) of ra, dec (degrees), dra, ddec (arcsec) and pa (degrees).
+    """
+    abg, jds, obs_code = args
+    liborbfit = _load_liborbfit()
+    result = numpy.zeros((5, len(jds)))
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.abg') as abg_file:
+        abg_file.write(abg)
+        abg_file.flush()
+        abg_filename = ctypes.c_char_p(abg_file.name.encode('utf-8'))
+        for idx, jd in enumerate(jds):
+            predict = liborbfit.predict(abg_filename, ctypes.c_double(jd), ctypes.c_int(obs_code))
+            result[:, idx] = predict.contents[0:5]
+    return result
+
+
+def _predict_orbit(orbit, jds):
+    """
+    Fall back for orbits, like mp_ephem.horizons.Body, that are not described by an abg.
+    """
+    result = numpy.zeros((5, len(jds)))
+    for idx, jd in enumerate(jds):
+        orbit.predict(Time(jd, format='jd', scale='utc'))
+        result[:, idx] = (orbit.coordinate.ra.to(units.degree).value,
+                          orbit.coordinate.dec.to(units.degree).value,
+                          orbit.dra.to(units.arcsec).value,
+                          orbit.ddec.to(units.arcsec).value,
+                          orbit.pa.to(units.degree).value)
+    return result
+
+
+def predict_many(orbits, times, obs_code=568, processes=None):
+    """
+    Predict the location of many orbits at many times.
+
+    :param orbits: list of Orbfit objects, abg strings or other objects with an Orbfit like predict method.
+    :param times: an astropy Time (scalar or array) or a list of Time, julian date floats or date strings.
+    :param obs_code: the Minor Planet Center observatory code the predictions are for.
+    :param processes: number of worker processes to spread the orbits over, default is to run in this process.
+    :return: the ra, dec, dra, ddec and pa of each orbit at each time, arrays of shape (len(orbits), len(times)).
+    :rtype: Ephemeris
+    """
+    jds = _julian_dates(times)
+    obs_code = obscode_to_int(obs_code)
+    abgs = []
+    for orbit in orbits:
+        abg = isinstance(orbit, str) and orbit or getattr(orbit, 'abg', None)
+        abgs.append(abg is not None and (abg, jds, obs_code) or None)
+
+    results = [None] * len(orbits)
+    jobs = [idx for idx in range(len(orbits)) if abgs[idx] is not None]
+    if processes is not None and processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            predictions = pool.map(_predict_abg, [abgs[idx] for idx in jobs])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        predictions = [_predict_abg(abgs[idx]) for idx in jobs]
+    for idx, prediction in zip(jobs, predictions):
+        results[idx] = prediction
+    for idx in range(len(orbits)):
+        if results[idx] is None:
+            results[idx] = _predict_orbit(orbits[idx], jds)
+
+    results = numpy.array(results).reshape(len(orbits), 5, len(jds))
+    return Ephemeris(ra=results[:, 0] * units.degree,
+                     dec=results[:, 1] * units.degree,
+                     dra=results[:, 2] * units.arcsec,
+                     ddec=results[:, 3] * units.arcsec,
+                     pa=results[:, 4] * units.degree)
+
+
+def orbit_cache():
+    """
+    The persistent cache of orbit fits, see cache.orbit_cache_from_config.
+    @rtype: cache.HeaderCache
+    """
+    global _orbit_cache
+    if _orbit_cache is None:
+        _orbit_cache = cache.orbit_cache_from_config()
+    return _orbit_cache
+
+
+def fit_key(ast_filename):
+    """
+    The cache key of the fit to the observations in ast_filename, a hash of the content of the file.
+    """
+    with open(ast_filename, 'rb') as ast_file:
+        digest = hashlib.sha1(ast_file.read()).hexdigest()
+    return "orbfit:{}:{}".format(mp_ephem.__version__, digest)
+
+
+def _fit_abg(args):
+    """
+    Fit the orbit of the observations in an astrometry file.
+
+    :return: the abg of the fit, None if there are too few observations for a fit.
+    """
+    ast_filename, abg_filename = args
+    if abg_filename is not None and not os.path.isdir(os.path.dirname(abg_filename)):
+        abg_filename = None
+    try:
+        return Orbfit(None, ast_filename, abg_filename).abg
+    except OrbfitError:
+        return None
+    except Exception as ex:
+        logging.error("Failed to compute orbit using inputs {}: {}".format(ast_filename, ex))
+        raise
+
+
+def orbit_from_abg(abg, ast_filename):
+    """
+    The Orbfit described by abg, no fit is done.
+
+    :param abg: the abg (as written by fit_radec) of the orbit.
+    :param ast_filename: the file holding the observations the orbit was fit to.
+    :rtype: Orbfit
+    """
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.abg') as abg_file:
+        abg_file.write(abg)
+        abg_file.flush()
+        orbit = Orbfit(None, ast_filename, abg_file.name)
+    orbit.abg_filename = None
+    return orbit
+
+
+def fit_many(ast_filenames, abg_filenames=None, processes=None, fit_cache=None):
+    """
+    Fit the orbits of the observations in many astrometry files.
+
+    Fits are looked up in the orbit cache by the content of each file, so a file is only fit again after it
+    changes.  Otherwise an existing abg file is used as it would be by Orbfit, the remaining files are fit
+    (spread over processes worker processes) and the results cached.
+
+    :param ast_filenames: list of files of MPC formatted observations.
+    :param abg_filenames: for each file, an abg file to use or to write the fit to (or None).
+    :param processes: number of worker processes to fit in, default is to fit in this process.
+    :param fit_cache: cache to look fits up in and store them to, default is orbit_cache().
+    :return: the orbit fit to each file.
+    :rtype: list(Orbfit)
+    :raises OrbfitError: if any file has too few observations for an orbit.
+    """
+    if abg_filenames is None:
+        abg_filenames = [None] * len(ast_filenames)
+    if fit_cache is None:
+        fit_cache = orbit_cache()
+
+    keys = [fit_key(ast_filename) for ast_filename in ast_filenames]
+    abgs = [fit_cache.lookup(key) for key in keys]
+    orbits = [None] * len(ast_filenames)
+    jobs = []
+    for idx, abg in enumerate(abgs):
+        if abg is not None:
+            orbits[idx] = orbit_from_abg(abg.decode('utf-8'), ast_filenames[idx])
+        elif abg_filenames[idx] is not None and os.access(abg_filenames[idx], os.R_OK):
+            orbits[idx] = Orbfit(None, ast_filenames[idx], abg_filenames[idx])
+        else:
+            jobs.append(idx)
+
+    args = [(ast_filenames[idx], abg_filenames[idx]) for idx in jobs]
+    if processes is not None and processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            fits = pool.map(_fit_abg, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        fits = [_fit_abg(arg) for arg in args]
+
+    for idx, abg in zip(jobs, fits):
+        if abg is None:
+            logging.error("Failed to compute orbit using inputs {}".format(ast_filenames[idx]))
+            raise OrbfitError()
+        fit_cache.store(keys[idx], abg)
+        orbits[idx] = orbit_from_abg(abg, ast_filenames[idx])
+    return orbits
@@ -1,6 +1,7 @@
 # coding=utf-8
 
 import logging
+import multiprocessing
 import os
 import re
 import sys
@@ -52,11 +53,14 @@ def ossos_objects_parser(fn):
 
 class TNO(object):
 
-    def __init__(self, observations, ast_filename=None, abg_filename=None):
+    def __init__(self, observations, ast_filename=None, abg_filename=None, orbit=None):
+        """
+        @param orbit: the orbit already fit to the observations in ast_filename, see orbfit.fit_many.
+        """
 
         if observations is None:
           try:
-            self.orbit = orbfit.Orbfit(None, ast_filename, abg_filename)
+            self.orbit = orbit is not None and orbit or orbfit.Orbfit(None, ast_filename, abg_filename)
             self.name = os.path.basename(ast_filename).split('.')[0]
           except Exception as ex:
             logging.error("Failed to compute orbit using inputs {}".format(ast_filename))
@@ -86,10 +90,14 @@ def ossos_discoveries(directory=parameters.REAL_KBO_AST_DIR,
                       single_object=None,
                       all_objects=True,
                       data_release=None,
+                      processes=None,
                       ):
     """
     Returns a list of objects holding orbfit.Orbfit objects with the observations in the Orbfit.observations field.
     Default is to return only the objects corresponding to the current Data Release.
+
+    Orbits are taken from the orbit fit cache when the file has been fit before, the others are fit using
+    processes worker processes (default: one per CPU).
     """
     retval = []
     # working_context = context.get_context(directory)
@@ -104,15 +112,20 @@ def ossos_discoveries(directory=parameters.REAL_KBO_AST_DIR,
         objects = data_release['object']
         files = [name for name in files if name.partition(suffix)[0].rstrip('.') in objects]
 
+    mpc_filenames = []
+    abg_filenames = []
     for filename in files:
         # keep out the not-tracked and uncharacteried.
         if no_nt_and_u and (filename.__contains__('nt') or filename.startswith('u')):
             continue
         # observations = mpc.MPCReader(directory + filename)
-        mpc_filename = directory + filename
-        abg_filename = os.path.abspath(directory + '/../abg/') + "/" + os.path.splitext(filename)[0] + ".abg"
-        obj = TNO(None, ast_filename=mpc_filename, abg_filename=abg_filename)
-        retval.append(obj)
+        mpc_filenames.append(directory + filename)
+        abg_filenames.append(os.path.abspath(directory + '/../abg/') + "/" + os.path.splitext(filename)[0] + ".abg")
+
+    processes = processes is None and multiprocessing.cpu_count() or processes
+    orbits = orbfit.fit_many(mpc_filenames, abg_filenames, processes=processes)
+    for mpc_filename, abg_filename, orbit in zip(mpc_filenames, abg_filenames, orbits):
+        retval.append(TNO(None, ast_filename=mpc_filename, abg_filename=abg_filename, orbit=orbit))
 
     return retval
 
@@ -100,19 +100,13 @@ def align(expnums, ccd, version='s', prefix='', dry_run=False, force=True):
                 filename = storage.get_image(expnum, ccd=ccd, version=version)
                 zmag[expnum] = storage.get_zeropoint(expnum, ccd, prefix=None, version=version)
                 mjdates[expnum] = float(fits.open(filename)[0].header.get('MJD-OBS'))
-                apcor[expnum] = [float(x) for x in open(storage.get_file(expnum,
-                                                                         ccd=ccd,
-                                                                         version=version,
-                                                                         ext=storage.APCOR_EXT)).read().split()]
+                apcor[expnum] = storage.get_apcor(expnum, ccd, version=version)
                 keys = ['crval1', 'cd1_1', 'cd1_2', 'crval2', 'cd2_1', 'cd2_2']
                 # load the .trans.jmp values into a 'wcs' like dictionary.
                 # .trans.jmp maps current frame to reference frame in pixel coordinates.
                 # the reference frame of all the frames supplied must be the same.
-                shifts = dict(list(zip(keys, [float(x) for x in
-                                              open(storage.get_file(expnum,
-                                                                    ccd=ccd,
-                                                                    version=version,
-                                                                    ext='trans.jmp')).read().split()])))
+                trans = storage.get_trans(expnum, ccd, version=version)
+                shifts = dict(list(zip(keys, [trans[key] for key in ['dx', 'cd11', 'cd12', 'dy', 'cd21', 'cd22']])))
                 shifts['crpix1'] = 0.0
                 shifts['crpix2'] = 0.0
                 # now create a wcs object based on those transforms, this wcs links the current frame's
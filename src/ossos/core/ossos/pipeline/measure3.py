@@ -1,11 +1,19 @@
 #!/usr/bin/env python
-# use the xy2skypv code to generate the astrometric values
-# that measure3 would normally produce.
+# use the in-process PV WCS (the xy2skypv algorithm) to generate the
+# astrometric values that measure3 would normally produce.
 import os
 import argparse
 import logging
 from pathlib import Path
+
+import numpy
+from astropy import units
+from astropy.io import fits
+from astropy.units import Quantity
+
+from ossos import astrom
 from ossos import storage
+from ossos import wcs
 
 
 SUCCESS_FILE = "measure3.OK"
@@ -16,7 +24,7 @@ CANDS_ASTROM_EXT = 'measure3.cands.astrom'
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Run xy2skypv on cands.comb files to produce cands.astrom")
+        description="Compute RA/DEC of cands.comb sources to produce cands.astrom")
     parser.add_argument('base_image',
                         help="The base image referencing the .cands.comb file")
     parser.add_argument('--dbimages',
@@ -29,9 +37,54 @@ def main():
     run(base_image, dbimages=storage.DBIMAGES)
 
 
+def read_cands(cands_filename):
+    """
+    Parse a cands.comb file in a single pass.
+
+    @param cands_filename: name of the cands.comb file written by step3.
+    @return: observations, sys_header, xy0 where xy0 is an array of shape (nsources, nframes, 4) holding X Y X_0 Y_0
+    """
+    with open(cands_filename) as cands_file:
+        filestr = cands_file.read()
+
+    parser = astrom.AstromParser()
+    observations = parser._parse_observation_list(filestr)
+    if len(observations) == 0:
+        raise ValueError("No exposures listed in {}".format(cands_filename))
+    # the cands.comb carries the observation headers, use those rather than fetching the mopheaders.
+    headers = [match.groupdict() for match in parser.obs_header_regex.finditer(filestr)]
+    if len(headers) != len(observations):
+        raise ValueError("{} lists {} exposures but has {} observation headers".format(cands_filename,
+                                                                                      len(observations),
+                                                                                      len(headers)))
+    for observation, header in zip(observations, headers):
+        header[astrom.MOPVERSION] = header['MOPversion']
+        observation.header = header
+    sys_header = parser._parse_system_header(filestr)
+
+    # comment and blank lines are skipped, the remaining lines cycle through the frames for each source.
+    xy0 = numpy.loadtxt(filestr.splitlines(), usecols=(0, 1, 2, 3), ndmin=2)
+    if len(xy0) % len(observations) != 0:
+        raise ValueError("{} has {} source lines, not a multiple of {} frames".format(cands_filename,
+                                                                                     len(xy0),
+                                                                                     len(observations)))
+    return observations, sys_header, xy0.reshape(-1, len(observations), 4)
+
+
+def frame_header(filename):
+    """
+    Get the header that holds the WCS of an image, the first extension with data.
+    """
+    with fits.open(filename) as hdulist:
+        for hdu in hdulist:
+            if hdu.header.get('NAXIS', 0) > 0:
+                return hdu.header
+        return hdulist[0].header
+
+
 def run(base_image, dbimages=None):
     """
-    execute sky2xypv on sources found in cands.comb file.
+    compute the RA/DEC of sources found in cands.comb file using the WCS of the frame they were measured on.
     """
 
     if dbimages is not None:
@@ -41,80 +94,25 @@ def run(base_image, dbimages=None):
 
     cands_filename = "%s.%s" % (base_image, CANDS_COMB_EXT)
     if not os.access(cands_filename, os.R_OK):
-        FileNotFoundError("Failed to open input candidate file %s\n" % cands_filename)
+        raise FileNotFoundError("Failed to open input candidate file %s\n" % cands_filename)
+
+    observations, sys_header, xy0 = read_cands(cands_filename)
 
-    astrom_header = """##   X        Y        X_0     Y_0          R.A.          DEC                   \n"""
+    # Now run the astrometry for each object on the frame that object was detected on
+    radec = numpy.zeros(xy0.shape[:2] + (2,))
+    for idx, observation in enumerate(observations):
+        logging.info("Computing RA/DEC on {}".format(observation.rawname))
+        header = frame_header(storage.get_frame(observation.rawname))
+        ra, dec = wcs.WCS(header).xy2sky(xy0[:, idx, 0], xy0[:, idx, 1])
+        radec[:, idx, 0] = Quantity(ra, units.degree).value
+        radec[:, idx, 1] = Quantity(dec, units.degree).value
 
     astrom_filename = "%s.%s" % (base_image, CANDS_ASTROM_EXT)
-    coords = []
-    base_names = []
-    line_counter = 0
-    xy_files = {}
-    xy_lines = {}
-    get_image_names = True
-    started = False
-    with open(astrom_filename, 'w') as astrom_file:
-        cands_lines = open(cands_filename).readlines()
-        for cands_line in cands_lines:
-            # read the names of the exposures to work from...
-            if len(cands_line.strip()) == 0:
-                # Skip EMPTY lines...
-                continue
-            if cands_line.lstrip()[0] == '#':
-                # write out all the header lines except the one with column
-                # names as its different for the astrom version 'X_0' is a
-                # column name in the cands.comb files.
-                if "X_0" not in cands_line:
-                    astrom_file.write(cands_line)
-                else:
-                    astrom_file.write(astrom_header)
-                if cands_line.lstrip()[1] == '#':
-                    get_image_names = not started
-                    continue
-                logging.info("Read this line: {}".format(cands_line[2:].strip()))
-                if get_image_names and cands_line.lstrip()[1] == ' ':
-                    base_name = cands_line[2:].strip()
-                    base_names.append(base_name)
-                    xy_files[base_name] = open("%s.xy" % base_name, 'w')
-                    started = True
-                    continue
-                continue
-            v = cands_line.strip().split()
-            coords.append(v)
-            base_name = base_names[line_counter % len(base_names)]
-            if base_name not in xy_lines:
-                xy_lines[base_name] = []
-            xy_lines[base_name].append(cands_line)
-            xy_files[base_name].write("%s %s\n" % (v[0], v[1]))
-            xy_files[base_name].flush()
-            line_counter += 1
-
-        # Now run the astrometry for each object on the frame that
-        # object was detected on
-
-        astrometry_lines = {}
-        for base_name in xy_files:
-            storage.get_frame(base_name)
-            xy_files[base_name].close()
-            cmd = 'xy2skypv %s.fits %s.xy %s.rd' % (base_name,
-                                                    base_name, base_name)
-            os.system(cmd)
-            astrometry_lines[base_name] = open("%s.rd" % base_name).readlines()
-
-        for idx in range(len(astrometry_lines[base_names[0]])):
-            astrom_file.write("\n")
-            for base_name in base_names:
-                rd = astrometry_lines[base_name][idx].split()
-                xy = xy_lines[base_name][idx].split()
-                if rd[2] != xy[0] or rd[3] != xy[1]:
-                    # the files are misalligned?
-                    raise ValueError("MISMATCH in astrometric code... bailing out.\n")
-                astrom_file.write(" %8.2f %8.2f %8.2f %8.2f %12.7f %12.7f\n" % (float(xy[0]),
-                                                                                float(xy[1]),
-                                                                                float(xy[2]),
-                                                                                float(xy[3]),
-                                                                                float(rd[0]),
-                                                                                float(rd[1])))
+    with open(astrom_filename, 'w+') as astrom_file:
+        writer = astrom.StreamingAstromWriter(astrom_file, sys_header)
+        writer.write_headers(observations, sys_header)
+        for rows in numpy.concatenate((xy0, radec), axis=2):
+            writer.write_rows(rows)
 
     Path(f'{SUCCESS_FILE}').touch()
     os.unlink(f'{base_image}.{FAILED_EXT}')
@@ -31,6 +31,7 @@ import sys
 from .. import storage
 from .. import util
 from .. import mopheader
+from . import runner
 
 task = "mk_mopheader"
 dependency = 'update_header'
@@ -133,6 +134,7 @@ def main():
                         action="store_true")
     parser.add_argument("--debug", "-d",
                         action="store_true")
+    runner.add_arguments(parser)
 
     args = parser.parse_args()
 
@@ -148,11 +150,17 @@ def main():
     else:
         ccdlist = [args.ccd]
 
-    exit_code = 0
+    jobs = []
     for expnum in args.expnum:
         for ccd in ccdlist:
-            run(expnum, ccd, args.type, args.dry_run, prefix=prefix, force=args.force, ignore_dependency=args.ignore_update_headers)
+            jobs.append(runner.Job(expnum, ccd, dict(version=args.type, dry_run=args.dry_run, prefix=prefix,
+                                                     force=args.force,
+                                                     ignore_dependency=args.ignore_update_headers)))
+    check = not args.dry_run and runner.StatusCheck(task, prefix, args.type) or None
+    report = runner.run(run, jobs, processes=args.processes, max_transfers=args.max_transfers,
+                        retries=args.retries, check=check, workdir=args.workdir)
+    return report.failed and 1 or 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
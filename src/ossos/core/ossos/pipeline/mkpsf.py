@@ -26,8 +26,12 @@ import argparse
 import os
 import sys
 import logging
+
+from astropy.io import fits
+
 from ossos import storage
 from ossos import util
+from ossos.pipeline import runner
 
 task = 'mkpsf'
 dependency = 'mk_mopheader'
@@ -56,7 +60,8 @@ def run(expnum, ccd, version, dry_run=False, prefix="", force=False):
 
             # get image from the vospace storage area
             logging.info("Getting fits image from VOSpace")
-            filename = storage.get_image(expnum, ccd, version=version, prefix=prefix)
+            # the IRAF tasks run by jmpmakepsf may write to the image header.
+            filename = storage.get_image(expnum, ccd, version=version, prefix=prefix, writable=True)
 
             # get mopheader from the vospace storage area
             logging.info("Getting mopheader from VOSpace")
@@ -79,17 +84,7 @@ def run(expnum, ccd, version, dry_run=False, prefix="", force=False):
                         'zeropoint.used', 'apcor', 'fwhm', 'phot'):
                 dest = storage.dbimages_uri(expnum, ccd, prefix=prefix, version=version, ext=ext)
                 source = basename + "." + str(ext)
-                count = 0
-                with open(source, 'r'):
-                  while True:
-                    count += 1
-                    try:
-                        logging.info("Attempt {} to copy {} -> {}".format(count, source, dest))
-                        storage.copy(source, dest)
-                        break
-                    except Exception as ex:
-                        if count > 10:
-                            raise ex
+                storage.copy(source, dest)
 
             # set some data parameters associated with the image, determined in this step.
             storage.set_status('fwhm', prefix, expnum, version=version, ccd=ccd, status=str(storage.get_fwhm(
@@ -97,6 +92,15 @@ def run(expnum, ccd, version, dry_run=False, prefix="", force=False):
             storage.set_status('zeropoint', prefix, expnum, version=version, ccd=ccd,
                                status=str(storage.get_zeropoint(
                                    expnum, ccd=ccd, prefix=prefix, version=version)))
+            # and mark the values in the exposure's calibration manifest out of date until main rebuilds it.
+            with open(basename + "." + storage.APCOR_EXT) as apcor_file:
+                apcor = [float(x) for x in apcor_file.read().split()]
+            storage.record_calibration(expnum, ccd, version=version, prefix=prefix,
+                                       fwhm=storage.get_fwhm(expnum, ccd=ccd, prefix=prefix, version=version),
+                                       zeropoint=storage.get_zeropoint(expnum, ccd=ccd, prefix=prefix,
+                                                                       version=version),
+                                       apcor=apcor,
+                                       astlevel=int(fits.getheader(filename).get('ASTLEVEL', 0)))
             logging.info(message)
         except Exception as e:
             message = str(e)
@@ -141,6 +145,10 @@ def main():
                         action="store_true")
     parser.add_argument("--debug", "-d",
                         action="store_true")
+    parser.add_argument("--build-manifest",
+                        action="store_true",
+                        help="only write the calibration manifest of the exposures, run once all their CCDs are done")
+    runner.add_arguments(parser)
 
     cmd_line = " ".join(sys.argv)
     args = parser.parse_args()
@@ -152,20 +160,25 @@ def main():
 
     storage.DBIMAGES = args.dbimages
 
-    exit_code = 0
+    if args.build_manifest:
+        return runner.build_manifests(args.expnum, args.type, prefix, args.dry_run)
+
+    jobs = []
     for expnum in args.expnum:
         if args.ccd is None:
-           if int(expnum) < 1785619:
-               # Last exposures with 36 CCD Megaprime
-               ccdlist = list(range(0,36))
-           else:
-               # First exposrues with 40 CCD Megaprime
-               ccdlist = list(range(0, 40))
+           ccdlist = storage.get_ccdlist(expnum)
         else:
            ccdlist = [args.ccd]
         for ccd in ccdlist:
-            run(expnum, ccd, args.type, args.dry_run, prefix, args.force)
-    return exit_code
+            jobs.append(runner.Job(expnum, ccd, dict(version=args.type, dry_run=args.dry_run,
+                                                     prefix=prefix, force=args.force)))
+    check = not args.dry_run and runner.StatusCheck(task, prefix, args.type) or None
+    report = runner.run(run, jobs, processes=args.processes, max_transfers=args.max_transfers,
+                        retries=args.retries, check=check, workdir=args.workdir)
+    if args.ccd is None and not args.dry_run and not report.failed:
+        # every CCD of the exposures is done, this is the one writer of their manifests.
+        runner.build_manifests(args.expnum, args.type, prefix)
+    return report.failed and 1 or 0
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -27,24 +27,24 @@ import argparse
 import errno
 import json
 import logging
-import math
 import os
 import sys
 import tempfile
 
+import numpy
 from astropy import wcs
 from astropy.io import fits
 from numpy import radians, fabs, log10, rint, cos, sin, transpose
 
 from ossos import storage
 from ossos import util
-from ossos.plant import KBOGenerator
+from ossos.plant import KBOGenerator, DaophotPSF, add_stars
 
 task = 'plant'
 dependency = 'mkpsf'
 
 
-def plant_kbos(filename, psf, kbos, shifts, prefix):
+def plant_kbos(filename, psf, kbos, shifts, prefix, backend='python'):
     """
     Add KBOs to an image
     :param filename: name of the image to add KBOs to
@@ -52,16 +52,9 @@ def plant_kbos(filename, psf, kbos, shifts, prefix):
     :param kbos: list of KBOs to add, has format as returned by KBOGenerator
     :param shifts: dictionary to transform coordinates to reference frame.
     :param prefix: an estimate FWHM of the image, used to determine trailing.
+    :param backend: 'python' to render the PSFs in process, 'iraf' to use daophot.addstar and chpix.
     :return: None
     """
-    from pyraf import iraf
-
-    iraf.set(uparm="./")
-    iraf.digiphot()
-    iraf.apphot()
-    iraf.daophot(_doprint=0)
-    iraf.images()
-
     if shifts['nmag'] < 4:
         logging.warning("Mag shift based on fewer than 4 common stars.")
         fd = open("plant.WARNING", 'a')
@@ -74,8 +67,6 @@ def plant_kbos(filename, psf, kbos, shifts, prefix):
         fd.write("Mag shift hsa large uncertainty.")
         fd.close()
 
-    addstar = tempfile.NamedTemporaryFile(suffix=".add", mode='w')
-
     # transform KBO locations to this frame using the shifts provided.
     w = get_wcs(shifts)
 
@@ -83,12 +74,12 @@ def plant_kbos(filename, psf, kbos, shifts, prefix):
 
     # set the rate of motion in units of pixels/hour instead of ''/hour
     scale = header['PIXSCAL1']
-    rate = kbos['sky_rate']/scale
+    rate = numpy.array(kbos['sky_rate'])/scale
 
     # compute the location of the KBOs in the current frame.
 
     # offset magnitudes from the reference frame to the current one.
-    mag = kbos['mag'] - shifts['dmag']
+    mag = numpy.array(kbos['mag']) - shifts['dmag']
     angle = radians(kbos['angle'])
 
     # Move the x/y locations to account for the sky motion of the source.
@@ -99,27 +90,17 @@ def plant_kbos(filename, psf, kbos, shifts, prefix):
     # Each source will be added as a series of PSFs so that a new PSF is
     # added for each pixel the source moves.
     itime = float(header['EXPTIME'])/3600.0
-    npsf = fabs(rint(rate * itime)) + 1
+    npsf = (fabs(rint(rate * itime)) + 1).astype(int)
     mag += 2.5*log10(npsf)
     dt_per_psf = itime/npsf
 
-    # Build an addstar file to be used in the planting of source.
-    idx = 0
-    for record in transpose([x, y, mag, npsf, dt_per_psf, rate, angle]):
-        x = record[0]
-        y = record[1]
-        mag = record[2]
-        npsf = record[3]
-        dt = record[4]
-        rate = record[5]
-        angle = record[6]
-        for i in range(int(npsf)):
-            idx += 1
-            x += dt*rate*math.cos(angle)
-            y += dt*rate*math.sin(angle)
-            addstar.write("{} {} {} {}\n".format(x, y, mag, idx))
+    # the position of every PSF along each trail, PSF i of a source is offset by i steps of its motion.
+    source = numpy.repeat(numpy.arange(len(npsf)), npsf)
+    step = numpy.arange(len(source)) - numpy.repeat(numpy.cumsum(npsf) - npsf, npsf) + 1
+    x = x[source] + step*dt_per_psf[source]*rate[source]*cos(angle[source])
+    y = y[source] + step*dt_per_psf[source]*rate[source]*sin(angle[source])
+    mag = mag[source]
 
-    addstar.flush()
     fk_image = prefix+filename
     try:
         os.unlink(fk_image)
@@ -129,6 +110,43 @@ def plant_kbos(filename, psf, kbos, shifts, prefix):
         else:
             raise
 
+    if backend != 'iraf':
+        try:
+            psf_model = DaophotPSF.from_file(psf)
+        except ValueError as ex:
+            logging.warning("{}, planting with IRAF addstar instead.".format(ex))
+            backend = 'iraf'
+    if backend == 'iraf':
+        _addstar_iraf(filename, psf, fk_image, x, y, mag)
+        return
+
+    with fits.open(filename) as hdulist:
+        data = hdulist[0].data.astype(numpy.float64)
+        header = hdulist[0].header
+        add_stars(data, psf_model, x, y, mag)
+        # convert the image to short integers, as chpix to 'ushort' would.
+        data = numpy.clip(rint(data), 0, 65535).astype(numpy.uint16)
+        fits.PrimaryHDU(data=data, header=header).writeto(fk_image)
+
+
+def _addstar_iraf(filename, psf, fk_image, x, y, mag):
+    """
+    Add PSFs at x/y/mag to filename with IRAF daophot.addstar writing fk_image.
+    """
+    from pyraf import iraf
+
+    iraf.set(uparm="./")
+    iraf.digiphot()
+    iraf.apphot()
+    iraf.daophot(_doprint=0)
+    iraf.images()
+
+    # Build an addstar file to be used in the planting of source.
+    addstar = tempfile.NamedTemporaryFile(suffix=".add", mode='w')
+    for idx, record in enumerate(transpose([x, y, mag])):
+        addstar.write("{} {} {} {}\n".format(record[0], record[1], record[2], idx + 1))
+    addstar.flush()
+
     # add the sources to the image.
     if os.access(f'{fk_image}.art', os.R_OK):
         os.unlink(f'{fk_image}.art')
@@ -156,7 +174,7 @@ def get_wcs(shifts):
 
 
 def plant(expnums, ccd, rmin, rmax, ang, width, number=10,
-          mmin=21.0, mmax=25.5, version='s', dry_run=False, force=True):
+          mmin=21.0, mmax=25.5, version='s', dry_run=False, force=True, backend='python'):
     """Plant artificial sources into the list of images provided.
 
     @param dry_run: don't push results to VOSpace.
@@ -171,6 +189,7 @@ def plant(expnums, ccd, rmin, rmax, ang, width, number=10,
     @param mmin: Minimum magnitude to plant sources at
     @param number: number of sources to plant.
     @param force: Run, even if we already succeeded at making a fk image.
+    @param backend: 'python' or 'iraf', how the PSFs are added to the images.
     """
     message = storage.SUCCESS
 
@@ -203,7 +222,7 @@ def plant(expnums, ccd, rmin, rmax, ang, width, number=10,
                 filename = storage.get_image(expnum, ccd, version)
                 psf = storage.get_file(expnum, ccd, version, ext='psf.fits')
                 plant_kbos(filename, psf, kbos,
-                           get_shifts(expnum, ccd, version), "fk")
+                           get_shifts(expnum, ccd, version), "fk", backend=backend)
 
             if dry_run:
                 return
@@ -279,6 +298,8 @@ def main():
                         type=float, help="angle of motion, 0 is West")
     parser.add_argument("--force", action="store_true")
     parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--backend", default="python", choices=['python', 'iraf'],
+                        help="render the PSFs in process or with IRAF's daophot.addstar")
 
     cmd_line = " ".join(sys.argv)
     args = parser.parse_args()
@@ -309,7 +330,7 @@ def main():
               args.rmin, args.rmax, args.ang, args.width,
               number=args.number, mmin=args.mmin, mmax=args.mmax,
               version=version,
-              dry_run=args.dry_run, force=args.force )
+              dry_run=args.dry_run, force=args.force, backend=args.backend)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+"""
+Run a pipeline step's run(expnum, ccd, ...) function over many CCDs in a pool of worker processes.
+
+The CCDs of an exposure are independent so each (expnum, ccd) job can run in its own process.  The pipeline
+steps write fixed filenames (weight.fits, the image, .mopheader, etc.) into the current directory, so every
+job is run inside its own scratch directory.  Calls to VOSpace are limited by a semaphore shared between the
+workers (see ossos.transport) so a large pool does not flood the service.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from collections import namedtuple
+
+import vos
+
+from ossos import storage
+from ossos import transport
+
+Job = namedtuple('Job', ['expnum', 'ccd', 'kwargs'])
+"""A unit of work: func(expnum, ccd, **kwargs), expnum can also be a list of exposures (eg. step2/step3)."""
+
+JobResult = namedtuple('JobResult', ['expnum', 'ccd', 'success', 'attempts', 'elapsed', 'message'])
+
+
+def add_arguments(parser):
+    """
+    Add the command line options that control the parallel driver to an argparse parser.
+    """
+    parser.add_argument("--processes", "-j",
+                        type=int,
+                        default=1,
+                        help="number of CCDs to process in parallel, 0 for one per core")
+    parser.add_argument("--max-transfers",
+                        type=int,
+                        default=8,
+                        help="maximum number of simultaneous VOSpace calls across all processes")
+    parser.add_argument("--retries",
+                        type=int,
+                        default=0,
+                        help="number of times to retry a CCD that failed")
+    parser.add_argument("--workdir",
+                        default=None,
+                        help="directory in which per-CCD scratch directories are made, default is current directory")
+
+
+class StatusCheck(object):
+    """
+    Decide if a job succeeded by looking at the VOSpace status tag the step records.
+    """
+
+    def __init__(self, task, prefix, version):
+        self.task = task
+        self.prefix = prefix is None and "" or prefix
+        self.version = version
+
+    def __call__(self, job):
+        expnum = isinstance(job.expnum, (list, tuple)) and job.expnum[0] or job.expnum
+        # the status was written by this worker, don't trust a previously fetched copy.
+        storage.tag_store.invalidate(expnum)
+        return storage.get_status(self.task, self.prefix, expnum, self.version, job.ccd)
+
+
+class RunReport(object):
+    """
+    Aggregated outcome of running a set of jobs.
+    """
+
+    def __init__(self, results, elapsed):
+        self.results = sorted(results, key=lambda result: (str(result.expnum), result.ccd))
+        self.elapsed = elapsed
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.success]
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.success]
+
+    def __str__(self):
+        lines = ["{} jobs: {} succeeded, {} failed in {:.1f}s".format(len(self.results),
+                                                                     len(self.succeeded),
+                                                                     len(self.failed),
+                                                                     self.elapsed)]
+        for result in self.failed:
+            lines.append("FAILED: {} ccd {:02d} after {} attempt(s): {}".format(result.expnum,
+                                                                               int(result.ccd),
+                                                                               result.attempts,
+                                                                               result.message))
+        return "\n".join(lines)
+
+
+def _init_worker(semaphore, dbimages):
+    # each worker gets its own connection to VOSpace rather than sharing the parent's sessions.
+    storage.transport = transport.transport_from_config(semaphore=semaphore)
+    storage.client = transport.ResilientClient(vos.Client(), storage.transport)
+    storage.DBIMAGES = dbimages
+    storage.tag_store.invalidate()
+
+
+def _run_job(func, job, retries, check, workdir=None, isolate=True):
+    """
+    Run one job, retrying if it raises or the check says it failed.
+
+    @param isolate: run the job inside its own scratch directory (made in workdir), removed afterwards.
+    """
+    start = time.time()
+    cwd = os.getcwd()
+    attempts = 0
+    message = None
+    success = False
+    while attempts <= retries and not success:
+        attempts += 1
+        scratch = None
+        try:
+            if isolate:
+                # steps that work on a set of exposures (step2, step3) have a list of expnums.
+                expnum = isinstance(job.expnum, (list, tuple)) and job.expnum[0] or job.expnum
+                scratch = tempfile.mkdtemp(prefix="{}_{:02d}_".format(expnum, int(job.ccd)),
+                                           dir=workdir is not None and workdir or cwd)
+                os.chdir(scratch)
+            message = func(job.expnum, job.ccd, **job.kwargs)
+            success = check is None or check(job)
+        except Exception as ex:
+            logging.error("{} ccd {} attempt {}: {}".format(job.expnum, job.ccd, attempts, ex))
+            message = str(ex)
+            success = False
+        finally:
+            if scratch is not None:
+                os.chdir(cwd)
+                shutil.rmtree(scratch, ignore_errors=True)
+        if not success and attempts <= retries:
+            time.sleep(min(2 ** attempts, 60))
+    return JobResult(job.expnum, job.ccd, success, attempts, time.time() - start, message)
+
+
+def run(func, jobs, processes=1, max_transfers=8, retries=0, check=None, workdir=None):
+    """
+    Run func(expnum, ccd, **kwargs) for each Job in jobs.
+
+    With processes == 1 the jobs run one after another in the current process and directory, exactly as
+    the pipeline scripts did before; otherwise each job runs in a worker process in its own scratch directory.
+
+    @param func: the step's run function.
+    @param jobs: list of Job
+    @param processes: size of the worker pool, 0 means one per core.
+    @param max_transfers: maximum number of simultaneous VOSpace calls across all the workers.
+    @param retries: number of times to re-run a job that raised or failed check.
+    @param check: callable(job) -> bool that determines if the job succeeded, eg. StatusCheck.
+    @param workdir: where to make the per-job scratch directories.
+    @return: RunReport
+    """
+    start = time.time()
+    processes = processes == 0 and multiprocessing.cpu_count() or processes
+    results = []
+    if processes == 1:
+        results = [_run_job(func, job, retries, check, isolate=False) for job in jobs]
+    else:
+        semaphore = multiprocessing.BoundedSemaphore(max(max_transfers, 1))
+        pool = multiprocessing.Pool(processes=min(processes, max(len(jobs), 1)),
+                                    initializer=_init_worker,
+                                    initargs=(semaphore, storage.DBIMAGES))
+        try:
+            pending = [pool.apply_async(_run_job, (func, job, retries, check, workdir)) for job in jobs]
+            for job, async_result in zip(jobs, pending):
+                try:
+                    results.append(async_result.get())
+                except Exception as ex:
+                    results.append(JobResult(job.expnum, job.ccd, False, 0, 0.0, str(ex)))
+        finally:
+            pool.close()
+            pool.join()
+    report = RunReport(results, time.time() - start)
+    logging.info(str(report))
+    return report
+
+
+def build_manifests(expnums, version, prefix, dry_run=False):
+    """
+    Write the calibration manifest of each exposure, once all of its CCDs have been processed.
+
+    The manifest covers every CCD of an exposure so it is built by a single writer: the run over all the CCDs,
+    or a separate --build-manifest run after the per-CCD jobs of a cluster submission, never a per-CCD job.
+
+    @return: exit status, 0 if every manifest was written.
+    """
+    failed = [expnum for expnum in expnums
+              if not storage.build_calibration_manifest(expnum, version=version, prefix=prefix, dry_run=dry_run)]
+    return failed and 1 or 0
@@ -38,7 +38,7 @@ dependency = "update_header"
 task = 'scramble'
 
 
-def scramble(expnums, ccd, version='p', dry_run=False, force=False, prefix=''):
+def scramble(expnums, ccd, version='p', dry_run=False, force=False, prefix='', virtual=False):
     """
     run the plant script on this combination of exposures
 
@@ -48,6 +48,9 @@ def scramble(expnums, ccd, version='p', dry_run=False, force=False, prefix=''):
     @param dry_run: if dry run then don't save back to VOSpace.
     @param force: if true then create scramble set, even if already exists.
     @param prefix: a string that will be pre-pended to the EXPNUM to get the filename, sometimes 'fk'.
+    @param virtual: record the scrambled images as header overrides of the originals (see
+    storage.make_virtual_image) rather than writing full copies, only for consumers that read images through
+    ossos.storage.
     @return: None
     """
 
@@ -62,8 +65,13 @@ def scramble(expnums, ccd, version='p', dry_run=False, force=False, prefix=''):
                 logging.info("{} recorded as complete for {} ccd {}".format(task, expnums, ccd))
                 return
             for expnum in expnums:
-                filename = storage.get_image(expnum, ccd=ccd, version=version)
-                fobjs.append(fits.open(filename))
+                if virtual:
+                    # only the header is needed.
+                    header = storage.get_header(storage.get_uri(expnum, ccd=ccd, version=version, ext='fits'))
+                    fobjs.append(fits.HDUList([fits.PrimaryHDU(header=header)]))
+                else:
+                    filename = storage.get_image(expnum, ccd=ccd, version=version)
+                    fobjs.append(fits.open(filename))
                 # Pull out values to replace in headers.. must pull them
                 # as otherwise we get pointers...
                 mjds.append(fobjs[-1][0].header['MJD-OBS'])
@@ -72,6 +80,11 @@ def scramble(expnums, ccd, version='p', dry_run=False, force=False, prefix=''):
             for idx in range(len(fobjs)):
                 logging.info("Flipping %d to %d" % (fobjs[idx][0].header['EXPNUM'],
                                                     expnums[order[idx]]))
+                if virtual:
+                    storage.make_virtual_image(expnums[order[idx]], ccd, expnums[idx],
+                                               {'EXPNUM': expnums[order[idx]], 'MJD-OBS': mjds[order[idx]]},
+                                               version='s', source_version=version, dry_run=dry_run)
+                    continue
                 fobjs[idx][0].header['EXPNUM'] = expnums[order[idx]]
                 fobjs[idx][0].header['MJD-OBS'] = mjds[order[idx]]
                 uri = storage.get_uri(expnums[order[idx]],
@@ -127,6 +140,9 @@ def main():
                         action='store_true')
     parser.add_argument("--dry-run", action="store_true", help="Do not copy back to VOSpace, implies --force")
     parser.add_argument("--force", action='store_true')
+    parser.add_argument("--virtual", action='store_true',
+                        help="record the scrambled images as header overrides of the originals rather than full "
+                             "copies, these can only be read through ossos.storage (not vcp)")
 
     cmd_line = " ".join(sys.argv)
     args = parser.parse_args()
@@ -152,7 +168,8 @@ def main():
         ccdlist = [args.ccd]
     for ccd in ccdlist:
         # check if scramble image alraedy made for this ccd
-        scramble(expnums=expnums, ccd=ccd, version=version, dry_run=args.dry_run, prefix=prefix, force=args.force)
+        scramble(expnums=expnums, ccd=ccd, version=version, dry_run=args.dry_run, prefix=prefix, force=args.force,
+                 virtual=args.virtual)
 
 
 if __name__ == '__main__':
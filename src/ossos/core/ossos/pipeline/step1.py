@@ -32,6 +32,7 @@ import logging
 import os
 from ossos import storage
 from ossos import util
+from ossos.pipeline import runner
 import sys
 
 _SEX_THRESHOLD = 1.1
@@ -127,17 +128,7 @@ def run(expnum,
                     obj_uri = storage.get_uri(expnum, ccd, version=version, ext=ext,
                                               prefix=prefix)
                     obj_filename = basename + "." + ext
-                    count = 0
-                    with open(obj_filename, 'r'):
-                        while True:
-                            try:
-                                count += 1
-                                logging.info("Attempt {} to copy {} -> {}".format(count, obj_filename, obj_uri))
-                                storage.copy(obj_filename, obj_uri)
-                                break
-                            except Exception as ex:
-                                if count > 10:
-                                    raise ex
+                    storage.copy(obj_filename, obj_uri)
             logging.info(message)
         except Exception as ex:
             message = str(ex)
@@ -193,6 +184,7 @@ def main():
                         action='store_true')
     parser.add_argument("--force", action="store_true")
     parser.add_argument("--dry-run", action="store_true", help="Do a dry run, not changes to vospce, implies --force")
+    runner.add_arguments(parser)
 
     cmd_line = " ".join(sys.argv)
     args = parser.parse_args()
@@ -205,26 +197,24 @@ def main():
     prefix = (args.fk and 'fk') or ''
     version = args.type
 
+    jobs = []
     for expnum in args.expnum:
         if args.ccd is None:
-            if int(expnum) < 1785619:
-                # Last exposures with 36 CCD Megaprime
-                ccdlist = list(range(0, 36))
-            else:
-                # First exposrues with 40 CCD Megaprime
-                ccdlist = list(range(0, 40))
+            ccdlist = storage.get_ccdlist(expnum)
         else:
             ccdlist = [args.ccd]
         for ccd in ccdlist:
-            run(expnum,
-                ccd,
-                prefix=prefix,
-                version=version,
-                sex_thresh=args.sex_thresh,
-                wave_thresh=args.wavelet_thresh,
-                dry_run=args.dry_run,
-                force=args.force,
-                ignore=args.ignore)
+            jobs.append(runner.Job(expnum, ccd, dict(prefix=prefix,
+                                                     version=version,
+                                                     sex_thresh=args.sex_thresh,
+                                                     wave_thresh=args.wavelet_thresh,
+                                                     dry_run=args.dry_run,
+                                                     force=args.force,
+                                                     ignore=args.ignore)))
+    check = not args.dry_run and runner.StatusCheck(task, prefix, version) or None
+    report = runner.run(run, jobs, processes=args.processes, max_transfers=args.max_transfers,
+                        retries=args.retries, check=check, workdir=args.workdir)
+    return report.failed and 1 or 0
 
 
 if __name__ == '__main__':
@@ -29,6 +29,7 @@ import os
 from astropy.io import fits
 from ossos import storage
 from ossos import util
+from ossos.pipeline import runner
 from ossos import wcs
 import sys
 
@@ -175,6 +176,11 @@ def run(expnums, ccd, version, prefix=None, dry_run=False, default="WCS", force=
                     uri = storage.dbimages_uri(expnum, ccd=ccd, version=version, ext=ext, prefix=prefix)
                     filename = os.path.basename(uri)
                     storage.copy(filename, uri)
+                filename = os.path.basename(storage.dbimages_uri(expnum, ccd=ccd, version=version, ext='trans.jmp',
+                                                                 prefix=prefix))
+                with open(filename) as trans:
+                    storage.record_calibration(expnum, ccd, version=version, prefix=prefix,
+                                               trans=storage.parse_trans(trans.read()))
 
         except Exception as ex:
             message = str(ex)
@@ -224,6 +230,10 @@ def main():
                         action="store_true")
     parser.add_argument("--dry-run", action="store_true", help="run without pushing back to VOSpace, implies --force")
     parser.add_argument("--force", action="store_true")
+    parser.add_argument("--build-manifest",
+                        action="store_true",
+                        help="only write the calibration manifest of the exposures, run once all their CCDs are done")
+    runner.add_arguments(parser)
 
     cmd_line = " ".join(sys.argv)
     args = parser.parse_args()
@@ -235,22 +245,27 @@ def main():
     expnums = args.expnums
     version = args.type
 
+    if args.build_manifest:
+        return runner.build_manifests(expnums, version, prefix, args.dry_run)
+
     if args.ccd is None:
-        expnum = min(expnums)
-        if int(expnum) < 1785619:
-            # Last exposures with 36 CCD Megaprime
-            ccdlist = list(range(0, 36))
-        else:
-            # First exposrues with 40 CCD Megaprime
-            ccdlist = list(range(0, 40))
+        ccdlist = storage.get_ccdlist(min(expnums))
     else:
         ccdlist = [args.ccd]
 
     if not args.no_sort:
         args.expnums.sort()
 
-    for ccd in ccdlist:
-        run(args.expnums, ccd, version=version, prefix=prefix, dry_run=args.dry_run, default=args.default, force=args.force)
+    jobs = [runner.Job(args.expnums, ccd, dict(version=version, prefix=prefix, dry_run=args.dry_run,
+                                               default=args.default, force=args.force))
+            for ccd in ccdlist]
+    check = not args.dry_run and runner.StatusCheck(task, prefix, version) or None
+    report = runner.run(run, jobs, processes=args.processes, max_transfers=args.max_transfers,
+                        retries=args.retries, check=check, workdir=args.workdir)
+    if args.ccd is None and not args.dry_run and not report.failed:
+        # every CCD of the exposures is done, this is the one writer of their manifests.
+        runner.build_manifests(args.expnums, version, prefix)
+    return report.failed and 1 or 0
 
 
 if __name__ == '__main__':
@@ -26,6 +26,7 @@ import argparse
 import logging
 import sys
 from ossos import util
+from ossos.pipeline import runner
 from ossos import storage
 
 _RATE_MIN = 0.5
@@ -163,6 +164,7 @@ def main():
                         type=float)
     parser.add_argument("--dry-run", action="store_true", help="do not copy to VOSpace, implies --force")
     parser.add_argument("--force", action="store_true")
+    runner.add_arguments(parser)
 
     cmd_line = " ".join(sys.argv)
     args = parser.parse_args()
@@ -175,29 +177,27 @@ def main():
     version = args.type
 
     if args.ccd is None:
-        expnum = min(expnums)
-        if int(expnum) < 1785619:
-            # Last exposures with 36 CCD Megaprime
-            ccdlist = list(range(0, 36))
-        else:
-            # First exposrues with 40 CCD Megaprime
-            ccdlist = list(range(0, 40))
+        ccdlist = storage.get_ccdlist(min(expnums))
     else:
         ccdlist = [args.ccd]
 
     if not args.no_sort:
         args.expnums.sort()
 
-    for ccd in ccdlist:
-        run(expnums, ccd, version=version,
-            rate_min=args.rate_min,
-            rate_max=args.rate_max,
-            angle=args.angle,
-            width=args.width,
-            field=args.field,
-            prefix=prefix,
-            force=args.force,
-            dry_run=args.dry_run)
+    jobs = [runner.Job(expnums, ccd, dict(version=version,
+                                          rate_min=args.rate_min,
+                                          rate_max=args.rate_max,
+                                          angle=args.angle,
+                                          width=args.width,
+                                          field=args.field,
+                                          prefix=prefix,
+                                          force=args.force,
+                                          dry_run=args.dry_run))
+            for ccd in ccdlist]
+    check = not args.dry_run and runner.StatusCheck(task, prefix, version) or None
+    report = runner.run(run, jobs, processes=args.processes, max_transfers=args.max_transfers,
+                        retries=args.retries, check=check, workdir=args.workdir)
+    return report.failed and 1 or 0
 
 
 if __name__ == '__main__':
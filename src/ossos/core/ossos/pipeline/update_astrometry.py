@@ -2,18 +2,30 @@
 """
 Update the astrometric and photometric measurements of an mpc observation based on the header contents of the
 observation.
+
+Observations are re-measured a frame (one CCD of one exposure) at a time: the headers, WCS, cutout and calibration
+values of a frame are retrieved once and shared by every observation made on it, and different exposures are
+retrieved concurrently.
 """
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+import glob
+import threading
 import time
 from astropy import units
+from astropy.coordinates import SkyCoord
 import os
 import math
 import numpy
 import logging
 import re
+import sys
 import mp_ephem
 from ossos import storage, wcs, astrom
+from ossos import daophot
 from ossos import orbfit
+from ossos.downloads.cutouts.downloader import SourceCutout
+from ossos.gui import config
 import argparse
 
 __author__ = 'jjk'
@@ -21,6 +33,17 @@ __author__ = 'jjk'
 # Maximum allowed change in angle during re-measure
 TOLERANCE = 2.00 * units.arcsec
 
+# Number of exposures whose headers and cutouts are retrieved at the same time.
+MAX_WORKERS = 8
+
+# Sources on the same frame within this distance of each other are measured on a single cutout.
+MAX_CUTOUT_RADIUS = 2.0 * units.arcminute
+
+FRAME_PATTERN = re.compile(r'(?P<expnum>\d{7})(?P<type>\S)(?P<ccd>\d\d)')
+
+# IRAF (the daophot backend) is not thread safe.
+_phot_lock = threading.Lock()
+
 
 def _flipped_ccd(ccd):
     """
@@ -34,6 +57,92 @@ def _flipped_ccd(ccd):
     return ccd < 18 or ccd in [36, 37]
 
 
+def _frame_key(mpc_obs):
+    """
+    The frame an observation was measured on, as recorded in the OSSOS comment.
+
+    @param mpc_obs: the observation
+    @type mpc_obs: mp_ephem.Observation
+    @return: expnum, exposure type and ccd or None if the frame can not be parsed from the comment.
+    @rtype: (int, str, int)
+    """
+    parts = FRAME_PATTERN.search(str(mpc_obs.comment.frame))
+    if parts is None:
+        return None
+    return int(parts.group('expnum')), parts.group('type'), int(parts.group('ccd'))
+
+
+class Frame(object):
+    """
+    One CCD of one exposure.
+
+    The astrometric headers, WCS, FWHM and zeropoint of the frame are retrieved (and the WCS built) the first time
+    they are needed and then shared by all the observations measured on the frame.
+    """
+
+    def __init__(self, expnum, ccd):
+        self.expnum = int(expnum)
+        self.ccd = int(ccd)
+        self._values = {}
+
+    def _cached(self, name, func, *args):
+        """
+        Call func(*args) once, later calls return the same result or raise the same error.
+        """
+        if name not in self._values:
+            try:
+                self._values[name] = (_connection_error_wrapper(func, *args), None)
+            except Exception as ex:
+                self._values[name] = (None, ex)
+        value, error = self._values[name]
+        if error is not None:
+            raise error
+        return value
+
+    @property
+    def header(self):
+        """
+        The astrometric (stephen's) header of this frame.
+        @rtype: astropy.io.fits.Header
+        """
+        headers = self._cached('headers', storage._get_sghead, self.expnum)
+        if headers is None:
+            raise IOError("Failed to get astrometric header for {}p{:02d}".format(self.expnum, self.ccd))
+        return headers[self.ccd + 1]
+
+    @property
+    def wcs(self):
+        """
+        The WCS built from the astrometric header.
+        @rtype: wcs.WCS
+        """
+        if 'wcs' not in self._values:
+            self._values['wcs'] = (wcs.WCS(self.header), None)
+        return self._values['wcs'][0]
+
+    @property
+    def image_wcs(self):
+        """
+        The WCS of the image the original measurements were made with.
+        @rtype: wcs.WCS
+        """
+        if 'image_wcs' not in self._values:
+            self._values['image_wcs'] = (wcs.WCS(self._cached('astheader', storage.get_astheader,
+                                                              self.expnum, self.ccd)), None)
+        return self._values['image_wcs'][0]
+
+    @property
+    def fwhm(self):
+        return self._cached('fwhm', storage.get_fwhm, self.expnum, self.ccd)
+
+    @property
+    def zeropoint(self):
+        """
+        The zeropoint (.zeropoint.used) likely used for the original photometry.
+        """
+        return self._cached('zeropoint', storage.get_zeropoint, self.expnum, self.ccd)
+
+
 def remeasure(mpc_in, reset_pixel_coordinates=True):
     """
     Compute the RA/DEC of the line based on the X/Y in the comment and the WCS of the associated image.
@@ -44,40 +153,82 @@ def remeasure(mpc_in, reset_pixel_coordinates=True):
     @type mpc_in: mp_ephem.Observation
     @param reset_pixel_coordinates: try and determine correct X/Y is X/Y doesn't map to correct RA/DEC value
     @type reset_pixel_coordinates: bool
-    @type reset_pixecl_coordinates: bool
 
     """
     if mpc_in.null_observation:
         return mpc_in
-    mpc_obs = deepcopy(mpc_in)
-    logging.debug("rm start: {}".format(mpc_obs.to_string()))
 
-    if not isinstance(mpc_obs.comment, mp_ephem.ephem.OSSOSComment):
+    if not isinstance(mpc_in.comment, mp_ephem.ephem.OSSOSComment):
         logging.error("Failed to convert comment line")
         return mpc_in
 
-    parts = re.search('(?P<expnum>\d{7})(?P<type>\S)(?P<ccd>\d\d)', str(mpc_obs.comment.frame))
-    if not parts:
+    key = _frame_key(mpc_in)
+    if key is None:
         logging.error("Failed to parse expnum from frame info in comment line")
         return mpc_in
-    ccd = int(parts.group('ccd'))
-    expnum = int(parts.group('expnum'))
-    exp_type = parts.group('type')
+    expnum, exp_type, ccd = key
+    return remeasure_frame(Frame(expnum, ccd), [mpc_in], reset_pixel_coordinates=reset_pixel_coordinates)[0]
+
+
+def remeasure_frame(frame, observations, reset_pixel_coordinates=True):
+    """
+    Compute the RA/DEC of all the observations made on frame, see remeasure.
+
+    The X/Y of all the observations are converted with a single call to the WCS of the frame.
+
+    @param frame: the frame the observations were measured on.
+    @type frame: Frame
+    @param observations: lines of astrometric measurement to recompute the RA/DEC of.
+    @type observations: list(mp_ephem.Observation)
+    @param reset_pixel_coordinates: try and determine correct X/Y is X/Y doesn't map to correct RA/DEC value
+    @return: the re-measured observations, in the same order.
+    @rtype: list(mp_ephem.Observation)
+    """
+    results = list(observations)
+    selected = []
+    for idx, mpc_in in enumerate(observations):
+        if mpc_in.null_observation:
+            continue
+        if not isinstance(mpc_in.comment, mp_ephem.ephem.OSSOSComment):
+            logging.error("Failed to convert comment line")
+            continue
+        selected.append(idx)
+    if not selected:
+        return results
 
     try:
-        header = _connection_error_wrapper(storage._get_sghead, expnum)[ccd+1]
+        frame.header
     except IOError as ioerr:
         logging.error(str(ioerr))
-        logging.error("Failed to get astrometric header for: {}".format(mpc_obs))
-        return mpc_in
+        for idx in selected:
+            logging.error("Failed to get astrometric header for: {}".format(observations[idx]))
+        return results
+
+    x = numpy.array([float(observations[idx].comment.x) for idx in selected])
+    y = numpy.array([float(observations[idx].comment.y) for idx in selected])
+    ra, dec = frame.wcs.xy2sky(x, y, usepv=True)
+    ra = numpy.atleast_1d(ra.to('degree').value)
+    dec = numpy.atleast_1d(dec.to('degree').value)
+    for idx, coordinate in zip(selected, zip(ra, dec)):
+        results[idx] = _remeasure_observation(observations[idx], coordinate, frame, reset_pixel_coordinates)
+    return results
+
+
+def _remeasure_observation(mpc_in, coordinate, frame, reset_pixel_coordinates):
+    """
+    Set the RA/DEC of a copy of mpc_in to coordinate, the WCS position of its comment X/Y, and work out
+    the astrometric uncertainty of the new position.
+    """
+    mpc_obs = deepcopy(mpc_in)
+    logging.debug("rm start: {}".format(mpc_obs.to_string()))
 
-    this_wcs = wcs.WCS(header)
+    header = frame.header
+    this_wcs = frame.wcs
 
-    coordinate = this_wcs.xy2sky(mpc_obs.comment.x, mpc_obs.comment.y, usepv=True)
-    mpc_obs.coordinate = coordinate[0].to('degree').value, coordinate[1].to('degree').value
+    mpc_obs.coordinate = coordinate
     sep = mpc_in.coordinate.separation(mpc_obs.coordinate)
 
-    if sep > TOLERANCE*20 and mpc_in.discovery and _flipped_ccd(ccd):
+    if sep > TOLERANCE*20 and mpc_in.discovery and _flipped_ccd(frame.ccd):
         logging.warn("Large ({}) offset using X/Y in comment line to compute RA/DEC".format(sep))
         if reset_pixel_coordinates:
             logging.info("flipping/flopping the discvoery x/y position recorded.")
@@ -96,9 +247,7 @@ def remeasure(mpc_in, reset_pixel_coordinates=True):
         logging.warn("sep: {} --> large offset when using comment line X/Y to compute RA/DEC")
         if reset_pixel_coordinates:
            logging.warn("Using RA/DEC and original WCS to compute X/Y and replacing X/Y in comment.".format(sep))
-           header2 = _connection_error_wrapper(storage.get_astheader, expnum, ccd)
-           image_wcs = wcs.WCS(header2)
-           (x, y) = image_wcs.sky2xy(mpc_in.coordinate.ra.degree, mpc_in.coordinate.dec.degree, usepv=False)
+           (x, y) = frame.image_wcs.sky2xy(mpc_in.coordinate.ra.degree, mpc_in.coordinate.dec.degree, usepv=False)
            mpc_obs.coordinate = this_wcs.xy2sky(x, y, usepv=True)
            mpc_obs.comment.x = x
            mpc_obs.comment.y = y
@@ -109,7 +258,7 @@ def remeasure(mpc_in, reset_pixel_coordinates=True):
     if mpc_obs.comment.mag_uncertainty is not None:
         try:
             merr = float(mpc_obs.comment.mag_uncertainty)
-            fwhm = float(_connection_error_wrapper(storage.get_fwhm, expnum, ccd))
+            fwhm = float(frame.fwhm)
             centroid_err = merr * fwhm * header['PIXSCAL1']
             logging.debug("Centroid uncertainty:  {} {} => {}".format(merr, fwhm, centroid_err))
         except Exception as err:
@@ -163,29 +312,130 @@ def recompute_mag(mpc_in, skip_centroids=False):
     """
     Get the mag of the object given the mp_ephem.ephem.Observation
     """
-    # TODO this really shouldn't need to build a 'reading' to get the cutout...
+    assert isinstance(mpc_in, mp_ephem.ephem.Observation)
+    assert isinstance(mpc_in.comment, mp_ephem.ephem.OSSOSComment)
 
-    from ossos.downloads.cutouts import downloader
-    dlm = downloader.ImageCutoutDownloader()
+    if mpc_in.null_observation:
+        return deepcopy(mpc_in)
 
-    mpc_obs = deepcopy(mpc_in)
-    assert isinstance(mpc_obs, mp_ephem.ephem.Observation)
-    assert isinstance(mpc_obs.comment, mp_ephem.ephem.OSSOSComment)
+    key = _frame_key(mpc_in)
+    if key is None:
+        return deepcopy(mpc_in)
+    expnum, exp_type, ccd = key
+    return recompute_frame_mags(Frame(expnum, ccd), [mpc_in], skip_centroids=skip_centroids)[0]
 
-    if mpc_obs.null_observation:
-        return mpc_obs
 
-    parts = re.search('(?P<expnum>\d{7})(?P<type>\S)(?P<ccd>\d\d)', mpc_obs.comment.frame)
-    if parts is None:
-        return mpc_obs
-    expnum = parts.group('expnum')
-    ccd = parts.group('ccd')
-    file_type = parts.group('type')
+def _cutout_groups(readings):
+    """
+    Split readings into groups whose sources all lie within MAX_CUTOUT_RADIUS of the first source of the group.
+
+    @param readings: dict of index -> SourceReading
+    @return: list of lists of indices.
+    """
+    groups = []
+    for idx, reading in readings.items():
+        for group in groups:
+            if readings[group[0]].sky_coord.separation(reading.sky_coord) < MAX_CUTOUT_RADIUS:
+                group.append(idx)
+                break
+        else:
+            groups.append([idx])
+    return groups
+
+
+def _group_cutouts(readings):
+    """
+    Retrieve one cutout that contains all of readings and a SourceCutout for each reading on that cutout.
+
+    @param readings: readings of sources on the same frame.
+    @type readings: list(astrom.SourceReading)
+    @rtype: list(SourceCutout)
+    """
+    min_radius = config.read('CUTOUTS.SINGLETS.RADIUS')
+    if not isinstance(min_radius, units.Quantity):
+        min_radius = min_radius * units.arcsec
+    ra = numpy.array([reading.ra for reading in readings])
+    dec = numpy.array([reading.dec for reading in readings])
+    centre = SkyCoord(ra.mean() * units.degree, dec.mean() * units.degree)
+    radius = max([centre.separation(reading.sky_coord) for reading in readings]) + min_radius
+
+    hdulist = _connection_error_wrapper(storage._cutout_expnum, readings[0].obs, centre, radius)
+    cutouts = [SourceCutout(reading, hdulist, radius=radius) for reading in readings]
+    # The sources are on the same CCD, the aperture correction is retrieved once.
+    try:
+        apcor = cutouts[0].apcor
+        for cutout in cutouts[1:]:
+            cutout._apcor = apcor
+    except Exception as ex:
+        logging.error("Failed to retrieve apcor: {}".format(ex))
+    return cutouts
+
+
+def _measure_cutouts(cutouts, centroids):
+    """
+    Measure the photometry of the sources on cutouts that share one image, with one call to daophot per extension.
+
+    @param cutouts: SourceCutouts sharing a single hdulist.
+    @param centroids: for each cutout, should the source be re-centroided?
+    @return: the photometry row of each cutout.
+    """
+    rows = [None] * len(cutouts)
+    batches = {}
+    for idx, cutout in enumerate(cutouts):
+        x, y, hdulist_index = cutout.pixel_coord
+        batches.setdefault((hdulist_index, centroids[idx]), []).append((idx, x, y))
+    for (hdulist_index, centroid), batch in batches.items():
+        cutout = cutouts[batch[0][0]]
+        with _phot_lock:
+            phot = daophot.phot_mag(cutout.hdulist[hdulist_index],
+                                    [x for idx, x, y in batch],
+                                    [y for idx, x, y in batch],
+                                    aperture=cutout.apcor.aperture,
+                                    sky=cutout.apcor.sky,
+                                    swidth=cutout.apcor.swidth,
+                                    apcor=cutout.apcor.apcor,
+                                    zmag=cutout.zmag,
+                                    maxcount=float(cutout.astrom_header.get("MAXCOUNT", 30000)),
+                                    centroid=centroid)
+        for row, (idx, x, y) in zip(phot, batch):
+            rows[idx] = row
+    return rows
+
+
+def recompute_frame_mags(frame, observations, skip_centroids=False):
+    """
+    Get the mags of all the observations made on frame, see recompute_mag.
 
-    observation = astrom.Observation(expnum, file_type, ccd)
-    assert isinstance(observation, astrom.Observation)
+    Sources close together share a single cutout and are measured with a single call to daophot.
 
-    ast_header = _connection_error_wrapper(storage._get_sghead, int(expnum))[int(ccd)+1]
+    @param frame: the frame the observations were measured on.
+    @type frame: Frame
+    @param observations: the observations to measure.
+    @type observations: list(mp_ephem.ephem.Observation)
+    @return: the observations with updated magnitudes (and X/Y), in the same order.
+    @rtype: list(mp_ephem.ephem.Observation)
+    """
+    results = [deepcopy(mpc_in) for mpc_in in observations]
+    readings = {}
+    for idx, mpc_obs in enumerate(results):
+        assert isinstance(mpc_obs, mp_ephem.ephem.Observation)
+        assert isinstance(mpc_obs.comment, mp_ephem.ephem.OSSOSComment)
+        if mpc_obs.null_observation:
+            continue
+        parts = FRAME_PATTERN.search(str(mpc_obs.comment.frame))
+        if parts is None:
+            continue
+        observation = astrom.Observation(parts.group('expnum'), parts.group('type'), parts.group('ccd'))
+        readings[idx] = astrom.SourceReading(float(mpc_obs.comment.x), float(mpc_obs.comment.y),
+                                             float(mpc_obs.comment.x), float(mpc_obs.comment.y),
+                                             mpc_obs.coordinate.ra.degree, mpc_obs.coordinate.dec.degree,
+                                             float(mpc_obs.comment.x), float(mpc_obs.comment.y),
+                                             observation, ssos=True, from_input_file=True,
+                                             null_observation=False, discovery=mpc_obs.discovery)
+    if not readings:
+        return results
+
+    ast_header = frame.header
 
     filter_value = None
     for keyword in ['FILTER', 'FILT1 NAME']:
@@ -200,27 +450,36 @@ def recompute_mag(mpc_in, skip_centroids=False):
     new_zp = ast_header.get('PHOTZP')
 
     # The .zeropoint.used value is likely the one used for the original photometry.
-    old_zp = _connection_error_wrapper(storage.get_zeropoint, int(expnum), int(ccd))
-
-    reading = astrom.SourceReading(float(mpc_obs.comment.x), float(mpc_obs.comment.y), float(mpc_obs.comment.x),
-                                   float(mpc_obs.comment.y), mpc_obs.coordinate.ra.degree,
-                                   mpc_obs.coordinate.dec.degree, float(mpc_obs.comment.x), float(mpc_obs.comment.y),
-                                   observation, ssos=True, from_input_file=True, null_observation=False,
-                                   discovery=mpc_obs.discovery)
+    try:
+        old_zp = frame.zeropoint
+    except Exception as ex:
+        logging.error(str(ex))
+        old_zp = None
 
-    cutout = _connection_error_wrapper(dlm.download_cutout, reading, needs_apcor=True)
-    cutout._zmag = new_zp
+    for group in _cutout_groups(readings):
+        try:
+            cutouts = _group_cutouts([readings[idx] for idx in group])
+            for cutout in cutouts:
+                cutout._zmag = new_zp
+            rows = _measure_cutouts(cutouts, [not skip_centroids and results[idx].note1 != "H" for idx in group])
+        except Exception as ex:
+            logging.error("ERROR: {}".format(str(ex)))
+            continue
+        for idx, cutout, row in zip(group, cutouts, rows):
+            if old_zp is not None and math.fabs(cutout.zmag - old_zp) > 0.3:
+                logging.warn("Large change in zeropoint detected: {}  -> {}".format(old_zp, cutout.zmag))
+            results[idx] = _update_mag(observations[idx], results[idx], cutout, row, filter_value, skip_centroids)
+    return results
 
-    if math.fabs(cutout.zmag - old_zp) > 0.3:
-        logging.warn("Large change in zeropoint detected: {}  -> {}".format(old_zp, cutout.zmag))
 
+def _update_mag(mpc_in, mpc_obs, cutout, phot, filter_value, skip_centroids):
+    """
+    Update mpc_obs, a copy of mpc_in, with the photometry measured on cutout.
+    """
     try:
-        PHOT = cutout.get_observed_magnitude(centroid=not skip_centroids and mpc_obs.note1 != "H")
-        x = PHOT['XCENTER']
-        y = PHOT['YCENTER']
-        mag = PHOT['MAG']
-        merr = PHOT['MERR']
-        cutout.update_pixel_location((x, y), hdu_index=cutout.extno)
+        mag = phot['MAG']
+        merr = phot['MERR']
+        cutout.update_pixel_location((float(phot['XCENTER']), float(phot['YCENTER'])), hdu_index=cutout.extno)
         x, y = cutout.observed_source_point
     except Exception as ex:
         logging.error("ERROR: {}".format(str(ex)))
@@ -228,7 +487,7 @@ def recompute_mag(mpc_in, skip_centroids=False):
 
     try:
         if mpc_obs.comment.mag_uncertainty is not None and mpc_obs.comment.mag is not None and math.fabs(mpc_obs.comment.mag - mag) > 3.5 * mpc_obs.comment.mag_uncertainty:
-           logging.warn("recomputed magnitude shift large: {} --> {}".format(mpc_obs.mag, mag[0]))
+           logging.warn("recomputed magnitude shift large: {} --> {}".format(mpc_obs.mag, mag))
         if math.sqrt((x.value - mpc_obs.comment.x) ** 2 + (y.value - mpc_obs.comment.y) ** 2) > 1.9:
             logging.warn("Centroid shifted ({},{}) -> ({},{})".format(mpc_obs.comment.x,
                                                                       mpc_obs.comment.y,
@@ -262,23 +521,60 @@ def recompute_mag(mpc_in, skip_centroids=False):
     return mpc_obs
 
 
-def run(mpc_file, cor_file, 
-        skip_discovery=True, skip_mags=False, 
-        skip_centroids=False, compare_orbits=False):
+def remeasure_observations(observations, skip_mags=False, skip_centroids=False, max_workers=MAX_WORKERS):
     """
-
-    :param mpc_file: A file containing the astrometric lines to be updated.
-    :param cor_file: The base name for the updated astrometry and diagnostic files.
-    :param skip_mags: Should we skip recomputing the magnitude of sources?
-    :return: :raise ValueError: If actions on the mpc_obs indicate this is not a valid OSSOS observations
+    Re-measure the astrometry, and the photometry unless skip_mags, of observations.
+
+    The observations are grouped by exposure and CCD so the headers, WCS and cutouts of each frame are retrieved
+    once, different exposures are processed concurrently.
+
+    @param observations: OSSOS observations, from any number of objects.
+    @type observations: list(mp_ephem.ephem.Observation)
+    @param skip_mags: Should we skip recomputing the magnitude of sources?
+    @param skip_centroids: Should we keep the X/Y of the sources rather than re-centroiding them?
+    @param max_workers: Number of exposures to process at the same time.
+    @return: the re-measured observations in the same order, None for those that could not be re-measured.
+    @rtype: list(mp_ephem.ephem.Observation)
+    """
+    results = [None] * len(observations)
+    exposures = {}
+    for idx, mpc_in in enumerate(observations):
+        key = _frame_key(mpc_in)
+        if key is None:
+            logging.error("Failed to parse expnum from frame info in comment line")
+            results[idx] = mpc_in
+            continue
+        expnum, exp_type, ccd = key
+        exposures.setdefault(expnum, {}).setdefault(ccd, []).append(idx)
+
+    def remeasure_exposure(expnum):
+        # The frames of an exposure share one header file, so they are done in turn.
+        for ccd, indices in exposures[expnum].items():
+            frame = Frame(expnum, ccd)
+            frame_observations = [observations[idx] for idx in indices]
+            try:
+                mpc_obs = remeasure_frame(frame, frame_observations)
+                if not skip_mags:
+                    mpc_obs = remeasure_frame(frame,
+                                              recompute_frame_mags(frame, mpc_obs, skip_centroids=skip_centroids),
+                                              reset_pixel_coordinates=not skip_centroids)
+            except Exception as ex:
+                logging.error("Failed to re-measure {}p{:02d}: {}".format(expnum, ccd, ex))
+                continue
+            for idx, new_obs in zip(indices, mpc_obs):
+                results[idx] = new_obs
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(remeasure_exposure, exposures))
+    return results
+
+
+def _select_observations(observations, skip_discovery=True):
     """
-    observations = mp_ephem.EphemerisReader().read(mpc_file)
-    logging.debug("Read in Observations: {}".format(observations))
-    original_obs = []
-    modified_obs = []
-    logging.info("ASTROMETRY FILE: {} --> {}.tlf".format(mpc_file, cor_file))
+    The observations that should be re-measured.
+    """
+    selected = []
     for mpc_in in observations:
-      try:
         if not isinstance(mpc_in.comment, mp_ephem.ephem.OSSOSComment):
             logging.info(type(mpc_in.comment))
             logging.info("Skipping: {}".format(mpc_in.to_string()))
@@ -288,54 +584,94 @@ def run(mpc_file, cor_file,
             logging.info("Discovery mis-match")
             logging.info("Skipping: {}".format(mpc_in.to_string()))
             continue
-        logging.info("="*220)
-        logging.info("   orig: {}".format(mpc_in.to_string()))
         if mpc_in.comment.astrometric_level == 4:
-            logging.info("Already at maximum AstLevel, skipping.")
+            logging.info("Already at maximum AstLevel, skipping: {}".format(mpc_in.to_string()))
             continue
         if mpc_in.null_observation:
             logging.info("Skipping NULL observation.")
             continue
-        mpc_obs = remeasure(mpc_in)
-        logging.info("new wcs: {}".format(mpc_obs.to_string()))
-
-        if not skip_mags:  
-            # and not mpc_obs.comment.photometry_note[0] == "Z":
-            mpc_mag = remeasure(recompute_mag(mpc_obs,
-                                              skip_centroids=skip_centroids),
-                                reset_pixel_coordinates=not skip_centroids)
-        else:
-            mpc_mag = mpc_obs
-
-        sep = mpc_in.coordinate.separation(mpc_mag.coordinate)
-        if sep > TOLERANCE:
-            logging.error("Large offset: {} arc-sec".format(sep))
-            logging.error("orig: {}".format(mpc_in.to_string()))
-            logging.error(" new: {}".format(mpc_mag.to_string()))
-            new_comment = "BIG SHIFT HERE"
-            mpc_mag.comment.comment = mpc_mag.comment.comment + " " + new_comment
-        logging.info("new cen: {}".format(mpc_mag.to_string()))
-        original_obs.append(mpc_in)
-        modified_obs.append(mpc_mag)
+        selected.append(mpc_in)
+    return selected
+
+
+def run(mpc_file, cor_file, 
+        skip_discovery=True, skip_mags=False, 
+        skip_centroids=False, compare_orbits=False, max_workers=MAX_WORKERS):
+    """
+
+    :param mpc_file: A file containing the astrometric lines to be updated.
+    :param cor_file: The base name for the updated astrometry and diagnostic files.
+    :param skip_mags: Should we skip recomputing the magnitude of sources?
+    :return: :raise ValueError: If actions on the mpc_obs indicate this is not a valid OSSOS observations
+    """
+    return run_many([mpc_file], [cor_file],
+                    skip_discovery=skip_discovery, skip_mags=skip_mags,
+                    skip_centroids=skip_centroids, compare=compare_orbits, max_workers=max_workers)
+
+
+def run_many(mpc_files, cor_files,
+             skip_discovery=True, skip_mags=False,
+             skip_centroids=False, compare=False, max_workers=MAX_WORKERS):
+    """
+    Update the astrometric lines of many files, for example a release directory of .ast files, together.
+
+    Observations of different objects made on the same frame share that frame's headers and cutouts.
+
+    :param mpc_files: Files containing the astrometric lines to be updated.
+    :param cor_files: The base name for the updated astrometry and diagnostic files of each mpc_file.
+    :param skip_mags: Should we skip recomputing the magnitude of sources?
+    :param compare: Compute and compare the orbits of the original and updated astrometry?
+    :param max_workers: Number of exposures to process at the same time.
+    """
+    selected = []
+    for mpc_file, cor_file in zip(mpc_files, cor_files):
+        observations = mp_ephem.EphemerisReader().read(mpc_file)
+        logging.debug("Read in Observations: {}".format(observations))
+        logging.info("ASTROMETRY FILE: {} --> {}.tlf".format(mpc_file, cor_file))
+        selected.append(_select_observations(observations, skip_discovery=skip_discovery))
+
+    remeasured = remeasure_observations([mpc_in for observations in selected for mpc_in in observations],
+                                        skip_mags=skip_mags, skip_centroids=skip_centroids,
+                                        max_workers=max_workers)
+
+    start = 0
+    for cor_file, observations in zip(cor_files, selected):
+        original_obs = []
+        modified_obs = []
+        for mpc_in, mpc_mag in zip(observations, remeasured[start:start + len(observations)]):
+            logging.info("="*220)
+            logging.info("   orig: {}".format(mpc_in.to_string()))
+            if mpc_mag is None:
+                logging.error("Skipping: {}".format(mpc_in))
+                continue
+            sep = mpc_in.coordinate.separation(mpc_mag.coordinate)
+            if sep > TOLERANCE:
+                logging.error("Large offset: {} arc-sec".format(sep))
+                logging.error("orig: {}".format(mpc_in.to_string()))
+                logging.error(" new: {}".format(mpc_mag.to_string()))
+                new_comment = "BIG SHIFT HERE"
+                mpc_mag.comment.comment = mpc_mag.comment.comment + " " + new_comment
+            logging.info("new cen: {}".format(mpc_mag.to_string()))
+            original_obs.append(mpc_in)
+            modified_obs.append(mpc_mag)
+        start += len(observations)
+        logging.info("="*220)
+
+        optr = open(cor_file + ".tlf", 'w')
+        for idx in range(len(modified_obs)):
+            inp = original_obs[idx]
+            out = modified_obs[idx]
+            if inp != out:
+                optr.write(out.to_tnodb()+"\n")
+        optr.close()
+
+        if not compare:
+            continue
+        try:
+           compare_orbits(original_obs, modified_obs, cor_file)
+        except Exception as ex:
+           logging.error("Orbit comparison failed: {}".format(ex))
         logging.info("="*220)
-      except:
-        logging.error("Skipping: {}".format(mpc_in))
-
-    optr = open(cor_file + ".tlf", 'w')
-    for idx in range(len(modified_obs)):
-        inp = original_obs[idx]
-        out = modified_obs[idx]
-        if inp != out:
-            optr.write(out.to_tnodb()+"\n")
-    optr.close()
-
-    if not compare_orbits:
-        return True
-    try:
-       compare_orbits(original_obs, modified_obs, cor_file)
-    except Exception as ex:
-       logging.error("Orbit comparison failed: {}".format(ex))
-    logging.info("="*220)
 
     return True
 
@@ -346,7 +682,7 @@ def compare_orbits(original_obs, modified_obs, cor_file):
     origin = orbfit.Orbfit(original_obs)
     modified = orbfit.Orbfit(modified_obs)
 
-    orbpt = file(cor_file+".orb", 'w')
+    orbpt = open(cor_file+".orb", 'w')
 
     # Dump summaries of the orbits
     orbpt.write("#"*80+"\n")
@@ -437,13 +773,16 @@ def main():
     entries to be consistent with the current best estimate for the astrometric and photometric calibrations.
     """
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('ast_file', help="An MPC file to update.")
+    parser.add_argument('ast_file', nargs='+',
+                        help="MPC files to update, directories are searched for .ast files.")
     parser.add_argument('--discovery', help="Only process the discovery images.", action='store_true', default=False)
     parser.add_argument('--result_base_name', help="base name for remeasurement results (defaults to basename of input)",
                         default=None)
     parser.add_argument('--skip-mags', action="store_true", help="Recompute magnitudes.", default=False)
     parser.add_argument('--skip-centroids', action="store_true", help="Recompute centroids.", default=False)
     parser.add_argument('--compare-orbits', action='store_true', help="Compute/Compare pre and post remeasure orbits?", default=False)
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                        help="Number of exposures to retrieve and measure at the same time.")
     parser.add_argument('--debug', action='store_true')
 
     args = parser.parse_args()
@@ -456,15 +795,25 @@ def main():
     logger = logging.getLogger('update_astrom')
     coloredlogs.install(level=level)
 
-    if args.result_base_name is None:
-        base_name = os.path.splitext(os.path.basename(args.ast_file))[0]
+    ast_files = []
+    for ast_file in args.ast_file:
+        if os.path.isdir(ast_file):
+            ast_files.extend(sorted(glob.glob(os.path.join(ast_file, "*.ast"))))
+        else:
+            ast_files.append(ast_file)
+
+    if args.result_base_name is not None:
+        if len(ast_files) != 1:
+            parser.error("--result_base_name can only be used when updating a single file.")
+        base_names = [args.result_base_name]
     else:
-        base_name = args.result_base_name
-    run(args.ast_file, base_name, 
-        skip_discovery=not args.discovery, 
-        skip_mags=args.skip_mags, 
-        skip_centroids=args.skip_centroids, 
-        compare_orbits=args.compare_orbits)
+        base_names = [os.path.splitext(os.path.basename(ast_file))[0] for ast_file in ast_files]
+    run_many(ast_files, base_names,
+             skip_discovery=not args.discovery,
+             skip_mags=args.skip_mags,
+             skip_centroids=args.skip_centroids,
+             compare=args.compare_orbits,
+             max_workers=args.max_workers)
 
 
 if __name__ == '__main__':
@@ -9,7 +9,7 @@ from astropy.coordinates import SkyCoord
 from astropy.time import TimeDelta, Time
 import numpy as np
 from ossos.cameras import Camera
-from ossos import mpc
+from ossos import mpc, orbfit
 import mp_ephem
 from ossos.ephem_target import EphemTarget
 import sys, os
@@ -46,13 +46,15 @@ def coverage(orbits, locations):
 
     # For each required target find the pointing that will include the largest number of other required targets
     # and then tweak that specific pointing to include the maximum number of secondary targets.
-    for location in locations:
+    kbo_names = list(orbits)
+    ephemeris = orbfit.predict_many([orbits[kbo_name] for kbo_name in kbo_names],
+                                    Time(locations["Start_Date"], format='mjd'))
+    ra = ephemeris.ra.to('degree').value
+    dec = ephemeris.dec.to('degree').value
+    for idx, location in enumerate(locations):
         p = Camera(SkyCoord(location["RA__J2000.0_"], location["Dec.__J2000.0_"], unit=('degree', 'degree')))
-        for kbo_name in orbits:
-            orbits[kbo_name].predict(Time(location["Start_Date"], format='mjd'))
-            if p.polygon.isInside(orbits[kbo_name].coordinate.ra.degree,
-                                  orbits[kbo_name].coordinate.dec.degree):
-                print((location['Target_Name'], kbo_name))
+        for kbo_idx in np.flatnonzero(p.contains(ra[:, idx], dec[:, idx]) >= 0):
+            print((location['Target_Name'], kbo_names[kbo_idx]))
 
 
 def main():
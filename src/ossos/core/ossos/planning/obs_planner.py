@@ -920,43 +920,49 @@ class Plot(Canvas):
                 time_step = TimeDelta(3.0*units.hour)
 
                 # Compute the mean position of KBOs in the field on current date.
-                for kbo_name, kbo in list(self.kbos.items()):
+                kbo_names = []
+                for kbo_name in self.kbos:
                     if kbo_name in Neptune or kbo_name in tracking_termination:
                         print('skipping', kbo_name)
                         continue
-                    kbo.predict(pointing_date)
-                    ra = kbo.coordinate.ra
-                    dec = kbo.coordinate.dec
+                    kbo_names.append(kbo_name)
+                ephemeris = orbfit.predict_many([self.kbos[kbo_name] for kbo_name in kbo_names], pointing_date)
+                for idx, kbo_name in enumerate(kbo_names):
+                    kbo = self.kbos[kbo_name]
+                    ra = ephemeris.ra[idx, 0].to(units.radian).value
+                    dec = ephemeris.dec[idx, 0].to(units.radian).value
                     if kbo_name in name:
                         print("{} matches pointing {} by name, adding to field.".format(kbo_name, name))
                         field_kbos.append(kbo)
-                        center_ra += ra.radian
-                        center_dec += dec.radian
+                        center_ra += ra
+                        center_dec += dec
                     else:
                         for polygon in polygons:
-                            if polygon.isInside(ra.radian, dec.radian):
+                            if polygon.isInside(ra, dec):
                                 print("{} inside pointing {} polygon, adding to field.".format(kbo_name, name))
                                 field_kbos.append(kbo)
-                                center_ra += ra.radian
-                                center_dec += dec.radian
+                                center_ra += ra
+                                center_dec += dec
 
                 # logging.critical("KBOs in field {0}: {1}".format(name, ', '.join([n.name for n in field_kbos])))
 
+                dates = []
                 today = start_date
                 while today < end_date:
                     today += time_step
+                    dates.append(today)
+                max_mag = 0.0
+                if len(field_kbos) > 0:
+                    field_ephemeris = orbfit.predict_many(field_kbos, dates)
+                    field_ra = field_ephemeris.ra.to(units.radian).value.sum(axis=0)
+                    field_dec = field_ephemeris.dec.to(units.radian).value.sum(axis=0)
+                    max_mag = max([max_mag] + [kbo.mag for kbo in field_kbos])
+
+                for date_idx, today in enumerate(dates):
                     mean_motion = (0, 0)
-                    max_mag = 0.0
                     if len(field_kbos) > 0:
-                        current_ra = 0
-                        current_dec = 0
-                        for kbo in field_kbos:
-                            kbo.predict(today)
-                            max_mag = max(max_mag, kbo.mag)
-                            current_ra += kbo.coordinate.ra.radian
-                            current_dec += kbo.coordinate.dec.radian
-                        mean_motion = ((current_ra - center_ra) / len(field_kbos),
-                                       (current_dec - center_dec) / len(field_kbos))
+                        mean_motion = ((field_ra[date_idx] - center_ra) / len(field_kbos),
+                                       (field_dec[date_idx] - center_dec) / len(field_kbos))
                     ra = pointing['camera'].coordinate.ra.radian + mean_motion[0]
                     dec = pointing['camera'].coordinate.dec.radian + mean_motion[1]
                     cc = SkyCoord(ra=ra,
@@ -1077,6 +1083,13 @@ NAME                |RA         |DEC        |EPOCH |POINT|
         kbos = self.kbos
         re_string = w.FilterVar.get()
         vlist = []
+        # predict the orbits all at once.
+        pointing_date = mpc.Time(w.date.get(), scale='utc').jd
+        trail_mid_point = 0
+        trail_dates = [pointing_date - trail_mid_point + days for days in range(trail_mid_point * 2 + 1)]
+        orbit_names = [name for name in kbos if re.search(re_string, name) and isinstance(kbos[name], orbfit.Orbfit)]
+        ephemeris = orbfit.predict_many([kbos[name] for name in orbit_names], trail_dates, 568)
+        orbit_index = dict((name, idx) for idx, name in enumerate(orbit_names))
         for name in kbos:
             if not re.search(re_string, name):
                 continue
@@ -1117,19 +1130,14 @@ NAME                |RA         |DEC        |EPOCH |POINT|
             elif isinstance(kbos[name], orbfit.Orbfit):
                 yoffset = -10
                 xoffset = -10
-                kbo = kbos[name]
-                pointing_date = mpc.Time(w.date.get(), scale='utc').jd
-                trail_mid_point = 0
-                for days in range(trail_mid_point * 2 + 1):
+                kbo_idx = orbit_index[name]
+                for days in range(len(trail_dates)):
                     point_size = days == trail_mid_point and 5 or 1
-                    today = mpc.Time(pointing_date - trail_mid_point + days, scale='utc', format='jd')
-                    kbo.predict(today, 568)
-                    ra = kbo.coordinate.ra.radian
-                    dec = kbo.coordinate.dec.radian
-                    from astropy import units
-                    a = kbo.dra.to(units.radian).value
-                    b = kbo.ddec.to(units.radian).value
-                    ang = kbo.pa.to(units.radian).value
+                    ra = ephemeris.ra[kbo_idx, days].to(units.radian).value
+                    dec = ephemeris.dec[kbo_idx, days].to(units.radian).value
+                    a = ephemeris.dra[kbo_idx, days].to(units.radian).value
+                    b = ephemeris.ddec[kbo_idx, days].to(units.radian).value
+                    ang = ephemeris.pa[kbo_idx, days].to(units.radian).value
                     lost = False
                     if a > math.radians(0.3):
                         lost = True
@@ -134,9 +134,6 @@ def optimize(orbits, required, locations, tokens, camera_name="MEGACAM_40"):
     token_order = np.random.permutation(required)
     optimal_pointings = {}
     covered = []  # the objects that have already been covered by a planned pointing.
-    search_order = [0, ]
-    # search_order = [22 + 4]
-    # search_order.extend(range(len(Camera.names)))
 
     # For each required target find the pointing that will include the largest number of other required targets
     # and then tweak that specific pointing to include the maximum number of secondary targets.
@@ -149,75 +146,38 @@ def optimize(orbits, required, locations, tokens, camera_name="MEGACAM_40"):
             continue
         obj = orbits[token]
         separations = obj.coordinate.separation(locations)
-        possible_tokens = tokens[separations < 1.3 * units.degree]
+        nearby = separations < 1.3 * units.degree
+        possible_tokens = tokens[nearby]
         this_required = []
         for this_token in required:
             if this_token in possible_tokens:
                 this_required.append(this_token)
         # This object is not inside the existing coverage.
-        max_sources_in_pointing = 0
-        best_coverage = []
         p = SkyCoord(obj.coordinate.ra,
                      obj.coordinate.dec)
         pointing = Camera(p, camera=camera_name)
         if len(possible_tokens) == 1:
-            optimal_pointings[token] = pointing, possible_tokens
+            # still shifted so that it doesn't land in a chip gap.
             logging.info(" {} is all alone!".format(token))
-            continue
 
         logging.debug("examining possible optimizations")
 
-        if len(this_required) == 1:
-            best_coverage = [token]
-        else:
-            logging.debug("Maximizing inclusion of required targets")
-            for idx in search_order:
-                pointing.offset(index=idx)
-                this_coverage = []
-                for this_token in this_required:
-                    if this_token in covered:
-                        continue
-                    this_obj = orbits[this_token]
-                    if pointing.polygon.isInside(this_obj.coordinate.ra.degree, this_obj.coordinate.dec.degree):
-                        this_coverage.append(this_token)
-
-                if len(this_coverage) > max_sources_in_pointing:
-                    max_sources_in_pointing = len(this_coverage)
-                    best_coverage = this_coverage
-
-        # best_pointing now contains the pointing that covers the largest number of required sources.
-        # best_coverage is the list of sources (tokens) that this pointing covered.
-        # now move around the best_pointing, keeping all the objects listed in best_coverage but maximizing the
-        # number of other sources that get coverage (optimal_coverage)
-        logging.info("{} pointing these {} required targets: {}".format(token, len(best_coverage), best_coverage))
-        max_sources_in_pointing = 0
-        optimal_coverage = []
-        optimal_pointing = None
-        for idx in search_order:
-            pointing.offset(index=idx)
-            exclude = False  # exclude this offset because it doesn't overlap one or more of the required sources.
-            for this_token in best_coverage:
-                this_obj = orbits[this_token]
-                if not pointing.polygon.isInside(this_obj.coordinate.ra.degree, this_obj.coordinate.dec.degree):
-                    exclude = True
-                    break
-
-            if exclude:
-                continue
-
-            # OK, this offset has all the required sources possible, how many extra sources do we get?
-            this_coverage = []
-            for this_token in possible_tokens:
-                if this_token in covered:
-                    continue
-                this_obj = orbits[this_token]
-                if pointing.polygon.isInside(this_obj.coordinate.ra.degree, this_obj.coordinate.dec.degree):
-                    this_coverage.append(this_token)
-
-            if len(this_coverage) > max_sources_in_pointing:
-                max_sources_in_pointing = len(this_coverage)
-                optimal_coverage = this_coverage
-                optimal_pointing = idx
+        # Score a grid of shifts of the pointing against all the nearby targets at once, the shift that covers the
+        # target the pointing is for, then the most required targets and then the most other targets is the
+        # optimal pointing.
+        uncovered = np.array([this_token not in covered for this_token in possible_tokens])
+        candidates = possible_tokens[uncovered]
+        is_required = np.array([this_token in this_required for this_token in candidates])
+        is_anchor = candidates == token
+        in_pointing = pointing.grid_search(locations[nearby].ra.degree[uncovered],
+                                           locations[nearby].dec.degree[uncovered],
+                                           required=is_required, anchor=is_anchor)
+        if not in_pointing[is_anchor].all():
+            logging.warning("No pointing found that covers {}, it falls in a chip gap of every shift".format(token))
+        optimal_coverage = list(candidates[in_pointing])
+        logging.info("{} pointing these {} required targets: {}".format(token,
+                                                                      (in_pointing & is_required).sum(),
+                                                                      list(candidates[in_pointing & is_required])))
 
         # remove all sources covered by optimal_pointing from further consideration.
         sys.stdout.write("{} pointing covers: ".format(token))
@@ -228,7 +188,6 @@ def optimize(orbits, required, locations, tokens, camera_name="MEGACAM_40"):
                 sys.stdout.write(" {} ".format(this_token))
                 covered.append(this_token)
         sys.stdout.write("\n")
-        pointing.offset(index=optimal_pointing)
         optimal_pointings[token] = pointing, unique_coverage_list
         n = 0
         new_required = []
@@ -238,6 +197,9 @@ def optimize(orbits, required, locations, tokens, camera_name="MEGACAM_40"):
                 n += 1
         logging.info("Remaining required targets: {}, targets covered: {}".format(n, len(covered)))
         required = new_required
+    missed = [token for token in token_order if token not in covered]
+    if missed:
+        logging.warning("Required targets not covered by any pointing: {}".format(" ".join(missed)))
     return optimal_pointings
 
 
@@ -1,10 +1,18 @@
 import fcntl
 import os
 from numpy import random
+from astropy.io import fits
 from astropy.table import Table
 import numpy
 from . import storage
 from scipy import interpolate
+from scipy import ndimage
+from scipy.special import erf
+
+# Pixels of planted sources rendered per block when adding PSFs to an image, bounds the temporary arrays.
+BLOCK_SIZE = 2 ** 22
+# PSF stamps are pre-computed at sub-pixel offsets that are multiples of 1/PHASES of a pixel.
+PHASES = 20
 
 
 class MatchFile(object):
@@ -74,6 +82,20 @@ class Range(object):
             self.value = self.dist
         return self.value
 
+    def sample(self, n):
+        """
+        Draw n values from the range in one go.
+
+        :param n: number of values to draw.
+        :return: numpy.array
+        """
+        if self.func is None:
+            return random.uniform(self.min, self.max, n)
+        if self._dist is None:
+            # evaluating dist once builds the inverse CDF interpolator.
+            self.dist
+        return self._dist(random.random(n))
+
     def __eq__(self, other):
         return float(self) == float(other)
 
@@ -133,18 +155,16 @@ class KBOGenerator(object):
     @classmethod
     def get_kbos(cls, n, rate, angle, mag, x, y, filename=None):
 
-        kbos = Table(names=('x', 'y', 'mag', 'sky_rate', 'angle', 'id'),
+        # generate the KBOs, drawing each column in one go.
+        kbos = Table([Range(x).sample(n),
+                      Range(y).sample(n),
+                      Range(mag, func=cls._step).sample(n),
+                      Range(rate, func=lambda value: value**0.25).sample(n),
+                      Range(angle).sample(n),
+                      numpy.arange(1, n + 1, dtype='int64')],
+                     names=('x', 'y', 'mag', 'sky_rate', 'angle', 'id'),
                      dtype=('float64', 'float64', 'float64', 'float64', 'float64', 'int64'))
 
-        # generate the KBOs.
-        for kbo in cls(n,
-                       rate=Range(rate, func=lambda value: value**0.25),
-                       angle=Range(angle),
-                       mag=Range(mag, func=cls._step),
-                       x=Range(x),
-                       y=Range(y)):
-            kbos.add_row(kbo)
-
         # Write to a local file if filename given.
         if filename is not None:
             fd = open(filename, 'w')
@@ -155,3 +175,168 @@ class KBOGenerator(object):
             fd.close()
 
         return kbos
+
+
+class DaophotPSF(object):
+    """
+    A PSF in the IRAF/DAOPHOT format written by daophot.psf (the mkpsf .psf.fits file): an analytic function plus
+    a look-up table of corrections sampled at half pixel intervals, optionally varying linearly or quadratically
+    with position in the image.
+
+    The analytic functions follow DAOPHOT II's PROFIL, the parameters being half-widths at half-maximum, with the
+    function integrated over the area of each pixel.
+    """
+
+    FUNCTIONS = ['gauss', 'lorentz', 'moffat15', 'moffat25']
+    # Gauss-Legendre abscissae and weights used to integrate the non-Gaussian functions across a pixel.
+    GAUSS_LEGENDRE = numpy.polynomial.legendre.leggauss(4)
+
+    def __init__(self, header, lookup=None):
+        self.function = header['FUNCTION'].strip().lower()
+        if self.function not in self.FUNCTIONS:
+            raise ValueError("PSF function {} not supported, use one of {}".format(self.function, self.FUNCTIONS))
+        self.height = float(header.get('PSFHEIGH', header.get('HEIGHT', 1.0)))
+        self.psfmag = float(header['PSFMAG'])
+        self.psfrad = float(header['PSFRAD'])
+        self.pars = []
+        while 'PAR{}'.format(len(self.pars) + 1) in header:
+            self.pars.append(float(header['PAR{}'.format(len(self.pars) + 1)]))
+        self.varorder = int(header.get('VARORDER', 0))
+        self.xpsf = float(header.get('XPSF', header.get('PSFX', 1.0)))
+        self.ypsf = float(header.get('YPSF', header.get('PSFY', 1.0)))
+        self.lookup = None
+        if lookup is not None and self.varorder >= 0:
+            lookup = numpy.asarray(lookup, dtype=numpy.float64)
+            if lookup.ndim == 2:
+                lookup = lookup[numpy.newaxis]
+            # pre-computing the spline coefficients once makes each interpolation a cheap evaluation.
+            self.lookup = numpy.array([ndimage.spline_filter(plane, order=3) for plane in lookup])
+        self._stamps = {}
+
+    @classmethod
+    def from_file(cls, filename):
+        with fits.open(filename) as hdulist:
+            return cls(hdulist[0].header, hdulist[0].data)
+
+    def _gaussian_integral(self, offset, hwhm):
+        # integral of exp(-ln2 (t/hwhm)^2) from offset - 0.5 to offset + 0.5
+        scale = numpy.sqrt(numpy.log(2.0)) / hwhm
+        return 0.5 * numpy.sqrt(numpy.pi) / scale * (erf(scale * (offset + 0.5)) - erf(scale * (offset - 0.5)))
+
+    def profile(self, dx, dy):
+        """
+        The analytic part of the PSF at pixel offsets (dx, dy) from the centre of the source.
+        """
+        p1, p2 = self.pars[0], self.pars[1]
+        if self.function == 'gauss':
+            return self._gaussian_integral(dx, p1) * self._gaussian_integral(dy, p2) / (p1 * p2)
+        p3 = len(self.pars) > 2 and self.pars[2] or 0.0
+        abscissae, weights = self.GAUSS_LEGENDRE
+        value = 0.0
+        for ax, wx in zip(abscissae / 2.0, weights / 2.0):
+            for ay, wy in zip(abscissae / 2.0, weights / 2.0):
+                x = dx + ax
+                y = dy + ay
+                z = x ** 2 / p1 ** 2 + y ** 2 / p2 ** 2 + x * y * p3
+                if self.function == 'lorentz':
+                    value = value + wx * wy / (1.0 + z)
+                else:
+                    beta = self.function == 'moffat15' and 1.5 or 2.5
+                    value = value + wx * wy / (1.0 + (2.0 ** (1.0 / beta) - 1.0) * z) ** beta
+        return value / (p1 * p2)
+
+    def correction(self, dx, dy):
+        """
+        The look-up table part of the PSF at offsets (dx, dy), one array per term of the variation with position.
+        """
+        if self.lookup is None:
+            return numpy.zeros((1,) + numpy.shape(dx))
+        centre = (self.lookup.shape[-1] - 1) / 2.0
+        coordinates = numpy.array([(centre + 2.0 * dy).ravel(), (centre + 2.0 * dx).ravel()])
+        return numpy.array([ndimage.map_coordinates(plane, coordinates, order=3, mode='constant',
+                                                    prefilter=False).reshape(numpy.shape(dx))
+                            for plane in self.lookup])
+
+    def terms(self, x, y):
+        """
+        The coefficients of the look-up table planes for sources at image positions x, y.
+        """
+        xn = (numpy.asarray(x) - self.xpsf) / self.xpsf
+        yn = (numpy.asarray(y) - self.ypsf) / self.ypsf
+        terms = [numpy.ones_like(xn), xn, yn, xn ** 2, xn * yn, yn ** 2]
+        return numpy.array(terms[:len(self.lookup) if self.lookup is not None else 1])
+
+    def stamps(self, half_width, phases=PHASES):
+        """
+        The PSF, for a source of magnitude psfmag, on (2 * half_width + 1) pixel square stamps centred at each
+        sub-pixel offset that is a multiple of 1/phases of a pixel.
+
+        :return: array indexed by [plane, y phase, x phase, row, column], plane 0 includes the analytic function.
+        """
+        key = (half_width, phases)
+        if key not in self._stamps:
+            offsets = numpy.arange(-half_width, half_width + 1)
+            shifts = numpy.arange(phases + 1) / float(phases) - 0.5
+            dx = offsets[None, None, None, :] - shifts[None, :, None, None]
+            dy = offsets[None, None, :, None] - shifts[:, None, None, None]
+            dx, dy = numpy.broadcast_arrays(dx, dy)
+            stamps = self.correction(dx, dy)
+            stamps[0] += self.height * self.profile(dx, dy)
+            self._stamps[key] = stamps
+        return self._stamps[key]
+
+
+def add_stars(data, psf, x, y, mag, noise=True, epadu=1.0):
+    """
+    Add stars to an image, the equivalent of daophot.addstar.
+
+    Each star is rendered as the PSF stamp pre-computed for the nearest 1/PHASES pixel offset to its sub-pixel
+    position, cut at the PSF radius, scaled to the star's magnitude and (optionally) with photon noise, then added
+    into data in place.
+
+    :param data: 2D image array, updated in place.
+    :param psf: DaophotPSF
+    :param x: 1-based (IRAF) x pixel coordinates of the stars.
+    :param y: 1-based (IRAF) y pixel coordinates of the stars.
+    :param mag: magnitudes of the stars, on the photometric system of the PSF.
+    :param noise: add photon noise to the added flux.
+    :param epadu: gain used for the noise, electrons per ADU.
+    :return: data
+    """
+    x = numpy.atleast_1d(numpy.asarray(x, dtype=numpy.float64))
+    y = numpy.atleast_1d(numpy.asarray(y, dtype=numpy.float64))
+    scale = 10 ** (0.4 * (psf.psfmag - numpy.atleast_1d(numpy.asarray(mag, dtype=numpy.float64))))
+
+    half_width = int(numpy.ceil(psf.psfrad))
+    offsets = numpy.arange(-half_width, half_width + 1)
+    stamps = psf.stamps(half_width)
+    phases = stamps.shape[1] - 1
+    block = max(1, BLOCK_SIZE // len(offsets) ** 2)
+    for start in range(0, len(x), block):
+        xs = x[start:start + block]
+        ys = y[start:start + block]
+        # the 0-based pixel nearest each star, the stamp pixels around it and the sub-pixel offset of the star.
+        xc = numpy.rint(xs)
+        yc = numpy.rint(ys)
+        cols = xc.astype(int)[:, None, None] - 1 + offsets[None, None, :]
+        rows = yc.astype(int)[:, None, None] - 1 + offsets[None, :, None]
+        xphase = numpy.rint((xs - xc + 0.5) * phases).astype(int)
+        yphase = numpy.rint((ys - yc + 0.5) * phases).astype(int)
+        dx = offsets[None, None, :] - (xs - xc)[:, None, None]
+        dy = offsets[None, :, None] - (ys - yc)[:, None, None]
+        inside = ((dx ** 2 + dy ** 2 <= psf.psfrad ** 2) &
+                  (cols >= 0) & (cols < data.shape[1]) & (rows >= 0) & (rows < data.shape[0]))
+        coefficients = scale[start:start + block] * psf.terms(xs, ys)
+        flux = 0.0
+        for plane, coefficient in zip(stamps, coefficients):
+            flux = flux + coefficient[:, None, None] * plane[yphase, xphase]
+        flux = flux[inside]
+        if noise:
+            # gaussian deviates with the photon noise of the added flux, as addstar does.
+            flux += numpy.sqrt(numpy.clip(flux, 0, None) / epadu) * random.standard_normal(flux.shape)
+        rows, cols = numpy.broadcast_arrays(rows, cols)
+        # bincount sums the overlapping stamps far faster than numpy.add.at.
+        data += numpy.bincount(rows[inside] * data.shape[1] + cols[inside],
+                               weights=flux,
+                               minlength=data.size).reshape(data.shape)
+    return data
@@ -0,0 +1,454 @@
+#!python
+"""
+A local equivalent of the CADC Solar System Object Image Search (SSOIS) for the exposures in dbimages.
+
+FootprintIndex keeps, in an SQLite database, the footprint of each CCD of each exposure (its corners on the sky and
+its WCS) along with the time, filter and target of the exposure.  search finds the CCDs an orbit lands on, using
+ephemerides computed for many orbits at once, and returns them as a table in the format of an SSOIS result so it
+can be given to ssos.SSOSParser.parse in place of a Query.
+"""
+import argparse
+import contextlib
+import logging
+import os
+import sqlite3
+import sys
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy
+from astropy import units
+from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+
+from . import orbfit, parameters, storage, wcs
+from .gui import config
+
+__author__ = 'jjk'
+
+# Columns of an SSOIS result, as read by ssos.SSOSParser.
+SSOS_COLUMNS = ('Image', 'Ext', 'X', 'Y', 'MJD', 'Filter', 'Exptime', 'Object_RA', 'Object_Dec', 'Image_target',
+                'Telescope/Instrument', 'Datalink')
+SSOS_DTYPES = ('U10', 'i4', 'f8', 'f8', 'f8', 'U20', 'f8', 'f8', 'f8', 'U20', 'U20', 'U100')
+
+TELESCOPE_INSTRUMENT = 'CFHT/MegaCam'
+DATALINK = "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/data/pub/CFHT/{}{}[{}]"
+
+# Size of a MegaCam CCD, for headers that don't give it.
+NAXIS1 = 2112
+NAXIS2 = 4644
+
+# Spacing, in days, of the ephemeris that the position at the time of each exposure is interpolated from.
+EPHEMERIS_STEP = 1.0
+
+# Number of exposures whose headers are retrieved at the same time when building the index.
+MAX_WORKERS = 8
+
+_footprint_index = None
+
+
+def _unit_vectors(ra, dec):
+    """
+    Cartesian unit vectors, along a new last axis, of ra/dec in degrees.
+    """
+    ra = numpy.radians(ra)
+    dec = numpy.radians(dec)
+    return numpy.stack([numpy.cos(dec) * numpy.cos(ra), numpy.cos(dec) * numpy.sin(ra), numpy.sin(dec)], axis=-1)
+
+
+def _ra_dec(vectors):
+    """
+    The ra/dec, in degrees, of (not necessarily unit) cartesian vectors along the last axis.
+    """
+    ra = numpy.degrees(numpy.arctan2(vectors[..., 1], vectors[..., 0])) % 360.0
+    dec = numpy.degrees(numpy.arctan2(vectors[..., 2], numpy.hypot(vectors[..., 0], vectors[..., 1])))
+    return ra, dec
+
+
+def _project(vectors, centre):
+    """
+    Gnomonic projection of cartesian unit vectors onto the plane tangent to the unit vector centre.
+
+    @return: the (east, north) coordinates along a new last axis, in radians.
+    """
+    north_pole = numpy.array([0.0, 0.0, 1.0])
+    east = numpy.cross(north_pole, centre)
+    norm = numpy.linalg.norm(east)
+    if norm > 0:
+        east /= norm
+    else:
+        # at a pole any direction will do.
+        east = numpy.array([0.0, 1.0, 0.0])
+    north = numpy.cross(centre, east)
+    depth = vectors.dot(centre)
+    return numpy.stack([vectors.dot(east) / depth, vectors.dot(north) / depth], axis=-1)
+
+
+def _in_quadrilaterals(point, corners):
+    """
+    Which of the convex quadrilaterals (n, 4, 2), with corners in order, contain point (2,).
+
+    @return: boolean array of shape (n,)
+    """
+    edges = numpy.roll(corners, -1, axis=1) - corners
+    offsets = point - corners
+    cross = edges[..., 0] * offsets[..., 1] - edges[..., 1] * offsets[..., 0]
+    return (cross >= 0).all(axis=1) | (cross <= 0).all(axis=1)
+
+
+def exposure_keywords(headers):
+    """
+    The time, filter, exposure time and target of an exposure from the first of headers that has them.
+
+    @param headers: list of fits.Header, entries may be None.
+    @return: mjd, filter, exptime, target
+    """
+    for header in headers:
+        if header is None:
+            continue
+        mjd = header.get('MJDATE', header.get('MJD-OBS', None))
+        if mjd is not None:
+            return (float(mjd), str(header.get('FILTER', '')), float(header.get('EXPTIME', 0.0)),
+                    str(header.get('OBJECT', '')))
+    raise KeyError("No MJDATE or MJD-OBS in headers")
+
+
+def ccd_corners(header):
+    """
+    The ra/dec (degrees) of the corners of the CCD described by header, in order around the CCD.
+
+    @rtype: numpy.ndarray of shape (4, 2)
+    """
+    naxis1 = header.get('NAXIS1', header.get('IMAGEW', NAXIS1))
+    naxis2 = header.get('NAXIS2', header.get('IMAGEH', NAXIS2))
+    ra, dec = wcs.WCS(header).xy2sky([1, naxis1, naxis1, 1], [1, 1, naxis2, naxis2])
+    return numpy.stack([numpy.asarray(getattr(ra, 'value', ra)), numpy.asarray(getattr(dec, 'value', dec))],
+                       axis=-1)
+
+
+class FootprintIndex(object):
+    """
+    The footprints of the CCDs of the exposures in dbimages, persisted in an SQLite database.
+
+    The exposures are held in memory sorted by time, with the unit vector and radius of the circle around each,
+    and the corners of each CCD.  The WCS of a CCD is only read from the database for CCDs an orbit lands on.
+    """
+
+    SCHEMA = ["""CREATE TABLE IF NOT EXISTS exposures (
+                     expnum TEXT PRIMARY KEY,
+                     ftype TEXT NOT NULL,
+                     mjd REAL NOT NULL,
+                     filter TEXT,
+                     exptime REAL,
+                     target TEXT,
+                     ra REAL NOT NULL,
+                     dec REAL NOT NULL,
+                     radius REAL NOT NULL)""",
+              """CREATE TABLE IF NOT EXISTS ccds (
+                     expnum TEXT NOT NULL,
+                     ccd INTEGER NOT NULL,
+                     corners BLOB NOT NULL,
+                     header BLOB NOT NULL,
+                     PRIMARY KEY (expnum, ccd))""",
+              "CREATE INDEX IF NOT EXISTS exposures_mjd ON exposures (mjd)"]
+
+    def __init__(self, filename, dbimages=None):
+        """
+        @param filename: the SQLite database holding the index.
+        @param dbimages: the dbimages container the exposures are listed from, default is storage.DBIMAGES.
+        """
+        self.filename = os.path.expanduser(filename)
+        self.dbimages = dbimages is None and storage.DBIMAGES or dbimages
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            for statement in self.SCHEMA:
+                connection.execute(statement)
+        self._exposures = None
+        self._wcs = {}
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def expnums(self):
+        """
+        @return: the exposure numbers in the index.
+        @rtype: set
+        """
+        with self._connect() as connection:
+            return set(row[0] for row in connection.execute("SELECT expnum FROM exposures"))
+
+    def add(self, expnum, headers, ftype='p'):
+        """
+        Add (or replace) the footprint of an exposure.
+
+        @param expnum: CFHT exposure number.
+        @param headers: the astrometric header of each CCD, as returned by storage._get_sghead, the header of CCD n
+        is the one with EXTVER n + 1 (or, without EXTVER, headers[n + 1]).  Entries without a WCS are skipped.
+        @param ftype: the type of the image the headers are for.
+        """
+        mjd, filter_name, exptime, target = exposure_keywords(headers)
+        rows = []
+        for ext, header in enumerate(headers):
+            # _get_sghead leaves an empty header after the END of the last CCD.
+            if header is None or 'CRVAL1' not in header:
+                continue
+            rows.append((str(expnum), int(header.get('EXTVER', ext)) - 1, ccd_corners(header), header))
+        if not rows:
+            raise ValueError("No CCD headers for {}".format(expnum))
+        vectors = _unit_vectors(*numpy.concatenate([row[2] for row in rows]).T)
+        centre = vectors.sum(axis=0)
+        centre /= numpy.linalg.norm(centre)
+        radius = numpy.degrees(numpy.arccos(numpy.clip(vectors.dot(centre), -1, 1)).max())
+        ra, dec = _ra_dec(centre)
+        with self._connect() as connection:
+            connection.execute("DELETE FROM ccds WHERE expnum=?", (str(expnum),))
+            connection.execute("INSERT OR REPLACE INTO exposures (expnum, ftype, mjd, filter, exptime, target, "
+                               "ra, dec, radius) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                               (str(expnum), ftype, mjd, filter_name, exptime, target, float(ra), float(dec),
+                                float(radius)))
+            connection.executemany("INSERT INTO ccds (expnum, ccd, corners, header) VALUES (?, ?, ?, ?)",
+                                   [(expnum, ccd, sqlite3.Binary(corners.astype('<f8').tobytes()),
+                                     sqlite3.Binary(zlib.compress(header.tostring().encode('utf-8'))))
+                                    for expnum, ccd, corners, header in rows])
+        self._exposures = None
+
+    def build(self, expnums=None, max_workers=MAX_WORKERS, force=False):
+        """
+        Add the exposures not yet in the index, their headers are retrieved max_workers at a time.
+
+        @param expnums: the exposures to add, default is every exposure in dbimages.
+        @param force: add the exposures even if already in the index.
+        @return: the number of exposures added.
+        """
+        if expnums is None:
+            expnums = [expnum for expnum in storage.list_dbimages(dbimages=self.dbimages) if expnum.isdigit()]
+        if not force:
+            indexed = self.expnums()
+            expnums = [expnum for expnum in expnums if str(expnum) not in indexed]
+        logging.info("Adding {} exposures to the footprint index {}".format(len(expnums), self.filename))
+        added = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict((executor.submit(storage._get_sghead, expnum), expnum) for expnum in expnums)
+            for future in as_completed(futures):
+                expnum = futures[future]
+                try:
+                    self.add(expnum, future.result())
+                    added += 1
+                except Exception as ex:
+                    logging.warning("Failed to add {} to the footprint index: {}".format(expnum, ex))
+        return added
+
+    def load(self):
+        """
+        Read the exposures and CCD corners into memory, done on the first search.
+        """
+        with self._connect() as connection:
+            exposures = connection.execute("SELECT expnum, ftype, mjd, filter, exptime, target, ra, dec, radius "
+                                           "FROM exposures ORDER BY mjd").fetchall()
+            ccds = {}
+            for expnum, ccd, corners in connection.execute("SELECT expnum, ccd, corners FROM ccds ORDER BY ccd"):
+                ccds.setdefault(expnum, []).append((ccd, numpy.frombuffer(corners, dtype='<f8').reshape(4, 2)))
+        columns = list(zip(*exposures)) or [()] * 9
+        self._exposures = {'expnum': list(columns[0]),
+                           'ftype': list(columns[1]),
+                           'mjd': numpy.array(columns[2], dtype=float),
+                           'filter': numpy.array(columns[3], dtype=str),
+                           'exptime': numpy.array(columns[4], dtype=float),
+                           'target': list(columns[5]),
+                           'vector': _unit_vectors(numpy.array(columns[6], dtype=float),
+                                                   numpy.array(columns[7], dtype=float)).reshape(-1, 3),
+                           'radius': numpy.array(columns[8], dtype=float),
+                           'ccds': [ccds.get(expnum, []) for expnum in columns[0]]}
+        return self._exposures
+
+    def _get_wcs(self, expnum, ccd):
+        key = (expnum, ccd)
+        if key not in self._wcs:
+            with self._connect() as connection:
+                row = connection.execute("SELECT header FROM ccds WHERE expnum=? AND ccd=?", key).fetchone()
+            self._wcs[key] = wcs.WCS(fits.Header.fromstring(zlib.decompress(row[0]).decode('utf-8')))
+        return self._wcs[key]
+
+    def _ephemeris(self, orbits, mjds, step, processes):
+        """
+        Predict the position and uncertainty of each orbit at each mjd by interpolating an ephemeris with nodes
+        step days apart, the orbits are only predicted on the nodes that bracket an exposure.
+
+        @return: unit vectors (orbits, mjds, 3) and the larger of dra and ddec, in degrees (orbits, mjds)
+        """
+        lower = numpy.floor(mjds / step) * step
+        nodes = numpy.unique(numpy.concatenate([lower, lower + step]))
+        ephemeris = orbfit.predict_many(orbits, Time(nodes, format='mjd', scale='utc'), processes=processes)
+        vectors = _unit_vectors(ephemeris.ra.to(units.degree).value, ephemeris.dec.to(units.degree).value)
+        uncertainty = numpy.maximum(ephemeris.dra.to(units.degree).value, ephemeris.ddec.to(units.degree).value)
+        idx = numpy.searchsorted(nodes, lower)
+        weight = ((mjds - nodes[idx]) / step)[numpy.newaxis, :]
+        vectors = (1 - weight)[..., numpy.newaxis] * vectors[:, idx] + weight[..., numpy.newaxis] * vectors[:, idx + 1]
+        vectors /= numpy.linalg.norm(vectors, axis=-1)[..., numpy.newaxis]
+        uncertainty = (1 - weight) * uncertainty[:, idx] + weight * uncertainty[:, idx + 1]
+        return vectors, uncertainty
+
+    def search_many(self, orbits, start_date=None, end_date=None, filters=None, step=EPHEMERIS_STEP,
+                    processes=None):
+        """
+        Find the CCDs each orbit lands on.
+
+        @param orbits: list of Orbfit objects (or anything orbfit.predict_many accepts).
+        @param start_date: Time, only search exposures taken after this.
+        @param end_date: Time, only search exposures taken before this.
+        @param filters: only search exposures taken in these filters, default is parameters.OSSOS_FILTERS.
+        @param step: spacing in days of the ephemeris positions are interpolated from.
+        @param processes: number of worker processes to compute the ephemerides in.
+        @return: a table in the format of an SSOIS result for each orbit.
+        @rtype: list(Table)
+        """
+        exposures = self._exposures is None and self.load() or self._exposures
+        filters = filters is None and parameters.OSSOS_FILTERS or filters
+        first, last = 0, len(exposures['mjd'])
+        if start_date is not None:
+            first = numpy.searchsorted(exposures['mjd'], Time(start_date).mjd, side='left')
+        if end_date is not None:
+            last = numpy.searchsorted(exposures['mjd'], Time(end_date).mjd, side='right')
+        selected = numpy.arange(first, last)
+        selected = selected[numpy.isin(exposures['filter'][selected], filters)]
+
+        rows = [[] for _ in orbits]
+        if len(orbits) > 0 and len(selected) > 0:
+            mjds = exposures['mjd'][selected]
+            vectors, uncertainty = self._ephemeris(orbits, mjds, step, processes)
+            # the exposures each orbit might be on, within the circle around the exposure plus the uncertainty.
+            cos_separation = (vectors * exposures['vector'][selected][numpy.newaxis]).sum(axis=-1)
+            limit = numpy.cos(numpy.radians(numpy.minimum(exposures['radius'][selected][numpy.newaxis] +
+                                                          uncertainty, 180.0)))
+            for orbit_idx, exposure_idx in zip(*numpy.nonzero(cos_separation >= limit)):
+                row = self._locate(selected[exposure_idx], vectors[orbit_idx, exposure_idx])
+                if row is not None:
+                    rows[orbit_idx].append(row)
+
+        tables = []
+        for orbit_rows in rows:
+            table = Table(rows=orbit_rows or None, names=SSOS_COLUMNS, dtype=SSOS_DTYPES)
+            table.meta['dbimages'] = self.dbimages
+            tables.append(table)
+        return tables
+
+    def search(self, orbit, start_date=None, end_date=None, filters=None, step=EPHEMERIS_STEP):
+        """
+        Find the CCDs an orbit lands on, see search_many.
+
+        @rtype: Table
+        """
+        return self.search_many([orbit], start_date=start_date, end_date=end_date, filters=filters, step=step)[0]
+
+    def _locate(self, idx, vector):
+        """
+        The row of an SSOIS result for the CCD of exposure idx that the position vector lands on, None if it is
+        in a gap or off the exposure.
+        """
+        exposures = self._exposures
+        ccds = exposures['ccds'][idx]
+        if not ccds:
+            return None
+        centre = exposures['vector'][idx]
+        corners = _project(_unit_vectors(*numpy.array([corner for ccd, corner in ccds]).T).transpose(1, 0, 2),
+                           centre)
+        inside = numpy.nonzero(_in_quadrilaterals(_project(vector, centre), corners))[0]
+        if not len(inside):
+            return None
+        expnum = exposures['expnum'][idx]
+        ftype = exposures['ftype'][idx]
+        ccd = ccds[inside[0]][0]
+        ra, dec = _ra_dec(vector)
+        x, y = self._get_wcs(expnum, ccd).sky2xy(float(ra), float(dec))
+        return ("{}{}".format(expnum, ftype), ccd + 1, float(x), float(y), exposures['mjd'][idx],
+                exposures['filter'][idx], exposures['exptime'][idx], float(ra), float(dec),
+                exposures['target'][idx], TELESCOPE_INSTRUMENT, DATALINK.format(expnum, ftype, ccd))
+
+
+def footprint_index_from_config():
+    """
+    The FootprintIndex in the PRECOVERY.DIRECTORY of the configuration.
+    """
+    try:
+        directory = config.read("PRECOVERY.DIRECTORY")
+    except KeyError:
+        directory = "~/.ossos/precovery"
+    return FootprintIndex(os.path.join(os.path.expanduser(directory), 'footprints.sqlite'))
+
+
+def local_index():
+    """
+    The footprint index to search in place of SSOIS, None unless PRECOVERY.ENABLED is set in the configuration.
+
+    @rtype: FootprintIndex
+    """
+    global _footprint_index
+    try:
+        enabled = config.read("PRECOVERY.ENABLED")
+    except KeyError:
+        enabled = False
+    if isinstance(enabled, str):
+        enabled = enabled.lower() in ['1', 'true', 'yes', 'on']
+    if not enabled:
+        return None
+    if _footprint_index is None:
+        _footprint_index = footprint_index_from_config()
+    return _footprint_index
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the local index of dbimages exposure footprints, or search it for the exposures that "
+                    "contain the objects whose astrometry is given.")
+    parser.add_argument('ast_files', nargs='*',
+                        help="MPC formatted astrometry files of objects to search for, with no files the index "
+                             "is brought up to date with dbimages.")
+    parser.add_argument('--index', default=None,
+                        help="the SQLite index, default is footprints.sqlite in PRECOVERY.DIRECTORY")
+    parser.add_argument('--expnums', nargs='*', default=None,
+                        help="add only these exposures to the index")
+    parser.add_argument('--start-date', default=parameters.SURVEY_START,
+                        help="search exposures taken after this date")
+    parser.add_argument('--end-date', default=None,
+                        help="search exposures taken before this date")
+    parser.add_argument('--output-dir', default='.',
+                        help="directory the SSOIS format result for each object is written to")
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes for the orbit fits and ephemerides")
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                        help="exposure headers retrieved at the same time when building the index")
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.debug and logging.DEBUG or logging.INFO)
+    index = args.index is None and footprint_index_from_config() or FootprintIndex(args.index)
+
+    if not args.ast_files:
+        added = index.build(expnums=args.expnums, max_workers=args.max_workers)
+        logging.info("Added {} exposures to {}".format(added, index.filename))
+        return 0
+
+    orbits = orbfit.fit_many(args.ast_files, processes=args.processes)
+    end_date = args.end_date is not None and Time(args.end_date, scale='utc') or None
+    tables = index.search_many(orbits, start_date=Time(args.start_date, scale='utc'), end_date=end_date,
+                               processes=args.processes)
+    for ast_file, table in zip(args.ast_files, tables):
+        filename = os.path.join(args.output_dir,
+                                os.path.splitext(os.path.basename(ast_file))[0] + '.ssos.tsv')
+        table.write(filename, format='ascii.basic', delimiter='\t', overwrite=True)
+        logging.info("{}: {} CCDs".format(filename, len(table)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,11 +8,12 @@ import requests
 from astropy import units
 from astropy.coordinates import SkyCoord
 from astropy.io import ascii
+from astropy.table import Table
 from astropy.time import Time
-from . import astrom, mpc, parameters
+from . import astrom, mpc, parameters, precovery
 from .astrom import SourceReading
 from .gui import logger, config
-from .orbfit import Orbfit
+from .orbfit import Orbfit, predict_many
 from . import storage
 
 
@@ -28,7 +29,11 @@ NEW_LINE = '\r\n'
 
 class TracksParser(object):
 
-    def __init__(self, inspect=True, skip_previous=False, lunation_count=0):
+    def __init__(self, inspect=True, skip_previous=False, lunation_count=0, precovery_index=None):
+        """
+        :param precovery_index: search this precovery.FootprintIndex rather than SSOIS, default is the one given by
+        precovery.local_index.
+        """
         logger.debug("Setting up TracksParser")
         self.orbit = None
         self._nights_per_darkrun = 18 * units.day
@@ -37,6 +42,7 @@ class TracksParser(object):
         self.skip_previous = skip_previous
         self.ssos_parser = None
         self.initial_lunation_count = lunation_count
+        self.precovery_index = precovery_index is not None and precovery_index or precovery.local_index()
 
     def parse(self, filename, print_summary=True):
         logger.debug("Parsing SSOS Query.")
@@ -111,12 +117,18 @@ class TracksParser(object):
                 self._nights_per_darkrun +
                 lunation_count * self._nights_separating_darkruns)), format='jd', scale='utc')
 
-        logger.info("Sending query to SSOS start_date: {} end_data: {}\n".format(search_start_date, search_end_date))
-        query = Query(mpc_observations,
-                      search_start_date=search_start_date,
-                      search_end_date=search_end_date)
+        if self.precovery_index is not None:
+            logger.info("Searching {} start_date: {} end_date: {}\n".format(self.precovery_index.filename,
+                                                                           search_start_date, search_end_date))
+            ssos_result = self.precovery_index.search(self.orbit, search_start_date, search_end_date)
+        else:
+            logger.info("Sending query to SSOS start_date: {} end_data: {}\n".format(search_start_date,
+                                                                                      search_end_date))
+            ssos_result = Query(mpc_observations,
+                                search_start_date=search_start_date,
+                                search_end_date=search_end_date).get()
         logger.debug("Parsing query results...")
-        tracks_data = self.ssos_parser.parse(query.get(), mpc_observations=mpc_observations)
+        tracks_data = self.ssos_parser.parse(ssos_result, mpc_observations=mpc_observations, orbit=self.orbit)
 
         tracks_data.mpc_observations = {}
 
@@ -135,38 +147,41 @@ class TracksParser(object):
         if not isinstance(min_radius, units.Quantity):
             min_radius = min_radius * units.arcsec
 
+        # the orbit's prediction for each of the observations.
+        astrom_observations = tracks_data.observations
+        ephemeris = predict_many([self.orbit], [Time(astrom_observation.mjd, format='mjd', scale='utc')
+                                                for astrom_observation in astrom_observations])
+
         for source in tracks_data.get_sources():
-            astrom_observations = tracks_data.observations
             source_readings = source.get_readings()
             foci = []
             # Loop over all the sources to determine which ones go which which focus location.
             # this is helpful to for blinking.
             for idx in range(len(source_readings)):
                 source_reading = source_readings[idx]
-                astrom_observation = astrom_observations[idx]
-                self.orbit.predict(Time(astrom_observation.mjd, format='mjd', scale='utc'))
                 assert isinstance(source_reading, SourceReading)
                 if ref_sky_coord is None or source_reading.sky_coord.separation(ref_sky_coord) > min_radius * 0.8:
                     foci.append([])
                     ref_sky_coord = source_reading.sky_coord
-                foci[-1].append(source_reading)
+                foci[-1].append(idx)
             for focus in foci:
                 ra = numpy.zeros(len(focus))
                 dec = numpy.zeros(len(focus))
-                for idx in range(len(focus)):
-                    source_reading = focus[idx]
-                    ra[idx] = source_reading.sky_coord.ra.to('degree').value
-                    dec[idx] = source_reading.sky_coord.dec.to('degree').value
+                for focus_idx, idx in enumerate(focus):
+                    source_reading = source_readings[idx]
+                    ra[focus_idx] = source_reading.sky_coord.ra.to('degree').value
+                    dec[focus_idx] = source_reading.sky_coord.dec.to('degree').value
                 ref_sky_coord = SkyCoord(ra.mean(), dec.mean(), unit='degree')
-                for source_reading in focus:
+                for idx in focus:
+                    source_reading = source_readings[idx]
                     source_reading.reference_sky_coord = ref_sky_coord
-                    source_reading.pa = self.orbit.pa
+                    source_reading.pa = ephemeris.pa[0, idx]
                     # why are these being recorded just in pixels?  Because the error ellipse is drawn in pixels.
                     # TODO: Modify error ellipse drawing routine to use WCS but be sure
                     # that this does not cause trouble with the use of dra/ddec for cutout computer
-                    source_reading.dx = self.orbit.dra
-                    source_reading.dy = self.orbit.ddec
-                    frame = astrom_observation.rawname
+                    source_reading.dx = ephemeris.dra[0, idx]
+                    source_reading.dy = ephemeris.ddec[0, idx]
+                    frame = astrom_observations[idx].rawname
                     if frame in tracks_data.mpc_observations:
                         source_reading.discovery = tracks_data.mpc_observations[frame].discovery
 
@@ -295,28 +310,39 @@ class SSOSParser(object):
                                   ftype=ftype,
                                   ccdnum=ccd)
 
-    def parse(self, ssos_result_filename_or_lines, mpc_observations=None):
+    def parse(self, ssos_result_filename_or_lines, mpc_observations=None, orbit=None):
         """
         given the result table create 'source' objects.
 
-        :param ssos_result_filename_or_lines:
+        :param ssos_result_filename_or_lines: the SSOIS result, or a Table in the same format from precovery.
         :param mpc_observations: a list of mpc.Observation objects used to retrieve the SSOS observations
+        :param orbit: the orbit fit to mpc_observations, fit here if not given.
         """
-        table_reader = ascii.get_reader(Reader=ascii.Basic)
-        table_reader.inconsistent_handler = self._skip_missing_data
-        table_reader.header.splitter.delimiter = '\t'
-        table_reader.data.splitter.delimiter = '\t'
-        ssos_table = table_reader.read(ssos_result_filename_or_lines)
+        if isinstance(ssos_result_filename_or_lines, Table):
+            ssos_table = ssos_result_filename_or_lines
+        else:
+            table_reader = ascii.get_reader(Reader=ascii.Basic)
+            table_reader.inconsistent_handler = self._skip_missing_data
+            table_reader.header.splitter.delimiter = '\t'
+            table_reader.data.splitter.delimiter = '\t'
+            ssos_table = table_reader.read(ssos_result_filename_or_lines)
 
-        dbimage_list = storage.list_dbimages(dbimages=storage.DBIMAGES)
-        logger.debug("Comparing to {} observations in dbimages: {}".format(len(dbimage_list), storage.DBIMAGES))
         sources = []
         observations = []
         source_readings = []
+        if len(ssos_table) == 0:
+            return SSOSData(observations, [source_readings], self.provisional_name)
 
-        if mpc_observations is not None and isinstance(mpc_observations[0], mpc.Observation):
-            orbit = Orbfit(mpc_observations)
+        if ssos_table.meta.get('dbimages', None) == storage.DBIMAGES:
+            # a precovery result, every exposure in it came from dbimages.
+            dbimage_list = None
         else:
+            dbimage_list = storage.list_dbimages(dbimages=storage.DBIMAGES)
+            logger.debug("Comparing to {} observations in dbimages: {}".format(len(dbimage_list), storage.DBIMAGES))
+
+        if orbit is None and mpc_observations is not None and isinstance(mpc_observations[0], mpc.Observation):
+            orbit = Orbfit(mpc_observations)
+        elif orbit is None:
             from mp_ephem import horizons
             start_time = Time(min(ssos_table['MJD']), format='mjd')
             stop_time = Time(max(ssos_table['MJD']), format='mjd')
@@ -325,8 +351,11 @@ class SSOSParser(object):
 
         warnings.filterwarnings('ignore')
         logger.info("Loading {} observations\n".format(len(ssos_table)))
+        logger.info("Calling predict")
+        ephemeris = predict_many([orbit], Time(ssos_table['MJD'], format='mjd', scale='utc'))
+        logger.info("Done calling predict")
         expnums_examined = []
-        for row in ssos_table:
+        for row_idx, row in enumerate(ssos_table):
             # Trim down to OSSOS-specific images
 
             logger.debug("Checking row: {}".format(row))
@@ -338,7 +367,7 @@ class SSOSParser(object):
             # For CFHT/MegaCam strip off the trailing character to get the exposure number.
             ftype = row['Image'][-1]
             expnum = row['Image'][:-1]
-            if str(expnum) not in dbimage_list:
+            if dbimage_list is not None and str(expnum) not in dbimage_list:
                 logger.debug("Expnum: {} Failed dbimage list check".format(expnum))
                 continue
             logger.debug("Expnum: {} Passed dbimage list check".format(expnum))
@@ -357,10 +386,10 @@ class SSOSParser(object):
             #    continue
 
             obs_date = Time(mjd, format='mjd', scale='utc')
-            logger.info("Calling predict")
-            orbit.predict(obs_date)
-            logger.info("Done calling predict")
-            if orbit.dra > 15 * units.arcminute or orbit.ddec > 15.0 * units.arcminute:
+            orbit_coordinate = SkyCoord(ephemeris.ra[0, row_idx], ephemeris.dec[0, row_idx])
+            orbit_dra = ephemeris.dra[0, row_idx]
+            orbit_ddec = ephemeris.ddec[0, row_idx]
+            if orbit_dra > 15 * units.arcminute or orbit_ddec > 15.0 * units.arcminute:
                 print("Skipping entry as orbit uncertainty at date {} is large.".format(obs_date))
                 continue
             if expnum in expnums_examined:
@@ -372,8 +401,8 @@ class SSOSParser(object):
                           "ra:{} dec:{} x:{} y:{}").format(expnum, ccd, ra, dec, x, y))
 
             logger.debug(("Orbfit Prediction: "
-                          "ra:{} dec:{} ").format(orbit.coordinate.ra.to(units.degree),
-                                                  orbit.coordinate.dec.to(units.degree)))
+                          "ra:{} dec:{} ").format(orbit_coordinate.ra.to(units.degree),
+                                                  orbit_coordinate.dec.to(units.degree)))
             logger.info("Building Observation")
             observation = SSOSParser.build_source_reading(expnum, ccd, ftype=ftype)
             observation.mjd = mjd
@@ -401,16 +430,16 @@ class SSOSParser(object):
             observations.append(observation)
             null_observation = observation.rawname in self.null_observations
 
-            ddec = orbit.ddec + abs(orbit.coordinate.dec - ssois_coordinate.dec)
-            dra = orbit.dra + abs(orbit.coordinate.ra - ssois_coordinate.ra)
+            ddec = orbit_ddec + abs(orbit_coordinate.dec - ssois_coordinate.dec)
+            dra = orbit_dra + abs(orbit_coordinate.ra - ssois_coordinate.ra)
 
             logger.info(" Building SourceReading .... \n")
             source_reading = astrom.SourceReading(x=x, y=y, x0=x, y0=y,
-                                                  ra=orbit.coordinate.ra.to(units.degree).value,
-                                                  dec=orbit.coordinate.dec.to(units.degree).value,
+                                                  ra=orbit_coordinate.ra.to(units.degree).value,
+                                                  dec=orbit_coordinate.dec.to(units.degree).value,
                                                   xref=x, yref=y, obs=observation,
                                                   ssos=True, from_input_file=from_input_file,
-                                                  dx=dra, dy=ddec, pa=orbit.pa,
+                                                  dx=dra, dy=ddec, pa=ephemeris.pa[0, row_idx],
                                                   null_observation=null_observation)
             source_reading.mpc_observation = mpc_observation
             source_readings.append(source_reading)
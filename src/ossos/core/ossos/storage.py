@@ -1,13 +1,21 @@
 """OSSOS VOSpace storage convenience package"""
+import atexit
 import sys, traceback
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from six import StringIO, BytesIO
 import math
 import errno
 import fnmatch
+import hashlib
+import json
 from glob import glob
 import os
 import re
+import shutil
 import tempfile
+import time
 import logging
 import warnings
 from glob import glob
@@ -19,6 +27,7 @@ from astropy.coordinates import SkyCoord
 from astropy.nddata import Cutout2D
 from astropy.io import ascii
 from astropy.io import fits
+from astropy.table import Table
 from astropy.io.fits.verify import VerifyWarning
 from astropy.time import Time
 from astropy.units import Quantity
@@ -27,14 +36,19 @@ from astropy.wcs import FITSFixedWarning
 from cadcutils import exceptions
 from six import BytesIO
 
+from . import cache
 from . import coding
 from . import util
+from .transport import ResilientClient, transport_from_config
 from .downloads.cutouts.calculator import CoordinateConverter
 from .gui import config
 from .gui import logger
 from .wcs import WCS
 
-client = vos.Client()
+# all calls to VOSpace go through the transport: retries with backoff, circuit breaking, deadlines and a limit on
+# simultaneous calls, see ossos.transport.
+transport = transport_from_config()
+client = ResilientClient(vos.Client(), transport)
 # from .gui.errorhandling import DownloadErrorHandler
 
 # Try and turn off warnings, only works for some releases of requests.
@@ -81,15 +95,23 @@ class Wrapper(object):
 SUCCESS = 'success'
 
 # cache holders.
+header_cache = cache.header_cache_from_config()
+file_cache = cache.file_cache_from_config()
 mopheaders = {}
+virtual_images = {}
 astheaders = {}
 sgheaders = {}
+node_dates = {}
 fwhm = {}
 zmag = {}
 tags = {}
 
 APCOR_EXT = "apcor"
 ZEROPOINT_USED_EXT = "zeropoint.used"
+CALIBRATION_EXT = "calibration.json"
+VIRTUAL_EXT = "virtual.json"
+# image versions that may be virtual, a header override of another image, see make_virtual_image.
+VIRTUAL_VERSIONS = ['s']
 PSF_EXT = "psf.fits"
 FITS_EXT = ".fits.fz"
 FITS_EXT = ".fits"
@@ -101,6 +123,9 @@ class MyRequests(object):
         self.requests = requests_module
 
     def get(self, *args, **kwargs):
+        return transport.call('web', self._get, *args, **kwargs)
+
+    def _get(self, *args, **kwargs):
         resp = self.requests.get(*args, **kwargs)
         resp.raise_for_status()
         return resp
@@ -129,6 +154,9 @@ def get_apcor(expnum, ccd, version='p', prefix=None):
     @return:
     """
     uri = get_uri(expnum, ccd, ext=APCOR_EXT, version=version, prefix=prefix)
+    apcor = get_calibration(expnum, ccd, 'apcor', version=version, prefix=prefix)
+    if apcor is not None:
+        return apcor
     apcor_file_name = tempfile.NamedTemporaryFile()
     client.copy(uri, apcor_file_name.name)
     apcor_file_name.seek(0)
@@ -374,20 +402,12 @@ def set_tags_on_uri(uri, keys, values=None):
 
 
 def _set_tags(expnum, keys, values=None):
-    uri = os.path.join(DBIMAGES, str(expnum))
-    node = client.get_node(uri, force=True)
     if values is None:
         values = []
         for idx in range(len(keys)):
             values.append(None)
     assert (len(values) == len(keys))
-    for idx in range(len(keys)):
-        key = keys[idx]
-        tag = tag_uri(key)
-        value = values[idx]
-        node.props[tag] = value
-    client.add_props(node)
-    return client.get_node(uri, force=True)
+    return tag_store.set_tags(expnum, dict(list(zip(keys, values))))
 
 
 def set_tags(expnum, props):
@@ -432,11 +452,7 @@ def get_tag(expnum, key):
     @return: the value of the tag
     @rtype: str
     """
-
-    uri = tag_uri(key)
-    force = uri not in get_tags(expnum)
-    value = get_tags(expnum, force=force).get(uri, None)
-    return value
+    return tag_store.get_tag(expnum, key)
 
 
 def get_process_tag(program, ccd, version='p'):
@@ -458,8 +474,386 @@ def get_tags(expnum, force=False):
     @return: dict
     @rtype: dict
     """
-    uri = os.path.join(DBIMAGES, str(expnum))
-    return client.get_node(uri, force=force).props
+    return tag_store.get_tags(expnum, force=force)
+
+
+class TagStore(object):
+    """
+    Serve the OSSOS tags (processing status etc.) of dbimages exposure nodes from memory.
+
+    The properties of an exposure's container node are retrieved once, with a single get_node call, and the
+    task/ccd lookups for that exposure are then answered from that copy for ttl seconds.  A lookup of a tag that
+    is not in the copy goes back to VOSpace, it may have been set since.  Tag writes are recorded as pending and
+    sent with one add_props call per node when the store is flushed, only the pending tags are sent so the tags
+    other processes have set meanwhile are not overwritten.  With autoflush on (the default) every set_tags call
+    is flushed immediately, inside a batch() block writes are held until the block exits.
+    """
+
+    def __init__(self, dbimages=None, autoflush=True, ttl=60.0):
+        """
+        @param dbimages: the dbimages containerNode, default is DBIMAGES at the time of the lookup.
+        @param ttl: seconds a retrieved node is used for before it is retrieved again.
+        """
+        self.dbimages = dbimages
+        self.autoflush = autoflush
+        self.ttl = ttl
+        self._nodes = {}
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def node_uri(self, expnum):
+        return os.path.join(self.dbimages is not None and self.dbimages or DBIMAGES, str(expnum))
+
+    def _node(self, expnum, force=False):
+        expnum = str(expnum)
+        with self._lock:
+            node, retrieved = self._nodes.get(expnum, (None, 0))
+        if node is None or force or time.time() - retrieved > self.ttl:
+            node = client.get_node(self.node_uri(expnum), force=True)
+            with self._lock:
+                self._nodes[expnum] = (node, time.time())
+        return node
+
+    def prefetch(self, expnums, max_workers=8):
+        """
+        Retrieve the nodes of all the given exposures, concurrently, so later lookups are served from memory.
+
+        @param expnums: list of exposure numbers
+        @param max_workers: maximum number of simultaneous requests to VOSpace.
+        """
+        missing = [str(expnum) for expnum in expnums if str(expnum) not in self._nodes]
+        if not missing:
+            return
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(self._node, missing))
+
+    def get_tags(self, expnum, force=False):
+        """
+        @param expnum: exposure whose tags are wanted.
+        @param force: retrieve the node from VOSpace even if we already have it.
+        @return: dict of tag uri -> value, including writes not yet flushed.
+        @rtype: dict
+        """
+        props = dict(self._node(expnum, force=force).props)
+        with self._lock:
+            props.update(self._pending.get(str(expnum), {}))
+        return props
+
+    def get_tag(self, expnum, key, force=False):
+        uri = tag_uri(key)
+        tags = self.get_tags(expnum, force=force)
+        if uri not in tags and not force:
+            tags = self.get_tags(expnum, force=True)
+        return tags.get(uri, None)
+
+    def set_tags(self, expnum, props):
+        """
+        Record the key/value pairs in props as tags on expnum, sent to VOSpace on the next flush.
+
+        @param expnum: str
+        @param props: dict
+        """
+        expnum = str(expnum)
+        with self._lock:
+            pending = self._pending.setdefault(expnum, {})
+            for key in props:
+                pending[tag_uri(key)] = props[key]
+        if self.autoflush:
+            self.flush(expnum)
+
+    def set_tag(self, expnum, key, value):
+        self.set_tags(expnum, {key: value})
+
+    def flush(self, expnum=None):
+        """
+        Send pending tag writes to VOSpace, one add_props call per exposure node.
+
+        @param expnum: only flush this exposure, default is all exposures with pending writes.
+        """
+        with self._lock:
+            expnums = [str(expnum)] if expnum is not None else list(self._pending.keys())
+        for this_expnum in expnums:
+            with self._lock:
+                pending = self._pending.pop(this_expnum, None)
+            if not pending:
+                continue
+            try:
+                # a fresh copy, so add_props (which sends what differs from the server) only sends our tags.
+                node = client.get_node(self.node_uri(this_expnum), force=True)
+                node.props.update(pending)
+                client.add_props(node)
+                with self._lock:
+                    self._nodes[this_expnum] = (node, time.time())
+            except Exception:
+                # put the writes back so a later flush can try again.
+                with self._lock:
+                    pending.update(self._pending.get(this_expnum, {}))
+                    self._pending[this_expnum] = pending
+                raise
+
+    @contextmanager
+    def batch(self):
+        """
+        Hold tag writes made inside the block and send them, coalesced per node, when the block exits.
+        """
+        autoflush = self.autoflush
+        self.autoflush = False
+        try:
+            yield self
+        finally:
+            self.autoflush = autoflush
+            self.flush()
+
+    def invalidate(self, expnum=None):
+        """
+        Forget the retrieved node(s) so the next lookup goes back to VOSpace.
+        """
+        with self._lock:
+            if expnum is None:
+                self._nodes.clear()
+            else:
+                self._nodes.pop(str(expnum), None)
+
+
+def _flush_tags_at_exit():
+    try:
+        tag_store.flush()
+    except Exception as ex:
+        logging.error("Failed to write pending tags to VOSpace: {}".format(ex))
+
+
+tag_store = TagStore()
+atexit.register(_flush_tags_at_exit)
+
+
+def _report_at_exit():
+    if file_cache.hits or file_cache.misses:
+        logger.info(str(file_cache))
+    if transport.stats():
+        logger.info("VOSpace transport:\n{}".format(transport))
+
+
+atexit.register(_report_at_exit)
+
+
+class CalibrationStore(object):
+    """
+    Serve the per-CCD calibration values of an exposure (fwhm, zeropoint, apcor, trans and astlevel) from a single
+    manifest file instead of one small file or tag per value per CCD.
+
+    The original files (and image headers) remain the reference, the manifest is only an accelerator:
+
+     * the pipeline step that produces a value records a digest of it as a tag on the exposure node (tags are
+       written one key at a time, so the CCDs of an exposure processed at the same time don't interfere);
+     * once all the CCDs are done, a single writer (build) reads the values from the original files and writes
+       dbimages/{expnum}/{expnum}.calibration.json holding the values of all the CCDs, keyed by prefix, version
+       and ccd (eg. 'p22' or 'fks05');
+     * a manifest value is only used when its digest matches the tag, so a value that has been recomputed since
+       the manifest was built is looked up in the original file instead.
+
+    The manifest is retrieved once per exposure, the tags come with the exposure node the status lookups use.
+    """
+
+    FIELDS = ['fwhm', 'zeropoint', 'apcor', 'trans', 'astlevel']
+
+    # the field held in each of the original one value files.
+    EXT_FIELDS = {'fwhm': 'fwhm', ZEROPOINT_USED_EXT: 'zeropoint', APCOR_EXT: 'apcor', 'trans.jmp': 'trans'}
+
+    def __init__(self):
+        self._manifests = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def uri(expnum):
+        return get_uri(expnum, ccd=None, version=None, ext=CALIBRATION_EXT)
+
+    @staticmethod
+    def entry_key(ccd, version='p', prefix=None):
+        return "{}{}{:02d}".format(prefix is not None and prefix or '', version, int(ccd))
+
+    @staticmethod
+    def tag(field, ccd, version='p', prefix=None):
+        """
+        The exposure tag holding the digest of the current value of field, eg. calibration_fwhm_p22.
+        """
+        return get_process_tag((prefix is not None and prefix or '') + 'calibration_' + field, ccd, version)
+
+    @staticmethod
+    def digest(value):
+        return hashlib.md5(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _retrieve(self, expnum):
+        try:
+            return json.loads(open_vos_or_local(self.uri(expnum)).read()).get('ccds', {})
+        except Exception as ex:
+            logger.debug("No calibration manifest for {}: {}".format(expnum, ex))
+            return {}
+
+    def manifest(self, expnum, force=False):
+        """
+        @param expnum: exposure whose manifest is wanted.
+        @param force: retrieve the manifest from VOSpace even if we already have it.
+        @return: dict of entry key -> dict of field -> value, empty if the exposure has no manifest.
+        @rtype: dict
+        """
+        expnum = str(expnum)
+        with self._lock:
+            manifest = self._manifests.get(expnum, None)
+        if manifest is None or force:
+            manifest = self._retrieve(expnum)
+            with self._lock:
+                self._manifests[expnum] = manifest
+        return manifest
+
+    def get(self, expnum, ccd, field, version='p', prefix=None):
+        """
+        @return: the value of field for the given CCD, None if it is not in the manifest or is out of date.
+        """
+        key = self.entry_key(ccd, version, prefix)
+        entry = self.manifest(expnum).get(key, None)
+        if entry is None or field not in entry:
+            return None
+        current = tag_store.get_tags(expnum).get(tag_uri(self.tag(field, ccd, version, prefix)), None)
+        if current is None:
+            return None
+        if self.digest(entry[field]) != current:
+            # maybe rebuilt since we retrieved it.
+            entry = self.manifest(expnum, force=True).get(key, {})
+            if field not in entry or self.digest(entry[field]) != current:
+                logger.debug("Manifest {} of {} is out of date".format(field, key))
+                return None
+        return entry[field]
+
+    def get_by_uri(self, uri):
+        """
+        The manifest value of the content of one of the original calibration files, eg. 1616681p22.apcor.
+
+        @return: the value, None if uri isn't a calibration file or the value is not in the manifest.
+        """
+        match = re.match(r'^(?P<prefix>\D*)(?P<expnum>\d+)(?P<version>[a-z])(?P<ccd>\d{2})\.(?P<ext>.+)$',
+                         os.path.basename(uri))
+        if match is None or match.group('ext') not in self.EXT_FIELDS:
+            return None
+        return self.get(match.group('expnum'), match.group('ccd'), self.EXT_FIELDS[match.group('ext')],
+                        version=match.group('version'), prefix=match.group('prefix'))
+
+    def record(self, expnum, ccd, values, version='p', prefix=None):
+        """
+        Record the digests of newly computed calibration values of one CCD, making the values in the manifest (if
+        any) out of date until it is rebuilt.
+
+        @param values: dict of field -> value, as read back from the original file by build.
+        """
+        unknown = set(values) - set(self.FIELDS)
+        if unknown:
+            raise ValueError("Unknown calibration fields: {}".format(", ".join(sorted(unknown))))
+        set_tags(expnum, dict((self.tag(field, ccd, version, prefix), self.digest(values[field]))
+                              for field in values))
+
+    @staticmethod
+    def read(expnum, ccd, field, version='p', prefix=None):
+        """
+        Read a calibration value from its original file (or image header).
+        """
+        if field == 'astlevel':
+            return int(get_astheader(expnum, ccd, version=version, prefix=prefix).get('ASTLEVEL', 0))
+        ext = [ext for ext in CalibrationStore.EXT_FIELDS if CalibrationStore.EXT_FIELDS[ext] == field][0]
+        content = open_vos_or_local(get_uri(expnum, ccd, version, ext=ext, prefix=prefix)).read()
+        if field == 'apcor':
+            return [float(x) for x in content.split()]
+        if field == 'trans':
+            return parse_trans(content)
+        return float(content)
+
+    def build(self, expnum, ccds, version='p', prefix=None, fields=None, max_workers=8, dry_run=False):
+        """
+        Write the manifest of an exposure from the original files, run once all the CCDs have been processed.
+
+        Values whose digest tag is missing (computed before the tags were recorded) get one.
+
+        @param ccds: the CCDs to include.
+        @param fields: the fields to include, default is all.
+        @return: the manifest.
+        """
+        fields = fields is None and self.FIELDS or fields
+        jobs = [(ccd, field) for ccd in ccds for field in fields]
+
+        def read(job):
+            try:
+                return self.read(expnum, job[0], job[1], version=version, prefix=prefix)
+            except Exception as ex:
+                logger.debug("No {} for {} ccd {}: {}".format(job[1], expnum, job[0], ex))
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            values = list(executor.map(read, jobs))
+
+        tags = tag_store.get_tags(expnum, force=True)
+        manifest = {}
+        missing = {}
+        for (ccd, field), value in zip(jobs, values):
+            if value is None:
+                continue
+            manifest.setdefault(self.entry_key(ccd, version, prefix), {})[field] = value
+            tag = self.tag(field, ccd, version, prefix)
+            if tags.get(tag_uri(tag), None) is None:
+                missing[tag] = self.digest(value)
+        if dry_run:
+            return manifest
+        if missing:
+            set_tags(expnum, missing)
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json') as fobj:
+            json.dump({'ccds': manifest}, fobj, indent=1, sort_keys=True)
+            fobj.flush()
+            copy(fobj.name, self.uri(expnum))
+        with self._lock:
+            self._manifests[str(expnum)] = manifest
+        return manifest
+
+    def invalidate(self, expnum=None):
+        """
+        Forget the retrieved manifest(s) so the next lookup goes back to VOSpace.
+        """
+        with self._lock:
+            if expnum is None:
+                self._manifests.clear()
+            else:
+                self._manifests.pop(str(expnum), None)
+
+
+calibrations = CalibrationStore()
+
+
+def get_calibration(expnum, ccd, field, version='p', prefix=None):
+    """
+    Look up a calibration value of expnum/ccd in the exposure's calibration manifest.
+
+    @param field: one of CalibrationStore.FIELDS
+    @return: the value, None if the exposure's manifest doesn't have it or it is out of date.
+    """
+    return calibrations.get(expnum, ccd, field, version=version, prefix=prefix)
+
+
+def record_calibration(expnum, ccd, version='p', prefix=None, **values):
+    """
+    Record that the calibration values (fwhm, zeropoint, apcor, trans, astlevel) of expnum/ccd were (re)computed.
+    """
+    return calibrations.record(expnum, ccd, values, version=version, prefix=prefix)
+
+
+def build_calibration_manifest(expnum, ccds=None, version='p', prefix=None, fields=None, dry_run=False):
+    """
+    Write the calibration manifest of an exposure, see CalibrationStore.build.
+
+    @return: success
+    """
+    try:
+        calibrations.build(expnum, ccds is None and get_ccdlist(expnum) or ccds, version=version, prefix=prefix,
+                           fields=fields, dry_run=dry_run)
+        return True
+    except Exception as ex:
+        logger.error("Failed to build the calibration manifest of {}: {}".format(expnum, ex))
+        return False
 
 
 class Task(object):
@@ -617,12 +1011,67 @@ def set_status(task, prefix, expnum, version, ccd, status):
     return set_tag(expnum, get_process_tag(prefix+task, ccd, version), status)
 
 
-def get_file(expnum, ccd=None, version='p', ext=FITS_EXT, subdir=None, prefix=None):
+def get_status_matrix(task, expnums, ccds, prefix='', version='p', return_message=False):
+    """
+    Report the status of task for every combination of expnums and ccds.
+
+    The tags of each exposure are retrieved once (concurrently across exposures) so this costs one VOSpace
+    request per exposure instead of one per exposure per ccd.
+
+    @param task:  name of the process or task that will be checked.
+    @param expnums: list of exposure numbers.
+    @param ccds: list of CCD numbers.
+    @param prefix: prefix of the file that was processed (often fk or '')
+    @param version: which version of the exposures (p, s, o)
+    @param return_message: report the tag values rather than True/False for Success/Failure?
+    @return: Table with an 'expnum' column and one column per ccd, named by the two digit ccd number.
+    @rtype: Table
+    """
+    prefix = prefix is None and "" or prefix
+    tag_store.prefetch(expnums)
+    rows = []
+    for expnum in expnums:
+        tags = tag_store.get_tags(expnum)
+        row = [expnum]
+        for ccd in ccds:
+            status = tags.get(tag_uri(get_process_tag(prefix + task, ccd, version)), None)
+            if return_message:
+                row.append(status is not None and status or "")
+            else:
+                row.append(status == SUCCESS)
+        rows.append(row)
+    names = ['expnum'] + ["{:02d}".format(int(ccd)) for ccd in ccds]
+    if not rows:
+        return Table(names=names)
+    return Table(rows=rows, names=names)
+
+
+def _cache_key(uri, cutout=None):
+    """
+    The file cache key of the content of uri (and cutout): includes the MD5, or failing that the date, of the
+    node so that a file regenerated in VOSpace (eg. by a --force re-run) is retrieved again.
+
+    @return: the key, None if the cache is disabled or the node has no MD5 or date, so uri is retrieved directly.
+    """
+    if not file_cache.enabled or not uri.startswith('vos:'):
+        return None
+    try:
+        props = client.get_node(uri, force=True).props
+    except Exception as ex:
+        logger.debug("No file cache key for {}: {}".format(uri, ex))
+        return None
+    version = props.get('MD5', None) or props.get('date', None)
+    if version is None:
+        return None
+    return "{}{}#{}".format(uri, cutout or "", version)
+
+
+def get_file(expnum, ccd=None, version='p', ext=FITS_EXT, subdir=None, prefix=None, writable=False):
     uri = get_uri(expnum=expnum, ccd=ccd, version=version, ext=ext, subdir=subdir, prefix=prefix)
     filename = os.path.basename(uri)
 
     if not os.access(filename, os.F_OK):
-        copy(uri, filename)
+        file_cache.get(_cache_key(uri), filename, lambda destination: copy(uri, destination), writable=writable)
 
     return filename
 
@@ -713,6 +1162,10 @@ def _cutout_expnum(observation, sky_coord, radius):
 
     else:
       uri = observation.get_image_uri()
+      virtual = get_virtual_image_by_uri(uri)
+      if virtual is not None:
+          # cut from the source image, the header overrides are applied below.
+          uri = _virtual_image_source_uri(virtual)
       cutout_filehandle = tempfile.NamedTemporaryFile()
       disposition_filename = client.copy(uri + "({},{},{})".format(sky_coord.ra.to('degree').value,
                                                                    sky_coord.dec.to('degree').value,
@@ -727,6 +1180,10 @@ def _cutout_expnum(observation, sky_coord, radius):
           hdulist = fits.open(cutout_filehandle, mode='update', lazy_load_hdus=False,
                               memmap=False)
           hdulist.verify('silentfix+ignore')
+      if virtual is not None:
+          for hdu in hdulist:
+              for key, value in virtual['header'].items():
+                  hdu.header[key] = value
       logger.debug("Initial Length of HDUList: {}".format(len(hdulist)))
 
     # Make sure here is a primaryHDU
@@ -777,6 +1234,33 @@ def _cutout_expnum(observation, sky_coord, radius):
     return hdulist
 
 
+def astrometric_header(expnum, extver, x0=1, y0=1):
+    """
+    The WCS part of stephen's astrometric header of one extension of an exposure, ready to update an image header.
+
+    @param expnum: CFHT exposure number.
+    @param extver: EXTVER of the extension.
+    @param x0: first column of the image the header is for, when that image is a cutout of the extension.
+    @param y0: first row of the image the header is for.
+    @rtype: astropy.io.fits.Header
+    """
+    for astheader in _get_sghead(expnum):
+        if astheader is not None and astheader.get('EXTVER', -1) == extver:
+            break
+    else:
+        raise KeyError("No astrometric header for extension {} of {}".format(extver, expnum))
+    # a copy, the cached header is shared by all the cutouts of the exposure.
+    astheader = astheader.copy()
+    astheader['CRPIX1'] = astheader.get('CRPIX1', 1) - x0 + 1
+    astheader['CRPIX2'] = astheader.get('CRPIX2', 1) - y0 + 1
+    # pull some data structure keywords out of the astrometric headers
+    for key in ['NAXIS', 'XTENSION', 'PCOUNT', 'GCOUNT',
+                'NAXIS1', 'NAXIS2', 'BITPIX', 'BZERO', 'BSCALE']:
+        if astheader.get(key, None) is not None:
+            del (astheader[key])
+    return astheader
+
+
 def ra_dec_cutout(uri, sky_coord, radius, update_wcs=False):
     """
 
@@ -838,23 +1322,8 @@ def ra_dec_cutout(uri, sky_coord, radius, update_wcs=False):
         if update_wcs:
             # Pull the SG header from VOSpace and reset the CRPIX values based on cutout info from disposition matrix
             try:
-                sg_key = "{}{}".format(hdu.header['expnum'], 'p')
-                if sg_key not in sgheaders:
-                    _get_sghead(hdu.header['expnum'])
-                if sg_key in sgheaders:
-                    for astheader in sgheaders[sg_key]:
-                        if astheader is None:
-                            continue
-                        if astheader.get('EXTVER', -1) == hdu.header['EXTVER']:
-                            break
-                astheader['CRPIX1'] = astheader.get('CRPIX1', 1) - int(cutout[1]) + 1
-                astheader['CRPIX2'] = astheader.get('CRPIX2', 1) - int(cutout[3]) + 1
-                # pull some data structure keywords out of the astrometric headers
-                for key in ['NAXIS', 'XTENSION', 'PCOUNT', 'GCOUNT',
-                            'NAXIS1', 'NAXIS2', 'BITPIX', 'BZERO', 'BSCALE']:
-                    if astheader.get(key, None) is not None:
-                        del (astheader[key])
-                hdu.header.update(astheader)
+                hdu.header.update(astrometric_header(hdu.header['expnum'], hdu.header['EXTVER'],
+                                                     int(cutout[1]), int(cutout[3])))
             except Exception as ex:
                 logging.error("Got error while updating WCS: {}".format(ex))
                 logging.error("Using existing WCS in image header")
@@ -905,8 +1374,118 @@ def get_frame(frameid, cutout=None):
     return get_image(cutout=cutout, **frame2expnum(frameid))
 
 
+def make_virtual_image(expnum, ccd, source_expnum, header, version='s', source_version='p', prefix=None,
+                       dry_run=False):
+    """
+    Record expnum/ccd/version as a virtual image: the source image with some primary header keywords replaced.
+
+    A small sidecar (VIRTUAL_EXT) is written in place of the image, get_image, get_hdu and the cutout service
+    calls resolve it transparently but programs reading dbimages directly (vcp, shell scripts) do not.
+
+    @param source_expnum: the exposure holding the pixels.
+    @param header: dict of primary header keyword -> value to override.
+    @param dry_run: only write the sidecar to the current directory, not to VOSpace.
+    @return: the uri of the sidecar.
+    """
+    uri = get_uri(expnum, ccd, version, ext=VIRTUAL_EXT, prefix=prefix)
+    virtual = {'source': {'expnum': int(source_expnum), 'ccd': int(ccd), 'version': source_version,
+                          'prefix': prefix},
+               'header': header}
+    filename = os.path.basename(uri)
+    with open(filename, 'w') as fobj:
+        json.dump(virtual, fobj, indent=1, sort_keys=True)
+    if not dry_run:
+        copy(filename, uri)
+    virtual_images[uri] = virtual
+    return uri
+
+
+def _not_found(ex):
+    """
+    Is the exception the answer that the file doesn't exist (rather than a failure to find out)?
+    """
+    if isinstance(ex, exceptions.NotFoundException):
+        return True
+    # vos reports the status of a failed request as the errno of an OSError.
+    return isinstance(ex, (OSError, IOError)) and getattr(ex, 'errno', None) in [errno.ENOENT, 404]
+
+
+def get_virtual_image(expnum, ccd, version='s', prefix=None):
+    """
+    @return: the description of the virtual image (source and header overrides), None if the image is real.
+    @rtype: dict
+    """
+    if version not in VIRTUAL_VERSIONS or ccd is None:
+        return None
+    uri = get_uri(expnum, ccd, version, ext=VIRTUAL_EXT, prefix=prefix)
+    if uri not in virtual_images:
+        try:
+            virtual_images[uri] = json.loads(open_vos_or_local(uri).read())
+        except Exception as ex:
+            if not _not_found(ex):
+                # don't remember a failure to look as the answer.
+                raise
+            logger.debug("{} is not a virtual image: {}".format(uri, ex))
+            virtual_images[uri] = None
+    return virtual_images[uri]
+
+
+def get_virtual_image_by_uri(uri):
+    """
+    The description of the virtual image at uri, eg. vos:OSSOS/dbimages/1616681/ccd22/1616681s22.fits
+
+    @return: the description of the virtual image, None if uri is not a virtual image.
+    @rtype: dict
+    """
+    match = re.match(r'^(?P<prefix>\D*)(?P<expnum>\d+)(?P<version>[a-z])(?P<ccd>\d{2})\.fits(\.fz)?$',
+                     os.path.basename(uri))
+    if match is None:
+        return None
+    return get_virtual_image(match.group('expnum'), match.group('ccd'), version=match.group('version'),
+                             prefix=match.group('prefix') or None)
+
+
+def _virtual_image_source_uri(virtual):
+    source = virtual['source']
+    return dbimages_uri(source['expnum'], ccd=source['ccd'], version=source['version'], prefix=source['prefix'],
+                        ext='.fits')
+
+
+def _get_virtual_image(virtual, filename, ext=FITS_EXT, cutout=None, return_file=True, flip_image=True):
+    """
+    Retrieve the source of a virtual image and apply the header overrides.
+
+    @param filename: the name the real image would have on disk.
+    """
+    source = virtual['source']
+
+    def override(hdulist):
+        for key, value in virtual['header'].items():
+            hdulist[0].header[key] = value
+        return hdulist
+
+    if return_file and cutout is None:
+        # materialised for programs that need a file, as a local copy: a hard link would share the header edit
+        # with the source image (and so with every other job that links to it through the file cache).
+        source_filename = get_image(source['expnum'], ccd=source['ccd'], version=source['version'], ext=ext,
+                                    prefix=source['prefix'], flip_image=flip_image)
+        shutil.copyfile(source_filename, filename)
+        with fits.open(filename, mode='update') as hdulist:
+            override(hdulist)
+        return filename
+
+    hdulist = override(get_image(source['expnum'], ccd=source['ccd'], version=source['version'], ext=ext,
+                                 prefix=source['prefix'], cutout=cutout, return_file=False,
+                                 flip_image=flip_image))
+    if not return_file:
+        return hdulist
+    cutout_filename = "{}_{}.fits".format(os.path.splitext(filename)[0], re.sub(r'\W+', '_', cutout).strip('_'))
+    hdulist.writeto(cutout_filename, overwrite=True)
+    return cutout_filename
+
+
 def get_image(expnum, ccd=None, version='p', ext=FITS_EXT,
-              subdir=None, prefix=None, cutout=None, return_file=True, flip_image=True):
+              subdir=None, prefix=None, cutout=None, return_file=True, flip_image=True, writable=False):
     """Get a FITS file for this expnum/ccd  from VOSpace.
 
 
@@ -919,6 +1498,7 @@ def get_image(expnum, ccd=None, version='p', ext=FITS_EXT,
     @param subdir:
     @param prefix:
     @param flip_image: Should the image be x/y flipped after being retrieved?
+    @param writable: the caller may change the file, so it must not be a link into the file cache.
     @return: astropy.io.fits.PrimaryHDU
     """
 
@@ -926,13 +1506,21 @@ def get_image(expnum, ccd=None, version='p', ext=FITS_EXT,
     if os.access(filename, os.F_OK) and return_file and cutout is None:
         return filename
 
+    if not os.access(filename, os.F_OK):
+        virtual = get_virtual_image(expnum, ccd, version=version, prefix=prefix)
+        if virtual is not None:
+            return _get_virtual_image(virtual, filename, ext=ext, cutout=cutout, return_file=return_file,
+                                      flip_image=flip_image)
+
     cutout_string = cutout
     try:
         if os.access(filename, os.F_OK) and cutout:
             cutout = datasec_to_list(cutout)
             with warnings.catch_warnings():
                 warnings.simplefilter('ignore', FITSFixedWarning)
-                hdulist = fits.open(filename, mode='update')
+                # the cutout is written to its own file, the image itself (maybe a link into the file cache) is
+                # not changed.
+                hdulist = fits.open(filename)
                 hdulist.verify('silentfix+ignore')
             for use_this_ext, hdu in enumerate(hdulist):
                 if hdu.header.get('NAXIS', 0) > 0:
@@ -1014,23 +1602,22 @@ def get_image(expnum, ccd=None, version='p', ext=FITS_EXT,
     while len(locations) > 0:
         (uri, cutout) = locations.pop(0)
         try:
-            hdu_list = get_hdu(uri, cutout)
             if return_file:
-                hdu_list.writeto(filename)
-                del hdu_list
+                key = _cache_key(uri, cutout)
+                file_cache.get(key is not None and "image:" + key or None, filename,
+                               lambda destination: get_hdu(uri, cutout, use_cache=False).writeto(destination,
+                                                                                             overwrite=True),
+                               writable=writable)
                 return filename
             else:
-                return hdu_list
+                return get_hdu(uri, cutout)
         except Exception as e:
             err = getattr(e, 'errno', errno.EAGAIN)
             logger.debug("{}".format(type(e)))
             logger.debug("Failed to open {} cutout:{}".format(uri, cutout))
             logger.debug("vos sent back error: {} code: {}".format(str(e), getattr(e, 'errno', 0)))
 
-    if err == errno.EAGAIN:
-        time.sleep(5)
-        return get_image(expnum, ccd=ccd, version=version, ext=ext,
-                         subdir=subdir, prefix=prefix, cutout=cutout, return_file=return_file, flip_image=flip_image)
+    # transient VOSpace failures have already been retried by the transport.
     raise IOError(err, "Failed to get image at uri: {} using {} {} {} {}.".format(uri, expnum, version, ccd, cutout))
 
 
@@ -1108,7 +1695,14 @@ def reset_datasec(cutout, datasec, naxis1, naxis2):
     return "[{}:{},{}:{}]".format(datasec[0], datasec[1], datasec[2], datasec[3])
 
 
-def get_hdu(uri, cutout=None):
+def _whole_extension(cutout):
+    """
+    Does the cutout select whole extensions (possibly flipped), rather than a region of pixels?
+    """
+    return cutout is None or re.match(r'^(\[\d+\])?(\[-?\*,-?\*\])?$', cutout) is not None
+
+
+def get_hdu(uri, cutout=None, use_cache=True):
     """Get a at the given uri from VOSpace, possibly doing a cutout.
 
     If the cutout is flips the image then we also must flip the datasec keywords.  Also, we must offset the
@@ -1116,6 +1710,7 @@ def get_hdu(uri, cutout=None):
 
     @param uri: The URI in VOSpace of the image to HDU to retrieve.
     @param cutout: A CADC data service CUTOUT paramter to be used when retrieving the observation.
+    @param use_cache: retrieve whole extensions through the file cache.
     @return: fits.HDU
     """
     try:
@@ -1133,16 +1728,26 @@ def get_hdu(uri, cutout=None):
                     break
 
         else:
+            virtual = get_virtual_image_by_uri(uri)
+            if virtual is not None:
+                return _get_virtual_image(virtual, filename, cutout=cutout, return_file=False)
             logger.debug("Pulling: {}{} from VOSpace".format(uri, cutout))
-            fpt = tempfile.NamedTemporaryFile(suffix='.fits', mode='w+b')
-            cutout = cutout is not None and cutout or ""
-            copy(uri+cutout, fpt.name)
-            fpt.seek(0, 2)
-            fpt.seek(0)
+            key = use_cache and _whole_extension(cutout) and _cache_key(uri, cutout) or None
+            if key is not None:
+                cutout = cutout is not None and cutout or ""
+                fpt = file_cache.path(key, lambda destination: copy(uri + cutout, destination))
+                mode = 'readonly'
+            else:
+                fpt = tempfile.NamedTemporaryFile(suffix='.fits', mode='w+b')
+                cutout = cutout is not None and cutout or ""
+                copy(uri+cutout, fpt.name)
+                fpt.seek(0, 2)
+                fpt.seek(0)
+                mode = 'update'
             logger.debug("Read from vospace completed. Building fits object.")
             with warnings.catch_warnings():
                 warnings.simplefilter('ignore', FITSFixedWarning)
-                hdu_list = fits.open(fpt, scale_back=False, mode='update')
+                hdu_list = fits.open(fpt, scale_back=False, mode=mode)
                 hdu_list.verify('silentfix+ignore')
             use_this_ext = 0
             for use_this_ext, hdu in enumerate(hdu_list):
@@ -1179,10 +1784,22 @@ def get_trans(expnum, ccd, prefix=None, version='p'):
     @return:
     """
     uri = get_uri(expnum, ccd, version, ext='trans.jmp', prefix=prefix)
+    if not os.access(os.path.basename(uri), os.F_OK):
+        trans = get_calibration(expnum, ccd, 'trans', version=version, prefix=prefix)
+        if trans is not None:
+            return trans
     logging.info("get_trans: {}".format(uri))
     fobj = open_vos_or_local(uri)
     line = fobj.read()
     fobj.close()
+    return parse_trans(line)
+
+
+def parse_trans(line):
+    """
+    @param line: the content of a trans.jmp file.
+    @return: the transformation as a dictionary.
+    """
     vs = line.split()
     trans = {'dx': float(vs[0]),
              'cd11': float(vs[1]),
@@ -1205,6 +1822,8 @@ def get_fwhm_tag(expnum, ccd, prefix=None, version='p'):
     """
     uri = get_uri(expnum, ccd, version, ext='fwhm', prefix=prefix)
     if uri not in fwhm:
+        fwhm[uri] = get_calibration(expnum, ccd, 'fwhm', version=version, prefix=prefix)
+    if fwhm[uri] is None:
         key = "fwhm_{:1s}{:02d}".format(version, int(ccd))
         fwhm[uri] = get_tag(expnum, key)
     return fwhm[uri]
@@ -1234,6 +1853,11 @@ def get_fwhm(expnum, ccd, prefix=None, version='p', default=4.0):
     except:
         pass
 
+    value = get_calibration(expnum, ccd, 'fwhm', version=version, prefix=prefix)
+    if value is not None:
+        fwhm[uri] = value
+        return fwhm[uri]
+
     try:
         fwhm[uri] = float(open_vos_or_local(uri).read())
         return fwhm[uri]
@@ -1255,6 +1879,9 @@ def _get_zeropoint(expnum, ccd, prefix=None, version='p'):
     if prefix is not None:
         DeprecationWarning("Prefix is no longer used here as the 'fk' and 's' have the same zeropoint.")
 
+    zeropoint = get_calibration(expnum, ccd, 'zeropoint', version=version)
+    if zeropoint is not None:
+        return zeropoint
     key = "zeropoint_{:1s}{:02d}".format(version, int(ccd))
     return get_tag(expnum, key)
 
@@ -1276,6 +1903,12 @@ def get_zeropoint(expnum, ccd, prefix=None, version='p'):
     except:
         pass
 
+    if not os.access(os.path.basename(uri), os.F_OK):
+        zeropoint = get_calibration(expnum, ccd, 'zeropoint', version=version, prefix=prefix)
+        if zeropoint is not None:
+            zmag[uri] = zeropoint
+            return zmag[uri]
+
     try:
         zmag[uri] = float(open_vos_or_local(uri).read())
         return zmag[uri]
@@ -1286,6 +1919,19 @@ def get_zeropoint(expnum, ccd, prefix=None, version='p'):
     return zmag[uri]
 
 
+def get_astrometric_level(expnum, ccd, version='p', prefix=None):
+    """
+    The level (ASTLEVEL) of the astrometric calibration of an exposure/ccd, from the calibration manifest or the
+    astrometric header.
+
+    @return: int
+    """
+    astlevel = get_calibration(expnum, ccd, 'astlevel', version=version, prefix=prefix)
+    if astlevel is None:
+        astlevel = get_astheader(expnum, ccd, version=version, prefix=prefix).get('ASTLEVEL', 0)
+    return int(astlevel)
+
+
 def mkdir(dirname):
     """make directory tree in vospace.
 
@@ -1357,7 +2003,6 @@ def copy(source, dest):
     @return:
     """
     logger.info("copying {} -> {}".format(source, dest))
-
     return client.copy(source, dest)
 
 
@@ -1429,6 +2074,17 @@ def listdir(directory, force=False):
     return client.listdir(directory, force=force)
 
 
+def list_properties(directory):
+    """
+    Retrieve the properties of every node in a VOSpace container with a single detailed listing request.
+
+    @param directory: uri of the container node.
+    @return: dict of node name -> dict of properties, keyed as in node.props (see get_property).
+    @rtype: dict
+    """
+    return dict((node.name, dict(node.props)) for node in client.get_info_list(directory))
+
+
 def list_dbimages(dbimages=DBIMAGES):
     return listdir(dbimages)
 
@@ -1501,39 +2157,19 @@ def set_property(node_uri, property_name, property_value, ossos_base=True):
     @param ossos_base:
     @return:
     """
-    while True:
-        try:
-            logger.info(f"Getting Node Property")
-            node = client.get_node(node_uri)
-            logger.info(f"{node}")
-            property_uri = tag_uri(property_name) if ossos_base else property_name
-            logger.info(f"{property_uri}")
-            break
-        except exceptions.HttpException:
-            print(f'Waiting to retry VOSpace')
-            time.sleep(3)
+    # VOSpace failures are retried by the transport.
+    node = client.get_node(node_uri)
+    property_uri = tag_uri(property_name) if ossos_base else property_name
 
     # If there is an existing value, clear it first
     if property_uri in node.props:
-        while True:
-            try:
-                    node.props[property_uri] = None
-                    logger.info(f"Clearing Node Property")
-                    client.add_props(node)
-                    break
-            except exceptions.HttpException:
-                print(f'Waiting to retry VOSpace')
-                time.sleep(3)
+        node.props[property_uri] = None
+        logger.info(f"Clearing Node Property")
+        client.add_props(node)
 
-    while True:
-        try:
-            node.props[property_uri] = property_value
-            logger.info(f"Adding Node Property {property_uri}: {property_value}")
-            client.add_props(node)
-            break
-        except exceptions.HttpException:
-            print(f'Waiting to retry VOSpace')
-            time.sleep(3)
+    node.props[property_uri] = property_value
+    logger.info(f"Adding Node Property {property_uri}: {property_value}")
+    client.add_props(node)
 
 
 def build_counter_tag(epoch_field, dry_run=False):
@@ -1592,6 +2228,34 @@ def increment_object_counter(node_uri, epoch_field, dry_run=False):
     return new_count
 
 
+def _node_mtime(uri):
+    """
+    The modification date of a VOSpace node, used to validate entries in the header cache.
+
+    The date of a node is retrieved once per process, so the headers of the CCDs of an exposure cost one call.
+
+    @param uri: the URI of the node, any [extension] or cutout is ignored.
+    """
+    if not uri.startswith('vos:'):
+        return None
+    uri = uri.split('[')[0]
+    if uri not in node_dates:
+        node_dates[uri] = client.get_node(uri, force=True).props.get('date', None)
+    return node_dates[uri]
+
+
+def _cached_header(uri, fetch_header):
+    """
+    Read a FITS header through the persistent header cache.
+
+    @param uri: the URI the header comes from.
+    @param fetch_header: callable that retrieves the fits.Header from uri on a cache miss.
+    @return: fits.Header
+    """
+    content = header_cache.get(uri, lambda: fetch_header().tostring(), get_mtime=_node_mtime)
+    return fits.Header.fromstring(content.decode('utf-8'))
+
+
 def get_mopheader(expnum, ccd, version='p', prefix=None):
     """
     Retrieve the mopheader, either from cache or from vospace
@@ -1618,7 +2282,9 @@ def get_mopheader(expnum, ccd, version='p', prefix=None):
         with open(filename, 'rb') as fobj:
             mopheader_fpt = BytesIO(fobj.read())
     else:
-        mopheader_fpt = BytesIO(open_vos_or_local(mopheader_uri).read())
+        mopheader_fpt = BytesIO(header_cache.get(mopheader_uri,
+                                                 lambda: open_vos_or_local(mopheader_uri).read(),
+                                                 get_mtime=_node_mtime))
 
     with warnings.catch_warnings():
         warnings.simplefilter('ignore', AstropyUserWarning)
@@ -1660,18 +2326,23 @@ def _get_sghead(expnum):
 
     header_filename = "{}{}.head".format(expnum, version)
 
-    if not os.access(header_filename, os.R_OK):
+    if os.access(header_filename, os.R_OK):
+        with open(header_filename, 'r') as hobj:
+            header_content = hobj.read()
+    else:
         url = "http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/data/pub/CFHTSG/{}".format(header_filename)
-        logging.getLogger("requests").setLevel(logging.ERROR)
-        logging.debug("Attempting to retrieve {}".format(url))
-        resp = requests.get(url)
-        if resp.status_code != 200:
-            raise IOError(errno.ENOENT, "Could not get {}".format(url))
-        with open(header_filename,'w') as hobj:
-            hobj.write(resp.content)
 
-    with open(header_filename, 'w') as hobj:
-        header_str_list = re.split('END      \n', hobj.read())
+        def fetch():
+            logging.getLogger("requests").setLevel(logging.ERROR)
+            logging.debug("Attempting to retrieve {}".format(url))
+            resp = requests.get(url)
+            if resp.status_code != 200:
+                raise IOError(errno.ENOENT, "Could not get {}".format(url))
+            return resp.content
+
+        header_content = header_cache.get(url, fetch).decode('utf-8')
+
+    header_str_list = re.split('END      \n', header_content)
 
     # # make the first entry in the list a Null
     headers = [None]
@@ -1689,7 +2360,7 @@ def get_header(uri):
     @param uri:  The URI of the image in VOSpace.
     """
     if uri not in astheaders:
-        astheaders[uri] = get_hdu(uri, cutout="[1:1,1:1]")[0].header
+        astheaders[uri] = _cached_header(uri, lambda: get_hdu(uri, cutout="[1:1,1:1]")[0].header)
     return astheaders[uri]
 
 
@@ -1717,21 +2388,28 @@ def get_astheader(expnum, ccd, version='p', prefix=None):
             print(ex)
             pass
 
+    def fetch_header(ext):
+        hdulist = get_image(expnum, ccd=ccd, version=version, prefix=prefix,
+                            cutout="[1:1,1:1]", return_file=False, ext=ext)
+        assert isinstance(hdulist, fits.HDUList)
+        return hdulist[0].header
+
+    def header_uri(ext):
+        # where get_image reads the header from: the CCD's extension of the exposure's file for 'p' images, the
+        # CCD's own file otherwise.
+        if version == 'p':
+            return "{}[{}]".format(dbimages_uri(expnum, version=version, ext=ext), int(ccd) + 1)
+        return dbimages_uri(expnum, ccd, version=version, prefix=prefix, ext=ext)
+
     try:
-       ast_uri = dbimages_uri(expnum, ccd, version=version, ext='.fits')
+       ast_uri = header_uri('.fits')
        if ast_uri not in astheaders:
-           hdulist = get_image(expnum, ccd=ccd, version=version, prefix=prefix,
-                               cutout="[1:1,1:1]", return_file=False, ext='.fits')
-           assert isinstance(hdulist, fits.HDUList)
-           astheaders[ast_uri] = hdulist[0].header
+           astheaders[ast_uri] = _cached_header(ast_uri, lambda: fetch_header('.fits'))
     except Exception as ex:
        logging.error(f'{ast_uri}: {ex}')
-       ast_uri = dbimages_uri(expnum, ccd, version=version, ext='.fits.fz')
+       ast_uri = header_uri('.fits.fz')
        if ast_uri not in astheaders:
-           hdulist = get_image(expnum, ccd=ccd, version=version, prefix=prefix,
-                               cutout="[1:1,1:1]", return_file=False, ext='.fits.fz')
-           assert isinstance(hdulist, fits.HDUList)
-           astheaders[ast_uri] = hdulist[0].header
+           astheaders[ast_uri] = _cached_header(ast_uri, lambda: fetch_header('.fits.fz'))
     return astheaders[ast_uri]
 
 
@@ -12,17 +12,45 @@ ivo://ivoa.net/vospace/core%23httpget&view=cutout&cutout=CIRCLE+ICRS+242.1318+-1
 """
 
 import argparse
+import json
 import logging
+import math
 import os
 import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy
 from astropy import units
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.nddata import Cutout2D
 from astropy.units import Quantity
 
-from ossos import (mpc, storage, parameters)
+from ossos import (mpc, storage, parameters, wcs)
 
 storage.FITS_EXT = ".fits"
 
+# Stamps of one CCD within this distance of each other are sliced from one region retrieved from VOSpace.
+MAX_REGION_RADIUS = 5 * units.arcminute
+
+# A postage stamp still to be made.
+Stamp = namedtuple('Stamp', ['obj_dir', 'filename', 'expnum', 'version', 'ccd', 'sky_coord'])
+
+
+def stamp_filename(obj, obs):
+    """
+    The name of the postage stamp of observation obs of obj.
+    """
+    return f"{obj.provisional_name}_" \
+           f"{obs.date.mjd:11.5f}_" \
+           f"{obs.coordinate.ra.degree:09.5f}_" \
+           f"{obs.coordinate.dec.degree:09.5f}.fits"
+
+
 def cutout(obj, obj_dir, radius):
 
     cutout_listing = storage.listdir(obj_dir, force=True)
@@ -44,18 +72,15 @@ def cutout(obj, obj_dir, radius):
             sky_coord = obs.coordinate
             # Using the WCS rather than the X/Y
             # (X/Y can be unreliable over the whole survey)
-            postage_stamp_filename = f"{obj.provisional_name}_" \
-                                     f"{obs.date.mjd:11.5f}_" \
-                                     f"{obs.coordinate.ra.degree:09.5f}_" \
-                                     f"{obs.coordinate.dec.degeee:09.5f}.fits"
+            postage_stamp_filename = stamp_filename(obj, obs)
 
             if postage_stamp_filename in cutout_listing:
                 # skipping existing cutouts
                 continue 
 
             # ast_header = storage._get_sghead(parts['expnum'])
-            while True:
-              try:
+            # VOSpace trouble is retried by the storage transport.
+            try:
                 hdulist = storage.ra_dec_cutout(uri, sky_coord, radius, update_wcs=True)
 
                 with open(postage_stamp_filename, 'w') as tmp_file:
@@ -63,12 +88,266 @@ def cutout(obj, obj_dir, radius):
                     storage.copy(postage_stamp_filename, obj_dir + "/" + postage_stamp_filename)
                 os.unlink \
                         (postage_stamp_filename)  # easier not to have them hanging around
-              except OSError as e:  # occasionally the node is not found: report and move on for later cleanup
+            except OSError as e:  # occasionally the node is not found: report and move on for later cleanup
                 logging.error("OSError: -> " +str(e))
-              except Exception as e:
+            except Exception as e:
                 logging.error("Exception: -> " +str(e))
+
+
+def stamp_uri(stamp):
+    return stamp.obj_dir + "/" + stamp.filename
+
+
+def plan_stamps(obj, obj_dir, existing=()):
+    """
+    The postage stamps needed for the observations of obj, see cutout.
+
+    @param obj: the object the stamps are of.
+    @type obj: mpc.MPCReader
+    @param obj_dir: VOSpace container the stamps of obj are stored in.
+    @param existing: names of the stamps already in obj_dir.
+    @rtype: list(Stamp)
+    """
+    stamps = []
+    for obs in obj.mpc_observations:
+        if obs.null_observation:
+            logging.debug('skipping: {}'.format(obs))
+            continue
+        if not obs.date > parameters.SURVEY_START:
+            # can't make postage stamps of earlier linkages
+            continue
+        try:
+            parts = storage.frame2expnum(obs.comment.frame)
+            ccd = int(parts['ccd'])
+        except Exception as ex:
+            logging.warning(f"Skipping: {obs}")
+            logging.debug(f"Failed to map comment.frame to expnum: {ex}")
+            continue
+        filename = stamp_filename(obj, obs)
+        if filename in existing:
+            continue
+        stamps.append(Stamp(obj_dir, filename, parts['expnum'], parts['version'], ccd, obs.coordinate))
+    return stamps
+
+
+def group_stamps(stamps, max_radius=MAX_REGION_RADIUS):
+    """
+    Group stamps by exposure and then into sets of stamps on the same CCD that lie close enough together to be
+    sliced from a single region of the image.
+
+    @return: exposure number -> list of groups of stamps.
+    @rtype: OrderedDict
+    """
+    exposures = OrderedDict()
+    for stamp in stamps:
+        groups = exposures.setdefault(stamp.expnum, [])
+        for group in groups:
+            if (group[0].version == stamp.version and group[0].ccd == stamp.ccd and
+                    group[0].sky_coord.separation(stamp.sky_coord) < max_radius):
+                group.append(stamp)
+                break
+        else:
+            groups.append([stamp])
+    return exposures
+
+
+class Region(object):
+    """
+    A piece of an image (anything from a whole CCD down to a small cutout) that stamps are sliced from.
+    """
+
+    def __init__(self, data, header):
+        self.data = data
+        self.header = header
+        self.wcs = wcs.WCS(header)
+
+    def pixel(self, sky_coord):
+        """
+        The x/y of sky_coord in the region, None if it does not fall on the region.
+        """
+        x, y = self.wcs.sky2xy(sky_coord.ra.degree, sky_coord.dec.degree)
+        if 0.5 <= x < self.header['NAXIS1'] + 0.5 and 0.5 <= y < self.header['NAXIS2'] + 0.5:
+            return x, y
+        return None
+
+    def stamp(self, sky_coord, radius):
+        """
+        Slice the postage stamp centred on sky_coord out of the region.
+
+        The header is adjusted the way storage.ra_dec_cutout adjusts the header of a cutout.
+
+        @rtype: fits.HDUList
+        """
+        position = self.pixel(sky_coord)
+        if position is None:
+            raise ValueError("{} is not on the region".format(sky_coord))
+        x, y = position
+        scale = math.sqrt(math.fabs(numpy.linalg.det(self.wcs.cd))) * units.degree
+        size = int(round((2 * radius / scale).decompose().value))
+        cut = Cutout2D(self.data, (x - 1, y - 1), (size, size), mode='trim')
+        x0, y0 = cut.origin_original
+        ny, nx = cut.data.shape
+
+        header = self.header.copy()
+        header['CRPIX1'] = header.get('CRPIX1', 1) - x0
+        header['CRPIX2'] = header.get('CRPIX2', 1) - y0
+        if 'DATASEC' in header:
+            header['DATASEC'] = storage.reset_datasec("[{}:{},{}:{}]".format(x0 + 1, x0 + nx, y0 + 1, y0 + ny),
+                                                      header['DATASEC'],
+                                                      header['NAXIS1'],
+                                                      header['NAXIS2'])
+        header['XOFFSET'] = header.get('XOFFSET', 0) + x0
+        header['YOFFSET'] = header.get('YOFFSET', 0) + y0
+        phdu = fits.PrimaryHDU()
+        phdu.header['ORIGIN'] = "OSSOS"
+        return fits.HDUList([phdu, fits.ImageHDU(data=numpy.array(cut.data), header=header)])
+
+
+def _local_image(stamp, image_dir):
+    """
+    The name of a local copy of the CCD, or failing that of the whole exposure, stamp is on.
+    """
+    for ccd in [stamp.ccd, None]:
+        filename = os.path.join(image_dir,
+                                os.path.basename(storage.get_uri(stamp.expnum, ccd=ccd, version=stamp.version)))
+        if os.access(filename, os.R_OK):
+            return filename
+    return None
+
+
+def _local_regions(filename, stamp):
+    """
+    The CCDs of a local image, memory mapped so only the pixels sliced into stamps are read.
+    """
+    regions = []
+    # the mapped arrays stay valid once the file is closed.
+    with fits.open(filename, memmap=True) as hdulist:
+        for hdu in hdulist:
+            if hdu.header.get('NAXIS', 0) != 2:
                 continue
-              break
+            header = hdu.header.copy()
+            try:
+                header.update(storage.astrometric_header(stamp.expnum, header.get('EXTVER', stamp.ccd + 1)))
+            except Exception as ex:
+                logging.error("Got error while updating WCS: {}".format(ex))
+                logging.error("Using existing WCS in image header")
+            regions.append(Region(hdu.data, header))
+    return regions
+
+
+def _remote_regions(stamps, radius):
+    """
+    Retrieve the single cutout of the image that holds all of stamps.
+    """
+    coordinates = SkyCoord([stamp.sky_coord for stamp in stamps])
+    ra = coordinates.ra.wrap_at(coordinates[0].ra + 180 * units.degree).degree
+    centre = SkyCoord(ra.mean(), coordinates.dec.degree.mean(), unit='degree')
+    region_radius = centre.separation(coordinates).max() + radius * math.sqrt(2)
+    uri = storage.get_uri(stamps[0].expnum, version=stamps[0].version)
+    hdulist = storage.ra_dec_cutout(uri, centre, region_radius, update_wcs=True)
+    return [Region(hdu.data, hdu.header) for hdu in hdulist[1:]]
+
+
+class StampManifest(object):
+    """
+    A record of the stamps uploaded so far, one JSON line per stamp, that lets an interrupted run resume.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.done = set()
+        self._lock = threading.Lock()
+        if filename is not None and os.access(filename, os.R_OK):
+            with open(filename) as manifest:
+                for line in manifest:
+                    try:
+                        self.done.add(json.loads(line)['uri'])
+                    except (ValueError, KeyError):
+                        logging.warning("Skipping unreadable manifest line: {}".format(line))
+
+    def __contains__(self, stamp):
+        return stamp_uri(stamp) in self.done
+
+    def record(self, stamp):
+        uri = stamp_uri(stamp)
+        with self._lock:
+            self.done.add(uri)
+            if self.filename is not None:
+                with open(self.filename, 'a') as manifest:
+                    manifest.write(json.dumps({'uri': uri,
+                                               'frame': "{}{}{:02d}".format(stamp.expnum, stamp.version, stamp.ccd),
+                                               'time': time.time()}) + "\n")
+
+
+def _upload(filename, stamp, manifest):
+    try:
+        storage.copy(filename, stamp_uri(stamp))
+        manifest.record(stamp)
+        return True
+    except Exception as ex:
+        logging.error("Failed to upload {}: {}".format(stamp_uri(stamp), ex))
+        return False
+    finally:
+        os.unlink(filename)
+
+
+def build_stamps(stamps, radius, manifest=None, workers=4, upload_workers=4, image_dir="."):
+    """
+    Make and upload postage stamps, retrieving each region of each exposure only once.
+
+    Stamps are grouped by exposure and CCD, each group is sliced from a memory mapped local copy of the image if
+    there is one in image_dir, otherwise from a single cutout retrieved from VOSpace.  Exposures are processed by
+    a pool of workers and the stamps are uploaded by a second pool, so retrieval and upload overlap.
+
+    @param stamps: the stamps to make, see plan_stamps.
+    @param radius: radius of the stamps.
+    @type radius: Quantity
+    @param manifest: record of the stamps already uploaded, these are skipped.
+    @type manifest: StampManifest
+    @param workers: number of exposures to process at a time.
+    @param upload_workers: number of stamps to upload at a time.
+    @param image_dir: directory searched for local copies of the images.
+    @return: number of stamps made and uploaded.
+    """
+    manifest = manifest is None and StampManifest() or manifest
+    exposures = group_stamps([stamp for stamp in stamps if stamp not in manifest])
+    uploads = ThreadPoolExecutor(max_workers=upload_workers)
+    pending = []
+    lock = threading.Lock()
+
+    def build_exposure(expnum):
+        local_regions = {}
+        for group in exposures[expnum]:
+            filename = _local_image(group[0], image_dir)
+            try:
+                if filename is not None:
+                    if filename not in local_regions:
+                        local_regions[filename] = _local_regions(filename, group[0])
+                    regions = local_regions[filename]
+                else:
+                    regions = _remote_regions(group, radius)
+            except Exception as ex:
+                logging.error("Failed to retrieve {}{}{:02d}: {}".format(expnum, group[0].version, group[0].ccd, ex))
+                continue
+            for stamp in group:
+                try:
+                    region = [region for region in regions if region.pixel(stamp.sky_coord) is not None][0]
+                    hdulist = region.stamp(stamp.sky_coord, radius)
+                    fd, stamp_file = tempfile.mkstemp(suffix=".fits")
+                    os.close(fd)
+                    hdulist.writeto(stamp_file, overwrite=True, output_verify='fix+ignore')
+                except Exception as ex:
+                    logging.error("Failed to make {}: {}".format(stamp_uri(stamp), ex))
+                    continue
+                with lock:
+                    pending.append(uploads.submit(_upload, stamp_file, stamp, manifest))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(build_exposure, exposures))
+    finally:
+        uploads.shutdown(wait=True)
+    return sum([future.result() for future in pending])
 
 
 def main():
@@ -103,7 +382,23 @@ def main():
                         default=None,
                         action="store",
                         help="A tuple of TNO IDs to rerun")
-
+    parser.add_argument("--grouped",
+                        action="store_true",
+                        help="Plan all the stamps first and retrieve each region of each CCD only once.")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=4,
+                        help="Number of exposures to process at a time in --grouped mode.")
+    parser.add_argument("--upload-workers",
+                        type=int,
+                        default=4,
+                        help="Number of stamps to upload at a time in --grouped mode.")
+    parser.add_argument("--manifest",
+                        default=None,
+                        help="File recording the stamps uploaded in --grouped mode, a rerun skips those stamps.")
+    parser.add_argument("--image-dir",
+                        default=".",
+                        help="Directory holding local copies of images, stamps are sliced from these when present.")
 
     args = parser.parse_args()
 
@@ -115,11 +410,16 @@ def main():
         logging.basicConfig(level=logging.ERROR)
 
 
+    radius = args.radius
+    if not isinstance(radius, Quantity):
+        radius = float(radius) * units.arcsec
+
     astdir = args.astdir
     flist = os.listdir(astdir)
     if args.recheck:
         flist = [args.recheck + '.ast']
 
+    stamps = []
     for fn in flist:
         if not fn.endswith('.ast'):
             continue
@@ -131,14 +431,25 @@ def main():
                     ("Processing astrometric files in {}".format(obj_dir))
                 storage.mkdir(obj_dir)
                 obj = mpc.MPCReader(astdir + fn)
+                if args.grouped:
+                    stamps.extend(plan_stamps(obj, obj_dir, storage.listdir(obj_dir, force=True)))
+                    continue
                 # assert storage.exists(obj_dir, force=True)
                 sys.stderr.write('{} beginning...'.format(obj.provisional_name))
                 # if int(obj.provisional_name[3:]) == 49:
-                assert isinstance(args.radius, Quantity)
-                cutout(obj, obj_dir, args.radius)
+                cutout(obj, obj_dir, radius)
                 sys.stderr.write \
                     ('{} complete.\n\n'.format(obj.provisional_name))
 
+    if args.grouped:
+        sys.stderr.write('Making {} postage stamps...'.format(len(stamps)))
+        made = build_stamps(stamps, radius,
+                            manifest=StampManifest(args.manifest),
+                            workers=args.workers,
+                            upload_workers=args.upload_workers,
+                            image_dir=args.image_dir)
+        sys.stderr.write('{} complete.\n'.format(made))
+
 
 if __name__ == '__main__':
     main()
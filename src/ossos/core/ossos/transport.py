@@ -0,0 +1,318 @@
+"""
+A resilient transport for the calls ossos.storage makes to VOSpace (and the other CADC web services).
+
+Every call goes through a Transport which:
+
+ * retries failures that are worth retrying (time outs, dropped connections, 5xx responses) with exponential
+   backoff and full jitter, so a crowd of workers doesn't return to a struggling service in lockstep;
+ * gives up once a call's deadline (covering all its attempts) would be passed;
+ * keeps a circuit breaker per service endpoint (the nodes service, the data service, ...): after a run of
+   failures calls to that endpoint fail immediately until a trial call, made after a cool off, succeeds;
+ * limits the number of simultaneous calls with a semaphore (which can be shared between processes);
+ * records the latency, failures and retries of the calls to each endpoint.
+"""
+import errno
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from cadcutils import exceptions
+
+from .cache import _read_value
+
+# errno values of errors that are worth another try.
+RETRYABLE_ERRNOS = [errno.EAGAIN, errno.EBUSY, errno.EIO, errno.ETIMEDOUT, errno.ECONNRESET, errno.ECONNREFUSED,
+                    errno.ECONNABORTED, errno.ENETUNREACH, errno.EHOSTUNREACH]
+
+# HTTP statuses, besides 5xx, of requests that are worth another try: request timeout and too many requests.
+RETRYABLE_STATUSES = [408, 429]
+
+# errors that are the answer to the request, not a failure of the service, trying again won't help.
+FINAL_EXCEPTIONS = (exceptions.NotFoundException, exceptions.AlreadyExistsException,
+                    exceptions.BadRequestException, exceptions.ForbiddenException,
+                    exceptions.UnauthorizedException, exceptions.PreconditionFailedException,
+                    exceptions.ByteLimitException)
+
+
+def is_retryable(ex):
+    """
+    Is the exception raised by a call the kind of failure that might not happen next time?
+    """
+    if isinstance(ex, CircuitOpenError) or isinstance(ex, FINAL_EXCEPTIONS):
+        return False
+    if isinstance(ex, requests.exceptions.HTTPError):
+        response = getattr(ex, 'response', None)
+        return response is None or response.status_code >= 500 or response.status_code in RETRYABLE_STATUSES
+    if isinstance(ex, (exceptions.HttpException, exceptions.TransferException, requests.exceptions.RequestException)):
+        return True
+    if isinstance(ex, (OSError, IOError)):
+        code = getattr(ex, 'errno', None)
+        if code in RETRYABLE_ERRNOS:
+            return True
+        # vos reports the HTTP status of a failed request as the errno.
+        return code is not None and (code >= 500 or code in RETRYABLE_STATUSES)
+    return False
+
+
+class CircuitOpenError(IOError):
+    """
+    Raised, without calling the service, while the circuit breaker of an endpoint is open.
+    """
+
+    def __init__(self, endpoint):
+        super(CircuitOpenError, self).__init__(errno.EAGAIN, "{} service unavailable (circuit open)".format(endpoint))
+        self.endpoint = endpoint
+
+
+class CircuitBreaker(object):
+    """
+    Trip after failure_threshold consecutive failures, then refuse calls for reset_timeout seconds before letting
+    a single trial call through: success closes the circuit again, failure re-opens it.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.time() - self.opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        """
+        @return: may a call be made now?
+        """
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        """
+        @return: did this failure open the circuit?
+        """
+        with self._lock:
+            self.failures += 1
+            was_open = self.opened_at is not None
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self.trial = False
+            return not was_open and self.opened_at is not None
+
+
+class RetryPolicy(object):
+    """
+    How many times, and for how long, a failing call is tried.
+    """
+
+    def __init__(self, attempts=5, base_delay=1.0, max_delay=60.0, deadline=600.0):
+        """
+        @param attempts: maximum number of times a call is made.
+        @param base_delay: the pause before the first retry, doubled for each retry after that.
+        @param max_delay: the longest pause between retries.
+        @param deadline: seconds from the first attempt after which a call is not tried again.
+        """
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def delay(self, attempt):
+        """
+        The pause before retry number attempt (1 for the first retry), a random fraction of the backoff.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class EndpointMetrics(object):
+    """
+    Counters of the calls made to one endpoint.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.rejected = 0
+        self.circuit_opens = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'failures': self.failures,
+                'retries': self.retries,
+                'rejected': self.rejected,
+                'circuit_opens': self.circuit_opens,
+                'mean_latency': self.calls and self.total_latency / self.calls or 0.0,
+                'max_latency': self.max_latency}
+
+
+class Transport(object):
+    """
+    Make calls to remote services with retries, deadlines, circuit breaking and a limit on concurrency.
+    """
+
+    def __init__(self, policy=None, failure_threshold=5, reset_timeout=30.0, semaphore=None):
+        """
+        @param policy: the RetryPolicy of calls.
+        @param failure_threshold: consecutive failures of an endpoint that open its circuit.
+        @param reset_timeout: seconds an open circuit waits before a trial call.
+        @param semaphore: limits the number of calls in progress at once, None for no limit.
+        """
+        self.policy = policy is not None and policy or RetryPolicy()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.semaphore = semaphore
+        self.breakers = {}
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _endpoint(self, endpoint):
+        with self._lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+                self.metrics[endpoint] = EndpointMetrics()
+            return self.breakers[endpoint], self.metrics[endpoint]
+
+    @contextmanager
+    def _slot(self):
+        if self.semaphore is None:
+            yield
+        else:
+            with self.semaphore:
+                yield
+
+    def call(self, endpoint, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs), a request to endpoint, retrying failures as allowed by the policy.
+
+        @raise CircuitOpenError: if the endpoint's circuit is open.
+        @return: what func returns.
+        """
+        breaker, metrics = self._endpoint(endpoint)
+        start = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            if not breaker.allow():
+                with self._lock:
+                    metrics.rejected += 1
+                raise CircuitOpenError(endpoint)
+            call_start = time.time()
+            try:
+                with self._slot():
+                    result = func(*args, **kwargs)
+            except Exception as ex:
+                self._record(metrics, time.time() - call_start, failed=True)
+                if not is_retryable(ex):
+                    # the service answered, it just wasn't the answer we wanted.
+                    breaker.success()
+                    raise
+                if breaker.failure():
+                    logging.warning("Too many failures of the {} service, circuit open for {}s".format(
+                        endpoint, self.reset_timeout))
+                    with self._lock:
+                        metrics.circuit_opens += 1
+                    raise
+                delay = self.policy.delay(attempt)
+                if attempt >= self.policy.attempts or time.time() + delay - start > self.policy.deadline:
+                    raise
+                logging.warning("{} call to {} failed (attempt {} of {}), retrying in {:.1f}s: {}".format(
+                    getattr(func, '__name__', func), endpoint, attempt, self.policy.attempts, delay, ex))
+                with self._lock:
+                    metrics.retries += 1
+                time.sleep(delay)
+                continue
+            breaker.success()
+            self._record(metrics, time.time() - call_start)
+            return result
+
+    def _record(self, metrics, latency, failed=False):
+        with self._lock:
+            metrics.calls += 1
+            metrics.failures += failed and 1 or 0
+            metrics.total_latency += latency
+            metrics.max_latency = max(metrics.max_latency, latency)
+
+    def stats(self):
+        """
+        @return: dictionary of endpoint -> dictionary of call counters and latencies.
+        """
+        with self._lock:
+            return dict((endpoint, metrics.as_dict()) for endpoint, metrics in self.metrics.items())
+
+    def __str__(self):
+        lines = []
+        for endpoint, stats in sorted(self.stats().items()):
+            lines.append("{endpoint}: {calls} calls, {failures} failed, {retries} retried, {rejected} rejected, "
+                         "circuit opened {circuit_opens} times, latency mean {mean_latency:.2f}s "
+                         "max {max_latency:.2f}s".format(endpoint=endpoint, **stats))
+        return "\n".join(lines)
+
+
+class ResilientClient(object):
+    """
+    Wrap a vos.Client so that each of its methods is called through a Transport.
+    """
+
+    # the endpoint each method talks to, the others talk to the nodes service.
+    ENDPOINTS = {'copy': 'data', 'open': 'data'}
+
+    def __init__(self, client, transport):
+        self.client = client
+        self.transport = transport
+
+    def __getattr__(self, attr):
+        orig_attr = getattr(self.client, attr)
+        if not callable(orig_attr):
+            return orig_attr
+
+        def call(*args, **kwargs):
+            return self.transport.call(self.ENDPOINTS.get(attr, 'nodes'), orig_attr, *args, **kwargs)
+        call.__name__ = attr
+        return call
+
+
+def transport_from_config(semaphore=None):
+    """
+    Build the Transport described by the STORAGE.TRANSPORT section of the configuration.
+
+    @param semaphore: limit on simultaneous calls, default is a MAX_CONCURRENT (if set) limit within this process.
+    """
+    max_concurrent = _read_value("STORAGE.TRANSPORT.MAX_CONCURRENT", 0, int)
+    if semaphore is None and max_concurrent > 0:
+        semaphore = threading.BoundedSemaphore(max_concurrent)
+    policy = RetryPolicy(attempts=_read_value("STORAGE.TRANSPORT.ATTEMPTS", 5, int),
+                         base_delay=_read_value("STORAGE.TRANSPORT.BASE_DELAY", 1.0, float),
+                         max_delay=_read_value("STORAGE.TRANSPORT.MAX_DELAY", 60.0, float),
+                         deadline=_read_value("STORAGE.TRANSPORT.DEADLINE", 600.0, float))
+    return Transport(policy,
+                     failure_threshold=_read_value("STORAGE.TRANSPORT.FAILURE_THRESHOLD", 5, int),
+                     reset_timeout=_read_value("STORAGE.TRANSPORT.RESET_TIMEOUT", 30.0, float),
+                     semaphore=semaphore)
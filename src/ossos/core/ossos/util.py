@@ -11,6 +11,7 @@ import time
 import sys
 import six
 import tempfile
+from scipy.spatial import cKDTree
 
 try:
     from astropy._erfa import d2dtf
@@ -146,6 +147,22 @@ def get_pixel_bounds_from_datasec_keyword(datasec):
     return (x1, x2), (y1, y2)
 
 
+def _match_coordinates(pos, spherical):
+    """
+    Convert an N x 2 array of positions into the coordinates used to build the matching KD-tree.
+
+    For spherical matching the RA/DEC (degrees) positions become unit vectors so that the
+    tree distances are chords on the unit sphere, which handles RA wrap and the poles.
+    """
+    if not spherical:
+        return numpy.asarray(pos[:, 0:2], dtype=numpy.float64)
+    ra = numpy.radians(pos[:, 0])
+    dec = numpy.radians(pos[:, 1])
+    return numpy.transpose([numpy.cos(dec) * numpy.cos(ra),
+                            numpy.cos(dec) * numpy.sin(ra),
+                            numpy.sin(dec)])
+
+
 def match_lists(pos1, pos2, tolerance=MATCH_TOLERANCE, spherical=False):
     """
     Given two sets of x/y positions match the lists, uniquely.
@@ -154,16 +171,17 @@ def match_lists(pos1, pos2, tolerance=MATCH_TOLERANCE, spherical=False):
     :param pos1: list of x/y positions.
     :param pos2: list of x/y positions.
     :param tolerance: float distance, in pixels, to consider a match
+    :param spherical: positions are RA/DEC in degrees, tolerance is then an angular separation in degrees.
 
     Algorithm:
-        - Find all the members of pos2 that are within tolerance of pos1[idx1].
-                These pos2 members are match_group_1
-        - Find all the members of pos1 that are within tolerance of match_group_1[idx2].
-                These pos1 members are match_group_2
-        - If pos1[idx] is in match_group_2 then pos1[idx] is a match of object at match_group_1[idx2]
+        - Build a KD-tree for each list of positions.
+        - Find the nearest member of pos2 within tolerance of each pos1[idx1] and the nearest member of pos1
+                within tolerance of each pos2[idx2].
+        - pos1[idx1] and pos2[idx2] are a match if each is the nearest neighbour of the other.
 
+    This scales as O(N log N) so whole-CCD (or larger) catalogues can be matched.
+    The returned index arrays are int64, masked where no match was found.
     """
-
     assert isinstance(pos1, numpy.ndarray)
     assert isinstance(pos2, numpy.ndarray)
 
@@ -172,53 +190,41 @@ def match_lists(pos1, pos2, tolerance=MATCH_TOLERANCE, spherical=False):
 
     if len(pos1) > 0:
         npts1 = len(pos1[:, 0])
-    pos1_idx_array = numpy.arange(npts1, dtype=numpy.int16)
 
     if len(pos2) > 0:
         npts2 = len(pos2[:, 0])
-    pos2_idx_array = numpy.arange(npts2, dtype=numpy.int16)
 
-    # this is the array of final matched index, -1 indicates no match found.
-    match1 = numpy.ma.zeros(npts1, dtype=numpy.int16)
+    # this is the array of final matched index, masked indicates no match found.
+    match1 = numpy.ma.zeros(npts1, dtype=numpy.int64)
     match1.mask = True
 
-    # this is the array of matches in pos2, -1 indicates no match found.
-    match2 = numpy.ma.zeros(npts2, dtype=numpy.int16)
+    # this is the array of matches in pos2, masked indicates no match found.
+    match2 = numpy.ma.zeros(npts2, dtype=numpy.int64)
     match2.mask = True
 
     # if one of the two input arrays are zero length then there is no matching to do.
     if npts1 * npts2 == 0:
         return match1, match2
 
-    for idx1 in range(npts1):
-
-        # compute the distance source idx1 to each member of pos2
-        if not spherical :
-           sep = numpy.sqrt((pos2[:, 0] - pos1[idx1, 0]) ** 2 + (pos2[:, 1] - pos1[idx1, 1]) ** 2)
-        else:
-           sep = numpy.sqrt((numpy.cos(numpy.radians(pos1[idx1,1]))*(pos2[:, 0] - pos1[idx1, 0])) ** 2 + (pos2[:, 1] - pos1[idx1, 1]) ** 2)
-
-        # considered a match if sep is below tolerance and is the closest match available.
-        match_condition = numpy.all((sep <= tolerance, sep == sep.min()), axis=0)
+    coords1 = _match_coordinates(pos1, spherical)
+    coords2 = _match_coordinates(pos2, spherical)
 
-        # match_group_1 is list of the indexes of pos2 entries that qualified as possible matches to pos1[idx1]
-        match_group_1 = pos2_idx_array[match_condition]
+    radius = tolerance
+    if spherical:
+        radius = 2 * numpy.sin(numpy.radians(min(tolerance, 180.0)) / 2.0)
+    # the tree query excludes neighbours at exactly the upper bound, we want to include those.
+    radius = numpy.nextafter(radius, numpy.inf)
 
-        # For each of those pos2 objects that could be a match to pos1[idx] find the best match in all of pos1
-        for idx2 in match_group_1:
-            # compute the distance from this pos2 object that is a possible match to pos1[idx1] to all members of pos1
-            sep = numpy.sqrt((pos1[:, 0] - pos2[idx2, 0]) ** 2 + (pos1[:, 1] - pos2[idx2, 1]) ** 2)
+    # nearest neighbour, within tolerance, in the other list. Missing neighbours are given index len(other list).
+    nearest2 = cKDTree(coords2).query(coords1, k=1, distance_upper_bound=radius)[1]
+    nearest1 = cKDTree(coords1).query(coords2, k=1, distance_upper_bound=radius)[1]
 
-            # considered a match if sep is below tolerance and is the closest match available.
-            match_condition = numpy.all((sep <= tolerance, sep == sep.min()), axis=0)
-            match_group_2 = pos1_idx_array[match_condition]
+    idx1 = numpy.flatnonzero(nearest2 < npts2)
+    idx2 = nearest2[idx1]
+    mutual = nearest1[idx2] == idx1
 
-            # Are any of the pos1 members that were matches to the matched pos2 member the pos1[idx] entry?
-            if idx1 in match_group_2:
-                match1[idx1] = idx2
-                match2[idx2] = idx1
-                # this BREAK is in here since once we have a match we're done.
-                break
+    match1[idx1[mutual]] = idx2[mutual]
+    match2[idx2[mutual]] = idx1[mutual]
 
     return match1, match2
 
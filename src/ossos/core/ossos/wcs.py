@@ -106,6 +106,11 @@ class WCS(astropy_wcs.WCS):
         return pos[0] * units.degree, pos[1] * units.degree
 
     def sky2xy(self, ra, dec, usepv=True):
+        """
+        Convert RA/DEC (degrees or Quantity) to pixel coordinates.
+
+        ra and dec may be scalars or arrays, arrays are converted in a single vectorized call.
+        """
         if isinstance(ra, Quantity):
             ra = ra.to(units.degree).value
         if isinstance(dec, Quantity):
@@ -124,25 +129,103 @@ class WCS(astropy_wcs.WCS):
         except Exception as ex:
             logger.warning("sky2xy raised exception: {0}".format(ex))
             logger.warning("Reverted to CD-Matrix WCS to convert: {0} {1} ".format(ra, dec))
-        pos = self.wcs_world2pix([[ra, dec], ], 1)
-        return pos[0][0], pos[0][1]
+        if numpy.ndim(ra) == 0 and numpy.ndim(dec) == 0:
+            pos = self.wcs_world2pix([[ra, dec], ], 1)
+            return pos[0][0], pos[0][1]
+        return self.wcs_world2pix(numpy.asarray(ra, dtype=float), numpy.asarray(dec, dtype=float), 1)
+
+
+def _pv_terms(x, y, pv, nord, derivatives=False):
+    """
+    Evaluate the PV distortion polynomial (and optionally its derivatives) at x, y.
 
+    x and y are numpy arrays of intermediate world coordinates (degrees) and all terms are computed
+    element wise, so this evaluates the polynomial for a whole list of sources at once.
 
-def sky2xypv(ra, dec, crpix1, crpix2, crval1, crval2, dc, pv, nord, maxiter=300):
+    Args:
+      x, y: numpy.ndarray
+        Intermediate world coordinates, degrees
+      pv: 2d array
+      nord: int
+        order of the fit
+      derivatives: bool
+        also return the partial derivatives needed for the Newton inversion.
+
+    Returns:
+      f, g: numpy.ndarray
+        the distorted coordinates
+      fx, fy, gx, gy: numpy.ndarray
+        partial derivatives of f and g (only if derivatives is True)
+    """
+    f = pv[0][0] + numpy.zeros_like(x)
+    g = pv[1][0] + numpy.zeros_like(y)
+
+    fx = numpy.zeros_like(x)
+    fy = numpy.zeros_like(x)
+    gx = numpy.zeros_like(x)
+    gy = numpy.zeros_like(x)
+
+    if nord >= 1:
+        r = numpy.sqrt(x ** 2 + y ** 2)
+        f += pv[0][1] * x + pv[0][2] * y + pv[0][3] * r
+        g += pv[1][1] * y + pv[1][2] * x + pv[1][3] * r
+        if derivatives:
+            fx += pv[0][1] + pv[0][3] * x / r
+            fy += pv[0][2] + pv[0][3] * y / r
+            gx += pv[1][2] + pv[1][3] * x / r
+            gy += pv[1][1] + pv[1][3] * y / r
+
+        if nord >= 2:
+            x2 = x ** 2
+            xy = x * y
+            y2 = y ** 2
+
+            f += pv[0][4] * x2 + pv[0][5] * xy + pv[0][6] * y2
+            g += pv[1][4] * y2 + pv[1][5] * xy + pv[1][6] * x2
+            if derivatives:
+                fx += pv[0][4] * 2 * x + pv[0][5] * y
+                fy += pv[0][5] * x + pv[0][6] * 2 * y
+                gx += pv[1][5] * y + pv[1][6] * 2 * x
+                gy += pv[1][4] * 2 * y + pv[1][5] * x
+
+            if nord >= 3:
+                x3 = x ** 3
+                x2y = x2 * y
+                xy2 = x * y2
+                y3 = y ** 3
+
+                f += pv[0][7] * x3 + pv[0][8] * x2y + pv[0][9] * xy2 + pv[0][10] * y3
+                g += pv[1][7] * y3 + pv[1][8] * xy2 + pv[1][9] * x2y + pv[1][10] * x3
+                if derivatives:
+                    fx += pv[0][7] * 3 * x2 + pv[0][8] * 2 * xy + pv[0][9] * y2
+                    fy += pv[0][8] * x2 + pv[0][9] * 2 * xy + pv[0][10] * 3 * y2
+                    gx += pv[0][8] * y2 + pv[1][9] * 2 * xy + pv[1][10] * 3 * x2
+                    gy += pv[1][7] * 3 * y2 + pv[0][8] * 2 * xy + pv[1][9] * x2
+
+    if derivatives:
+        return f, g, fx, fy, gx, gy
+    return f, g
+
+
+def sky2xypv(ra, dec, crpix1, crpix2, crval1, crval2, dc, pv, nord, maxiter=300, return_converged=False):
     """
     Transforms from celestial coordinates to pixel coordinates to taking
     non-linear distortion into account with the World Coordinate System
     FITS keywords as used in MegaPipe.
 
+    ra and dec can be scalars or arrays.  For arrays the distortion polynomial and the Newton
+    inversion are run for all positions at once, with each element dropped from the iteration
+    as soon as it has converged.
+
     For the inverse operation see xy2sky.
 
     Reference material:
     http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/megapipe/docs/CD_PV_keywords.pdf
 
     Args:
-      ra: float
+      ra: float or numpy.ndarray
         Right ascension
-      dec: float
+      dec: float or numpy.ndarray
         Declination
       crpix1: float
         Tangent point x, pixels
@@ -158,108 +241,69 @@ def sky2xypv(ra, dec, crpix1, crpix2, crval1, crval2, dc, pv, nord, maxiter=300)
       pv: 2d array
       nord: int
         order of the fit
+      maxiter: int
+        maximum number of Newton iterations.
+      return_converged: bool
+        also return a boolean mask of which positions converged.
 
     Returns:
-      x, y: float
+      x, y: float or numpy.ndarray
         Pixel coordinates
+      converged: bool or numpy.ndarray
+        only if return_converged is True.
     """
-    if math.fabs(ra - crval1) > 100:
-        if crval1 < 180:
-            ra -= 360
-        else:
-            ra += 360
+    scalar_input = numpy.ndim(ra) == 0 and numpy.ndim(dec) == 0
+    ra, dec = numpy.broadcast_arrays(numpy.array(ra, dtype=float, ndmin=1),
+                                     numpy.array(dec, dtype=float, ndmin=1))
+
+    wrap = 360 if crval1 >= 180 else -360
+    ra = numpy.where(numpy.fabs(ra - crval1) > 100, ra + wrap, ra)
 
-    ra /= PI180
-    dec /= PI180
+    ra = ra / PI180
+    dec = dec / PI180
 
-    tdec = math.tan(dec)
+    tdec = numpy.tan(dec)
     ra0 = crval1 / PI180
     dec0 = crval2 / PI180
     ctan = math.tan(dec0)
     ccos = math.cos(dec0)
 
-    traoff = math.tan(ra - ra0)
-    craoff = math.cos(ra - ra0)
+    traoff = numpy.tan(ra - ra0)
+    craoff = numpy.cos(ra - ra0)
     etar = (1 - ctan * craoff / tdec) / (ctan + craoff / tdec)
     xir = traoff * ccos * (1 - etar * ctan)
     xi = xir * PI180
     eta = etar * PI180
 
-    if nord < 0:
-        # The simple solution
-        x = xi
-        y = eta
-    else:
-        # Reverse by Newton's method
-        tolerance = 0.001 / 3600
+    # Initial guess
+    x = xi.copy()
+    y = eta.copy()
+    converged = numpy.ones(x.shape, dtype=bool)
 
-        # Initial guess
-        x = xi
-        y = eta
+    if nord >= 0:
+        # Reverse by Newton's method, iterating only on the elements that have not yet converged.
+        tolerance = 0.001 / 3600
+        converged[...] = False
         iteration = 0
-
-        converged = False
-        while not converged:
-            assert nord >= 0
-
-            # Estimates
-            f = pv[0][0]
-            g = pv[1][0]
-
-            # Derivatives
-            fx = 0
-            fy = 0
-            gx = 0
-            gy = 0
-
-            if nord >= 1:
-                r = math.sqrt(x ** 2 + y ** 2)
-                f += pv[0][1] * x + pv[0][2] * y + pv[0][3] * r
-                g += pv[1][1] * y + pv[1][2] * x + pv[1][3] * r
-                fx += pv[0][1] + pv[0][3] * x / r
-                fy += pv[0][2] + pv[0][3] * y / r
-                gx += pv[1][2] + pv[1][3] * x / r
-                gy += pv[1][1] + pv[1][3] * y / r
-
-                if nord >= 2:
-                    x2 = x ** 2
-                    xy = x * y
-                    y2 = y ** 2
-
-                    f += pv[0][4] * x2 + pv[0][5] * xy + pv[0][6] * y2
-                    g += pv[1][4] * y2 + pv[1][5] * xy + pv[1][6] * x2
-                    fx += pv[0][4] * 2 * x + pv[0][5] * y
-                    fy += pv[0][5] * x + pv[0][6] * 2 * y
-                    gx += pv[1][5] * y + pv[1][6] * 2 * x
-                    gy += pv[1][4] * 2 * y + pv[1][5] * x
-
-                    if nord >= 3:
-                        x3 = x ** 3
-                        x2y = x2 * y
-                        xy2 = x * y2
-                        y3 = y ** 3
-
-                        f += pv[0][7] * x3 + pv[0][8] * x2y + pv[0][9] * xy2 + pv[0][10] * y3
-                        g += pv[1][7] * y3 + pv[1][8] * xy2 + pv[1][9] * x2y + pv[1][10] * x3
-                        fx += pv[0][7] * 3 * x2 + pv[0][8] * 2 * xy + pv[0][9] * y2
-                        fy += pv[0][8] * x2 + pv[0][9] * 2 * xy + pv[0][10] * 3 * y2
-                        gx += pv[0][8] * y2 + pv[1][9] * 2 * xy + pv[1][10] * 3 * x2
-                        gy += pv[1][7] * 3 * y2 + pv[0][8] * 2 * xy + pv[1][9] * x2
-
-            f -= xi
-            g -= eta
-            dx = (-f * gy + g * fy) / (fx * gy - fy * gx)
-            dy = (-g * fx + f * gx) / (fx * gy - fy * gx)
-            x += dx
-            y += dy
-
-            if math.fabs(dx) < tolerance and math.fabs(dy) < tolerance:
-                converged = True
-
-            iteration += 1
-
-            if iteration > maxiter:
+        while iteration <= maxiter:
+            active = numpy.flatnonzero(~converged)
+            if not len(active):
                 break
+            xa = x.flat[active]
+            ya = y.flat[active]
+            f, g, fx, fy, gx, gy = _pv_terms(xa, ya, pv, nord, derivatives=True)
+            f -= xi.flat[active]
+            g -= eta.flat[active]
+            det = fx * gy - fy * gx
+            dx = (-f * gy + g * fy) / det
+            dy = (-g * fx + f * gx) / det
+            x.flat[active] = xa + dx
+            y.flat[active] = ya + dy
+            converged.flat[active] = (numpy.fabs(dx) < tolerance) & (numpy.fabs(dy) < tolerance)
+            iteration += 1
+        if not converged.all():
+            logger.warning("sky2xypv: {} of {} positions did not converge after {} iterations".format(
+                (~converged).sum(), converged.size, maxiter))
 
     xp = dc[0][0] * x + dc[0][1] * y
     yp = dc[1][0] * x + dc[1][1] * y
@@ -267,6 +311,11 @@ def sky2xypv(ra, dec, crpix1, crpix2, crval1, crval2, dc, pv, nord, maxiter=300)
     x = xp + crpix1
     y = yp + crpix2
 
+    if scalar_input:
+        x, y, converged = float(x[0]), float(y[0]), bool(converged[0])
+
+    if return_converged:
+        return x, y, converged
     return x, y
 
 
@@ -276,13 +325,15 @@ def xy2skypv(x, y, crpix1, crpix2, crval1, crval2, cd, pv, nord):
     non-linear distortion into account with the World Coordinate System
     FITS keywords as used in MegaPipe.
 
+    x and y may be scalars or arrays, the whole array is converted in one pass.
+
     For the inverse operation see sky2xy
 
     Reference material:
     http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/megapipe/docs/CD_PV_keywords.pdf
 
     Args:
-      x, y: float
+      x, y: float or numpy.ndarray
         Input pixel coordinate
       crpix1: float
         Tangent point x, pixels
@@ -300,11 +351,13 @@ def xy2skypv(x, y, crpix1, crpix2, crval1, crval2, cd, pv, nord):
         order of the fit
 
     Returns:
-      ra: float
+      ra: Quantity
         Right ascension
-      dec: float
+      dec: Quantity
         Declination
     """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
     xp = x - crpix1
     yp = y - crpix2
 
@@ -317,30 +370,7 @@ def xy2skypv(x, y, crpix1, crpix2, crval1, crval2, cd, pv, nord):
         xi = x
         eta = y
     else:
-        xi = pv[0][0]
-        eta = pv[1][0]
-
-    if nord >= 1:
-        r = numpy.sqrt(x_deg ** 2 + y_deg ** 2)
-        xi += pv[0][1] * x_deg + pv[0][2] * y_deg + pv[0][3] * r
-        eta += pv[1][1] * y_deg + pv[1][2] * x_deg + pv[1][3] * r
-
-        if nord >= 2:
-            x2 = x_deg ** 2
-            xy = x_deg * y_deg
-            y2 = y_deg ** 2
-
-            xi += pv[0][4] * x2 + pv[0][5] * xy + pv[0][6] * y2
-            eta += pv[1][4] * y2 + pv[1][5] * xy + pv[1][6] * x2
-
-            if nord >= 3:
-                x3 = x_deg ** 3
-                x2y = x2 * y_deg
-                xy2 = x_deg * y2
-                y3 = y_deg ** 3
-
-                xi += pv[0][7] * x3 + pv[0][8] * x2y + pv[0][9] * xy2 + pv[0][10] * y3
-                eta += pv[1][7] * y3 + pv[1][8] * xy2 + pv[1][9] * x2y + pv[1][10] * x3
+        xi, eta = _pv_terms(x_deg, y_deg, pv, nord)
 
     xir = xi / PI180
     etar = eta / PI180
@@ -0,0 +1,147 @@
+#!python
+"""
+Write a synthetic .cands.astrom file of a given size and compare reading its sources with the streaming
+parser (AstromParser.parse_iter) against reading the whole file into memory the way AstromParser.parse used to.
+
+The observation headers are not read, so no connection to VOSpace is needed.
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import resource
+import tempfile
+import time
+
+import numpy
+
+from ossos import astrom
+
+OBSERVATIONS = ['1616681p22', '1616692p22', '1616703p22']
+HEADER = {astrom.MOPVERSION: '1.20', astrom.MJD_OBS_CENTER: '2013 04 09.36658', astrom.EXPTIME: 287.14,
+          astrom.THRES: 2.70, astrom.FWHM: 3.30, astrom.MAXCOUNT: 30000.0, astrom.CRVAL1: 26.92871,
+          astrom.CRVAL2: 29.01125, astrom.EXPNUM: 1616681, astrom.SCALE: 0.185, astrom.CHIP: 23,
+          astrom.CRPIX1: -3061.34, astrom.CRPIX2: 9034.21, astrom.NAX1: 2112, astrom.NAX2: 4644,
+          astrom.DETECTOR: 'MegaCam', astrom.PHADU: 1.60, astrom.RDNOIS: 3.00}
+SYS_HEADER = {astrom.RMIN: 0.5, astrom.RMAX: 10.3, astrom.ANGLE: -19.9, astrom.AWIDTH: 22.3}
+# sources formatted per write.
+BLOCK = 10000
+
+
+def observations():
+    result = []
+    for rawname in OBSERVATIONS:
+        observation = astrom.Observation(rawname[:7], rawname[7], rawname[8:])
+        observation.header = dict(HEADER)
+        result.append(observation)
+    return result
+
+
+def write_file(filename, size):
+    """
+    Write an astrom file of about size bytes of randomly placed sources.
+    """
+    nobs = len(OBSERVATIONS)
+    source_format = "\n" + " %8.2f %8.2f %8.2f %8.2f %12.7f %12.7f\n" * nobs
+    block_format = source_format * BLOCK
+    nsources = 0
+    with open(filename, 'w+') as fobj:
+        astrom.StreamingAstromWriter(fobj, SYS_HEADER).write_headers(observations(), SYS_HEADER)
+        while fobj.tell() < size:
+            x = numpy.random.uniform(1, 2112, (BLOCK, 1)) + numpy.arange(nobs) * 2.0
+            y = numpy.random.uniform(1, 4644, (BLOCK, 1)) + numpy.arange(nobs) * 0.5
+            ra = 26.92871 + (x - 1056) * 0.185 / 3600.0
+            dec = 29.01125 + (y - 2322) * 0.185 / 3600.0
+            rows = numpy.stack([x, y, x, y, ra, dec], axis=-1)
+            fobj.write(block_format % tuple(rows.ravel()))
+            nsources += BLOCK
+    return nsources
+
+
+def max_rss():
+    """Peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _measure(results, func, args):
+    rss = max_rss()
+    start = time.time()
+    count = func(*args)
+    results.put((count, time.time() - start, max_rss() - rss))
+
+
+def measure(func, *args):
+    """
+    Run func(*args) in a fresh process so that the peak memory of each way of reading is measured on its own.
+
+    @return: the result of func, the seconds it took and the MB the peak memory grew by.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(results, func, args))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError("{} exited with code {}, out of memory?".format(func.__name__, process.exitcode))
+    process.join()
+    return result
+
+
+def stream(filename, chunk_size):
+    parser = astrom.AstromParser()
+    with open(filename, 'rb') as filehandle:
+        header, remainder = parser._read_header(filehandle, chunk_size)
+        obs = parser._parse_observation_list(header)
+        count = 0
+        for source in astrom.AstromStream(filehandle, obs, parser._parse_system_header(header),
+                                          remainder=remainder, chunk_size=chunk_size):
+            count += 1
+    return count
+
+
+def whole(filename):
+    parser = astrom.AstromParser()
+    with open(filename, 'rb') as filehandle:
+        filestr = filehandle.read().decode('utf-8')
+    obs = parser._parse_observation_list(filestr)
+    sources = parser._parse_source_data(filestr, obs)
+    return astrom.AstromData(obs, parser._parse_system_header(filestr), sources).get_source_count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=float, default=1024,
+                        help="size of the synthetic astrom file in MB")
+    parser.add_argument('--chunk-size', type=int, default=astrom.STREAM_CHUNK_SIZE,
+                        help="bytes read at a time by the streaming parser")
+    parser.add_argument('--whole', action='store_true',
+                        help="also time reading the whole file into memory (needs several times the file size)")
+    parser.add_argument('--filename', default=None,
+                        help="write the synthetic file here and keep it, default is a temporary file")
+    args = parser.parse_args()
+
+    filename = args.filename
+    if filename is None:
+        fd, filename = tempfile.mkstemp(suffix='.cands.astrom')
+        os.close(fd)
+    try:
+        start = time.time()
+        nsources = write_file(filename, int(args.size * 1024 ** 2))
+        print("wrote {} sources, {:.0f} MB in {:.1f}s".format(nsources, os.path.getsize(filename) / 1024.0 ** 2,
+                                                             time.time() - start))
+
+        print("parse_iter: {} sources in {:.1f}s, peak memory grew by {:.0f} MB".format(
+            *measure(stream, filename, args.chunk_size)))
+        if args.whole:
+            print("whole file: {} sources in {:.1f}s, peak memory grew by {:.0f} MB".format(
+                *measure(whole, filename)))
+    finally:
+        if args.filename is None:
+            os.unlink(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!python
+"""
+Compare the time to convert a list of positions through ossos.wcs one point at a time (the way
+the pipeline and the validation GUI used to call sky2xypv/xy2skypv) against a single vectorized call.
+"""
+import argparse
+import time
+
+import numpy
+
+from ossos import wcs
+
+# PV solution from http://www.cadc-ccda.hia-iha.nrc-cnrc.gc.ca/data/pub/CFHTSG/821543p.head
+CRPIX1 = -7535.57493517
+CRPIX2 = 9808.40914361
+CRVAL1 = 176.486157083
+CRVAL2 = 8.03697351091
+CD = [[5.115244026718E-05, 7.064503033578E-07],
+      [-1.280229655229E-07, -5.123112374523E-05]]
+PV = [[-7.030338745606E-03, 1.01755337222, 8.262429361142E-03,
+       0.00000000000, -5.910145454849E-04, -7.494178330178E-04,
+       -3.470178516657E-04, -2.331150605755E-02, -8.187062772669E-06,
+       -2.325429510806E-02, 1.135299506292E-04],
+      [-6.146513090656E-03, 1.01552885426, 8.259666421752E-03,
+       0.00000000000, -4.567030382243E-04, -6.978676921999E-04,
+       -3.732572951216E-04, -2.332572754467E-02, -2.354317291723E-05,
+       -2.329623852891E-02, 1.196394469003E-04]]
+NORD = 3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--npoints', type=int, default=100000,
+                        help="number of positions to convert")
+    parser.add_argument('--nloop', type=int, default=5000,
+                        help="number of positions converted with the scalar loop, time is scaled to npoints")
+    args = parser.parse_args()
+
+    dc = numpy.linalg.inv(CD)
+    x = numpy.random.uniform(14000, 16000, args.npoints)
+    y = numpy.random.uniform(19000, 21000, args.npoints)
+
+    start = time.time()
+    ra, dec = wcs.xy2skypv(x, y, CRPIX1, CRPIX2, CRVAL1, CRVAL2, CD, PV, NORD)
+    xy2sky_vector = time.time() - start
+    ra = ra.to('degree').value
+    dec = dec.to('degree').value
+
+    start = time.time()
+    for i in range(args.nloop):
+        wcs.xy2skypv(x[i], y[i], CRPIX1, CRPIX2, CRVAL1, CRVAL2, CD, PV, NORD)
+    xy2sky_loop = (time.time() - start) * args.npoints / args.nloop
+
+    start = time.time()
+    x1, y1, converged = wcs.sky2xypv(ra, dec, CRPIX1, CRPIX2, CRVAL1, CRVAL2, dc, PV, NORD,
+                                     return_converged=True)
+    sky2xy_vector = time.time() - start
+
+    start = time.time()
+    for i in range(args.nloop):
+        wcs.sky2xypv(float(ra[i]), float(dec[i]), CRPIX1, CRPIX2, CRVAL1, CRVAL2, dc, PV, NORD)
+    sky2xy_loop = (time.time() - start) * args.npoints / args.nloop
+
+    print("{} positions, {} converged, max round trip error {:.2e} pixels".format(
+        args.npoints, converged.sum(), max(numpy.fabs(x1 - x).max(), numpy.fabs(y1 - y).max())))
+    print("xy2skypv: scalar loop {:8.3f}s  vectorized {:8.3f}s  speed-up {:6.1f}".format(
+        xy2sky_loop, xy2sky_vector, xy2sky_loop / xy2sky_vector))
+    print("sky2xypv: scalar loop {:8.3f}s  vectorized {:8.3f}s  speed-up {:6.1f}".format(
+        sky2xy_loop, sky2xy_vector, sky2xy_loop / sky2xy_vector))
+
+
+if __name__ == '__main__':
+    main()
@@ -47,6 +47,9 @@ import requests
 
 __Version__ = "2.0"
 import re, os, string, sys
+import multiprocessing
+import shutil
+import tempfile
 import vos
 import numpy as np
 import logging
@@ -54,6 +57,12 @@ from astropy.io import fits
 
 version = __Version__
 
+# working copies of a tile of the stack made while combining, used to size the tiles for --memory.
+TILE_COPIES = 4
+
+# CCDs combined at the same time by default, each worker uses up to --memory MB.
+DEFAULT_PROCESSES = min(4, multiprocessing.cpu_count())
+
 elixir_header = {'PHOT_C': ( 30.0000, "Fake Elixir zero point" ),
                  'PHOT_CS': ( 1.0000, "Fake Elixir zero point - scatter" ),
                  'PHOT_NS': ( 0, 'Elixir zero point - N stars' ),
@@ -84,12 +93,10 @@ def trim(hdu, datasec='DATASEC'):
     t = int(datasec[3])
     logger.info("Trimming [%d:%d,%d:%d]" % ( l, r, b, t))
     hdu.data = hdu.data[b:t, l:r]
-    hdu.header.update('DATASEC',
-                      "[%d:%d,%d:%d]" % (1, r - l + 1, 1, t - b + 1),
-                      comment="Image was trimmed")
-    hdu.header.update('ODATASEC',
-                      "[%d:%d,%d:%d]" % (l + 1, r, b + 1, t),
-                      comment="previous DATASEC")
+    hdu.header['DATASEC'] = ("[%d:%d,%d:%d]" % (1, r - l + 1, 1, t - b + 1),
+                             "Image was trimmed")
+    hdu.header['ODATASEC'] = ("[%d:%d,%d:%d]" % (l + 1, r, b + 1, t),
+                              "previous DATASEC")
     return
 
 
@@ -134,7 +141,7 @@ def overscan(hdu,
         bias /= float(len(hdu.data[b:t, bl:bh][0]))
         mean = bias.mean()
         hdu.data[b:t, al:ah] -= bias[:, np.newaxis]
-        hdu.header.update("BIAS%d" % (idx ), mean, comment="Mean bias level")
+        hdu.header["BIAS%d" % (idx )] = (mean, "Mean bias level")
         del (bias)
 
     ### send back the mean bias level subtracted
@@ -192,6 +199,209 @@ def get_from_dbimages(file_id, ext='o.fits.fz', calibrator=False):
     return fits_handles[ext][file_id]
 
 
+def output_filename(hdu, ccd):
+    """Name of the file the processed ccd of hdu is written to, creating the --dist directories as needed."""
+    if not opt.outfile and not opt.combine:
+        imtype = hdu.header.get('OBSTYPE')
+        outfile = str(hdu.header.get('EXPNUM')) + flag[imtype]
+    elif (opt.combine or len(file_ids) < 2) and opt.outfile:
+        outfile = opt.outfile
+    else:
+        logger.error(("Mulitple input images needs one output "
+                      "but --output option not set? [Logic Error]"))
+        sys.exit(-1)
+    subs = "."
+    if opt.dist:
+        subs = opt.dist
+        object = hdu.header.get('OBJECT')
+        nccd = hdu.header.get('EXTNAME')
+        for dirs in [nccd, object]:
+            subs = subs + "/" + dirs
+            if not os.access(subs, os.F_OK):
+                os.makedirs(subs)
+    subs = subs + "/"
+    if opt.split:
+        nccd = hdu.header.get('EXTVER')
+        outfile = outfile + str(nccd).zfill(2)
+    return subs + outfile + ".fits"
+
+
+def image_mode(data, bins=1000):
+    """The mode of the pixel values, the middle of the two most populated histogram bins."""
+    (h, b) = np.histogram(data, bins=bins)
+    idx = h.argsort()
+    return float((b[idx[-1]] + b[idx[-2]]) / 2.0)
+
+
+def flat_name(header):
+    """The name of the flat, in the calibrators container, for the run and filter of the image with header."""
+    qrunid = header.get('QRUNID', header.get('CRUNID', '13A'))[0:3]
+    filter = header.get('FILTER', header.get('CRUNID', '13A'))[0]
+    flat_key = qrunid + "_" + filter
+    flat = flats.get(flat_key, flats.get("ALL", None))
+    if flat is None:
+        raise ValueError("No available flat for {}".format(qrunid))
+    return flat
+
+
+def process(hdu, ccd, normal=True):
+    """Apply the requested overscan, bias, trim, flat, normalisation and flip to the ccd in hdu."""
+    if opt.overscan:
+        logger.info("Overscan subtracting")
+        overscan(hdu)
+    if opt.bias:
+        logger.info("Subtracting bias frame " + opt.bias)
+        hdu.data -= bias[ccd + 1].data
+    if opt.trim:
+        logger.info("Trimming image")
+        trim(hdu)
+    if opt.flat:
+        flat = get_from_dbimages(flat_name(hdu.header), calibrator=True)
+        logger.info("Dividing by flat field " + flat.filename())
+        hdu.data /= flat[ccd + 1].data
+        hdu.header["Flat"] = (flat.filename(), "Flat Image")
+    if opt.normal and normal:
+        logger.info("Normalizing the frame")
+        hdu.data /= image_mode(hdu.data)
+
+    if opt.flip:
+        if ccd < 18:
+            logger.info("Flipping the x and y axis")
+            hdu.data = hdu.data[::-1, ::-1]
+            hdu.header['CRPIX2'] = hdu.data.shape[0] - hdu.header['CRPIX2']
+            hdu.header['CRPIX1'] = hdu.data.shape[1] - hdu.header['CRPIX1']
+            hdu.header['CD1_1'] = -1.0 * hdu.header['CD1_1']
+            hdu.header['CD2_2'] = -1.0 * hdu.header['CD2_2']
+
+    hdu.header['CADCPROC'] = (float(version), 'Version of cadcproc')
+    if opt.megapipe:
+        for keyword in elixir_header:
+            hdu.header[keyword] = (hdu.header.get(keyword, default=elixir_header[keyword][0]),
+                                   elixir_header[keyword][1])
+
+
+def tile_rows(shape, memory, itemsize=4):
+    """
+    Number of rows of a (images, rows, columns) stack to combine at a time so that the tile, and the copies
+    that normalising and np.percentile make of it, fit in memory bytes.
+    """
+    nimages, nrows, ncols = shape
+    return int(max(1, min(nrows, memory // (TILE_COPIES * nimages * ncols * itemsize))))
+
+
+def stack_modes(stack, rows, bins=1000):
+    """
+    The mode of each image in the stack, as image_mode computes it, with the histograms built a tile of rows at a time.
+
+    The histograms of all the images in a tile are counted with a single np.bincount.  The bin of each pixel is
+    computed in place in a float32 and an intp buffer (the index type np.bincount takes without a copy), 3 float32
+    copies of a tile, within the TILE_COPIES that tile_rows allows for.
+    """
+    nimages, nrows, ncols = stack.shape
+    low = np.empty(nimages)
+    low.fill(np.inf)
+    high = np.empty(nimages)
+    high.fill(-np.inf)
+    for start in range(0, nrows, rows):
+        tile = stack[:, start:start + rows]
+        low = np.minimum(low, tile.min(axis=(1, 2)))
+        high = np.maximum(high, tile.max(axis=(1, 2)))
+    width = (high - low) / bins
+    width[width == 0] = 1.0
+    counts = np.zeros(nimages * bins, dtype=np.int64)
+    low_tile = low.astype(np.float32)[:, np.newaxis, np.newaxis]
+    width_tile = width.astype(np.float32)[:, np.newaxis, np.newaxis]
+    offsets = (np.arange(nimages, dtype=np.intp) * bins)[:, np.newaxis, np.newaxis]
+    values = np.empty(nimages * rows * ncols, dtype=np.float32)
+    idx = np.empty(nimages * rows * ncols, dtype=np.intp)
+    for start in range(0, nrows, rows):
+        tile = stack[:, start:start + rows]
+        size = tile.size
+        tile_values = values[:size].reshape(tile.shape)
+        tile_idx = idx[:size].reshape(tile.shape)
+        np.subtract(tile, low_tile, out=tile_values)
+        np.floor_divide(tile_values, width_tile, out=tile_values)
+        np.copyto(tile_idx, tile_values, casting='unsafe')
+        np.clip(tile_idx, 0, bins - 1, out=tile_idx)
+        np.add(tile_idx, offsets, out=tile_idx)
+        counts += np.bincount(idx[:size], minlength=nimages * bins)
+    order = counts.reshape(nimages, bins).argsort(axis=1)
+    return low + width * (order[:, -1] + order[:, -2]) / 2.0
+
+
+def combine_stack(stack, rows, percentile=40, modes=None):
+    """
+    Combine the (images, rows, columns) stack a tile of rows at a time, dividing each image by its mode first if
+    modes are given.
+    """
+    data = np.empty(stack.shape[1:], dtype=np.float32)
+    for start in range(0, stack.shape[1], rows):
+        tile = stack[:, start:start + rows]
+        if modes is not None:
+            tile = tile / modes[:, np.newaxis, np.newaxis].astype(np.float32)
+        data[start:start + rows] = np.percentile(tile, percentile, axis=0)
+    return data
+
+
+def init_worker(options, images, flat_list, log_level):
+    """
+    Set up the module state that combine_ccd uses in a pool worker.
+
+    The state is set from the arguments, so workers work with any start method, including spawn, where the
+    globals set under __main__ do not exist.
+    """
+    global opt, file_ids, flats, logger, vos_client, bias
+    opt = options
+    file_ids = images
+    flats = flat_list
+    logger = logging.getLogger()
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    logger.setLevel(log_level)
+    vos_client = vos.Client()
+    # files opened by the parent share their offsets with a forked worker, open our own.
+    fits_handles.clear()
+    bias = opt.bias and fits.open(opt.bias, "readonly") or None
+
+
+def combine_ccd(ccd):
+    """
+    Process the ccd of each input image into a memory mapped stack on disk and combine it in tiles.
+
+    Run in a worker process set up by init_worker, one per ccd.
+    @return: the ccd, the combined data and the header of the last image in the stack.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='preproc')
+    try:
+        stack = None
+        for idx, file_id in enumerate(file_ids):
+            logger.info("Processing " + file_id)
+            hdu = get_from_dbimages(file_id)[int(ccd) + 1]
+            process(hdu, ccd, normal=False)
+            if stack is None:
+                stack = np.lib.format.open_memmap(os.path.join(tmpdir, 'stack.npy'), mode='w+', dtype=np.float32,
+                                                  shape=(len(file_ids),) + hdu.data.shape)
+            stack[idx] = hdu.data
+            header = hdu.header
+            hdu.data = None
+        stack.flush()
+        rows = tile_rows(stack.shape, opt.memory * 1024 ** 2)
+        modes = None
+        if opt.normal:
+            logger.info("Normalizing the frames")
+            modes = stack_modes(stack, rows)
+        logger.info("Median combining {} images in tiles of {} rows".format(len(file_ids), rows))
+        data = combine_stack(stack, rows, modes=modes)
+        del stack
+    finally:
+        for ext in fits_handles:
+            for handle in fits_handles[ext].values():
+                handle.close()
+        fits_handles.clear()
+        shutil.rmtree(tmpdir)
+    return ccd, data, header
+
+
 if __name__ == '__main__':
     ### Must be running as a script
     import argparse
@@ -272,6 +482,14 @@ if __name__ == '__main__':
                         nargs='+',
                         help=("Images to process with give flat/bias/trim "
                               "or stack into output flat/bias"))
+    parser.add_argument("--memory",
+                        type=int,
+                        default=1024,
+                        help="MB of memory each worker may use to combine a stack, sets the size of the tiles")
+    parser.add_argument("--processes",
+                        type=int,
+                        default=DEFAULT_PROCESSES,
+                        help="number of CCDs to combine at the same time, each may use --memory MB")
     parser.add_argument("--megapipe",
                         action="store_true",
                         default=False,
@@ -335,97 +553,74 @@ if __name__ == '__main__':
 
     ccds = args.ccds
 
-    for ccd in ccds:
-        logger.info("Working on ccd " + str(ccd))
-        stack = []
-        mstack = []
-        nim = 0
+    if opt.combine and len(file_ids) > 1:
+        # fetch the inputs, and the flats they need, before the workers start so they do not race to download them.
         for file_id in file_ids:
-
-            nim += 1
-            hdu = get_from_dbimages(file_id)[int(ccd) + 1]
-
-            ### reopen the output file for each extension.
-            ### Create an output MEF file based on extension name if
-            ### opt.split is set.
-            if not opt.outfile and not opt.combine:
-                imtype = hdu.header.get('OBSTYPE')
-                outfile = str(hdu.header.get('EXPNUM')) + flag[imtype]
-            elif (opt.combine or len(file_ids) < 2) and opt.outfile:
-                re.match(r"(^.*)\.fits.fz", opt.outfile)
-                outfile = opt.outfile
-            else:
-                logger.error(("Mulitple input images needs one output "
-                              "but --output option not set? [Logic Error]"))
-                sys.exit(-1)
-            subs = "."
-            if opt.dist:
-                subs = opt.dist
-                object = hdu.header.get('OBJECT')
-                nccd = hdu.header.get('EXTNAME')
-                for dirs in [nccd, object]:
-                    subs = subs + "/" + dirs
-                    if not os.access(subs, os.F_OK):
-                        os.makedirs(subs)
-            subs = subs + "/"
-            if opt.split:
-                nccd = hdu.header.get('EXTVER')
-                outfile = outfile + string.zfill(str(nccd), 2)
-            outfile = subs + outfile + ".fits"
-            ### exit if the file exist and this is the ccd or
-            ### were splitting so every file should only have one
-            ### extension
-            if os.access(outfile, os.W_OK) and (ccd == 0 or opt.split) and not opt.combine:
-                sys.exit("Output file " + outfile + " already exists")
-
-            ### do the overscan for each file
-            logger.info("Processing " + file_id)
-
-            if opt.overscan:
-                logger.info("Overscan subtracting")
-                overscan(hdu)
-            if opt.bias:
-                logger.info("Subtracting bias frame " + opt.bias)
-                hdu.data -= bias[ccd + 1].data
-            if opt.trim:
-                logger.info("Trimming image")
-                trim(hdu)
+            hdulist = get_from_dbimages(file_id)
             if opt.flat:
-                qrunid = hdu.header.get('QRUNID',hdu.header.get('CRUNID','13A'))[0:3]
-                filter = hdu.header.get('FILTER', hdu.header.get('CRUNID', '13A'))[0]
-                flat_key = qrunid + "_" + filter
-                flat = flats.get(flat_key, flats.get("ALL", None))
-                if flat is None:
-                    raise ValueError("No available flat for {}".format(qrunid))
-                flat = get_from_dbimages(flat, calibrator=True)
-                logger.info("Dividing by flat field " + flat.filename())
-                hdu.data /= flat[ccd + 1].data
-                hdu.header.update("Flat", flat.filename(), comment="Flat Image")
-            if opt.normal:
-                logger.info("Normalizing the frame")
-                (h, b) = np.histogram(hdu.data, bins=1000)
-                idx = h.argsort()
-                mode = float((b[idx[-1]] + b[idx[-2]]) / 2.0)
-                hdu.data /= mode
-
-            if opt.flip:
-                if ccd < 18:
-                    logger.info("Flipping the x and y axis")
-                    hdu.data = hdu.data[::-1, ::-1]
-                    hdu.header['CRPIX2'] = hdu.data.shape[0] - hdu.header['CRPIX2']
-                    hdu.header['CRPIX1'] = hdu.data.shape[1] - hdu.header['CRPIX1']
-                    hdu.header['CD1_1'] = -1.0 * hdu.header['CD1_1']
-                    hdu.header['CD2_2'] = -1.0 * hdu.header['CD2_2']
-
-            hdu.header.update('CADCPROC', float(version),
-                              comment='Version of cadcproc')
-            ### write out this image if not combining
-            if args.megapipe:
-                for keyword in elixir_header:
-                    hdu.header.update(keyword, hdu.header.get(keyword, default=elixir_header[keyword][0]),
-                                      elixir_header[keyword][1])
-
-            if not opt.combine or len(file_ids) == 1:
+                get_from_dbimages(flat_name(hdulist[int(ccds[0]) + 1].header), calibrator=True)
+        pool = multiprocessing.Pool(opt.processes, initializer=init_worker,
+                                    initargs=(opt, file_ids, flats, logger.level))
+        try:
+            for ccd, data, header in pool.imap(combine_ccd, ccds):
+                outfile = output_filename(fits.ImageHDU(header=header), ccd)
+                stack = fits.ImageHDU(data)
+                stack.header[args.extname_kw] = (header.get(args.extname_kw, args.extname_kw), 'Extension Name')
+                stack.header['QRUNID'] = (header.get('QRUNID', ''), 'CFHT QSO Run flat built for')
+                stack.header['FILTER'] = (header.get('FILTER', ''), 'Filter flat works for')
+                stack.header['DETSIZE'] = header.get('DETSIZE', '')
+                stack.header['DETSEC'] = header.get('DETSEC', '')
+
+                for im in file_ids:
+                    stack.header['comment'] = str(im) + " used to make this flat"
+                logger.info("writing median combined stack to file " + outfile)
+                if opt.split:
+                    if not os.access(outfile, os.W_OK):
+                        fits.HDUList([fits.PrimaryHDU()]).writeto(outfile)
+                    fitsobj = fits.open(outfile, 'update')
+                    fitsobj[0] = fits.PrimaryHDU(data=stack.data, header=stack.header)
+                    if opt.short:
+                        logger.info("Scaling data to ushort")
+                        fitsobj[0].scale(type='int16', bzero=32768)
+                    fitsobj.close()
+                else:
+                    if not os.access(outfile, os.W_OK):
+                        logger.info("Creating output image " + outfile)
+                        fitsobj = fits.HDUList()
+                        fitsobj.append(fits.PrimaryHDU())
+                        fitsobj.writeto(outfile)
+                        fitsobj.close()
+                    fitsobj = fits.open(outfile, 'append')
+                    fitsobj.append(stack)
+                    if opt.short:
+                        logger.info("Scaling data to ushort")
+                        fitsobj[-1].scale(type='int16', bzero=32768)
+                    fitsobj.close()
+                del stack
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for ccd in ccds:
+            logger.info("Working on ccd " + str(ccd))
+            for file_id in file_ids:
+                hdu = get_from_dbimages(file_id)[int(ccd) + 1]
+
+                ### reopen the output file for each extension.
+                ### Create an output MEF file based on extension name if
+                ### opt.split is set.
+                outfile = output_filename(hdu, ccd)
+                ### exit if the file exist and this is the ccd or
+                ### were splitting so every file should only have one
+                ### extension
+                if os.access(outfile, os.W_OK) and (ccd == 0 or opt.split) and not opt.combine:
+                    sys.exit("Output file " + outfile + " already exists")
+
+                ### do the overscan for each file
+                logger.info("Processing " + file_id)
+                process(hdu, ccd)
+
+                ### write out this image
                 logger.info("writing data to " + outfile)
                 ### write out the image now (don't overwrite
                 ### files that exist at the start of this process
@@ -444,61 +639,7 @@ if __name__ == '__main__':
                 hdul.close()
                 hdu = None
                 hdul = None
-                nim = 0
-            else:
-                logger.info("Saving the data for later")
-                data = hdu.data
-                naxis1 = hdu.data.shape[0]
-                naxis2 = hdu.data.shape[1]
-                mstack.append(data)
-
-        ### free up the memory being used by the bias and flat
-        if opt.bias:
-            bias[ccd + 1].data = None
-        if opt.flat:
-            flat[ccd + 1].data = None
-
-        ### last image has been processed so combine the stack
-        ### if this is a combine and we have more than on hdu
-
-        if opt.combine and len(file_ids) > 1:
-            logger.info("Median combining " + str(nim) + " images")
-            mstack = np.vstack(mstack)
-            mstack.shape = [len(file_ids), naxis1, naxis2]
-            data = np.percentile(mstack, 40, axis=0)
-            del (mstack)
-            stack = fits.ImageHDU(data)
-            stack.header[args.extname_kw] = (hdu.header.get(args.extname_kw, args.extname_kw), 'Extension Name')
-            stack.header['QRUNID'] = (hdu.header.get('QRUNID', ''), 'CFHT QSO Run flat built for')
-            stack.header['FILTER'] = (hdu.header.get('FILTER', ''), 'Filter flat works for')
-            stack.header['DETSIZE'] = hdu.header.get('DETSIZE', '')
-            stack.header['DETSEC'] = hdu.header.get('DETSEC', '')
-
-            for im in file_ids:
-                hdu.header['comment'] = str(im) + " used to make this flat"
-            logger.info("writing median combined stack to file " + outfile)
-            if opt.split:
-                fitsobj = fits.open(outfile, 'update')
-                fitsobj[0] = hdu
-                if opt.short:
-                    logger.info("Scaling data to ushort")
-                    fitsobj[0].scale(type='int16', bzero=32768)
-                fitsobj.close()
-            else:
-                if not os.access(outfile, os.W_OK):
-                    logger.info("Creating output image " + outfile)
-                    fitsobj = fits.HDUList()
-                    pdu = fits.PrimaryHDU()
-                    fitsobj.append(fits.PrimaryHDU())
-                    fitsobj.writeto(outfile)
-                    fitsobj.close()
-                fitsobj = fits.open(outfile, 'append')
-                fitsobj.append(stack)
-                if opt.short:
-                    logger.info("Scaling data to ushort")
-                    fitsobj[-1].scale(type='int16', bzero=32768)
-                fitsobj.close()
-        del (stack)
-        del (hdu)
-    
 
+            ### free up the memory being used by the bias
+            if opt.bias:
+                bias[ccd + 1].data = None
@@ -34,7 +34,8 @@ console_scripts = ['mkpsf = ossos.pipeline.mkpsf:main', 'step3 = ossos.pipeline.
                    'align = ossos.pipeline.align:main',
                    'plant = ossos.pipeline.plant:main',
                    'astrom_mag_check = ossos.pipeline.astrom_mag_check:main',
-                   'scramble = ossos.pipeline.scramble:main']
+                   'scramble = ossos.pipeline.scramble:main',
+                   'precovery = ossos.precovery:main']
 
 gui_scripts = ['validate = ossos.tools.validate:main']
 
@@ -1,5 +1,8 @@
 from unittest import TestCase
+
+import numpy
 from astropy import units
+from astropy.coordinates import SkyCoord
 
 from ossos import cameras
 
@@ -44,3 +47,58 @@ class TestCamera(TestCase):
 
     def test_separation(self):
         self.fail()
+
+
+class TestFootprint(TestCase):
+
+    def setUp(self):
+        self.camera = cameras.Camera(SkyCoord(150.0, 20.0, unit='degree'))
+        self.footprint = self.camera.footprint
+
+    def test_contains_ccd_centres(self):
+        x = self.footprint.centres[:, 0]
+        y = self.footprint.centres[:, 1]
+        ccd = [self.footprint.deproject(x[idx], y[idx]) for idx in range(len(x))]
+        ra = numpy.array([c.ra.degree for c in ccd])
+        dec = numpy.array([c.dec.degree for c in ccd])
+        self.assertEqual(list(self.camera.contains(ra, dec)), list(range(len(x))))
+
+    def test_contains_off_camera(self):
+        self.assertEqual(list(self.camera.contains([150.0, 170.0], [22.0, 20.0])), [-1, -1])
+
+    def test_contains_agrees_with_polygon(self):
+        ra = 150.0 + numpy.linspace(-0.7, 0.7, 40)
+        dec = 20.0 + numpy.linspace(-0.6, 0.6, 40)
+        ccd = self.camera.contains(ra, dec)
+        for idx in range(len(ra)):
+            self.assertEqual(ccd[idx] >= 0, self.camera.polygon.isInside(ra[idx], dec[idx]))
+
+    def test_polygon_cached(self):
+        self.assertIs(self.camera.polygon, self.camera.polygon)
+        polygon = self.camera.polygon
+        self.camera.offset(index=4)
+        self.assertIsNot(self.camera.polygon, polygon)
+
+    def test_grid_search(self):
+        numpy.random.seed(0)
+        ra = 150.6 + numpy.random.uniform(-0.4, 0.4, 200)
+        dec = 20.4 + numpy.random.uniform(-0.4, 0.4, 200)
+        required = numpy.zeros(len(ra), dtype=bool)
+        required[:5] = True
+        before = (self.camera.contains(ra, dec) >= 0).sum()
+        covered = self.camera.grid_search(ra, dec, required=required)
+        self.assertTrue(covered[required].all())
+        self.assertGreater(covered.sum(), before)
+        numpy.testing.assert_array_equal(self.camera.contains(ra, dec)[required] >= 0, True)
+
+    def test_grid_search_anchor(self):
+        # the two required targets can't be covered along with the first one.
+        ra = numpy.array([150.6, 152.1, 152.1])
+        dec = numpy.array([20.4, 20.4, 20.45])
+        required = numpy.array([False, True, True])
+        camera = cameras.Camera(150.6 * units.degree, 20.4 * units.degree)
+        numpy.testing.assert_array_equal(camera.grid_search(ra, dec, required=required, half_width=1.0),
+                                         [False, True, True])
+        camera = cameras.Camera(150.6 * units.degree, 20.4 * units.degree)
+        covered = camera.grid_search(ra, dec, required=required, anchor=[True, False, False], half_width=1.0)
+        self.assertTrue(covered[0])
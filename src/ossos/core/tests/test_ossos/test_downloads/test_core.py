@@ -0,0 +1,48 @@
+import io
+import os
+import tempfile
+import unittest
+
+import numpy
+from astropy.io import fits
+from mock import patch
+
+from ossos.downloads.core import Downloader
+
+
+class ChunkedResponse(io.BytesIO):
+    """A VOSpace response that hands back at most a few bytes per read, as a slow connection would."""
+
+    def read(self, size=-1):
+        return super(ChunkedResponse, self).read(min(size, 5000))
+
+
+class DownloadHdulistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        self.data = numpy.arange(200 * 100, dtype=numpy.float32).reshape(200, 100)
+        buffer = io.BytesIO()
+        fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data=self.data)]).writeto(buffer)
+        self.content = buffer.getvalue()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.rmdir(self.tmpdir)
+
+    def test_download_streams_response(self):
+        downloader = Downloader()
+        with patch('ossos.storage.vofile', return_value=ChunkedResponse(self.content)):
+            hdulist = downloader.download_hdulist("vos:OSSOS/dbimages/1616681/1616681p.fits",
+                                                  view="cutout", cutout="[1]")
+
+        self.assertTrue(numpy.all(hdulist[1].data == self.data))
+        self.assertEqual(downloader.last_download.nbytes, len(self.content))
+        self.assertEqual(downloader.total_downloads, 1)
+        hdulist.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,9 +3,10 @@ __author__ = "David Rusk <drusk@uvic.ca>"
 import unittest
 
 from hamcrest import assert_that, contains_inanyorder, equal_to
+from mock import patch
 
 from tests.base_tests import FileReadingTestCase
-from ossos.gui.context import LocalDirectoryWorkingContext
+from ossos.gui.context import LocalDirectoryWorkingContext, VOSpaceWorkingContext
 
 
 class LocalDirectoryContextTest(FileReadingTestCase):
@@ -24,5 +25,37 @@ class LocalDirectoryContextTest(FileReadingTestCase):
                     equal_to(self.get_abs_path("data/testdir/xxx1.cands.astrom")))
 
 
+class VOSpaceContextSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.properties = {"xxx1.cands.astrom": {"length": "1024"},
+                           "xxx2.cands.astrom": {"length": "0"},
+                           "xxx1.reals.astrom": {}}
+
+    def test_listing_and_sizes_from_one_request(self):
+        with patch('ossos.storage.list_properties', return_value=self.properties, create=True) as list_properties, \
+                patch('ossos.storage.get_property', return_value="7", create=True) as get_property:
+            context = VOSpaceWorkingContext("vos:OSSOS/measure3/2015B", userid="jkavelaars")
+
+            assert_that(context.get_listing("cands.astrom"),
+                        contains_inanyorder("xxx1.cands.astrom", "xxx2.cands.astrom"))
+            assert_that(context.get_file_size("xxx1.cands.astrom"), equal_to(1024))
+            assert_that(context.get_file_size("xxx2.cands.astrom"), equal_to(0))
+            assert_that(list_properties.call_count, equal_to(1))
+            assert_that(get_property.call_count, equal_to(0))
+
+            # no length in the listing, ask for the node.
+            assert_that(context.get_file_size("xxx1.reals.astrom"), equal_to(7))
+
+            context.get_properties(force=True)
+            assert_that(list_properties.call_count, equal_to(2))
+
+    def test_snapshot_expires(self):
+        with patch('ossos.storage.list_properties', return_value=self.properties, create=True) as list_properties:
+            context = VOSpaceWorkingContext("vos:OSSOS/measure3/2015B", userid="jkavelaars", snapshot_lifetime=-1)
+            context.listdir()
+            context.listdir()
+            assert_that(list_properties.call_count, equal_to(2))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+
+import numpy
+from astropy.io import fits
+from mock import Mock, patch
+
+from ossos.downloads.async_download import AsynchronousDownloadManager
+from ossos.gui.models.collections import StatefulCollection
+from ossos.gui.models.exceptions import ImageNotLoadedException
+from ossos.gui.models.imagemanager import ImageManager
+
+
+class ImageManagerPrefetchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sources = StatefulCollection([self.create_source(index) for index in range(6)])
+        self.workunit = Mock()
+        self.workunit.get_sources.return_value = self.sources
+        self.workunit.is_source_finished.return_value = False
+        self.workunit.is_apcor_needed.return_value = False
+
+        self.download_manager = Mock(spec=AsynchronousDownloadManager)
+        self.image_manager = ImageManager(self.download_manager, Mock(spec=AsynchronousDownloadManager),
+                                          prefetch_depth=2, memory_budget=1000)
+        self.focus_patch = patch('ossos.gui.models.imagemanager.SingletFocusCalculator')
+        self.focus_patch.start()
+
+    def tearDown(self):
+        self.focus_patch.stop()
+
+    @staticmethod
+    def create_source(index):
+        source = Mock(discovery_only=False)
+        source.get_readings.return_value = ["reading{}".format(index)]
+        return source
+
+    def submitted(self):
+        return [(call[0][0].reading, call[1]['priority']) for call in self.download_manager.submit_request.call_args_list]
+
+    def loaded(self, reading, size):
+        cutout = Mock(reading=reading)
+        cutout.hdulist = fits.HDUList([fits.PrimaryHDU(data=numpy.zeros(size, dtype=numpy.uint8))])
+        self.image_manager.on_singlet_image_loaded(cutout)
+        return cutout
+
+    def test_lookahead_queued_nearest_first(self):
+        self.image_manager.download_singlets_for_workunit(self.workunit)
+
+        self.assertEqual(self.submitted(), [("reading0", 0), ("reading1", 1), ("reading2", 2)])
+
+    def test_jump_cancels_superseded_requests(self):
+        self.image_manager.download_singlets_for_workunit(self.workunit)
+        requests = [call[0][0] for call in self.download_manager.submit_request.call_args_list]
+        self.loaded("reading0", 10)
+
+        self.sources.index = 4
+        self.image_manager.prefetch_singlets(self.workunit)
+
+        self.assertTrue(requests[1].cancelled)
+        self.assertTrue(requests[2].cancelled)
+        # reading0 is already loaded so only the new sources are requested.
+        self.assertEqual(self.submitted()[3:], [("reading4", 0), ("reading5", 1)])
+
+    def test_memory_budget_and_hit_rate(self):
+        self.image_manager.download_singlets_for_workunit(self.workunit)
+        cutout = self.loaded("reading0", 600)
+        self.assertIs(self.image_manager.get_cutout("reading0"), cutout)
+        # over budget, but the current source and the look-ahead window are kept.
+        self.loaded("reading1", 600)
+        self.assertIs(self.image_manager.get_cutout("reading0"), cutout)
+
+        self.sources.index = 3
+        self.image_manager.prefetch_singlets(self.workunit)
+        self.loaded("reading3", 600)
+
+        self.assertRaises(ImageNotLoadedException, self.image_manager.get_cutout, "reading0")
+        self.assertRaises(ImageNotLoadedException, self.image_manager.get_cutout, "reading1")
+        self.image_manager.get_cutout("reading3")
+        # reading1 was evicted before it was first displayed.
+        self.assertEqual(self.image_manager.prefetch_hits, 2)
+        self.assertEqual(self.image_manager.prefetch_misses, 1)
+
+    def test_failed_download_is_requested_again(self):
+        self.image_manager.download_singlets_for_workunit(self.workunit)
+        request = self.download_manager.submit_request.call_args_list[0][0][0]
+        downloader = Mock()
+        downloader.download_cutout.side_effect = IOError("connection reset")
+
+        self.assertRaises(IOError, request.execute, downloader)
+        self.image_manager.prefetch_singlets(self.workunit)
+
+        self.assertEqual(self.submitted()[3:], [("reading0", 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,17 +1,22 @@
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+import shutil
+import tempfile
 import unittest
 
-from mock import Mock
+from mock import Mock, patch
 from hamcrest import (assert_that, contains_inanyorder, has_length, contains,
                       equal_to)
 
 from tests.base_tests import FileReadingTestCase
 from ossos.gui import tasks
-from ossos.gui.context import LocalDirectoryWorkingContext
+from ossos import storage
+from ossos.gui.context import LocalDirectoryWorkingContext, VOSpaceWorkingContext
 from ossos.gui.progress import (LocalProgressManager, InMemoryProgressManager,
+                                   VOSpaceProgressManager, SQLiteProgressManager,
                                    FileLockedException, RequiresLockException,
-                                   LOCK_SUFFIX)
+                                   LOCK_SUFFIX, DONE_PROPERTY, LOCK_PROPERTY,
+                                   PROCESSED_INDICES_PROPERTY)
 
 WD_HAS_PROGRESS = "data/persistence_has_progress"
 WD_NO_LOG = "data/persistence_no_log"
@@ -280,5 +285,132 @@ class InMemoryProgressManagerTest(unittest.TestCase):
         assert_that(self.undertest.owns_lock(self.file2), equal_to(True))
 
 
+class VOSpaceProgressManagerFilterTest(unittest.TestCase):
+    def test_filter_available_uses_listing(self):
+        working_context = Mock(spec=VOSpaceWorkingContext)
+        working_context.get_properties.return_value = {
+            "done.cands.astrom": {"length": "10", storage.tag_uri(DONE_PROPERTY): "someone"},
+            "empty.cands.astrom": {"length": "0"},
+            "theirs.cands.astrom": {"length": "10", storage.tag_uri(LOCK_PROPERTY): "someone"},
+            "mine.cands.astrom": {"length": "10", storage.tag_uri(LOCK_PROPERTY): "me"},
+            "free.cands.astrom": {"length": "10"}}
+        progress_manager = VOSpaceProgressManager(working_context, userid="me")
+
+        available = progress_manager.filter_available(["done.cands.astrom", "empty.cands.astrom",
+                                                       "theirs.cands.astrom", "mine.cands.astrom",
+                                                       "free.cands.astrom", "new.cands.astrom"])
+
+        assert_that(available, contains("mine.cands.astrom", "free.cands.astrom", "new.cands.astrom"))
+
+
+class SQLiteProgressManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.mkdtemp()
+        self.undertest = self.create_progress_manager("main_user", index_batch=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.working_directory)
+
+    def create_progress_manager(self, userid, **kwargs):
+        return SQLiteProgressManager(LocalDirectoryWorkingContext(self.working_directory), userid=userid, **kwargs)
+
+    def test_lock(self):
+        file1 = "xxx1.cands.astrom"
+        self.undertest.lock(file1)
+        self.undertest.lock(file1)
+
+        manager2 = self.create_progress_manager("lock_requesting_user")
+        try:
+            manager2.lock(file1)
+            self.fail("Should have thrown FileLockedException")
+        except FileLockedException as ex:
+            assert_that(ex.locker, equal_to("main_user"))
+        self.assertRaises(FileLockedException, manager2.unlock, file1)
+        assert_that(manager2.filter_available([file1, "xxx2.cands.astrom"]), contains("xxx2.cands.astrom"))
+
+        self.undertest.unlock(file1)
+        manager2.lock(file1)
+        assert_that(manager2.owns_lock(file1), equal_to(True))
+        assert_that(self.undertest.owns_lock(file1), equal_to(False))
+
+    def test_record_progress(self):
+        file1 = "xxx1.cands.astrom"
+        self.assertRaises(RequiresLockException, self.undertest.record_index, file1, 0)
+        self.undertest.lock(file1)
+        for index in [1, 3, 0]:
+            self.undertest.record_index(file1, index)
+
+        # indices are written in batches, but always visible to the manager that recorded them.
+        manager2 = self.create_progress_manager("test_user")
+        assert_that(manager2.get_processed_indices(file1), contains(1, 3))
+        assert_that(self.undertest.get_processed_indices(file1), contains(1, 3, 0))
+
+        self.undertest.record_done(file1)
+        self.undertest.unlock(file1)
+        assert_that(manager2.is_done(file1), equal_to(True))
+        assert_that(manager2.get_done(tasks.CANDS_TASK), contains(file1))
+        assert_that(manager2.get_done(tasks.REALS_TASK), has_length(0))
+        assert_that(manager2.filter_available([file1]), has_length(0))
+
+        self.undertest.clean()
+        assert_that(manager2.is_done(file1), equal_to(False))
+        assert_that(manager2.get_processed_indices(file1), has_length(0))
+
+
+class SQLiteProgressManagerSyncTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.properties = {}
+        self.calls = []
+        self.working_context = Mock(spec=VOSpaceWorkingContext)
+        self.working_context.directory = "vos:OSSOS/measure3/test"
+        self.working_context.is_remote.return_value = True
+        self.working_context.get_full_path.side_effect = lambda filename: filename
+        self.working_context.get_properties.return_value = None
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_property(self, uri, keyword, ossos_base=True):
+        self.calls.append(("get", uri, keyword))
+        return self.properties.get((uri, keyword), None)
+
+    def set_property(self, uri, keyword, value, ossos_base=True):
+        self.calls.append(("set", uri, keyword))
+        self.properties[(uri, keyword)] = value
+
+    def has_property(self, uri, keyword, ossos_base=True):
+        return self.get_property(uri, keyword) is not None
+
+    def test_progress_synced_in_background(self):
+        filename = "xxx1.cands.astrom"
+        with patch.multiple("ossos.storage", get_property=self.get_property, set_property=self.set_property,
+                            has_property=self.has_property):
+            undertest = SQLiteProgressManager(self.working_context, userid="me",
+                                              filename=self.directory + "/progress.sqlite", sync_interval=3600)
+            self.properties[("theirs.cands.astrom", LOCK_PROPERTY)] = "someone"
+            self.assertRaises(FileLockedException, undertest.lock, "theirs.cands.astrom")
+            assert_that(undertest.owns_lock("theirs.cands.astrom"), equal_to(False))
+
+            self.properties[(filename, PROCESSED_INDICES_PROPERTY)] = "0"
+            undertest.lock(filename)
+            assert_that(self.properties[(filename, LOCK_PROPERTY)], equal_to("me"))
+            assert_that(undertest.get_processed_indices(filename), contains(0))
+
+            self.calls = []
+            for index in [1, 2]:
+                undertest.record_index(filename, index)
+            undertest.record_done(filename)
+            undertest.unlock(filename)
+            # progress is only pushed to VOSpace on sync.
+            assert_that(self.calls, has_length(0))
+
+            undertest.close()
+            assert_that(self.properties[(filename, DONE_PROPERTY)], equal_to("me"))
+            assert_that(self.properties[(filename, PROCESSED_INDICES_PROPERTY)], equal_to("0,1,2"))
+            assert_that(self.properties[(filename, LOCK_PROPERTY)], equal_to(None))
+            assert_that(undertest.sync(), equal_to(0))
+
+
 if __name__ == '__main__':
     unittest.main()
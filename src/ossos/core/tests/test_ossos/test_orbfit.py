@@ -7,9 +7,12 @@ from hamcrest import assert_that, equal_to, has_length, contains
 from astropy import coordinates
 from astropy import units
 
+from ossos import cache
 from ossos import mpc
 from ossos import orbfit
 import os
+import shutil
+import tempfile
 
 
 class OrbfitTest(unittest.TestCase):
@@ -44,6 +47,72 @@ class OrbfitTest(unittest.TestCase):
         HL7j2 = orbfit.Orbfit(observations)
         self.assertAlmostEqual(HL7j2.a, 135.75, 1)
 
+    def test_predict_many(self):
+        mpc_lines=("     HL7j2    C2013 04 03.62926 17 12 01.16 +04 13 33.3          24.1 R      568",
+                   "     HL7j2    C2013 04 04.58296 17 11 59.80 +04 14 05.5          24.0 R      568",
+                   "     HL7j2    C2013 05 03.52252 17 10 38.28 +04 28 00.9          23.4 R      568",
+                   "     HL7j2    C2013 05 08.56725 17 10 17.39 +04 29 47.8          23.4 R      568")
+
+        observations = []
+        for line in mpc_lines:
+            observations.append(mpc.Observation.from_string(line))
+
+        HL7j2 = orbfit.Orbfit(observations=observations)
+        dates = [observation.date for observation in observations]
+        ephemeris = orbfit.predict_many([HL7j2, HL7j2.abg], dates, 568)
+        assert_that(ephemeris.ra.shape, equal_to((2, 4)))
+        for idx, date in enumerate(dates):
+            HL7j2.predict(date, 568)
+            for orbit_idx in range(2):
+                self.assertAlmostEqual(ephemeris.ra[orbit_idx, idx].to(units.degree).value,
+                                       HL7j2.coordinate.ra.degree, 8)
+                self.assertAlmostEqual(ephemeris.dec[orbit_idx, idx].to(units.degree).value,
+                                       HL7j2.coordinate.dec.degree, 8)
+                self.assertAlmostEqual(ephemeris.dra[orbit_idx, idx].to(units.arcsec).value,
+                                       HL7j2.dra.to(units.arcsec).value, 8)
+                self.assertAlmostEqual(ephemeris.pa[orbit_idx, idx].to(units.degree).value,
+                                       HL7j2.pa.to(units.degree).value, 8)
+
+        pooled = orbfit.predict_many([HL7j2, HL7j2.abg], dates, 568, processes=2)
+        self.assertTrue((pooled.ra == ephemeris.ra).all())
+
+    def test_fit_many_cached(self):
+        mpc_lines=("     HL7j2    C2013 04 03.62926 17 12 01.16 +04 13 33.3          24.1 R      568",
+                   "     HL7j2    C2013 04 04.58296 17 11 59.80 +04 14 05.5          24.0 R      568",
+                   "     HL7j2    C2013 05 03.52252 17 10 38.28 +04 28 00.9          23.4 R      568",
+                   "     HL7j2    C2013 05 08.56725 17 10 17.39 +04 29 47.8          23.4 R      568")
+
+        directory = tempfile.mkdtemp()
+        try:
+            ast_filenames = []
+            for name, lines in [('HL7j2', mpc_lines), ('HL7j2_short', mpc_lines[:3])]:
+                ast_filenames.append(os.path.join(directory, name + ".ast"))
+                with open(ast_filenames[-1], 'w') as ast_file:
+                    ast_file.write("\n".join(lines) + "\n")
+            fit_cache = cache.HeaderCache(os.path.join(directory, 'cache'))
+
+            orbits = orbfit.fit_many(ast_filenames, processes=2, fit_cache=fit_cache)
+            self.assertEqual(fit_cache.misses, 2)
+            expected = orbfit.Orbfit(None, ast_filenames[0])
+            self.assertEqual(orbits[0].abg, expected.abg)
+            self.assertEqual(orbits[0].a, expected.a)
+
+            cached = orbfit.fit_many(ast_filenames, fit_cache=fit_cache)
+            self.assertEqual(fit_cache.hits, 2)
+            for orbit, fit in zip(cached, orbits):
+                self.assertEqual(orbit.abg, fit.abg)
+                self.assertEqual(orbit.a, fit.a)
+            self.assertEqual(len(cached[0].observations), 4)
+
+            # a changed file is fit again.
+            with open(ast_filenames[1], 'w') as ast_file:
+                ast_file.write("\n".join(mpc_lines[1:]) + "\n")
+            refit = orbfit.fit_many(ast_filenames, fit_cache=fit_cache)
+            self.assertEqual(fit_cache.misses, 3)
+            self.assertEqual(refit[1].a, orbfit.Orbfit(None, ast_filenames[1]).a)
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from astropy.io import fits
+from mock import patch
+
+from ossos import astrom
+from ossos import wcs
+from ossos.pipeline import measure3
+from tests.base_tests import FileReadingTestCase
+
+BASE_IMAGE = "15BS+1+1_p39"
+
+
+def frame_header(crval1):
+    header = fits.Header()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = 2112
+    header['NAXIS2'] = 4644
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRPIX1'] = -9745.95
+    header['CRPIX2'] = 4595.07
+    header['CRVAL1'] = crval1
+    header['CRVAL2'] = 6.00267
+    header['CD1_1'] = -5.1e-05
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 5.1e-05
+    header['NORDFIT'] = 1
+    for axis in (1, 2):
+        header['PV{}_0'.format(axis)] = 0.0
+        header['PV{}_1'.format(axis)] = 1.0
+        header['PV{}_2'.format(axis)] = 0.0
+    return header
+
+
+class Measure3Test(FileReadingTestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        shutil.copy(self.get_abs_path("data/{}.cands.comb".format(BASE_IMAGE)), self.tmpdir)
+        os.chdir(self.tmpdir)
+        self.headers = {}
+        for idx, frame in enumerate(['1832036p39', '1832046p39', '1832056p39']):
+            self.headers[frame] = frame_header(6.44258 + idx * 0.001)
+            fits.PrimaryHDU(data=numpy.zeros((2, 2)), header=self.headers[frame]).writeto(frame + ".fits")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_cands(self):
+        observations, sys_header, xy0 = measure3.read_cands("{}.cands.comb".format(BASE_IMAGE))
+
+        self.assertEqual([obs.rawname for obs in observations], ['1832036p39', '1832046p39', '1832056p39'])
+        self.assertEqual(float(sys_header[astrom.RMAX]), 15.0)
+        self.assertEqual(xy0.shape[1:], (3, 4))
+        self.assertEqual(list(xy0[0, 1]), [593.42, 3051.76, 596.28, 3053.64])
+
+    def test_run_writes_astrom(self):
+        with patch('ossos.storage.get_frame', lambda frame, cutout=None: frame + ".fits", create=True):
+            measure3.run(BASE_IMAGE)
+
+        self.assertTrue(os.access(measure3.SUCCESS_FILE, os.F_OK))
+        self.assertFalse(os.access("{}.{}".format(BASE_IMAGE, measure3.FAILED_EXT), os.F_OK))
+
+        observations, sys_header, xy0 = measure3.read_cands("{}.cands.comb".format(BASE_IMAGE))
+        with open("{}.{}".format(BASE_IMAGE, measure3.CANDS_ASTROM_EXT)) as astrom_file:
+            filestr = astrom_file.read()
+        written = numpy.loadtxt(filestr.splitlines()).reshape(-1, 3, 6)
+        self.assertEqual(len(written), len(xy0))
+        numpy.testing.assert_allclose(written[:, :, :4], xy0, atol=0.005)
+        self.assertEqual(len(astrom.AstromParser()._parse_observation_list(filestr)), 3)
+        for idx, obs in enumerate(observations):
+            ra, dec = wcs.WCS(self.headers[obs.rawname]).xy2sky(xy0[:, idx, 0], xy0[:, idx, 1])
+            numpy.testing.assert_allclose(written[:, idx, 4], ra.value, atol=1e-7)
+            numpy.testing.assert_allclose(written[:, idx, 5], dec.value, atol=1e-7)
+
+
+if __name__ == '__main__':
+    unittest.main()
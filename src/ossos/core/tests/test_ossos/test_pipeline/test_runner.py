@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from ossos.pipeline import runner
+
+
+def write_fixed_filename(expnum, ccd, value=None):
+    """A stand in for a pipeline step, writes a fixed filename into the current directory."""
+    if os.access('weight.fits', os.F_OK):
+        raise IOError("weight.fits left behind by another CCD")
+    with open('weight.fits', 'w') as fobj:
+        fobj.write("{} {} {}".format(expnum, ccd, value))
+    return os.getcwd()
+
+
+def fail_on_ccd_three(expnum, ccd):
+    if ccd == 3:
+        raise ValueError("ccd 3 failed")
+    return "success"
+
+
+class RunnerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_parallel_jobs_run_in_isolated_directories(self):
+        jobs = [runner.Job(1616681, ccd, dict(value='p')) for ccd in range(8)]
+
+        report = runner.run(write_fixed_filename, jobs, processes=4, workdir=self.workdir)
+
+        self.assertEqual(len(report.succeeded), 8)
+        self.assertEqual(len(set(result.message for result in report.results)), 8)
+        self.assertEqual(os.listdir(self.workdir), [])
+
+    def test_exposure_set_jobs(self):
+        # step2 and step3 jobs are for a list of exposures.
+        jobs = [runner.Job([1616681, 1616682, 1616683], ccd, {}) for ccd in range(2)]
+
+        report = runner.run(write_fixed_filename, jobs, processes=2, workdir=self.workdir)
+
+        self.assertEqual(len(report.succeeded), 2)
+        self.assertTrue(all(os.path.basename(result.message).startswith("1616681_") for result in report.results))
+
+    def test_failures_are_retried_and_reported(self):
+        jobs = [runner.Job(1616681, ccd, {}) for ccd in range(4)]
+
+        report = runner.run(fail_on_ccd_three, jobs, processes=2, retries=1, workdir=self.workdir)
+
+        self.assertEqual(len(report.failed), 1)
+        self.assertEqual(report.failed[0].ccd, 3)
+        self.assertEqual(report.failed[0].attempts, 2)
+        self.assertTrue("ccd 3 failed" in str(report))
+
+    def test_serial_jobs_check(self):
+        jobs = [runner.Job(1616681, ccd, {}) for ccd in range(2)]
+
+        report = runner.run(fail_on_ccd_three, jobs, processes=1, check=lambda job: job.ccd == 0)
+
+        self.assertEqual([result.success for result in report.results], [True, False])
+
+    @patch('ossos.storage.build_calibration_manifest')
+    def test_build_manifests(self, build):
+        build.side_effect = lambda expnum, **kwargs: expnum != 1616682
+
+        status = runner.build_manifests([1616681, 1616682], 'p', '')
+
+        self.assertEqual(status, 1)
+        self.assertEqual([call[0][0] for call in build.call_args_list], [1616681, 1616682])
+        self.assertEqual(build.call_args_list[0][1], dict(version='p', prefix='', dry_run=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
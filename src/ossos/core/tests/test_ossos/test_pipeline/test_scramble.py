@@ -0,0 +1,112 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from astropy.io import fits
+from mock import MagicMock, patch
+
+from ossos import cache, storage
+from ossos.pipeline import scramble
+
+get_hdu = storage.get_hdu
+
+
+class ScrambleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        self.dbimages = os.path.join(self.directory, 'dbimages')
+        self.expnums = [1616681, 1616682, 1616683]
+        self.mjds = {}
+        for idx, expnum in enumerate(self.expnums):
+            os.makedirs(os.path.join(self.dbimages, str(expnum), 'ccd22'))
+            hdu = fits.PrimaryHDU(data=numpy.zeros((20, 10), dtype='float32') + expnum)
+            hdu.header['EXPNUM'] = expnum
+            hdu.header['MJD-OBS'] = self.mjds[expnum] = 56391.36 + idx / 24.0
+            hdu.writeto(os.path.join(self.dbimages, str(expnum), 'ccd22', '{}p22.fits'.format(expnum)))
+        os.mkdir(os.path.join(self.directory, 'work'))
+        os.chdir(os.path.join(self.directory, 'work'))
+
+        self.patches = [patch('ossos.storage.DBIMAGES', self.dbimages),
+                        patch('ossos.storage.copy', shutil.copy),
+                        patch('ossos.storage.get_hdu', self.get_hdu),
+                        patch('ossos.storage.header_cache', cache.HeaderCache(self.directory, enabled=False)),
+                        patch('ossos.storage.virtual_images', {}),
+                        patch('ossos.storage.LoggingManager', MagicMock()),
+                        patch('ossos.storage.get_status', lambda *args, **kwargs: False),
+                        patch('ossos.storage.set_status', MagicMock())]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def get_hdu(self, uri, cutout=None, use_cache=True):
+        # the dbimages used here are local and only hold CCD files, an extension of a MEF is taken from the CCD
+        # file and any pixel cutout is ignored.
+        if not os.access(uri, os.F_OK):
+            ccd = int(re.match(r'\[(\d+)\]', cutout).group(1)) - 1
+            basename = os.path.splitext(os.path.basename(uri))[0]
+            uri = os.path.join(os.path.dirname(uri), 'ccd{:02d}'.format(ccd), '{}{:02d}.fits'.format(basename, ccd))
+        return fits.open(uri)
+
+    def test_scramble_writes_virtual_images(self):
+        scramble.scramble(self.expnums, 22, virtual=True)
+
+        for expnum in self.expnums:
+            ccd_dir = os.path.join(self.dbimages, str(expnum), 'ccd22')
+            self.assertEqual(sorted(os.listdir(ccd_dir)),
+                             ['{}p22.fits'.format(expnum), '{}s22.{}'.format(expnum, storage.VIRTUAL_EXT)])
+            os.unlink('{}s22.{}'.format(expnum, storage.VIRTUAL_EXT))
+        storage.virtual_images.clear()
+
+        # the first exposure keeps its time, the second and third swap.
+        for expnum, source in zip(self.expnums, [1616681, 1616683, 1616682]):
+            hdulist = storage.get_image(expnum, 22, version='s', return_file=False)
+            self.assertEqual(hdulist[0].header['EXPNUM'], expnum)
+            self.assertEqual(hdulist[0].header['MJD-OBS'], self.mjds[expnum])
+            self.assertTrue((hdulist[0].data == source).all())
+
+        filename = storage.get_image(1616682, 22, version='s')
+        self.assertEqual(filename, '1616682s22.fits')
+        with fits.open(filename) as hdulist:
+            self.assertEqual(hdulist[0].header['EXPNUM'], 1616682)
+            self.assertTrue((hdulist[0].data == 1616683).all())
+        # materialising the image leaves the source alone.
+        with fits.open('1616683p22.fits') as hdulist:
+            self.assertEqual(hdulist[0].header['EXPNUM'], 1616683)
+
+    def test_get_hdu_resolves_virtual_image(self):
+        scramble.scramble(self.expnums, 22, virtual=True)
+        os.unlink('1616682s22.{}'.format(storage.VIRTUAL_EXT))
+        storage.virtual_images.clear()
+
+        hdulist = get_hdu(storage.get_uri(1616682, 22, version='s', ext='fits'))
+        self.assertEqual(hdulist[0].header['EXPNUM'], 1616682)
+        self.assertTrue((hdulist[0].data == 1616683).all())
+
+    def test_lookup_failure_not_cached(self):
+        with patch('ossos.storage.open_vos_or_local', side_effect=OSError(503, "Service Unavailable")):
+            self.assertRaises(OSError, storage.get_virtual_image, 1616682, 22)
+        self.assertEqual(storage.virtual_images, {})
+        self.assertIsNone(storage.get_virtual_image(1616682, 22))
+        self.assertEqual(list(storage.virtual_images.values()), [None])
+
+    def test_full_copy(self):
+        scramble.scramble(self.expnums, 22)
+
+        with fits.open(os.path.join(self.dbimages, '1616682', 'ccd22', '1616682s22.fits')) as hdulist:
+            self.assertEqual(hdulist[0].header['EXPNUM'], 1616682)
+            self.assertTrue((hdulist[0].data == 1616683).all())
+        self.assertIsNone(storage.get_virtual_image(1616682, 22))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mp_ephem
+import numpy
+from astropy.io import fits
+from astropy import units
+from mock import Mock, patch
+
+from ossos import wcs
+from ossos.pipeline import update_astrometry
+
+LINE = ("     o3e01    C2014 02 24.60898 14 28 39.810-15 20 16.67         21.8 r      568 20140224_568_1 20141108 "
+        "0000000000                      O 1691684p19 O13AE3M     Y   469.54 2711.47 0.06 3 21.76 0.03 %          ")
+
+
+def frame_header(ccd):
+    header = fits.Header()
+    header['NAXIS'] = 2
+    header['NAXIS1'] = 2112
+    header['NAXIS2'] = 4644
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRPIX1'] = -9745.95 + ccd * 2112
+    header['CRPIX2'] = 4595.07
+    header['CRVAL1'] = 217.16
+    header['CRVAL2'] = -15.34
+    header['CD1_1'] = -5.1e-05
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 5.1e-05
+    header['NORDFIT'] = 1
+    for axis in (1, 2):
+        header['PV{}_0'.format(axis)] = 0.0
+        header['PV{}_1'.format(axis)] = 1.0
+        header['PV{}_2'.format(axis)] = 0.0
+        header['PV{}_3'.format(axis)] = 0.0
+    header['PIXSCAL1'] = 0.185
+    header['ASTERR'] = 0.1
+    header['ASTLEVEL'] = 3
+    return header
+
+
+class UpdateAstrometryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.headers = [None] + [frame_header(ccd) for ccd in range(40)]
+        self.sghead_calls = []
+        self.observations = []
+        for expnum in ['1691684', '1691685']:
+            for ccd, x, y in [(19, 469.54, 2711.47), (19, 1200.0, 300.0), (20, 50.0, 4000.0)]:
+                observation = mp_ephem.ephem.Observation.from_string(LINE)
+                observation.comment.frame = "{}p{:02d}".format(expnum, ccd)
+                observation.comment.x = x
+                observation.comment.y = y
+                # the recorded position is 0.5 arc-seconds from the position given by the header.
+                ra, dec = wcs.WCS(self.headers[ccd + 1]).xy2sky(x, y)
+                observation.coordinate = ra.value + 0.5 / 3600.0, dec.value
+                self.observations.append(observation)
+
+    def get_sghead(self, expnum):
+        self.sghead_calls.append(expnum)
+        return self.headers
+
+    def test_remeasure_frame_matches_remeasure(self):
+        with patch('ossos.storage._get_sghead', self.get_sghead), \
+                patch('ossos.storage.get_fwhm', lambda expnum, ccd: 3.0):
+            expected = [update_astrometry.remeasure(observation) for observation in self.observations]
+            self.sghead_calls = []
+            remeasured = update_astrometry.remeasure_observations(self.observations, skip_mags=True, max_workers=2)
+
+        # one header retrieval per frame, not one per observation.
+        self.assertEqual(sorted(self.sghead_calls), [1691684, 1691684, 1691685, 1691685])
+        self.assertEqual([observation.to_string() for observation in remeasured],
+                         [observation.to_string() for observation in expected])
+        for observation in remeasured:
+            ra, dec = wcs.WCS(self.headers[int(observation.comment.frame[-2:]) + 1]).xy2sky(observation.comment.x,
+                                                                                         observation.comment.y)
+            numpy.testing.assert_allclose([observation.coordinate.ra.degree, observation.coordinate.dec.degree],
+                                          [ra.value, dec.value], atol=1e-6)
+            self.assertAlmostEqual(observation.comment.plate_uncertainty, (0.1 ** 2 + (0.03 * 3.0 * 0.185) ** 2) ** 0.5)
+
+    def test_remeasure_observations_header_failure(self):
+        with patch('ossos.storage._get_sghead', lambda expnum: None), \
+                patch('ossos.pipeline.update_astrometry.time.sleep', lambda seconds: None):
+            remeasured = update_astrometry.remeasure_observations(self.observations, skip_mags=True)
+        self.assertEqual(remeasured, self.observations)
+
+
+class FakeOrbit(object):
+    """
+    Stands in for an orbit fit, the elements are scaled by the number of observations fit.
+    """
+
+    def __init__(self, observations):
+        self.observations = observations
+        self.residuals = ""
+        for element in ['a', 'e', 'inc', 'om', 'Node', 'T']:
+            setattr(self, element, (40.0 + len(observations)) * units.dimensionless_unscaled)
+            setattr(self, "d" + element, 0.01 * units.dimensionless_unscaled)
+
+    def summarize(self):
+        return "{} observations".format(len(self.observations))
+
+
+class CompareOrbitsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @staticmethod
+    def observation(ra_residual):
+        observation = Mock(null_observation=False, ra_residual=ra_residual, dec_residual=0.1, band='r', mag=23.1)
+        observation.comment.plate_uncertainty = 0.2
+        return observation
+
+    def test_compare_orbits(self):
+        cor_file = os.path.join(self.directory, "o3e01.cor")
+        original = [self.observation(0.1), self.observation(-0.1)]
+        modified = original + [self.observation(0.05)]
+        with patch('ossos.orbfit.Orbfit', FakeOrbit):
+            update_astrometry.compare_orbits(original, modified, cor_file)
+
+        with open(cor_file + ".orb") as orb:
+            report = orb.read()
+        self.assertTrue("# ORIGINAL ORBIT\n2 observations" in report)
+        self.assertTrue("# MODIFIED ORBIT\n3 observations" in report)
+        self.assertTrue("ra_std:" in report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,10 @@
+import os
+import shutil
+import tempfile
 import unittest
-from ossos.plant import KBOGenerator
+
+import numpy
+from ossos.plant import KBOGenerator, DaophotPSF, add_stars
 # from ossos.pipeline import plant
 from ossos import storage
 from astropy.io import fits
@@ -41,3 +46,84 @@ class PlantTest(unittest.TestCase):
         plant.plant_kbos(filename, psf, kbos, shifts, "fk")
 
         self.assertEqual(len(kbos), self.number)
+
+
+def gauss_psf_header(hwhm=2.0, psfmag=20.0, height=1000.0, psfrad=10.0):
+    header = fits.Header()
+    header['FUNCTION'] = 'gauss'
+    header['PSFHEIGH'] = height
+    header['PSFMAG'] = psfmag
+    header['PSFRAD'] = psfrad
+    header['PAR1'] = hwhm
+    header['PAR2'] = hwhm
+    header['VARORDER'] = 0
+    return header
+
+
+class KBOGeneratorTest(unittest.TestCase):
+
+    def test_get_kbos_in_range(self):
+        kbos = KBOGenerator.get_kbos(n=1000, rate=(0.5, 15), angle=(-10, 50), mag=(21, 25.5),
+                                     x=(33, 2080), y=(1, 4612))
+
+        self.assertEqual(len(kbos), 1000)
+        self.assertEqual(list(kbos['id'][:3]), [1, 2, 3])
+        for column, (low, high) in [('sky_rate', (0.5, 15)), ('mag', (21, 25.5)), ('x', (33, 2080))]:
+            self.assertTrue(numpy.all((kbos[column] >= low) & (kbos[column] <= high)), column)
+
+
+class AddStarsTest(unittest.TestCase):
+
+    def test_flux_scales_with_magnitude(self):
+        psf = DaophotPSF(gauss_psf_header())
+        data = numpy.zeros((100, 100))
+
+        add_stars(data, psf, [30.3, 70.0], [40.6, 60.0], [20.0, 22.5], noise=False)
+
+        bright = data[20:60, 10:50].sum()
+        faint = data[40:80, 50:90].sum()
+        self.assertAlmostEqual(bright / faint, 10.0, 3)
+        rows, cols = numpy.mgrid[0:100, 0:100] + 1
+        stamp = data[20:60, 10:50]
+        self.assertAlmostEqual((stamp * cols[20:60, 10:50]).sum() / bright, 30.3, 2)
+        self.assertAlmostEqual((stamp * rows[20:60, 10:50]).sum() / bright, 40.6, 2)
+
+    def test_lookup_table_is_added(self):
+        lookup = numpy.zeros((41, 41))
+        lookup[20, 20] = 5.0
+        psf = DaophotPSF(gauss_psf_header(height=0.0), lookup)
+        data = numpy.zeros((50, 50))
+
+        add_stars(data, psf, [25.0], [25.0], [20.0], noise=False)
+
+        self.assertAlmostEqual(data[24, 24], 5.0, 6)
+
+
+class PlantKbosTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        header = fits.Header()
+        header['PIXSCAL1'] = 0.185
+        header['EXPTIME'] = 287.0
+        fits.PrimaryHDU(data=numpy.full((200, 200), 1000, dtype=numpy.uint16), header=header).writeto('image.fits')
+        fits.PrimaryHDU(header=gauss_psf_header(psfmag=25.0)).writeto('image.psf.fits')
+        self.shifts = {'nmag': 10, 'emag': 0.01, 'dmag': 0.0, 'dmjd': 0.0,
+                       'crval1': 0.0, 'crval2': 0.0, 'crpix1': 0.0, 'crpix2': 0.0,
+                       'cd1_1': 1.0, 'cd1_2': 0.0, 'cd2_1': 0.0, 'cd2_2': 1.0}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_plant_kbos_writes_ushort_image(self):
+        from ossos.pipeline import plant
+
+        kbos = KBOGenerator.get_kbos(n=50, rate=(0.5, 15), angle=(-10, 50), mag=(21, 23), x=(20, 180), y=(20, 180))
+        plant.plant_kbos('image.fits', 'image.psf.fits', kbos, self.shifts, 'fk')
+
+        data = fits.open('fkimage.fits')[0].data
+        self.assertEqual(data.dtype, numpy.dtype('uint16'))
+        self.assertGreater(data.sum(), 1000 * 200 * 200)
@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from astropy import units
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.time import Time
+from mock import patch
+
+from ossos import precovery, ssos, storage, wcs
+
+
+def ccd_header(ccd, crval1, mjd):
+    header = fits.Header()
+    header['NAXIS1'] = 2112
+    header['NAXIS2'] = 4644
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    # two CCDs side by side, east to west.
+    header['CRPIX1'] = 2112 - ccd * 2200
+    header['CRPIX2'] = 2322.0
+    header['CRVAL1'] = crval1
+    header['CRVAL2'] = 10.0
+    header['CD1_1'] = -5.1e-05
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 5.1e-05
+    header['NORDFIT'] = 1
+    for axis in (1, 2):
+        header['PV{}_0'.format(axis)] = 0.0
+        header['PV{}_1'.format(axis)] = 1.0
+        header['PV{}_2'.format(axis)] = 0.0
+        header['PV{}_3'.format(axis)] = 0.0
+    header['MJDATE'] = mjd
+    header['FILTER'] = 'R.MP9601'
+    header['EXPTIME'] = 287.0
+    header['OBJECT'] = 'O13AE'
+    return header
+
+
+class LinearOrbit(object):
+    """
+    An orbit that moves west at a constant rate, with an Orbfit like predict method.
+    """
+
+    def __init__(self, ra, dec, mjd, rate):
+        self.ra0 = ra
+        self.dec0 = dec
+        self.mjd0 = mjd
+        self.rate = rate
+        self.dra = 1.0 * units.arcsec
+        self.ddec = 1.0 * units.arcsec
+        self.pa = 0.0 * units.degree
+
+    def position(self, mjd):
+        return self.ra0 - self.rate * (mjd - self.mjd0), self.dec0
+
+    def predict(self, date):
+        ra, dec = self.position(Time(date).mjd)
+        self.coordinate = SkyCoord(ra, dec, unit='degree')
+
+
+class FootprintIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.index = precovery.FootprintIndex(os.path.join(self.directory, 'footprints.sqlite'),
+                                              dbimages=storage.DBIMAGES)
+        self.exposures = {'1616681': (30.0, 56391.36), '1616692': (30.0, 56391.45), '1617000': (50.0, 56392.36)}
+        for expnum, (crval1, mjd) in self.exposures.items():
+            self.index.add(expnum, [None] + [ccd_header(ccd, crval1, mjd) for ccd in range(2)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_search(self):
+        # starts on the western CCD of the first exposure and moves onto the eastern one by the second.
+        orbit = LinearOrbit(30.01, 10.001, 56391.36, 0.3)
+        table = precovery.FootprintIndex(self.index.filename, dbimages=storage.DBIMAGES).search(orbit)
+
+        self.assertEqual(list(table['Image']), ['1616681p', '1616692p'])
+        self.assertEqual(list(table['Ext']), [1, 2])
+        for row in table:
+            # interpolated from an ephemeris with nodes a day apart.
+            ra, dec = orbit.position(row['MJD'])
+            self.assertAlmostEqual(row['Object_RA'], ra, 4)
+            self.assertAlmostEqual(row['Object_Dec'], dec, 4)
+            header = ccd_header(row['Ext'] - 1, *self.exposures[row['Image'][:-1]])
+            x, y = wcs.WCS(header).sky2xy(row['Object_RA'], row['Object_Dec'])
+            self.assertAlmostEqual(row['X'], x, 1)
+            self.assertAlmostEqual(row['Y'], y, 1)
+
+        # limited in time and filter.
+        self.assertEqual(len(self.index.search(orbit, start_date=Time(56391.4, format='mjd'))), 1)
+        self.assertEqual(len(self.index.search(orbit, filters=['g.MP9401'])), 0)
+
+    def test_add_sghead(self):
+        # a .head file as served by CFHTSG, the CCDs in any order and ending with an END card.
+        content = ""
+        for ccd in (1, 0):
+            header = ccd_header(ccd, 30.0, 56391.36)
+            header['EXTVER'] = ccd + 1
+            content += "\n".join(card.image for card in header.cards) + "\nEND      \n"
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            with open('1616700p.head', 'w') as hobj:
+                hobj.write(content)
+            headers = storage._get_sghead(1616700)
+        finally:
+            os.chdir(cwd)
+            storage.sgheaders.pop('1616700p', None)
+
+        self.index.add('1616700', headers)
+
+        with self.index._connect() as connection:
+            ccds = [row[0] for row in connection.execute("SELECT ccd FROM ccds WHERE expnum='1616700' ORDER BY ccd")]
+            radius = connection.execute("SELECT radius FROM exposures WHERE expnum='1616700'").fetchone()[0]
+        self.assertEqual(ccds, [0, 1])
+        self.assertTrue(radius < 0.5)
+        orbit = LinearOrbit(30.01, 10.001, 56391.36, 0.0)
+        self.assertEqual(list(self.index.search(orbit, filters=['R.MP9601'], start_date=Time(56391.3, format='mjd'),
+                                                end_date=Time(56391.4, format='mjd'))['Ext']), [1, 1])
+
+    def test_search_many(self):
+        orbits = [LinearOrbit(30.01, 10.001, 56391.36, 0.3), LinearOrbit(50.01, 10.0, 56392.36, 0.0),
+                  LinearOrbit(40.0, 10.0, 56392.36, 0.0)]
+        tables = self.index.search_many(orbits)
+        self.assertEqual([list(table['Image']) for table in tables], [['1616681p', '1616692p'], ['1617000p'], []])
+
+    def test_parse_search_result(self):
+        orbit = LinearOrbit(30.01, 10.001, 56391.36, 0.3)
+        with patch('ossos.storage.list_dbimages', side_effect=AssertionError("dbimages listed")):
+            tracks_data = ssos.SSOSParser('o3e01').parse(self.index.search(orbit), orbit=orbit)
+        self.assertEqual([observation.rawname for observation in tracks_data.observations],
+                         ['1616681p00', '1616692p01'])
+        numpy.testing.assert_allclose([reading.x for reading in tracks_data.get_sources()[0].get_readings()],
+                                      self.index.search(orbit)['X'])
+
+
+if __name__ == '__main__':
+    unittest.main()
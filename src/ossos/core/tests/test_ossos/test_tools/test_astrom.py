@@ -3,13 +3,15 @@ __author__ = "David Rusk <drusk@uvic.ca>"
 import tempfile
 import unittest
 
+from astropy import units
 from hamcrest import (assert_that, equal_to, has_length, has_entries,
                       same_instance, contains, close_to)
 
 from tests.base_tests import FileReadingTestCase
 from ossos import astrom
 from ossos.astrom import (AstromParser, StreamingAstromWriter, Observation,
-                             BaseAstromWriter, BulkAstromWriter, SourceReading)
+                             BaseAstromWriter, BulkAstromWriter, SourceReading,
+                             SourceColumns)
 
 TEST_FILE_1 = "data/1584431p15.measure3.cands.astrom"
 TEST_FILE_2 = "data/1616681p22.measure3.cands.astrom"
@@ -237,6 +239,49 @@ class ParserTest(FileReadingTestCase):
         assert_that(obs0.ccdnum, equal_to("00"))
         assert_that(obs0.is_fake(), equal_to(True))
 
+    def test_parse_iter_matches_parse(self):
+        astrom_data = self.parse(FK_FILE)
+
+        # a small chunk size so sources are split across reads.
+        with self.parser.parse_iter(self.get_abs_path(FK_FILE), chunk_size=100) as stream:
+            assert_that([obs.rawname for obs in stream.observations],
+                        contains(*[obs.rawname for obs in astrom_data.observations]))
+            assert_that(stream.sys_header, equal_to(astrom_data.sys_header))
+            sources = list(stream)
+
+        assert_that(sources, has_length(21))
+        for source, expected in zip(sources, astrom_data.get_sources()):
+            assert_that([(reading.x, reading.y, reading.x0, reading.y0, reading.ra, reading.dec)
+                         for reading in source.get_readings()],
+                        equal_to([(reading.x, reading.y, reading.x0, reading.y0, reading.ra, reading.dec)
+                                  for reading in expected.get_readings()]))
+
+
+class StationaryParserTest(unittest.TestCase):
+    def setUp(self):
+        self.vetting_list = tempfile.NamedTemporaryFile(mode='w', suffix='.txt')
+        self.vetting_list.write("2\n"
+                                "s1 150.10 20.40 1616681p22 1616682p22 1616683p22\n"
+                                "s2 150.20 20.50 1616681p23 1616682p23 1616683p23\n")
+        self.vetting_list.flush()
+
+    def tearDown(self):
+        self.vetting_list.close()
+
+    def test_parse_iter_matches_parse(self):
+        parser = astrom.StationaryParser()
+        astrom_data = parser.parse(self.vetting_list.name)
+
+        with parser.parse_iter(self.vetting_list.name) as stream:
+            assert_that(stream.sys_header, equal_to(astrom_data.sys_header))
+            sources = list(stream)
+
+        assert_that(sources, has_length(2))
+        for source, expected in zip(sources, astrom_data.get_sources()):
+            assert_that([(reading.ra, reading.dec, reading.discovery) for reading in source.get_readings()],
+                        equal_to([(reading.ra, reading.dec, reading.discovery)
+                                  for reading in expected.get_readings()]))
+
 
 class GeneralAstromWriterTest(FileReadingTestCase):
     def setUp(self):
@@ -407,6 +452,43 @@ class AstromDataTest(FileReadingTestCase):
         astrom_data = AstromParser().parse(self.get_abs_path(TEST_FILE_1))
         assert_that(astrom_data.get_reading_count(), equal_to(9))
 
+    def test_readings_are_views_of_columns(self):
+        astrom_data = AstromParser().parse(self.get_abs_path(TEST_FILE_1))
+        assert_that(astrom_data.columns.x.shape, equal_to((3, 3)))
+
+        reading = astrom_data.get_sources()[0].get_reading(1)
+        assert_that(reading.x, equal_to(astrom_data.columns.x[0, 1]))
+        reading.pix_coord = (100.5, 200.5)
+        assert_that(astrom_data.columns.x[0, 1], equal_to(100.5))
+        assert_that(astrom_data.columns.y[0, 1], equal_to(200.5))
+        # moving the reading does not move the reference point
+        assert_that(reading.xref, equal_to(911.00))
+
+
+class SourceColumnsTest(unittest.TestCase):
+    def test_reference_and_cutout(self):
+        # a source moving 20" per observation in dec, the reference is the middle observation.
+        step = 20 / 3600.0
+        columns = SourceColumns.from_rows([[1, 2, 1, 2, 10.0, 0.0],
+                                           [3, 4, 3, 4, 10.0, step],
+                                           [5, 6, 5, 6, 10.0, 2 * step],
+                                           [7, 8, 7, 8, 50.0, 0.0],
+                                           [7, 8, 7, 8, 50.0, 0.0],
+                                           [7, 8, 7, 8, 50.0, 0.0]], 3)
+
+        assert_that(len(columns), equal_to(2))
+        assert_that(list(columns.xref), contains(1, 7))
+        assert_that(list(columns.ref_dec), contains(step, 0.0))
+        assert_that(columns.max_separation[0], close_to(20.0, 1e-6))
+        assert_that(list(columns.min_cutout), contains(close_to(30.0, 1e-6), close_to(30.0, 1e-6)))
+
+        observations = [Observation("1616681", "p", "22"), Observation("1616682", "p", "22"),
+                        Observation("1616683", "p", "22")]
+        reading = columns.get_readings(observations)[0][2]
+        assert_that(reading.obs, same_instance(observations[2]))
+        assert_that(reading.reference_sky_coord.dec.degree, close_to(step, 1e-9))
+        assert_that(reading.uncertainty_ellipse.a.to(units.arcsec).value, close_to(8.0, 1e-6))
+
 
 class URIResolvingTest(unittest.TestCase):
     def test_resolve_image_uri(self):
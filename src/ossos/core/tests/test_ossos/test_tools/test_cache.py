@@ -0,0 +1,200 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import Mock, patch
+
+from ossos import cache
+
+
+class HeaderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.uri = "vos:OSSOS/dbimages/1616681/ccd22/1616681p22.fits"
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_miss_then_hit(self):
+        header_cache = cache.HeaderCache(self.directory)
+        fetch = Mock(return_value=b"SIMPLE  =                    T")
+
+        self.assertEqual(header_cache.get(self.uri, fetch), b"SIMPLE  =                    T")
+        self.assertEqual(header_cache.get(self.uri, fetch), b"SIMPLE  =                    T")
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(header_cache.hits, 1)
+        self.assertEqual(header_cache.misses, 1)
+
+    def test_persists_between_instances(self):
+        cache.HeaderCache(self.directory).get(self.uri, lambda: b"header")
+        fetch = Mock(return_value=b"other")
+
+        self.assertEqual(cache.HeaderCache(self.directory).get(self.uri, fetch), b"header")
+        self.assertFalse(fetch.called)
+
+    def test_lru_eviction(self):
+        header_cache = cache.HeaderCache(self.directory, max_size=25)
+        header_cache.get("uri1", lambda: b"x" * 10)
+        header_cache.get("uri2", lambda: b"x" * 10)
+        header_cache.get("uri1", lambda: b"unused")
+        header_cache.get("uri3", lambda: b"x" * 10)
+
+        self.assertEqual(header_cache.evictions, 1)
+        self.assertEqual(header_cache.get("uri1", lambda: b"refetched"), b"x" * 10)
+        self.assertEqual(header_cache.get("uri2", lambda: b"refetched"), b"refetched")
+
+    def test_validation_of_expired_entries(self):
+        get_mtime = Mock(return_value="2017-01-01T00:00:00.000")
+        header_cache = cache.HeaderCache(self.directory, ttl=60)
+        with patch('ossos.cache.time.time', return_value=1000.0):
+            header_cache.get(self.uri, lambda: b"header", get_mtime=get_mtime)
+        get_mtime.reset_mock()
+
+        # within the ttl the node isn't consulted.
+        with patch('ossos.cache.time.time', return_value=1030.0):
+            self.assertEqual(header_cache.get(self.uri, lambda: b"new", get_mtime=get_mtime), b"header")
+        self.assertFalse(get_mtime.called)
+
+        with patch('ossos.cache.time.time', return_value=1100.0):
+            self.assertEqual(header_cache.get(self.uri, lambda: b"new", get_mtime=get_mtime), b"header")
+        self.assertTrue(get_mtime.called)
+
+        get_mtime.return_value = "2018-01-01T00:00:00.000"
+        with patch('ossos.cache.time.time', return_value=1200.0):
+            self.assertEqual(header_cache.get(self.uri, lambda: b"new", get_mtime=get_mtime), b"new")
+
+    def test_failed_validation_is_a_miss(self):
+        header_cache = cache.HeaderCache(self.directory, ttl=60)
+        with patch('ossos.cache.time.time', return_value=1000.0):
+            header_cache.get(self.uri, lambda: b"header")
+        with patch('ossos.cache.time.time', return_value=1100.0):
+            self.assertEqual(header_cache.get(self.uri, lambda: b"new", get_mtime=Mock(side_effect=IOError("down"))),
+                             b"new")
+
+    def test_stored_without_modification_time(self):
+        header_cache = cache.HeaderCache(self.directory, ttl=60)
+        get_mtime = Mock(side_effect=IOError("no such node"))
+        with patch('ossos.cache.time.time', return_value=1000.0):
+            header_cache.get(self.uri, lambda: b"header", get_mtime=get_mtime)
+        with patch('ossos.cache.time.time', return_value=1030.0):
+            self.assertEqual(header_cache.get(self.uri, lambda: b"new", get_mtime=get_mtime), b"header")
+        self.assertEqual(header_cache.hits, 1)
+
+    def test_created_on_first_use(self):
+        directory = os.path.join(self.directory, 'headers')
+        header_cache = cache.HeaderCache(directory)
+        self.assertFalse(os.path.exists(directory))
+
+        header_cache.get(self.uri, lambda: b"header")
+        self.assertTrue(os.path.exists(header_cache.filename))
+
+    def test_disabled(self):
+        header_cache = cache.HeaderCache(self.directory, enabled=False)
+        fetch = Mock(return_value=b"header")
+        header_cache.get(self.uri, fetch)
+        header_cache.get(self.uri, fetch)
+
+        self.assertEqual(fetch.call_count, 2)
+
+
+class FileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, 'cache')
+        self.uri = "vos:OSSOS/dbimages/1616681/1616681p.fits"
+        self.fetches = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, content=b"x" * 10, delay=0):
+        def _fetch(filename):
+            self.fetches.append(filename)
+            time.sleep(delay)
+            with open(filename, 'wb') as fobj:
+                fobj.write(content)
+        return _fetch
+
+    def test_single_flight(self):
+        file_cache = cache.FileCache(self.cache_dir)
+        filenames = [os.path.join(self.directory, "job{}.fits".format(idx)) for idx in range(4)]
+        threads = [threading.Thread(target=file_cache.get, args=(self.uri, filename, self.fetch(delay=0.2)))
+                   for filename in filenames]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(self.fetches), 1)
+        self.assertEqual((file_cache.hits, file_cache.misses), (3, 1))
+        self.assertEqual(file_cache.stats()['bytes_saved'], 30)
+        for filename in filenames:
+            with open(filename, 'rb') as fobj:
+                self.assertEqual(fobj.read(), b"x" * 10)
+
+    def test_hard_link_is_read_only(self):
+        file_cache = cache.FileCache(self.cache_dir)
+        filename = file_cache.get(self.uri, os.path.join(self.directory, "job.fits"), self.fetch())
+
+        self.assertEqual(os.stat(filename).st_ino, os.stat(file_cache.path(self.uri, self.fetch())).st_ino)
+        self.assertFalse(os.stat(filename).st_mode & 0o222)
+
+    def test_writable_copy(self):
+        file_cache = cache.FileCache(self.cache_dir)
+        filename = file_cache.get(self.uri, os.path.join(self.directory, "job.fits"), self.fetch(), writable=True)
+
+        self.assertNotEqual(os.stat(filename).st_ino, os.stat(file_cache.path(self.uri, self.fetch())).st_ino)
+        self.assertTrue(os.stat(filename).st_mode & 0o200)
+
+    def test_evicted_before_link(self):
+        for link in ['hard', 'symbolic']:
+            file_cache = cache.FileCache(os.path.join(self.cache_dir, link), link=link)
+            path = file_cache.path
+            evicted = []
+
+            def evicting_path(key, fetch):
+                # another process evicts the entry right after the first lookup.
+                filename = path(key, fetch)
+                if not evicted:
+                    evicted.append(filename)
+                    os.unlink(filename)
+                return filename
+
+            file_cache.path = evicting_path
+            filename = file_cache.get(self.uri, os.path.join(self.directory, "{}.fits".format(link)), self.fetch())
+
+            self.assertTrue(os.path.exists(filename))
+            with open(filename, 'rb') as fobj:
+                self.assertEqual(fobj.read(), b"x" * 10)
+        self.assertEqual(len(self.fetches), 4)
+
+    def test_lru_eviction(self):
+        file_cache = cache.FileCache(self.cache_dir, max_size=25)
+        first = file_cache.path("uri1", self.fetch())
+        os.utime(first, (0, 0))
+        file_cache.path("uri2", self.fetch())
+        file_cache.path("uri3", self.fetch())
+
+        self.assertEqual(file_cache.evictions, 1)
+        self.assertFalse(os.path.exists(first))
+        file_cache.path("uri2", self.fetch())
+        self.assertEqual(len(self.fetches), 3)
+
+    def test_disabled(self):
+        file_cache = cache.FileCache(self.cache_dir, enabled=False)
+        filename = os.path.join(self.directory, "job.fits")
+        file_cache.get(self.uri, filename, self.fetch())
+        file_cache.get(self.uri, filename, self.fetch())
+
+        self.assertEqual(self.fetches, [filename, filename])
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
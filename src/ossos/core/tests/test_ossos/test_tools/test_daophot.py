@@ -2,9 +2,18 @@ __author__ = "David Rusk <drusk@uvic.ca>"
 
 import unittest
 
+import numpy
+from astropy.io import fits
+
 from tests.base_tests import FileReadingTestCase
 from ossos import daophot
 
+try:
+    import pyraf
+    HAVE_IRAF = True
+except Exception:
+    HAVE_IRAF = False
+
 DELTA = 0.0001
 
 
@@ -71,5 +80,61 @@ class DaophotTest(FileReadingTestCase):
         assert_that(magerr, close_to(0.290, 0.0011))
 
 
+class PythonPhotTest(unittest.TestCase):
+    """
+    The in process photometry engine on a synthetic star on a flat, noiseless, sky.
+    """
+
+    def setUp(self):
+        self.sky = 1000.0
+        self.flux = 50000.0
+        self.x0 = 50.3
+        self.y0 = 40.7
+        self.sigma = 1.5
+        y, x = numpy.mgrid[1:81, 1:101]
+        star = numpy.exp(-((x - self.x0) ** 2 + (y - self.y0) ** 2) / (2 * self.sigma ** 2))
+        self.hdu = fits.ImageHDU(data=self.sky + self.flux * star / star.sum())
+        self.hdu.header['PHOTZP'] = 30.0
+
+    def test_centroid_and_magnitude(self):
+        result = daophot.phot(self.hdu, self.x0 + 1.2, self.y0 - 0.8, aperture=10, sky=15, swidth=5,
+                              apcor=0.0, zmag=30.0, backend='python')
+
+        self.assertAlmostEqual(result['XCENTER'][0], self.x0, delta=0.2)
+        self.assertAlmostEqual(result['YCENTER'][0], self.y0, delta=0.2)
+        self.assertAlmostEqual(result['MSKY'][0], self.sky, 3)
+        self.assertAlmostEqual(result['MAG'][0], 30.0 - 2.5 * numpy.log10(self.flux), 2)
+        self.assertEqual(result['PIER'][0], 0)
+
+    def test_apcor_and_many_sources(self):
+        result = daophot.phot(fits.HDUList([fits.PrimaryHDU(), self.hdu]), [self.x0, 2.0], [self.y0, 2.0],
+                              aperture=10, sky=15, swidth=5, apcor=0.3, zmag=30.0, extno=1, centroid=False)
+
+        self.assertEqual(len(result), 2)
+        self.assertAlmostEqual(result['MAG'][0], 30.0 - 2.5 * numpy.log10(self.flux) - 0.3, 2)
+        self.assertEqual(result['PIER'][1], daophot.PIER_OFF_IMAGE)
+        self.assertTrue(result['MAG'].mask[1])
+
+
+@unittest.skipUnless(HAVE_IRAF, "pyraf is not available")
+class IrafCrossCheckTest(FileReadingTestCase):
+    """
+    The python and IRAF backends should agree on a real image.
+    """
+
+    def test_python_matches_iraf(self):
+        fits_filename = self.get_abs_path("data/cutout_1200_2400_1350_2300-1616681p.fits")
+        data = fits.open(fits_filename)[0].data
+        y_in, x_in = numpy.unravel_index(numpy.argmax(data), data.shape)
+        kwargs = dict(aperture=4, sky=11, swidth=4, apcor=0.0, maxcount=60000.0, zmag=32.026)
+
+        iraf_result = daophot.phot(fits_filename, x_in + 1.3, y_in + 0.6, backend='iraf', **kwargs)
+        python_result = daophot.phot(fits_filename, x_in + 1.3, y_in + 0.6, backend='python', **kwargs)
+
+        for column, places in [('XCENTER', 1), ('YCENTER', 1), ('MAG', 2), ('MERR', 2)]:
+            self.assertAlmostEqual(python_result[column][0], iraf_result[column][0], places, msg=column)
+        self.assertEqual(python_result['PIER'][0], iraf_result['PIER'][0])
+
+
 if __name__ == '__main__':
     unittest.main()
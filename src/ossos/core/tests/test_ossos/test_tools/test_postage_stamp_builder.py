@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from astropy import units
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from mock import patch
+
+from ossos import wcs
+from ossos.tools import postage_stamp_builder
+from ossos.tools.postage_stamp_builder import Stamp
+
+
+def ccd_header(ccd):
+    header = fits.Header()
+    header['EXTVER'] = ccd + 1
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRPIX1'] = 1056.0 - ccd * 2112
+    header['CRPIX2'] = 2322.0
+    header['CRVAL1'] = 26.9
+    header['CRVAL2'] = 29.0
+    header['CD1_1'] = -5.1e-05
+    header['CD1_2'] = 0.0
+    header['CD2_1'] = 0.0
+    header['CD2_2'] = 5.1e-05
+    header['NORDFIT'] = 1
+    for axis in (1, 2):
+        header['PV{}_0'.format(axis)] = 0.0
+        header['PV{}_1'.format(axis)] = 1.0
+        header['PV{}_2'.format(axis)] = 0.0
+        header['PV{}_3'.format(axis)] = 0.0
+    return header
+
+
+class PostageStampBuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.headers = [None] + [ccd_header(ccd) for ccd in range(2)]
+        hdulist = fits.HDUList([fits.PrimaryHDU()])
+        for ccd in range(2):
+            data = numpy.arange(400 * 300, dtype='float32').reshape(400, 300) + ccd * 1e6
+            hdu = fits.ImageHDU(data=data, header=self.headers[ccd + 1])
+            hdu.header['DATASEC'] = '[1:300,1:400]'
+            hdulist.append(hdu)
+        hdulist.writeto(os.path.join(self.directory, '1616681p.fits'))
+        self.uploaded = os.path.join(self.directory, 'uploaded')
+        os.mkdir(self.uploaded)
+
+        self.stamps = []
+        for idx, (ccd, x, y) in enumerate([(0, 100, 100), (0, 150, 300), (1, 200, 50)]):
+            ra, dec = wcs.WCS(self.headers[ccd + 1]).xy2sky(x, y)
+            self.stamps.append(Stamp(self.uploaded, "o3e01_{}.fits".format(idx), '1616681', 'p', ccd,
+                                     SkyCoord(ra, dec)))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def copy(self, source, destination):
+        shutil.copy(source, destination)
+
+    def test_group_stamps(self):
+        far = self.stamps[0]._replace(sky_coord=self.stamps[0].sky_coord.directional_offset_by(0 * units.degree,
+                                                                                             10 * units.arcmin))
+        exposures = postage_stamp_builder.group_stamps(self.stamps + [far])
+        self.assertEqual(list(exposures), ['1616681'])
+        self.assertEqual([[stamp.filename for stamp in group] for group in exposures['1616681']],
+                         [['o3e01_0.fits', 'o3e01_1.fits'], ['o3e01_2.fits'], ['o3e01_0.fits']])
+
+    def test_build_stamps_from_local_image(self):
+        manifest_file = os.path.join(self.directory, 'manifest.json')
+        radius = 4 * 0.18 * 5 * units.arcsec
+        with patch('ossos.storage._get_sghead', lambda expnum: self.headers), \
+                patch('ossos.storage.copy', self.copy), \
+                patch('ossos.storage.ra_dec_cutout', side_effect=AssertionError("local image not used")):
+            made = postage_stamp_builder.build_stamps(self.stamps, radius,
+                                                      manifest=postage_stamp_builder.StampManifest(manifest_file),
+                                                      image_dir=self.directory)
+            self.assertEqual(made, 3)
+            # a rerun picks up where the manifest left off.
+            made = postage_stamp_builder.build_stamps(self.stamps, radius,
+                                                      manifest=postage_stamp_builder.StampManifest(manifest_file),
+                                                      image_dir=self.directory)
+            self.assertEqual(made, 0)
+
+        with fits.open(os.path.join(self.directory, '1616681p.fits')) as image:
+            for stamp in self.stamps:
+                with fits.open(os.path.join(self.uploaded, stamp.filename)) as hdulist:
+                    hdu = hdulist[1]
+                    # the stamp is two radii, about 39 pixels, across.
+                    self.assertEqual(hdu.data.shape, (39, 39))
+                    x0, y0 = hdu.header['XOFFSET'], hdu.header['YOFFSET']
+                    numpy.testing.assert_array_equal(hdu.data, image[stamp.ccd + 1].data[y0:y0 + 39, x0:x0 + 39])
+                    x, y = wcs.WCS(hdu.header).sky2xy(stamp.sky_coord.ra.degree, stamp.sky_coord.dec.degree)
+                    self.assertAlmostEqual(x + x0, wcs.WCS(self.headers[stamp.ccd + 1]).sky2xy(
+                        stamp.sky_coord.ra.degree, stamp.sky_coord.dec.degree)[0], 6)
+                    self.assertTrue(18 <= x <= 22 and 18 <= y <= 22)
+
+
+if __name__ == '__main__':
+    unittest.main()
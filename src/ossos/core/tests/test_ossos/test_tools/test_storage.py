@@ -3,13 +3,16 @@ from astropy.io import fits
 
 __author__ = "David Rusk <drusk@uvic.ca>"
 
+import os
+import shutil
+import tempfile
 import unittest
 from astropy import units
-from mock import patch
+from mock import Mock, patch
 #from hamcrest import assert_that, equal_to
 from astropy import table
 
-from ossos import storage, mpc
+from ossos import cache, storage, mpc
 
 
 class ConeSearchTest(unittest.TestCase):
@@ -107,5 +110,277 @@ class ObjectCountTest(unittest.TestCase):
                                              ossos_base=True)
 
 
+class TagStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.node = Mock()
+        self.node.props = {storage.tag_uri("mkpsf_p00"): storage.SUCCESS,
+                           storage.tag_uri("mkpsf_p01"): "failed"}
+        self.tag_store = storage.TagStore()
+
+    @patch("ossos.storage.client")
+    def test_node_fetched_once_per_exposure(self, client):
+        client.get_node.return_value = self.node
+
+        self.assertEqual(self.tag_store.get_tag(1616681, "mkpsf_p00"), storage.SUCCESS)
+        self.assertEqual(self.tag_store.get_tag(1616681, "mkpsf_p01"), "failed")
+        self.assertEqual(client.get_node.call_count, 1)
+
+        # a tag we don't have might have been set since the node was retrieved.
+        self.assertEqual(self.tag_store.get_tag(1616681, "mkpsf_p02"), None)
+        self.assertEqual(client.get_node.call_count, 2)
+
+    @patch("ossos.storage.client")
+    def test_node_expires(self, client):
+        client.get_node.return_value = self.node
+        tag_store = storage.TagStore(ttl=-1)
+        tag_store.get_tag(1616681, "mkpsf_p00")
+        tag_store.get_tag(1616681, "mkpsf_p00")
+
+        self.assertEqual(client.get_node.call_count, 2)
+
+    @patch("ossos.storage.client")
+    def test_flush_sends_only_pending_tags(self, client):
+        stale = Mock()
+        stale.props = dict(self.node.props)
+        fresh = Mock()
+        fresh.props = {storage.tag_uri("mkpsf_p00"): storage.SUCCESS,
+                       storage.tag_uri("mkpsf_p01"): storage.SUCCESS}
+        client.get_node.side_effect = [stale, fresh]
+
+        self.tag_store.get_tag(1616681, "mkpsf_p00")
+        self.tag_store.set_tag(1616681, "step1_p00", storage.SUCCESS)
+
+        # the tag another process set after our copy was retrieved is not sent back with its old value.
+        client.add_props.assert_called_once_with(fresh)
+        self.assertEqual(fresh.props[storage.tag_uri("mkpsf_p01")], storage.SUCCESS)
+        self.assertEqual(fresh.props[storage.tag_uri("step1_p00")], storage.SUCCESS)
+
+    @patch("ossos.storage.client")
+    def test_batched_writes_are_coalesced(self, client):
+        client.get_node.return_value = self.node
+
+        with self.tag_store.batch():
+            self.tag_store.set_tag(1616681, "step1_p00", storage.SUCCESS)
+            self.tag_store.set_tag(1616681, "step1_p01", storage.SUCCESS)
+            self.assertEqual(self.tag_store.get_tag(1616681, "step1_p01"), storage.SUCCESS)
+            self.assertFalse(client.add_props.called)
+
+        client.add_props.assert_called_once_with(self.node)
+        self.assertEqual(self.node.props[storage.tag_uri("step1_p00")], storage.SUCCESS)
+        self.assertEqual(self.node.props[storage.tag_uri("step1_p01")], storage.SUCCESS)
+
+    @patch("ossos.storage.client")
+    def test_get_status_matrix(self, client):
+        client.get_node.return_value = self.node
+
+        with patch("ossos.storage.tag_store", self.tag_store):
+            table = storage.get_status_matrix("mkpsf", [1616681, 1616682], [0, 1])
+
+        self.assertEqual(list(table['expnum']), [1616681, 1616682])
+        self.assertEqual(list(table['00']), [True, True])
+        self.assertEqual(list(table['01']), [False, False])
+        self.assertEqual(client.get_node.call_count, 2)
+
+
+class FakeTagStore(object):
+    """
+    Exposure tags held in memory.
+    """
+
+    def __init__(self):
+        self.tags = {}
+
+    def get_tags(self, expnum, force=False):
+        return dict(self.tags.get(str(expnum), {}))
+
+    def set_tags(self, expnum, props):
+        for key in props:
+            self.tags.setdefault(str(expnum), {})[storage.tag_uri(key)] = props[key]
+
+
+class CalibrationStoreTest(unittest.TestCase):
+
+    TRANS = {'dx': 1.5, 'cd11': 1.0, 'cd12': 0.0, 'dy': -2.5, 'cd21': 0.0, 'cd22': 1.0}
+
+    def setUp(self):
+        self.dbimages = tempfile.mkdtemp()
+        self.calibrations = storage.CalibrationStore()
+        self.tag_store = FakeTagStore()
+        self.patches = [patch('ossos.storage.DBIMAGES', self.dbimages),
+                        patch('ossos.storage.copy', shutil.copy),
+                        patch('ossos.storage.calibrations', self.calibrations),
+                        patch('ossos.storage.tag_store', self.tag_store)]
+        for patcher in self.patches:
+            patcher.start()
+        storage.fwhm.clear()
+        storage.zmag.clear()
+        self.write(22, 'fwhm', "3.2")
+        self.write(22, storage.ZEROPOINT_USED_EXT, "26.1")
+        self.write(22, storage.APCOR_EXT, "5.0 25.0 0.3 0.02")
+        self.write(22, 'trans.jmp', "1.5 1.0 0.0 -2.5 0.0 1.0")
+        self.write(23, 'fwhm', "3.4")
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        storage.fwhm.clear()
+        storage.zmag.clear()
+        shutil.rmtree(self.dbimages)
+
+    def write(self, ccd, ext, content):
+        filename = storage.get_uri(1616681, ccd, ext=ext)
+        if not os.access(os.path.dirname(filename), os.F_OK):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as fobj:
+            fobj.write(content)
+        return filename
+
+    def build(self):
+        return self.calibrations.build(1616681, [22, 23], fields=['fwhm', 'zeropoint', 'apcor', 'trans'])
+
+    def test_getters_use_manifest(self):
+        storage.record_calibration(1616681, 22, fwhm=3.2, zeropoint=26.1, apcor=[5.0, 25.0, 0.3, 0.02],
+                                   trans=self.TRANS)
+        storage.record_calibration(1616681, 23, fwhm=3.4)
+        self.assertEqual(self.build(), {'p22': {'fwhm': 3.2, 'zeropoint': 26.1, 'apcor': [5.0, 25.0, 0.3, 0.02],
+                                                'trans': self.TRANS},
+                                        'p23': {'fwhm': 3.4}})
+        self.calibrations.invalidate()
+
+        with patch('ossos.storage.open_vos_or_local', wraps=storage.open_vos_or_local) as open_vos_or_local, \
+                patch('ossos.storage.get_tag', side_effect=AssertionError("tag retrieved")):
+            self.assertEqual(storage.get_fwhm(1616681, 22), 3.2)
+            self.assertEqual(storage.get_fwhm_tag(1616681, 23), 3.4)
+            self.assertEqual(storage.get_zeropoint(1616681, 22), 26.1)
+            self.assertEqual(storage._get_zeropoint(1616681, 22), 26.1)
+            self.assertEqual(storage.get_apcor(1616681, 22), [5.0, 25.0, 0.3, 0.02])
+            self.assertEqual(storage.get_trans(1616681, 22), self.TRANS)
+            self.assertEqual(self.calibrations.get_by_uri(storage.get_uri(1616681, 22, ext=storage.APCOR_EXT)),
+                             [5.0, 25.0, 0.3, 0.02])
+        # one retrieval of the manifest for all the values.
+        self.assertEqual(open_vos_or_local.call_count, 1)
+
+    def test_recomputed_value_falls_back_to_file(self):
+        self.build()
+        self.write(22, 'fwhm', "3.9")
+        storage.record_calibration(1616681, 22, fwhm=3.9)
+
+        self.assertEqual(self.calibrations.get(1616681, 22, 'fwhm'), None)
+        self.assertEqual(storage.get_fwhm(1616681, 22), 3.9)
+        self.assertEqual(self.calibrations.get(1616681, 22, 'zeropoint'), 26.1)
+
+        # a value without a digest (or a manifest without the value) isn't trusted either.
+        self.tag_store.tags.clear()
+        self.assertEqual(self.calibrations.get(1616681, 23, 'fwhm'), None)
+        self.assertEqual(self.calibrations.get(1616681, 23, 'zeropoint'), None)
+
+    def test_build_tags_legacy_values(self):
+        storage.record_calibration(1616681, 22, fwhm=3.2)
+        digest = self.tag_store.get_tags(1616681)[storage.tag_uri('calibration_fwhm_p22')]
+        self.build()
+
+        tags = self.tag_store.get_tags(1616681)
+        self.assertEqual(tags[storage.tag_uri('calibration_fwhm_p22')], digest)
+        self.assertEqual(tags[storage.tag_uri('calibration_fwhm_p23')], storage.CalibrationStore.digest(3.4))
+        self.assertEqual(storage.CalibrationStore().get(1616681, 23, 'fwhm'), 3.4)
+        self.assertRaises(ValueError, storage.record_calibration, 1616681, 22, seeing=1.0)
+
+
+class FileCacheKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.props = {'MD5': 'a1'}
+        self.copies = []
+        client = Mock()
+        client.get_node.side_effect = lambda uri, force=False: Mock(props=dict(self.props))
+        self.patches = [patch('ossos.storage.client', client),
+                        patch('ossos.storage.copy', self.copy),
+                        patch('ossos.storage.file_cache', cache.FileCache(os.path.join(self.directory, 'cache')))]
+        for patcher in self.patches:
+            patcher.start()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def copy(self, source, dest):
+        self.copies.append(source)
+        with open(dest, 'w') as fobj:
+            fobj.write(self.props.get('MD5', 'none'))
+
+    def get_file(self):
+        filename = storage.get_file(1616681, 22, ext='trans.jmp')
+        with open(filename) as fobj:
+            content = fobj.read()
+        os.unlink(filename)
+        return content
+
+    def test_regenerated_file_is_retrieved_again(self):
+        self.assertEqual(self.get_file(), 'a1')
+        self.assertEqual(self.get_file(), 'a1')
+        self.assertEqual(len(self.copies), 1)
+
+        # rewritten in VOSpace by a --force re-run.
+        self.props['MD5'] = 'b2'
+        self.assertEqual(self.get_file(), 'b2')
+        self.assertEqual(len(self.copies), 2)
+
+    def test_unversioned_node_bypasses_cache(self):
+        self.props = {}
+        self.get_file()
+        self.get_file()
+        self.assertEqual(len(self.copies), 2)
+        self.assertEqual(storage.file_cache.hits + storage.file_cache.misses, 0)
+
+
+class AstHeaderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.client = Mock()
+        self.client.get_node.return_value = Mock(props={'date': '2017-01-01T00:00:00.000'})
+        self.get_image = Mock(side_effect=lambda *args, **kwargs: fits.HDUList([fits.PrimaryHDU()]))
+        self.patches = [patch('ossos.storage.client', self.client),
+                        patch('ossos.storage.get_image', self.get_image),
+                        patch('ossos.storage._get_sghead', side_effect=IOError("no sg header")),
+                        patch('ossos.storage.header_cache', cache.HeaderCache(self.directory))]
+        for patcher in self.patches:
+            patcher.start()
+        storage.astheaders.clear()
+        storage.node_dates.clear()
+
+    def tearDown(self):
+        for patcher in self.patches:
+            patcher.stop()
+        storage.astheaders.clear()
+        storage.node_dates.clear()
+        shutil.rmtree(self.directory)
+
+    def test_validated_on_exposure_file(self):
+        for ccd in range(3):
+            storage.get_astheader(1616681, ccd)
+        self.assertEqual(self.get_image.call_count, 3)
+        # one node, the exposure's file, for all the CCDs.
+        self.assertEqual([call[0][0] for call in self.client.get_node.call_args_list],
+                         [storage.dbimages_uri(1616681, version='p', ext='.fits')])
+        self.assertEqual(storage.header_cache.stats()['entries'], 3)
+
+        # a new process: the headers come from the cache without any network access.
+        storage.astheaders.clear()
+        storage.node_dates.clear()
+        self.client.reset_mock()
+        self.get_image.reset_mock()
+        for ccd in range(3):
+            storage.get_astheader(1616681, ccd)
+        self.assertFalse(self.get_image.called)
+        self.assertFalse(self.client.get_node.called)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+
+import numpy
+from hamcrest import assert_that, equal_to
+
+from ossos import util
+
+
+class MatchListsTest(unittest.TestCase):
+
+    def test_match_lists_mutual_nearest(self):
+        pos1 = numpy.array([[10.0, 10.0], [50.0, 50.0], [100.0, 100.0]])
+        pos2 = numpy.array([[100.5, 100.0], [10.0, 11.0], [500.0, 500.0]])
+
+        match1, match2 = util.match_lists(pos1, pos2, tolerance=5)
+
+        assert_that(list(match1.filled(-1)), equal_to([1, -1, 0]))
+        assert_that(list(match2.filled(-1)), equal_to([2, 0, -1]))
+
+    def test_match_lists_only_closest_is_matched(self):
+        pos1 = numpy.array([[10.0, 10.0], [10.0, 12.0]])
+        pos2 = numpy.array([[10.0, 11.5]])
+
+        match1, match2 = util.match_lists(pos1, pos2, tolerance=5)
+
+        assert_that(list(match1.filled(-1)), equal_to([-1, 0]))
+        assert_that(list(match2.filled(-1)), equal_to([1]))
+
+    def test_match_lists_empty(self):
+        match1, match2 = util.match_lists(numpy.array([[1.0, 1.0]]), numpy.array([]))
+
+        assert_that(match1.count(), equal_to(0))
+        assert_that(len(match2), equal_to(0))
+
+    def test_match_lists_large_index(self):
+        npts = 40000
+        pos1 = numpy.transpose([numpy.arange(npts) * 10.0, numpy.zeros(npts)])
+        pos2 = pos1[::-1] + 0.5
+
+        match1, match2 = util.match_lists(pos1, pos2, tolerance=1)
+
+        assert_that(match1.count(), equal_to(npts))
+        assert_that(int(match1[-1]), equal_to(0))
+        assert_that(int(match2[0]), equal_to(npts - 1))
+
+    def test_match_lists_spherical_across_ra_wrap(self):
+        pos1 = numpy.array([[359.9999, 10.0], [180.0, -45.0]])
+        pos2 = numpy.array([[180.0001, -45.0001], [0.0001, 10.0]])
+
+        match1, match2 = util.match_lists(pos1, pos2, tolerance=1.0 / 3600.0, spherical=True)
+
+        assert_that(list(match1.filled(-1)), equal_to([1, 0]))
+        assert_that(list(match2.filled(-1)), equal_to([1, 0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
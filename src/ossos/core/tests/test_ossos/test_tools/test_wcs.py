@@ -2,6 +2,8 @@ __author__ = "David Rusk <drusk@uvic.ca>"
 
 import unittest
 
+import numpy
+
 from hamcrest import assert_that, contains, has_length
 
 from astropy.io import fits
@@ -101,6 +103,64 @@ class WCSTest(unittest.TestCase):
         assert_that(x, almost_equal(15000.066582252624, SIGFIGS))
         assert_that(y, almost_equal(19999.992539886229, SIGFIGS))
 
+    def test_sky2xy_nord3_array(self):
+        ra = numpy.array([177.62042274595882, 177.5, 177.7])
+        dec = numpy.array([7.5256071336988679, 7.55, 7.45])
+        crpix1 = -7535.57493517
+        crpix2 = 9808.40914361
+        crval1 = 176.486157083
+        crval2 = 8.03697351091
+        dc = [[19550.08417778, 269.58539826],
+              [-48.85428173, -19520.05812122]]
+        pv = [[-7.030338745606E-03, 1.01755337222, 8.262429361142E-03,
+               0.00000000000, -5.910145454849E-04, -7.494178330178E-04,
+               -3.470178516657E-04, -2.331150605755E-02, -8.187062772669E-06,
+               -2.325429510806E-02, 1.135299506292E-04],
+              [-6.146513090656E-03, 1.01552885426, 8.259666421752E-03,
+               0.00000000000, -4.567030382243E-04, -6.978676921999E-04,
+               -3.732572951216E-04, -2.332572754467E-02, -2.354317291723E-05,
+               -2.329623852891E-02, 1.196394469003E-04]]
+        nord = 3
+
+        x, y, converged = wcs.sky2xypv(ra, dec, crpix1, crpix2, crval1, crval2, dc, pv, nord,
+                                       return_converged=True)
+
+        assert_that(x, has_length(3))
+        assert_that(converged.all())
+        assert_that(x[0], almost_equal(15000.066582252624, SIGFIGS))
+        assert_that(y[0], almost_equal(19999.992539886229, SIGFIGS))
+        for i in range(len(ra)):
+            xi, yi = wcs.sky2xypv(ra[i], dec[i], crpix1, crpix2, crval1, crval2, dc, pv, nord)
+            assert_that(x[i], almost_equal(xi, SIGFIGS))
+            assert_that(y[i], almost_equal(yi, SIGFIGS))
+
+    def test_xy2sky_sky2xy_round_trip_array(self):
+        crpix1 = -7535.57493517
+        crpix2 = 9808.40914361
+        crval1 = 176.486157083
+        crval2 = 8.03697351091
+        cd = [[5.115244026718E-05, 7.064503033578E-07],
+              [-1.280229655229E-07, -5.123112374523E-05]]
+        dc = numpy.linalg.inv(cd)
+        pv = [[-7.030338745606E-03, 1.01755337222, 8.262429361142E-03,
+               0.00000000000, -5.910145454849E-04, -7.494178330178E-04,
+               -3.470178516657E-04, -2.331150605755E-02, -8.187062772669E-06,
+               -2.325429510806E-02, 1.135299506292E-04],
+              [-6.146513090656E-03, 1.01552885426, 8.259666421752E-03,
+               0.00000000000, -4.567030382243E-04, -6.978676921999E-04,
+               -3.732572951216E-04, -2.332572754467E-02, -2.354317291723E-05,
+               -2.329623852891E-02, 1.196394469003E-04]]
+        nord = 3
+        x = numpy.linspace(14000, 16000, 50)
+        y = numpy.linspace(19000, 21000, 50)
+
+        ra, dec = wcs.xy2skypv(x, y, crpix1, crpix2, crval1, crval2, cd, pv, nord)
+        x1, y1 = wcs.sky2xypv(ra.to('deg').value, dec.to('deg').value,
+                              crpix1, crpix2, crval1, crval2, dc, pv, nord)
+
+        assert_that(numpy.fabs(x1 - x).max() < 1e-3)
+        assert_that(numpy.fabs(y1 - y).max() < 1e-3)
+
 
 class WCSParseTest(FileReadingTestCase):
     def setUp(self):
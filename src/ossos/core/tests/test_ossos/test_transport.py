@@ -0,0 +1,92 @@
+import errno
+import unittest
+
+from cadcutils import exceptions
+from mock import Mock, patch
+
+from ossos import transport
+
+
+class TransportTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('ossos.transport.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.transport = transport.Transport(transport.RetryPolicy(attempts=4, base_delay=1.0, max_delay=8.0),
+                                             failure_threshold=3, reset_timeout=30.0)
+
+    def test_transient_failures_are_retried(self):
+        func = Mock(side_effect=[IOError(errno.ETIMEDOUT, "timed out"), exceptions.HttpException("503"), "done"])
+
+        self.assertEqual(self.transport.call('nodes', func, 'vos:OSSOS/dbimages'), "done")
+        self.assertEqual(func.call_count, 3)
+        # exponential backoff with jitter.
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertTrue(0 <= self.sleep.call_args_list[0][0][0] <= 1.0)
+        self.assertTrue(0 <= self.sleep.call_args_list[1][0][0] <= 2.0)
+        stats = self.transport.stats()['nodes']
+        self.assertEqual((stats['calls'], stats['failures'], stats['retries']), (3, 2, 2))
+
+    def test_http_status_errors(self):
+        # vos raises OSError(status_code, ...) for failed transfers.
+        func = Mock(side_effect=[OSError(503, "Service Unavailable"), OSError(429, "Too Many Requests"), "done"])
+
+        self.assertEqual(self.transport.call('data', func), "done")
+        self.assertEqual(func.call_count, 3)
+
+        func = Mock(side_effect=OSError(404, "Not Found"))
+        self.assertRaises(OSError, self.transport.call, 'data', func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_final_errors_are_not_retried(self):
+        func = Mock(side_effect=exceptions.NotFoundException("no such node"))
+
+        self.assertRaises(exceptions.NotFoundException, self.transport.call, 'nodes', func)
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual(self.transport.breakers['nodes'].state, transport.CircuitBreaker.CLOSED)
+
+    def test_attempts_and_deadline(self):
+        func = Mock(side_effect=IOError(errno.EAGAIN, "try again"))
+        self.assertRaises(IOError, self.transport.call, 'data', func)
+        self.assertEqual(func.call_count, 3)
+
+        func.reset_mock()
+        self.transport.breakers['data'].success()
+        self.transport.policy.deadline = 0.0
+        self.assertRaises(IOError, self.transport.call, 'data', func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_circuit_breaker(self):
+        func = Mock(side_effect=IOError(errno.ECONNREFUSED, "refused"))
+        self.assertRaises(IOError, self.transport.call, 'data', func)
+        self.assertEqual(func.call_count, 3)
+
+        # while open calls fail without reaching the service, other endpoints are not affected.
+        self.assertRaises(transport.CircuitOpenError, self.transport.call, 'data', func)
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(self.transport.call('nodes', Mock(return_value="ok")), "ok")
+
+        # after the reset timeout one trial call is let through.
+        with patch('ossos.transport.time.time', return_value=self.transport.breakers['data'].opened_at + 31):
+            func.side_effect = None
+            func.return_value = "ok"
+            self.assertEqual(self.transport.call('data', func), "ok")
+        self.assertEqual(self.transport.breakers['data'].state, transport.CircuitBreaker.CLOSED)
+        stats = self.transport.stats()['data']
+        self.assertEqual((stats['rejected'], stats['circuit_opens']), (1, 1))
+
+    def test_resilient_client(self):
+        client = Mock()
+        client.copy.side_effect = [IOError(errno.EIO, "broken pipe"), "1616681p.fits"]
+        client.isdir.return_value = True
+        resilient = transport.ResilientClient(client, self.transport)
+
+        self.assertEqual(resilient.copy("vos:OSSOS/dbimages/1616681/1616681p.fits", "1616681p.fits"), "1616681p.fits")
+        self.assertTrue(resilient.isdir("vos:OSSOS/dbimages"))
+        self.assertEqual(self.transport.stats()['data']['retries'], 1)
+        self.assertEqual(self.transport.stats()['nodes']['calls'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()